@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+BeeGramm — сжатие ответов и статика с хэшем в имени 🐝
+
+Сборка (при деплое, после изменения css/js):
+
+    python assets.py build [--static static] [--out static/dist]
+
+Каждый файл static/css и static/js копируется в static/dist под именем с
+хэшем содержимого (main.js -> main.3f2a9c1b07.js) вместе с готовыми .gz и .br
+(brotli — если установлен). manifest.json сопоставляет исходное имя с
+хэшированным. Имя меняется только вместе с содержимым, поэтому такие файлы
+отдаются с Cache-Control: immutable на год: повторная загрузка страницы не
+запрашивает их вовсе. Сжатые варианты готовы заранее — на запрос ничего не
+сжимается. Файлы прошлых сборок не удаляются: открытые вкладки со старым
+HTML ещё могут их запросить.
+
+Без сборки шаблоны ссылаются на исходные /static/... как раньше.
+
+Динамические ответы JSON сжимает compress() по Accept-Encoding (br, затем
+gzip), если они больше порога — см. _compress_response в server.py.
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST = 'manifest.json'
+SOURCES = ('css', 'js')
+EXTENSIONS = ('.css', '.js')
+# Суффикс файла предсжатого варианта для Content-Encoding
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+
+def encodings():
+    """Поддерживаемые кодировки в порядке предпочтения"""
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def negotiate(accept_encoding, offered=None):
+    """Первая из offered (по умолчанию encodings()), которую принимает клиент по Accept-Encoding, или None"""
+    accepted = set()
+    for part in (accept_encoding or '').lower().split(','):
+        name, _, params = part.strip().partition(';')
+        params = params.replace(' ', '')
+        if name and params not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            accepted.add(name)
+    for encoding in (encodings() if offered is None else offered):
+        if encoding in accepted or '*' in accepted:
+            return encoding
+    return None
+
+
+def compress(data, encoding, level=6):
+    """data -> bytes в кодировке br или gzip. level — уровень gzip (1..9) или quality brotli (до 11)"""
+    if encoding == 'br':
+        return brotli.compress(data, quality=min(level, 11))
+    # mtime=0 — одинаковый вывод для одинакового входа
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def load_manifest(out_dir):
+    """{'js/main.js': 'js/main.<hash>.js'} последней сборки; {} — сборки нет"""
+    try:
+        with open(os.path.join(out_dir, MANIFEST), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _hashed_name(rel, data):
+    stem, ext = os.path.splitext(rel)
+    return f'{stem}.{hashlib.sha256(data).hexdigest()[:10]}{ext}'
+
+
+def build(static_dir='static', out_dir=None):
+    """Собрать static/dist: файлы с хэшем, .gz и .br к ним и manifest.json. Возвращает манифест."""
+    out_dir = out_dir or os.path.join(static_dir, 'dist')
+    manifest = {}
+    for source in SOURCES:
+        for root, _dirs, files in os.walk(os.path.join(static_dir, source)):
+            for name in sorted(files):
+                if not name.endswith(EXTENSIONS):
+                    continue
+                path = os.path.join(root, name)
+                rel = os.path.relpath(path, static_dir).replace(os.sep, '/')
+                with open(path, 'rb') as f:
+                    data = f.read()
+                hashed = _hashed_name(rel, data)
+                target = os.path.join(out_dir, hashed)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                if not os.path.exists(target):
+                    shutil.copyfile(path, target)
+                for encoding in encodings():
+                    if not os.path.exists(target + SUFFIXES[encoding]):
+                        with open(target + SUFFIXES[encoding], 'wb') as f:
+                            f.write(compress(data, encoding, level=9 if encoding == 'gzip' else 11))
+                manifest[rel] = hashed
+
+    # Манифест пишется последним и атомарно: сервер не увидит ссылку на недописанный файл
+    tmp = os.path.join(out_dir, MANIFEST + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(tmp, os.path.join(out_dir, MANIFEST))
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Статика BeeGramm')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    p_build = sub.add_parser('build', help='файлы с хэшем в имени и предсжатые .gz/.br')
+    p_build.add_argument('--static', default='static')
+    p_build.add_argument('--out', default=None, help='по умолчанию <static>/dist')
+    args = parser.parse_args(argv)
+
+    if brotli is None:
+        print('⚠️ brotli не установлен: собираются только .gz')
+    out_dir = args.out or os.path.join(args.static, 'dist')
+    manifest = build(args.static, out_dir)
+    for rel, hashed in sorted(manifest.items()):
+        sizes = [f'{enc} {os.path.getsize(os.path.join(out_dir, hashed + SUFFIXES[enc]))}' for enc in encodings()]
+        print(f"{rel} -> {hashed}  {os.path.getsize(os.path.join(out_dir, hashed))} байт, {', '.join(sizes)}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""
+BeeGramm — онлайн-бэкапы SQLite 🐝
+
+Снимок: sqlite3 backup() маленькими шагами по pages_per_step страниц, между
+шагами управление отдаётся event loop. База в режиме WAL, поэтому копирование
+только читает и не блокирует запись в чат.
+
+Непрерывная архивация WAL: приложение открывает соединения с
+wal_autocheckpoint = 0, и чекпойнты делает только WalArchiver. Перед каждым
+чекпойнтом он дописывает новые закоммиченные кадры WAL в файл поколения
+(<папка>/wal/<база>/<эпоха>-<номер>.wal). Блокировка записи берётся только
+на дочитывание хвоста — это несколько миллисекунд.
+
+Восстановление: снимок + по порядку все поколения WAL той же эпохи (эпоха —
+запуск сервера). Кадры WAL — полные образы страниц, поэтому повторное
+применение поколения, уже попавшего в снимок, безопасно.
+
+    python backup.py list [--folder backups]
+    python backup.py verify <каталог_снимка>
+    python backup.py restore <каталог_снимка> <куда> [--no-wal] [--force]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+WAL_HEADER = 32
+FRAME_HEADER = 24
+
+MANIFEST = 'manifest.json'
+
+
+def _wal_dir(folder, db_path):
+    return os.path.join(folder, 'wal', os.path.basename(db_path))
+
+
+# ============= СНИМКИ =============
+
+class BackupRestarted(Exception):
+    pass
+
+
+def snapshot_file(src_path, dest_path, pages_per_step=256, pause=None, max_restarts=5):
+    """Скопировать одну базу через backup API. Возвращает (страниц, перезапусков).
+
+    Если во время копирования базу меняют другие соединения, SQLite начинает
+    копию заново. После max_restarts перезапусков дочитываем одним шагом: в WAL
+    это по-прежнему только чтение со снимка, писатели не ждут.
+    """
+    part = dest_path + '.part'
+    if os.path.exists(part):
+        os.remove(part)
+    src = sqlite3.connect(src_path)
+    dst = sqlite3.connect(part)
+    state = {'restarts': 0, 'remaining': None, 'total': 0}
+
+    def progress(status, remaining, total):
+        if state['remaining'] is not None and remaining > state['remaining']:
+            state['restarts'] += 1
+            if state['restarts'] > max_restarts:
+                raise BackupRestarted()
+        state['remaining'] = remaining
+        state['total'] = total
+        if pause:
+            pause()
+
+    try:
+        try:
+            src.backup(dst, pages=pages_per_step, progress=progress)
+        except BackupRestarted:
+            src.backup(dst, pages=-1)
+    finally:
+        dst.close()
+        src.close()
+    os.replace(part, dest_path)
+    return state['total'], state['restarts']
+
+
+def create_backup(db_paths, folder, pages_per_step=256, pause=None, max_restarts=5, archivers=None):
+    """Снимок всех файлов базы в <folder>/<время>/ с manifest.json. Возвращает манифест.
+
+    archivers — {путь базы: WalArchiver}; их поколения записываются в манифест,
+    чтобы restore знал, с какого WAL продолжать.
+    """
+    archivers = archivers or {}
+    name = datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+    target = os.path.join(folder, name)
+    os.makedirs(target, exist_ok=False)
+
+    manifest = {'name': name, 'created_at': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'), 'files': {}}
+    started = time.monotonic()
+    for path in db_paths:
+        archiver = archivers.get(path)
+        # Поколение фиксируем до копирования: всё, что запишут во время копии, окажется в WAL
+        wal = archiver.position() if archiver else None
+        pages, restarts = snapshot_file(path, os.path.join(target, os.path.basename(path)),
+                                        pages_per_step=pages_per_step, pause=pause, max_restarts=max_restarts)
+        manifest['files'][os.path.basename(path)] = {
+            'pages': pages,
+            'bytes': os.path.getsize(os.path.join(target, os.path.basename(path))),
+            'restarts': restarts,
+            'wal': wal,
+        }
+    manifest['seconds'] = round(time.monotonic() - started, 3)
+
+    with open(os.path.join(target, MANIFEST), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+
+def list_backups(folder):
+    """Манифесты снимков, новые сверху"""
+    result = []
+    if not os.path.isdir(folder):
+        return result
+    for name in sorted(os.listdir(folder), reverse=True):
+        path = os.path.join(folder, name, MANIFEST)
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                result.append(json.load(f))
+    return result
+
+
+def prune_backups(folder, keep, current_epoch=None):
+    """Оставить keep последних снимков и поколения WAL, которые им нужны. Возвращает число удалённых снимков.
+
+    Поколения текущей эпохи (current_epoch) не трогаем — они понадобятся следующему снимку.
+    """
+    manifests = list_backups(folder)
+    removed = 0
+    for m in manifests[keep:]:
+        shutil.rmtree(os.path.join(folder, m['name']), ignore_errors=True)
+        removed += 1
+
+    # db -> эпоха -> первое поколение, нужное какому-либо оставшемуся снимку
+    needed = {}
+    for m in manifests[:keep]:
+        for db_name, info in m['files'].items():
+            wal = info.get('wal')
+            if wal:
+                epochs = needed.setdefault(db_name, {})
+                epochs[wal['epoch']] = min(epochs.get(wal['epoch'], wal['seq']), wal['seq'])
+
+    wal_root = os.path.join(folder, 'wal')
+    if os.path.isdir(wal_root):
+        for db_name in os.listdir(wal_root):
+            for gen_file in os.listdir(os.path.join(wal_root, db_name)):
+                key = _parse_generation(gen_file)
+                if not key or key[0] == current_epoch:
+                    continue
+                first = needed.get(db_name, {}).get(key[0])
+                if first is None or key[1] < first:
+                    os.remove(os.path.join(wal_root, db_name, gen_file))
+    return removed
+
+
+# ============= НЕПРЕРЫВНАЯ АРХИВАЦИЯ WAL =============
+
+def _generation_name(epoch, seq):
+    return f'{epoch}-{seq:06d}.wal'
+
+
+def _parse_generation(name):
+    if not name.endswith('.wal'):
+        return None
+    try:
+        epoch, seq = name[:-4].split('-')
+        return epoch, int(seq)
+    except ValueError:
+        return None
+
+
+class WalArchiver:
+    """Копирует закоммиченные кадры WAL одной базы и сам делает чекпойнты.
+
+    Пока архиватор жив, он держит открытым соединение с базой: иначе закрытие
+    последнего соединения приложения сделало бы чекпойнт и удалило WAL раньше,
+    чем кадры попали в архив.
+    """
+
+    def __init__(self, db_path, folder, epoch=None, restart_bytes=16 * 1024 * 1024):
+        self.db_path = db_path
+        self.restart_bytes = restart_bytes
+        self.wal_path = db_path + '-wal'
+        self.dir = _wal_dir(folder, db_path)
+        os.makedirs(self.dir, exist_ok=True)
+        self.epoch = epoch or datetime.utcnow().strftime('%Y%m%d%H%M%S')
+        self._seq = 0
+        self._salt = None
+        self._pos = 0  # сколько байт текущего поколения уже в архиве
+        self._hold = sqlite3.connect(db_path)
+        # Соединение считается открытым для WAL только после первого чтения
+        self._hold.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+        self.stats = {'ticks': 0, 'generations': 0, 'last_lock_ms': 0.0, 'max_lock_ms': 0.0, 'last_tick_at': None}
+
+    def position(self):
+        """Поколение, с которого восстановление продолжит снимок, снятый сейчас"""
+        return {'epoch': self.epoch, 'seq': max(1, self._seq)}
+
+    def close(self):
+        self._hold.close()
+
+    def _generation_path(self):
+        return os.path.join(self.dir, _generation_name(self.epoch, self._seq))
+
+    def _scan(self, f, start, header):
+        """Конец последнего закоммиченного кадра текущего поколения, начиная с offset start.
+
+        Кадры после последнего коммита не берём: это незавершённая или откатанная
+        транзакция, SQLite перезапишет их следующей.
+        """
+        page_size = int.from_bytes(header[8:12], 'big')
+        frame_size = FRAME_HEADER + page_size
+        salt = header[16:24]
+        size = f.seek(0, os.SEEK_END)
+        end = offset = start
+        while offset + frame_size <= size:
+            f.seek(offset)
+            frame = f.read(FRAME_HEADER)
+            if frame[8:16] != salt:
+                break  # старые кадры прошлого поколения
+            offset += frame_size
+            if int.from_bytes(frame[4:8], 'big'):  # кадр с коммитом
+                end = offset
+        return end, frame_size
+
+    def _read(self):
+        """Новые кадры с self._pos: (байты, конец, размер кадра). Переключает поколение при перезапуске WAL."""
+        if not os.path.exists(self.wal_path):
+            return b'', self._pos, 0
+        with open(self.wal_path, 'rb') as f:
+            header = f.read(WAL_HEADER)
+            if len(header) < WAL_HEADER:
+                return b'', self._pos, 0
+            if header[16:24] != self._salt:
+                # WAL перезапущен (или первый тик) — новое поколение с начала файла
+                self._seq += 1
+                self._salt = header[16:24]
+                self._pos = 0
+                self.stats['generations'] += 1
+            end, frame_size = self._scan(f, max(self._pos, WAL_HEADER), header)
+            if end <= self._pos:
+                return b'', self._pos, frame_size
+            f.seek(self._pos)
+            return f.read(end - self._pos), end, frame_size
+
+    def _write(self, data, end):
+        if data:
+            mode = 'r+b' if os.path.exists(self._generation_path()) else 'wb'
+            with open(self._generation_path(), mode) as out:
+                out.seek(end - len(data))
+                out.write(data)
+                out.truncate()
+                out.flush()
+                os.fsync(out.fileno())
+        self._pos = end
+
+    def tick(self):
+        """Один цикл: копия без блокировок, дочитывание хвоста под блокировкой записи, чекпойнт"""
+        # 1. Основной объём — без блокировок
+        data, end, frame_size = self._read()
+        self._write(data, end)
+        # После перезапуска WAL файл не укорачивается, и страница последнего кадра
+        # могла ещё не быть дописана поверх старой — перечитаем его под блокировкой
+        if frame_size and self._pos > WAL_HEADER:
+            self._pos -= frame_size
+
+        lock = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        reader = sqlite3.connect(self.db_path, isolation_level=None)
+        try:
+            lock.execute('BEGIN IMMEDIATE')
+            locked_at = time.perf_counter()
+            try:
+                # 2. Писатели стоят: только читаем хвост в память
+                data, end, _ = self._read()
+                restart = end >= self.restart_bytes
+                if restart:
+                    # WAL вырос: переносим всё в базу, пока писатели стоят, — следующий
+                    # писатель начнёт WAL заново. Перенести нужно лишь кадры с прошлого тика.
+                    self._hold.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+                else:
+                    # Иначе фиксируем снимок читателя на этом кадре
+                    reader.execute('BEGIN')
+                    reader.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+            finally:
+                lock.execute('ROLLBACK')
+                lock_ms = (time.perf_counter() - locked_at) * 1000
+            # 3. Запись и fsync архива — уже без блокировки; чекпойнт не пойдёт дальше
+            #    снимка читателя, то есть дальше того, что лежит в архиве
+            self._write(data, end)
+            if not restart:
+                self._hold.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+                reader.execute('ROLLBACK')
+        finally:
+            reader.close()
+            lock.close()
+
+        self.stats['ticks'] += 1
+        self.stats['last_lock_ms'] = round(lock_ms, 3)
+        self.stats['max_lock_ms'] = max(self.stats['max_lock_ms'], round(lock_ms, 3))
+        self.stats['last_tick_at'] = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        return dict(self.stats, seq=self._seq, epoch=self.epoch, archived_bytes=self._pos)
+
+
+# ============= ВОССТАНОВЛЕНИЕ И ПРОВЕРКА =============
+
+def _generations(folder, db_name, wal):
+    """Файлы поколений для восстановления снимка, по порядку"""
+    if not wal:
+        return []
+    wal_dir = os.path.join(folder, 'wal', db_name)
+    if not os.path.isdir(wal_dir):
+        return []
+    result = []
+    for name in os.listdir(wal_dir):
+        key = _parse_generation(name)
+        if key and key[0] == wal['epoch'] and key[1] >= wal['seq']:
+            result.append((key, os.path.join(wal_dir, name)))
+    return [path for _, path in sorted(result)]
+
+
+def integrity_check(path):
+    """PRAGMA integrity_check; пустой список — база цела"""
+    conn = sqlite3.connect(path)
+    try:
+        rows = [r[0] for r in conn.execute('PRAGMA integrity_check').fetchall()]
+    finally:
+        conn.close()
+    return [] if rows == ['ok'] else rows
+
+
+def restore_backup(backup_dir, target_dir, replay_wal=True, force=False):
+    """Восстановить снимок (и WAL после него) в target_dir. Возвращает отчёт по файлам."""
+    with open(os.path.join(backup_dir, MANIFEST), encoding='utf-8') as f:
+        manifest = json.load(f)
+    folder = os.path.dirname(os.path.abspath(backup_dir))
+    os.makedirs(target_dir, exist_ok=True)
+
+    report = {}
+    for db_name, info in manifest['files'].items():
+        target = os.path.join(target_dir, db_name)
+        if os.path.exists(target) and not force:
+            raise FileExistsError(f'{target} уже существует (используйте --force)')
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(target + suffix):
+                os.remove(target + suffix)
+        shutil.copyfile(os.path.join(backup_dir, db_name), target)
+
+        generations = _generations(folder, db_name, info.get('wal')) if replay_wal else []
+        for gen in generations:
+            # SQLite сам применит закоммиченные кадры при открытии, чекпойнт переносит их в файл
+            shutil.copyfile(gen, target + '-wal')
+            conn = sqlite3.connect(target)
+            try:
+                conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+            finally:
+                conn.close()
+
+        report[db_name] = {'generations': len(generations), 'problems': integrity_check(target)}
+    return report
+
+
+def verify_backup(backup_dir):
+    """Восстановить снимок во временный каталог и проверить целостность"""
+    tmp = tempfile.mkdtemp(prefix='beegram-verify-')
+    try:
+        return restore_backup(backup_dir, tmp)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Бэкапы BeeGramm')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    p_list = sub.add_parser('list', help='список снимков')
+    p_list.add_argument('--folder', default='backups')
+    p_verify = sub.add_parser('verify', help='восстановить во временный каталог и проверить')
+    p_verify.add_argument('backup_dir')
+    p_restore = sub.add_parser('restore', help='восстановить снимок (сервер должен быть остановлен)')
+    p_restore.add_argument('backup_dir')
+    p_restore.add_argument('target_dir')
+    p_restore.add_argument('--no-wal', action='store_true', help='только снимок, без WAL после него')
+    p_restore.add_argument('--force', action='store_true', help='перезаписать существующие файлы')
+    args = parser.parse_args(argv)
+
+    if args.cmd == 'list':
+        for m in list_backups(args.folder):
+            size = sum(f['bytes'] for f in m['files'].values())
+            print(f"{m['name']}  {m['created_at']}  файлов {len(m['files'])}  {size} байт")
+        return 0
+
+    if args.cmd == 'verify':
+        report = verify_backup(args.backup_dir)
+    else:
+        report = restore_backup(args.backup_dir, args.target_dir,
+                                replay_wal=not args.no_wal, force=args.force)
+
+    ok = True
+    for db_name, item in report.items():
+        status = 'ok' if not item['problems'] else '; '.join(item['problems'][:5])
+        ok = ok and not item['problems']
+        print(f"{'✅' if not item['problems'] else '❌'} {db_name}: поколений WAL {item['generations']}, {status}")
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Сравнение кодировщиков JSON на типичных ответах BeeGramm 🐝
+
+Страница истории (50 сообщений с профилем отправителя и реакциями, как
+/chats/<id>/messages?limit=50) и список из 100 чатов с превью (/chats/list).
+Строки берутся из SQLite в памяти тем же SELECT, что и в repository.py.
+
+    python bench_json.py [--rounds 2000]
+
+Печатает микросекунды на одно кодирование и размер ответа для:
+  flask      — стандартный провайдер Flask (json, sort_keys, ensure_ascii)
+  json       — serialization с бэкендом json
+  orjson     — serialization с бэкендом orjson
+"""
+
+import argparse
+import random
+import sqlite3
+import timeit
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+import serialization
+from repository import _MESSAGE_WITH_SENDER
+
+WORDS = ('мёд', 'пчёлка', 'улей', 'привет', 'как дела', 'сегодня', 'встреча', 'hello', 'ok', '🐝', '🍯', 'ага')
+
+
+def _text(rnd, n):
+    return ' '.join(rnd.choice(WORDS) for _ in range(n))
+
+
+def build_db(rnd, messages=50, chats=100):
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.executescript('''
+        CREATE TABLE users (id INTEGER PRIMARY KEY, username TEXT, nickname TEXT, avatar TEXT, is_premium INTEGER);
+        CREATE TABLE messages (id INTEGER PRIMARY KEY, chat_id INTEGER, user_id INTEGER, content TEXT,
+                               message_type TEXT DEFAULT 'text', file_url TEXT, is_read INTEGER DEFAULT 0,
+                               is_deleted INTEGER DEFAULT 0, deleted_at TIMESTAMP, deleted_by INTEGER,
+                               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+        CREATE TABLE chats (id INTEGER PRIMARY KEY, name TEXT, is_group INTEGER, is_channel INTEGER,
+                            avatar TEXT, description TEXT, creator_id INTEGER, subscribers_count INTEGER,
+                            is_support INTEGER, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+    ''')
+    conn.executemany('INSERT INTO users VALUES (?, ?, ?, ?, ?)',
+                     [(i, f'user{i}', f'Пчела {i}', f'avatar_{i}.png', i % 3 == 0) for i in range(1, 6)])
+    conn.executemany('INSERT INTO messages (chat_id, user_id, content, message_type, file_url) VALUES (?, ?, ?, ?, ?)',
+                     [(1, rnd.randint(1, 5), _text(rnd, rnd.randint(2, 25)),
+                       'text' if i % 10 else 'image', None if i % 10 else f'/uploads/images/{i}.jpg')
+                      for i in range(messages)])
+    conn.executemany('INSERT INTO chats (name, is_group, is_channel, avatar, description, creator_id, subscribers_count,'
+                     ' is_support) VALUES (?, ?, ?, ?, ?, ?, ?, 0)',
+                     [(f'Чат {i}', i % 2, int(i % 7 == 0), 'group.png', _text(rnd, 6), 1, rnd.randint(0, 500))
+                      for i in range(chats)])
+    return conn
+
+
+def message_page(conn, rnd):
+    page = [dict(r) for r in conn.execute(_MESSAGE_WITH_SENDER + ' WHERE m.chat_id = 1 ORDER BY m.id DESC LIMIT 50')]
+    for msg in page:
+        msg['reactions'] = [{'emoji': rnd.choice('👍❤️😂🐝'), 'count': rnd.randint(1, 9),
+                             'user_ids': [rnd.randint(1, 5) for _ in range(2)]}] if msg['id'] % 3 == 0 else []
+    return page
+
+
+def chat_list(conn, rnd):
+    result = []
+    for chat in conn.execute('SELECT * FROM chats').fetchall():
+        item = dict(chat)
+        item['type'] = 'channel' if item['is_channel'] else ('group' if item['is_group'] else 'private')
+        item['last_message'] = {'id': rnd.randint(1, 10 ** 6), 'content': _text(rnd, 8), 'message_type': 'text',
+                                'created_at': '2024-05-01 12:00:00', 'user_id': 2, 'nickname': 'Пчела 2'}
+        item['unread_count'] = rnd.randint(0, 30)
+        result.append(item)
+    return result
+
+
+def measure(fn, rounds):
+    best = min(timeit.repeat(fn, number=rounds, repeat=5))
+    return best / rounds * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=2000)
+    args = parser.parse_args()
+
+    rnd = random.Random(42)
+    conn = build_db(rnd)
+    flask_provider = DefaultJSONProvider(Flask(__name__))
+    payloads = {
+        'message page': {'success': True, 'messages': message_page(conn, rnd)},
+        'chat list': {'success': True, 'chats': chat_list(conn, rnd)},
+    }
+
+    encoders = [('flask', None, lambda obj: flask_provider.dumps(obj).encode('utf-8'))]
+    for backend in serialization.BACKENDS:
+        if backend == 'orjson' and serialization.orjson is None:
+            print('orjson не установлен — сравниваем только json')
+            continue
+        encoders.append((backend, backend, serialization.dumps_bytes))
+
+    print(f'{"payload":<14}{"encoder":<12}{"µs/encode":>11}{"bytes":>9}')
+    for title, payload in payloads.items():
+        for name, backend, encode in encoders:
+            if backend:
+                serialization.configure(backend)
+            us = measure(lambda: encode(payload), args.rounds)
+            print(f'{title:<14}{name:<12}{us:>11.1f}{len(encode(payload)):>9}')
+
+
+if __name__ == '__main__':
+    main()
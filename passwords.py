@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+BeeGramm — хэширование паролей 🐝
+
+bcrypt считает сотни миллисекунд. В воркере gevent синхронный вызов стоит
+на event loop целиком: пока проверяется один пароль, сообщения не уходят ни
+одному сокету воркера. Поэтому bcrypt выполняется в ограниченном пуле
+настоящих потоков (на время расчёта bcrypt отпускает GIL), а запрос ждёт
+результат, уступая управление остальным гринлетам. Очередь ожидающих тоже
+ограничена: при шторме входов лишние получают PasswordBusy (ответ 503) —
+растёт только задержка входа, доставка сообщений не страдает.
+
+Стоимость bcrypt (rounds) задаёт configure(); needs_rehash() говорит, что хэш
+посчитан с другой стоимостью, и /login прозрачно пересчитывает его.
+"""
+
+import threading
+
+import bcrypt
+
+_rounds = 12
+_run = None
+_slots = None
+
+
+class PasswordBusy(Exception):
+    """Очередь на bcrypt переполнена — попробовать позже"""
+
+
+def configure(rounds=12, workers=4, max_pending=64, async_mode='threading'):
+    """Стоимость хэша и пул потоков под режим Flask-SocketIO (gevent, eventlet или потоки)"""
+    global _rounds, _run, _slots
+    _rounds = rounds
+    if async_mode == 'gevent':
+        from gevent.lock import BoundedSemaphore
+        from gevent.threadpool import ThreadPool
+        pool = ThreadPool(workers)
+        _run = lambda fn, *args: pool.spawn(fn, *args).get()
+        _slots = BoundedSemaphore(max_pending)
+    elif async_mode == 'eventlet':
+        from eventlet import tpool
+        from eventlet.semaphore import BoundedSemaphore
+        tpool.set_num_threads(workers)
+        _run = tpool.execute
+        _slots = BoundedSemaphore(max_pending)
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+        _run = lambda fn, *args: pool.submit(fn, *args).result()
+        _slots = threading.BoundedSemaphore(max_pending)
+
+
+def _offload(fn, *args):
+    if _run is None:
+        return fn(*args)
+    if not _slots.acquire(blocking=False):
+        raise PasswordBusy()
+    try:
+        return _run(fn, *args)
+    finally:
+        _slots.release()
+
+
+def hash_password(password):
+    """bcrypt-хэш пароля с текущей стоимостью"""
+    salt = bcrypt.gensalt(rounds=_rounds)
+    return _offload(bcrypt.hashpw, password.encode('utf-8'), salt).decode('utf-8')
+
+
+def _checkpw(password, hashed):
+    try:
+        return bcrypt.checkpw(password, hashed)
+    except ValueError:
+        return False
+
+
+def check_password(password, hashed):
+    """Совпадает ли пароль с хэшем; битый или пустой хэш — не совпадает"""
+    if not password or not hashed:
+        return False
+    return _offload(_checkpw, password.encode('utf-8'), hashed.encode('utf-8'))
+
+
+def needs_rehash(hashed):
+    """Хэш посчитан не с текущей стоимостью ($2b$<rounds>$...)"""
+    try:
+        return int(hashed.split('$')[2]) != _rounds
+    except (AttributeError, IndexError, ValueError):
+        return False
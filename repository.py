@@ -0,0 +1,2105 @@
+# -*- coding: utf-8 -*-
+"""
+BeeGramm — слой доступа к данным 🐝
+
+Запросы к users, chats, messages, reactions, reports и ключам объявлены здесь
+как именованные объекты Query; маршруты server.py вызывают методы репозиториев
+(users.get, messages.insert, ...) и не собирают SQL сами.
+
+Через Query проходят замеры (add_hook, stats) и кэш чтений с инвалидацией по
+таблицам, поэтому любая оптимизация хранилища — правка в одном месте.
+
+SQL пишется в диалекте SQLite; под Postgres его переводит storage.translate.
+"""
+
+import base64
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+import backup
+import storage
+
+_db_path = 'beegram.db'
+_message_shards = 1
+_shard_id_floor = 0
+_backend_name = 'sqlite'
+_dsn = None
+_pool_size = 10
+_cache_size = 5000
+_manual_checkpoints = False
+_backend = None
+_replica_mode = 'off'
+_replica_path = 'beegram_replica.db'
+_replica_dsn = None
+_replica_backend = None
+
+
+def configure(db_path=None, message_shards=None, backend=None, dsn=None, pool_size=None,
+              manual_checkpoints=None, replica=None, replica_path=None, replica_dsn=None, cache_size=None):
+    """Задать хранилище (sqlite | postgres), путь/DSN и число шардов сообщений (до первого запроса).
+
+    manual_checkpoints — SQLite не делает автоматических чекпойнтов WAL (их делает архиватор WAL).
+    replica — off | wal | snapshot: куда идут тяжёлые чтения админки (см. replica_connect).
+    cache_size — сколько результатов держит кэш запросов (LRU).
+    """
+    global _db_path, _message_shards, _backend_name, _dsn, _pool_size, _manual_checkpoints, _backend
+    global _replica_mode, _replica_path, _replica_dsn, _replica_backend, _cache_size
+    if db_path is not None:
+        _db_path = db_path
+    if message_shards is not None:
+        _message_shards = int(message_shards)
+    if backend is not None:
+        _backend_name = backend
+    if dsn is not None:
+        _dsn = dsn
+    if pool_size is not None:
+        _pool_size = int(pool_size)
+    if cache_size is not None:
+        _cache_size = int(cache_size)
+    if manual_checkpoints is not None:
+        _manual_checkpoints = bool(manual_checkpoints)
+    if replica is not None:
+        if replica not in ('off', 'wal', 'snapshot'):
+            raise ValueError(f'Неизвестный режим реплики: {replica}')
+        _replica_mode = replica
+    if replica_path is not None:
+        _replica_path = replica_path
+    if replica_dsn is not None:
+        _replica_dsn = replica_dsn
+        if _replica_backend is not None:
+            _replica_backend.close()
+            _replica_backend = None
+    if _backend_name != 'sqlite' and _message_shards != 1:
+        raise ValueError('MESSAGE_SHARDS > 1 поддерживается только для SQLite')
+    if _backend is not None and any(v is not None for v in (db_path, backend, dsn, pool_size, manual_checkpoints)):
+        _backend.close()
+        _backend = None
+
+
+def backend():
+    """Текущий драйвер хранилища (создаётся при первом обращении)"""
+    global _backend
+    if _backend is None:
+        _backend = storage.make_backend(_backend_name, _db_path, dsn=_dsn, pool_size=_pool_size,
+                                        manual_checkpoints=_manual_checkpoints)
+    return _backend
+
+
+def backend_name():
+    return _backend_name
+
+
+def init_schema():
+    """Создать схему для серверных бэкендов (SQLite мигрирует init_db)"""
+    backend().init_schema()
+
+
+def connect():
+    """Соединение с основной БД (строки доступны по имени и по номеру колонки)"""
+    return backend().connect()
+
+
+def insert_id(conn, sql, params=()):
+    """INSERT одной строки через соединение или курсор -> id новой строки на любом бэкенде"""
+    return storage.insert_id(conn, sql, params)
+
+
+def replica_connect():
+    """Соединение только для чтения для тяжёлых выборок админки, модерации и аналитики.
+
+    SQLite, режим wal — отдельное соединение с query_only: читает свой снимок WAL
+    и не держит блокировок, мешающих записи в чат.
+    SQLite, режим snapshot — копия базы, которую обновляет refresh_replica();
+    пока копии нет, читаем как в режиме wal.
+    Postgres — пул реплики replica_dsn (read-only), если он задан.
+    Кэш Query такие соединения не наполняют: реплика может отставать.
+    """
+    global _replica_backend
+    if _backend_name == 'sqlite':
+        if _replica_mode == 'off':
+            return connect()
+        path = _db_path
+        if _replica_mode == 'snapshot' and os.path.exists(_replica_path):
+            path = _replica_path
+        return storage.open_sqlite(path, read_only=True)
+    if _replica_dsn:
+        if _replica_backend is None:
+            _replica_backend = storage.PostgresBackend(_replica_dsn, pool_size=_pool_size, read_only=True)
+        return _replica_backend.connect()
+    return connect()
+
+
+@contextmanager
+def replica():
+    """with repo.replica() as conn: ... — соединение replica_connect() с закрытием"""
+    conn = replica_connect()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def refresh_replica(pages_per_step=256, pause=None):
+    """Обновить копию базы для режима snapshot. Возвращает число страниц или None, если режим другой."""
+    if _backend_name != 'sqlite' or _replica_mode != 'snapshot':
+        return None
+    tmp = _replica_path + '.next'
+    pages, _ = backup.snapshot_file(_db_path, tmp, pages_per_step=pages_per_step, pause=pause)
+    # Копия без WAL: её только читают, а подмена файла не должна встретить чужой -wal
+    conn = sqlite3.connect(tmp)
+    try:
+        conn.execute('PRAGMA journal_mode = DELETE')
+    finally:
+        conn.close()
+    os.replace(tmp, _replica_path)
+    return pages
+
+
+@contextmanager
+def transaction(conn=None):
+    """Соединение, общее для нескольких вызовов репозиториев: commit в конце, rollback при ошибке.
+
+    Если conn уже передан — используем его и ничего не коммитим (транзакцией владеет вызывающий).
+    """
+    if conn is not None:
+        yield conn
+        return
+    conn = connect()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+# ============= ИМЕНОВАННЫЕ ЗАПРОСЫ, ХУКИ, КЭШ =============
+
+QUERIES = {}
+
+_hooks = []
+_stats = defaultdict(lambda: {'calls': 0, 'cached': 0, 'rows': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+
+# (имя, параметры) -> (истекает, значение) в порядке LRU, не больше _cache_size записей;
+# таблица -> ключи кэша, которые от неё зависят
+_cache = OrderedDict()
+_cache_keys = defaultdict(set)
+
+# Максимум параметров в одном IN (...) — SQLite по умолчанию держит 999
+IN_CHUNK = 500
+
+
+def add_hook(fn):
+    """Подписаться на выполнение запросов: fn(name, elapsed_ms, rows, cached)"""
+    _hooks.append(fn)
+
+
+def stats():
+    """Сводка по запросам, самые дорогие сверху"""
+    result = []
+    for name, s in _stats.items():
+        item = dict(s, name=name)
+        item['avg_ms'] = round(s['total_ms'] / max(1, s['calls'] - s['cached']), 3)
+        item['total_ms'] = round(s['total_ms'], 3)
+        item['max_ms'] = round(s['max_ms'], 3)
+        result.append(item)
+    result.sort(key=lambda x: x['total_ms'], reverse=True)
+    return result
+
+
+def _forget(key):
+    """Убрать запись кэша и её ключ из индексов всех таблиц, которые читает запрос"""
+    _cache.pop(key, None)
+    for table in QUERIES[key[0]].reads:
+        keys = _cache_keys.get(table)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del _cache_keys[table]
+
+
+def invalidate(*tables):
+    """Сбросить кэшированные чтения, зависящие от таблиц"""
+    for table in tables:
+        for key in list(_cache_keys.get(table, ())):
+            _forget(key)
+
+
+# Запись сбрасывает кэш дважды: сразу (свои следующие чтения) и после commit —
+# чтение с другого соединения до commit ещё видит старые строки и могло положить их в кэш
+storage.add_commit_hook(lambda tables: invalidate(*tables))
+
+
+def _record(name, elapsed_ms, rows, cached):
+    s = _stats[name]
+    s['calls'] += 1
+    s['rows'] += rows
+    if cached:
+        s['cached'] += 1
+    else:
+        s['total_ms'] += elapsed_ms
+        s['max_ms'] = max(s['max_ms'], elapsed_ms)
+    for fn in _hooks:
+        try:
+            fn(name, elapsed_ms, rows, cached)
+        except Exception:
+            pass
+
+
+def _copy(value):
+    # Вызывающие код часто дописывают поля в результат — кэш отдаёт копии
+    if isinstance(value, dict):
+        return dict(value)
+    if isinstance(value, list):
+        return [dict(v) if isinstance(v, dict) else v for v in value]
+    return value
+
+
+class Query:
+    """Именованный запрос.
+
+    reads — таблицы, от которых зависит кэш (нужен cache_ttl > 0);
+    writes — таблицы, кэш которых сбрасывается после выполнения.
+    Токен {ids} в SQL раскрывается в список плейсхолдеров (см. all_in).
+    """
+
+    def __init__(self, name, sql, reads=(), writes=(), cache_ttl=0):
+        if name in QUERIES:
+            raise ValueError(f'Запрос {name} уже объявлен')
+        self.name = name
+        self.sql = sql
+        self.reads = tuple(reads)
+        self.writes = tuple(writes)
+        self.cache_ttl = cache_ttl
+        QUERIES[name] = self
+
+    def _execute(self, conn, params, fetch, sql=None, returning_id=False):
+        params = tuple(params)
+        key = (self.name, params)
+        on_replica = getattr(conn, 'replica', False)
+        name = self.name + '@replica' if on_replica else self.name
+        cached = self.cache_ttl and not on_replica
+        if cached:
+            hit = _cache.get(key)
+            if hit and hit[0] > time.monotonic():
+                _cache.move_to_end(key)
+                _record(name, 0.0, 0, True)
+                return _copy(hit[1])
+            if hit:
+                _forget(key)
+
+        started = time.perf_counter()
+        cur = storage.execute(conn, sql or self.sql, params, returning_id)
+        result, rows = fetch(cur)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if self.writes:
+            invalidate(*self.writes)
+            storage.note_writes(conn, self.writes)
+        _record(name, elapsed_ms, rows, False)
+
+        if cached:
+            _cache[key] = (time.monotonic() + self.cache_ttl, _copy(result))
+            _cache.move_to_end(key)
+            for table in self.reads:
+                _cache_keys[table].add(key)
+            while len(_cache) > _cache_size:
+                _forget(next(iter(_cache)))
+        return result
+
+    def one(self, conn, params=()):
+        """Первая строка как dict или None"""
+        def fetch(cur):
+            row = cur.fetchone()
+            return (dict(row) if row else None), (1 if row else 0)
+        return self._execute(conn, params, fetch)
+
+    def all(self, conn, params=()):
+        """Все строки как список dict"""
+        def fetch(cur):
+            rows = [dict(r) for r in cur.fetchall()]
+            return rows, len(rows)
+        return self._execute(conn, params, fetch)
+
+    def scalar(self, conn, params=()):
+        """Первая колонка первой строки"""
+        def fetch(cur):
+            row = cur.fetchone()
+            return (row[0] if row else None), (1 if row else 0)
+        return self._execute(conn, params, fetch)
+
+    def run(self, conn, params=()):
+        """INSERT/UPDATE/DELETE; возвращает курсор (rowcount)"""
+        return self._execute(conn, params, lambda cur: (cur, max(cur.rowcount, 0)))
+
+    def insert(self, conn, params=()):
+        """INSERT одной строки; возвращает её id"""
+        return self._execute(conn, params, lambda cur: (cur.lastrowid, max(cur.rowcount, 0)),
+                             returning_id=True)
+
+    def many(self, conn, seq):
+        """executemany одной пачкой; возвращает число затронутых строк"""
+        seq = list(seq)
+        if not seq:
+            return 0
+        started = time.perf_counter()
+        cur = conn.executemany(self.sql, seq)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if self.writes:
+            invalidate(*self.writes)
+            storage.note_writes(conn, self.writes)
+        _record(self.name, elapsed_ms, max(cur.rowcount, 0), False)
+        return cur.rowcount
+
+    def run_in(self, conn, ids, params=()):
+        """UPDATE/DELETE для списка id пачками по IN_CHUNK: params идут перед id
+        (SET ... WHERE id IN ({ids})); возвращает число затронутых строк"""
+        ids = list(ids)
+        total = 0
+        for start in range(0, len(ids), IN_CHUNK):
+            chunk = ids[start:start + IN_CHUNK]
+            sql = self.sql.replace('{ids}', ','.join('?' * len(chunk)))
+            cur = self._execute(conn, (*params, *chunk), lambda cur: (cur, max(cur.rowcount, 0)), sql=sql)
+            total += max(cur.rowcount, 0)
+        return total
+
+    def all_in(self, conn, ids, params=()):
+        """Строки для списка id: {ids} раскрывается пачками по IN_CHUNK, params идут после id"""
+        ids = list(ids)
+        result = []
+        for start in range(0, len(ids), IN_CHUNK):
+            chunk = ids[start:start + IN_CHUNK]
+            sql = self.sql.replace('{ids}', ','.join('?' * len(chunk)))
+
+            def fetch(cur):
+                rows = [dict(r) for r in cur.fetchall()]
+                return rows, len(rows)
+            result.extend(self._execute(conn, (*chunk, *params), fetch, sql=sql))
+        return result
+
+
+# ============= СПИСКИ С КУРСОРОМ (KEYSET) =============
+
+# Страница — это WHERE (ключ сортировки) > ключа последней строки прошлой
+# страницы, ORDER BY тот же ключ, LIMIT n + 1. На каждый ключ есть индекс,
+# поэтому страница стоит одинаково и на первой, и на тысячной — без OFFSET
+# и без прохода по всей таблице.
+
+
+def encode_cursor(values):
+    raw = json.dumps(list(values), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Ключ последней строки прошлой страницы; ValueError, если курсор испорчен"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8'))
+    except Exception:
+        raise ValueError('Неверный курсор')
+    if not isinstance(values, list) or not all(isinstance(v, (int, float, str)) for v in values):
+        raise ValueError('Неверный курсор')
+    return values
+
+
+def prefix_range(prefix):
+    """Границы для поиска по префиксу через индекс: col >= lo AND col < hi (LIKE 'p%' индекс не берёт)"""
+    return prefix, prefix + '\U0010ffff'
+
+
+class KeysetList:
+    """Постраничный список с фильтрами.
+
+    sorts: имя -> (ASC | DESC, ((выражение, поле строки), ...)); ключ должен
+    однозначно задавать строку, поэтому в конце неуникальных ключей идёт id.
+    filters: имя -> условие WHERE с плейсхолдерами; значения (кортеж, если их
+    несколько или нет совсем) передаются в page(), None — фильтр выключен.
+    Запрос на каждую комбинацию сортировки и фильтров собирается один раз
+    и виден в stats() как «имя[сортировка;фильтры]».
+    """
+
+    def __init__(self, name, select, sorts, filters=None, where=()):
+        self.name = name
+        self.select = select
+        self.sorts = sorts
+        self.filters = filters or {}
+        self.where = tuple(where)
+        self._queries = {}
+
+    def _query(self, sort, names, after):
+        key = (sort, names, after)
+        query = self._queries.get(key)
+        if query is None:
+            direction, columns = self.sorts[sort]
+            exprs = ', '.join(expr for expr, _ in columns)
+            clauses = list(self.where) + [f'({self.filters[n]})' for n in names]
+            if after:
+                op = '<' if direction == 'DESC' else '>'
+                marks = ', '.join('?' * len(columns))
+                clauses.append(f'({exprs}) {op} ({marks})' if len(columns) > 1 else f'{exprs} {op} ?')
+            sql = self.select
+            if clauses:
+                sql += ' WHERE ' + ' AND '.join(clauses)
+            order = ', '.join(f'{expr} {direction}' for expr, _ in columns)
+            sql += f' ORDER BY {order} LIMIT ?'
+            label = f'{self.name}[{sort}' + (';' + ','.join(names) if names else '') + (';after' if after else '') + ']'
+            query = Query(label, sql)
+            self._queries[key] = query
+        return query
+
+    def page(self, conn, filters=None, sort='new', cursor=None, limit=50):
+        """(строки, курсор следующей страницы или None)"""
+        if sort not in self.sorts:
+            raise ValueError(f'Неизвестная сортировка: {sort}')
+        filters = {n: v for n, v in (filters or {}).items() if v is not None}
+        unknown = set(filters) - set(self.filters)
+        if unknown:
+            raise ValueError(f'Неизвестные фильтры: {", ".join(sorted(unknown))}')
+        _, columns = self.sorts[sort]
+        names = tuple(sorted(filters))
+        params = []
+        for n in names:
+            value = filters[n]
+            params.extend(value if isinstance(value, tuple) else (value,))
+        after = decode_cursor(cursor) if cursor else None
+        if after is not None:
+            if len(after) != len(columns):
+                raise ValueError('Неверный курсор')
+            params.extend(after)
+        params.append(limit + 1)
+        rows = self._query(sort, names, after is not None).all(conn, params)
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor([rows[-1][field] for _, field in columns])
+        return rows, next_cursor
+
+
+# ============= ОДНОКРАТНЫЕ МИГРАЦИИ ДАННЫХ =============
+
+# Строка schema_migrations — отметка, что миграция данных выполнена. Отметка
+# пишется первой в транзакции миграции: узел, стартующий одновременно,
+# упрётся в UNIQUE и пропустит её.
+MIGRATION_CLAIM = Query('migrations.claim', 'INSERT OR IGNORE INTO schema_migrations (name) VALUES (?)')
+
+
+def claim_migration(name, conn):
+    """True — миграцию name ещё не выполняли и её нужно выполнить в транзакции conn"""
+    return MIGRATION_CLAIM.run(conn, (name,)).rowcount > 0
+
+
+# ============= ШАРДЫ СООБЩЕНИЙ =============
+
+# messages и reactions (вместе с is_read) разложены по message_shards файлам,
+# шард выбирается по chat_id % N; users, chats и остальное живут в основной БД.
+# При N == 1 шард — это сама основная БД, поведение прежнее.
+
+
+def shard_count():
+    return _message_shards
+
+
+def database_files():
+    """Файлы SQLite, из которых состоит база (основной и шарды)"""
+    if _backend_name != 'sqlite':
+        return []
+    if _message_shards == 1:
+        return [_db_path]
+    return [_db_path] + [shard_path(i) for i in range(_message_shards)]
+
+
+def shard_path(index):
+    if _message_shards == 1:
+        return _db_path
+    base, ext = _db_path.rsplit('.', 1) if '.' in _db_path else (_db_path, 'db')
+    return f'{base}_shard_{index}.{ext}'
+
+
+def shard_for_chat(chat_id):
+    return int(chat_id) % _message_shards
+
+
+def shards_for_message(message_id):
+    """Шарды, где может лежать сообщение с этим id"""
+    n = _message_shards
+    if n == 1:
+        return [0]
+    if int(message_id) > _shard_id_floor:
+        # Новые id выдаются так, что id % N == номер шарда
+        return [int(message_id) % n]
+    return list(range(n))
+
+
+def shard_connect(chat_id=None, index=None):
+    """Соединение с шардом сообщений (по chat_id или по номеру шарда)"""
+    if _message_shards == 1:
+        return connect()
+    if index is None:
+        index = shard_for_chat(chat_id)
+    conn = storage.open_sqlite(shard_path(index), _manual_checkpoints)
+    # users/reports остаются доступны без префикса
+    conn.execute('ATTACH DATABASE ? AS g', (_db_path,))
+    return conn
+
+
+@contextmanager
+def _shard(chat_id=None, index=None):
+    conn = shard_connect(chat_id, index)
+    try:
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def init_shards():
+    """Создать файлы шардов и однократно перенести в них сообщения из основной БД"""
+    global _shard_id_floor
+    if not backend().supports_shards:
+        return
+    n = _message_shards
+    conn = sqlite3.connect(_db_path)
+    try:
+        conn.execute('CREATE TABLE IF NOT EXISTS shard_meta (key TEXT PRIMARY KEY, value TEXT)')
+        meta = dict(conn.execute('SELECT key, value FROM shard_meta').fetchall())
+        current = int(meta.get('shards') or 1)
+        if current != 1 and current != n:
+            raise RuntimeError(f'Сообщения разложены по {current} шардам, а MESSAGE_SHARDS = {n}: '
+                               f'решардинг не поддерживается')
+        if n == 1:
+            return
+
+        # Схема шарда = схема messages/reactions из основной БД (таблицы, потом индексы)
+        schema = conn.execute('''SELECT type, sql FROM sqlite_master
+                                  WHERE tbl_name IN ('messages', 'reactions', 'message_changes')
+                                  AND sql IS NOT NULL
+                                  ORDER BY type DESC''').fetchall()
+        columns = {t: conn.execute(f'PRAGMA table_info({t})').fetchall()
+                   for t in ('messages', 'reactions', 'message_changes')}
+        for i in range(n):
+            shard = sqlite3.connect(shard_path(i))
+            if not shard.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages'").fetchone():
+                shard.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            shard.execute('PRAGMA journal_mode = WAL')
+            for kind, sql in schema:
+                prefix = 'CREATE TABLE ' if kind == 'table' else 'CREATE INDEX '
+                shard.execute(sql.replace(prefix, prefix + 'IF NOT EXISTS ', 1))
+            # Миграции колонок, добавленные в init_db после шардирования
+            for table, cols in columns.items():
+                existing = {row[1] for row in shard.execute(f'PRAGMA table_info({table})').fetchall()}
+                for _cid, name, col_type, _notnull, default, _pk in cols:
+                    if name not in existing:
+                        ddl = f'ALTER TABLE {table} ADD COLUMN {name} {col_type}'
+                        if default is not None:
+                            ddl += f' DEFAULT {default}'
+                        shard.execute(ddl)
+            # Последний выданный id шарда. Для шардов, созданных до появления таблицы,
+            # начинаем с наибольшего id, который где-либо мог сохраниться
+            shard.execute('''CREATE TABLE IF NOT EXISTS message_seq (
+                                 id INTEGER PRIMARY KEY CHECK (id = 1),
+                                 last_id INTEGER NOT NULL
+                             )''')
+            reported = conn.execute('SELECT IFNULL(MAX(message_id), 0) FROM reports WHERE chat_id % ? = ?',
+                                    (n, i)).fetchone()[0]
+            shard.execute('''INSERT OR IGNORE INTO message_seq (id, last_id)
+                             SELECT 1, MAX((SELECT IFNULL(MAX(id), 0) FROM messages),
+                                           (SELECT IFNULL(MAX(message_id), 0) FROM message_changes), ?)''',
+                          (reported,))
+            shard.commit()
+            shard.close()
+
+        if current == 1:
+            print(f'🔧 Переносим сообщения в {n} шардов...')
+            floor = conn.execute('SELECT IFNULL(MAX(id), 0) FROM messages').fetchone()[0]
+            for i in range(n):
+                conn.execute('ATTACH DATABASE ? AS s', (shard_path(i),))
+                conn.execute('''INSERT OR IGNORE INTO s.messages
+                                SELECT * FROM main.messages WHERE chat_id % ? = ?''', (n, i))
+                conn.execute('''INSERT OR IGNORE INTO s.reactions
+                                SELECT * FROM main.reactions WHERE message_id IN (
+                                    SELECT id FROM main.messages WHERE chat_id % ? = ?
+                                )''', (n, i))
+                conn.commit()
+                conn.execute('DETACH DATABASE s')
+            conn.execute('DELETE FROM reactions')
+            conn.execute('DELETE FROM messages')
+            conn.execute("INSERT OR REPLACE INTO shard_meta (key, value) VALUES ('shards', ?), ('id_floor', ?)",
+                         (str(n), str(floor)))
+            conn.commit()
+            meta['id_floor'] = floor
+            print('✅ Сообщения разложены по шардам')
+
+        _shard_id_floor = int(meta.get('id_floor') or 0)
+    finally:
+        conn.close()
+
+
+# ============= ПОЛЬЗОВАТЕЛИ =============
+
+class UserRepository:
+    # Короткий TTL: профиль читается на каждый запрос (early access, права),
+    # а записи через репозиторий сбрасывают кэш сразу
+    GET = Query('users.get', 'SELECT * FROM users WHERE id = ?', reads=('users',), cache_ttl=5)
+    GET_BY_USERNAME = Query('users.get_by_username', 'SELECT * FROM users WHERE username = ?',
+                            reads=('users',), cache_ttl=5)
+    PROFILES = Query('users.profiles', '''SELECT id, nickname, username, avatar, is_premium
+                                          FROM users WHERE id IN ({ids})''')
+    # Только если хэш не сменился с момента проверки (параллельная смена пароля)
+    REHASH = Query('users.rehash', 'UPDATE users SET password = ? WHERE id = ? AND password = ?',
+                   writes=('users',))
+    CREATE = Query('users.create', 'INSERT INTO users (username, password, nickname) VALUES (?, ?, ?)',
+                   writes=('users',))
+    DELETE = Query('users.delete', 'DELETE FROM users WHERE id = ?', writes=('users',))
+    # Без кэша: по старым значениям считаются дельты счётчиков статистики
+    COUNTED = Query('users.counted', 'SELECT is_premium, spam_blocked, bee_stars FROM users WHERE id = ?')
+    # Массовые действия модерации: администраторов не трогают
+    RESTRICTABLE = Query('users.restrictable', '''SELECT id, username, spam_blocked FROM users
+                                                  WHERE is_admin = 0 AND id IN ({ids})''')
+    SET_SPAM_BLOCKED = Query('users.set_spam_blocked', '''UPDATE users SET spam_blocked = ?, token_epoch = token_epoch + 1
+                                                          WHERE is_admin = 0 AND id IN ({ids})''', writes=('users',))
+    SET_BANNED_UNTIL = Query('users.set_banned_until', '''UPDATE users SET banned_until = ?, token_epoch = token_epoch + 1
+                                                          WHERE is_admin = 0 AND id IN ({ids})''', writes=('users',))
+    # Эпоха токенов /login: подъём отзывает все выданные токены (server._bearer_user_id).
+    # Читается без кэша — отзыв должен действовать сразу на всех узлах
+    TOKEN_EPOCH = Query('users.token_epoch', 'SELECT token_epoch FROM users WHERE id = ?')
+    REVOKE_TOKENS = Query('users.revoke_tokens', 'UPDATE users SET token_epoch = token_epoch + 1 WHERE id = ?',
+                          writes=('users',))
+    SEARCH = Query('users.search', '''SELECT id, username, nickname, avatar, is_premium, bee_stars
+                                      FROM users
+                                      WHERE username LIKE ? OR nickname LIKE ?
+                                      LIMIT 20''')
+    SEARCH_MODERATION = Query('users.search_moderation', '''SELECT id, username, nickname, spam_blocked
+                                                            FROM users
+                                                            WHERE username LIKE ? OR nickname LIKE ?
+                                                            ORDER BY created_at DESC
+                                                            LIMIT 30''')
+    # id растёт вместе с created_at, поэтому «новые» — это id DESC по первичному ключу
+    LIST = KeysetList('users.list', '''SELECT id, username, nickname, avatar, is_premium, is_admin, is_moderator,
+                                           spam_blocked, early_access, bee_stars, created_at
+                                    FROM users''',
+                      sorts={'new': ('DESC', (('id', 'id'),)),
+                             'old': ('ASC', (('id', 'id'),)),
+                             'username': ('ASC', (('username', 'username'),)),
+                             'stars': ('DESC', (('bee_stars', 'bee_stars'), ('id', 'id')))},
+                      filters={'admin': 'is_admin = 1',
+                               'moderator': 'is_admin = 0 AND is_moderator = 1',
+                               'regular': 'is_admin = 0 AND is_moderator = 0',
+                               'premium': 'is_premium = ?',
+                               'spam_blocked': 'spam_blocked = ?',
+                               'early_access': 'early_access = ?',
+                               'prefix': 'username >= ? AND username < ?'})
+    ROLES = ('admin', 'moderator', 'regular')
+    CHAT_PARTNER = Query('users.chat_partner', '''SELECT u.id, u.nickname, u.username, u.avatar, u.status, u.is_premium
+                                                  FROM users u
+                                                  JOIN chat_members cm ON u.id = cm.user_id
+                                                  WHERE cm.chat_id = ? AND u.id != ?
+                                                  LIMIT 1''')
+
+    # Колонки, которые можно менять через update(); запрос на каждый набор полей создаётся один раз
+    UPDATABLE = ('nickname', 'bio', 'status', 'theme', 'avatar', 'is_premium', 'bee_stars', 'is_admin',
+                 'is_moderator', 'spam_blocked', 'early_access', 'banned_until')
+    # Поля, которые сервер кэширует в подписанных claims сессии (server._issue_claims)
+    CLAIM_FIELDS = ('username', 'nickname', 'is_admin', 'is_moderator', 'early_access', 'is_premium',
+                    'spam_blocked', 'banned_until')
+    _updates = {}
+    _listeners = []
+
+    def add_listener(self, fn):
+        """Подписаться на изменения CLAIM_FIELDS: fn(user_ids) — сразу после записи, до commit"""
+        self._listeners.append(fn)
+
+    def _notify(self, user_ids):
+        for fn in self._listeners:
+            try:
+                fn(user_ids)
+            except Exception:
+                pass
+
+    def get(self, user_id, conn=None):
+        with transaction(conn) as c:
+            return self.GET.one(c, (user_id,))
+
+    def get_by_username(self, username, conn=None):
+        with transaction(conn) as c:
+            return self.GET_BY_USERNAME.one(c, (username,))
+
+    def profiles(self, user_ids, conn=None):
+        """{id: профиль для подписи сообщений} одним запросом на пачку id"""
+        with transaction(conn) as c:
+            return {r['id']: r for r in self.PROFILES.all_in(c, set(user_ids))}
+
+    def create(self, username, password_hash, nickname, conn=None):
+        with transaction(conn) as c:
+            user_id = self.CREATE.insert(c, (username, password_hash, nickname))
+            row = self.COUNTED.one(c, (user_id,))
+            counters.add('users', 1, series=True, conn=c)
+            counters.add_user(row, conn=c)
+            # Стартовые пчёлки (DEFAULT в схеме) — первая запись журнала
+            stars.log('signup', None, user_id, row['bee_stars'] or 0, conn=c)
+            return user_id
+
+    def token_epoch(self, user_id, conn=None):
+        """Текущая эпоха токенов пользователя или None, если его нет"""
+        with transaction(conn) as c:
+            epoch = self.TOKEN_EPOCH.one(c, (user_id,))
+            return int(epoch['token_epoch'] or 0) if epoch else None
+
+    def revoke_tokens(self, user_id, conn=None):
+        with transaction(conn) as c:
+            self.REVOKE_TOKENS.run(c, (user_id,))
+            self._notify([user_id])
+
+    def rehash_password(self, user_id, old_hash, new_hash, conn=None):
+        with transaction(conn) as c:
+            return self.REHASH.run(c, (new_hash, user_id, old_hash)).rowcount
+
+    def update(self, user_id, conn=None, **fields):
+        """UPDATE одним запросом для набора полей из UPDATABLE"""
+        names = tuple(sorted(fields))
+        if not names:
+            return
+        unknown = set(names) - set(self.UPDATABLE)
+        if unknown:
+            raise ValueError(f'Нельзя обновить поля users: {", ".join(sorted(unknown))}')
+        query = self._updates.get(names)
+        if query is None:
+            sets = ', '.join(f'{n} = ?' for n in names)
+            if set(names) & set(self.CLAIM_FIELDS):
+                sets += ', token_epoch = token_epoch + 1'
+            query = Query(f'users.update[{",".join(names)}]', f'UPDATE users SET {sets} WHERE id = ?',
+                          writes=('users',))
+            self._updates[names] = query
+        with transaction(conn) as c:
+            old = self.COUNTED.one(c, (user_id,)) if set(names) & set(counters.USER_FIELDS) else None
+            query.run(c, (*(fields[n] for n in names), user_id))
+            if set(names) & set(self.CLAIM_FIELDS):
+                self._notify([user_id])
+            if old and 'bee_stars' in fields:
+                delta = int(fields['bee_stars'] or 0) - int(old['bee_stars'] or 0)
+                stars.log('adjust', None, user_id, delta, conn=c)
+            if old:
+                counters.add_user(old, -1, conn=c)
+                counters.add_user(dict(old, **{n: fields[n] for n in counters.USER_FIELDS if n in fields}), conn=c)
+                if not old['is_premium'] and fields.get('is_premium'):
+                    counters.add('premium_activations', 1, series=True, conn=c)
+
+    def restrict_many(self, user_ids, conn=None, spam_blocked=None, banned_until=None):
+        """Спам-блок и/или бан (banned_until, 0 — снять) для пачки пользователей:
+        по UPDATE на поле. Возвращает строки (id, username) тех, к кому применено."""
+        with transaction(conn) as c:
+            targets = self.RESTRICTABLE.all_in(c, user_ids)
+            ids = [t['id'] for t in targets]
+            if ids and spam_blocked is not None:
+                changed = sum(1 for t in targets if bool(t['spam_blocked']) != bool(spam_blocked))
+                self.SET_SPAM_BLOCKED.run_in(c, ids, (int(spam_blocked),))
+                counters.add('spam_blocked', changed if spam_blocked else -changed, conn=c)
+            if ids and banned_until is not None:
+                self.SET_BANNED_UNTIL.run_in(c, ids, (banned_until,))
+            if ids and (spam_blocked is not None or banned_until is not None):
+                self._notify(ids)
+            return [{'id': t['id'], 'username': t['username']} for t in targets]
+
+    def delete(self, user_id, conn=None):
+        with transaction(conn) as c:
+            old = self.COUNTED.one(c, (user_id,))
+            self.DELETE.run(c, (user_id,))
+            self._notify([user_id])
+            if old:
+                counters.add('users', -1, conn=c)
+                counters.add_user(old, -1, conn=c)
+
+    def search(self, query, conn=None):
+        with transaction(conn) as c:
+            return self.SEARCH.all(c, (f'%{query}%', f'%{query}%'))
+
+    def search_moderation(self, query, conn=None):
+        with transaction(conn) as c:
+            return self.SEARCH_MODERATION.all(c, (f'%{query}%', f'%{query}%'))
+
+    def page(self, sort='new', cursor=None, limit=50, role=None, premium=None, spam_blocked=None,
+             early_access=None, prefix=None, conn=None):
+        """Страница списка админки: (строки, next_cursor). role — admin | moderator | regular."""
+        if role is not None and role not in self.ROLES:
+            raise ValueError(f'Неизвестная роль: {role}')
+        filters = {'premium': premium, 'spam_blocked': spam_blocked, 'early_access': early_access,
+                   'prefix': prefix_range(prefix) if prefix else None}
+        if role:
+            filters[role] = ()
+        with transaction(conn) as c:
+            return self.LIST.page(c, filters, sort, cursor, limit)
+
+    def chat_partner(self, chat_id, user_id, conn=None):
+        """Собеседник user_id в личном чате"""
+        with transaction(conn) as c:
+            return self.CHAT_PARTNER.one(c, (chat_id, user_id))
+
+
+# ============= ЧАТЫ =============
+
+class ChatRepository:
+    GET = Query('chats.get', 'SELECT * FROM chats WHERE id = ?')
+    CREATE_CHANNEL = Query('chats.create_channel', '''INSERT INTO chats (name, is_channel, description, creator_id, subscribers_count)
+                                                      VALUES (?, 1, ?, ?, 1)''', writes=('chats',))
+    CREATE_GROUP = Query('chats.create_group', '''INSERT INTO chats (name, is_group, description, creator_id)
+                                                  VALUES (?, 1, ?, ?)''', writes=('chats',))
+    CREATE_PRIVATE = Query('chats.create_private', 'INSERT INTO chats (is_group, creator_id) VALUES (0, ?)',
+                           writes=('chats',))
+    DELETE = Query('chats.delete', 'DELETE FROM chats WHERE id = ?', writes=('chats',))
+    ADD_MEMBER = Query('chats.add_member', 'INSERT INTO chat_members (chat_id, user_id) VALUES (?, ?)',
+                       writes=('chat_members',))
+    REMOVE_MEMBER = Query('chats.remove_member', 'DELETE FROM chat_members WHERE chat_id = ? AND user_id = ?',
+                          writes=('chat_members',))
+    DELETE_MEMBERS = Query('chats.delete_members', 'DELETE FROM chat_members WHERE chat_id = ?',
+                           writes=('chat_members',))
+    IS_MEMBER = Query('chats.is_member', 'SELECT 1 FROM chat_members WHERE chat_id = ? AND user_id = ? LIMIT 1')
+    MEMBER_CHAT_IDS = Query('chats.member_chat_ids', 'SELECT chat_id FROM chat_members WHERE user_id = ?')
+    ADD_SUBSCRIBERS = Query('chats.add_subscribers', 'UPDATE chats SET subscribers_count = subscribers_count + ? WHERE id = ?',
+                            writes=('chats',))
+    FIND_PRIVATE = Query('chats.find_private', '''SELECT c.id FROM chats c
+                                                  JOIN chat_members cm1 ON c.id = cm1.chat_id
+                                                  JOIN chat_members cm2 ON c.id = cm2.chat_id
+                                                  WHERE c.is_group = 0
+                                                  AND COALESCE(c.is_channel, 0) = 0
+                                                  AND cm1.user_id = ? AND cm2.user_id = ?
+                                                  LIMIT 1''')
+    FOR_USER = Query('chats.for_user', '''SELECT DISTINCT c.id, c.name, c.is_group, c.is_channel, c.description,
+                                                 c.avatar, c.creator_id, c.subscribers_count
+                                          FROM chats c
+                                          JOIN chat_members cm ON c.id = cm.chat_id
+                                          WHERE cm.user_id = ?
+                                          ORDER BY c.id DESC''')
+    PRIVATE_FOR_USER = Query('chats.private_for_user', '''SELECT c.id
+                                                          FROM chats c
+                                                          JOIN chat_members cm ON c.id = cm.chat_id
+                                                          WHERE c.is_group = 0 AND COALESCE(c.is_channel, 0) = 0
+                                                          AND cm.user_id = ?''')
+    CHANNEL_BY_NAME = Query('chats.channel_by_name', 'SELECT id FROM chats WHERE is_channel = 1 AND name = ?',
+                            reads=('chats',), cache_ttl=60)
+    SEARCH_CHANNELS = Query('chats.search_channels', '''SELECT c.id, c.name, c.description, c.subscribers_count, c.avatar,
+                                                               u.nickname as creator_name
+                                                        FROM chats c
+                                                        LEFT JOIN users u ON c.creator_id = u.id
+                                                        WHERE c.is_channel = 1
+                                                        AND (c.name LIKE ? OR c.description LIKE ?)
+                                                        ORDER BY c.subscribers_count DESC
+                                                        LIMIT 20''')
+    LIST_CHANNELS = KeysetList('chats.list_channels', '''SELECT c.*, u.username as creator_username
+                                                         FROM chats c
+                                                         LEFT JOIN users u ON c.creator_id = u.id''',
+                               where=('c.is_channel = 1',),
+                               sorts={'new': ('DESC', (('c.id', 'id'),)),
+                                      'old': ('ASC', (('c.id', 'id'),)),
+                                      'name': ('ASC', (('c.name', 'name'), ('c.id', 'id'))),
+                                      'subscribers': ('DESC', (('c.subscribers_count', 'subscribers_count'),
+                                                               ('c.id', 'id')))},
+                               filters={'prefix': 'c.name >= ? AND c.name < ?'})
+    # Участников считаем только для строк страницы (idx_chat_members_chat), а не GROUP BY по всем группам
+    LIST_GROUPS = KeysetList('chats.list_groups', '''SELECT c.*, u.username as creator_username,
+                                                            (SELECT COUNT(*) FROM chat_members cm
+                                                             WHERE cm.chat_id = c.id) as members_count
+                                                     FROM chats c
+                                                     LEFT JOIN users u ON c.creator_id = u.id''',
+                             where=('c.is_group = 1', 'c.is_channel = 0'),
+                             sorts={'new': ('DESC', (('c.id', 'id'),)),
+                                    'old': ('ASC', (('c.id', 'id'),)),
+                                    'name': ('ASC', (('c.name', 'name'), ('c.id', 'id')))},
+                             filters={'prefix': 'c.name >= ? AND c.name < ?'})
+
+    def get(self, chat_id, conn=None):
+        with transaction(conn) as c:
+            return self.GET.one(c, (chat_id,))
+
+    def create_channel(self, name, description, creator_id, conn=None):
+        """Канал; создатель сразу первый подписчик"""
+        with transaction(conn) as c:
+            chat_id = self.CREATE_CHANNEL.insert(c, (name, description, creator_id))
+            self.ADD_MEMBER.run(c, (chat_id, creator_id))
+            counters.add_chat({'is_channel': 1}, conn=c)
+            return chat_id
+
+    def create_group(self, name, description, creator_id, member_ids=(), conn=None):
+        with transaction(conn) as c:
+            chat_id = self.CREATE_GROUP.insert(c, (name, description, creator_id))
+            self.add_members(chat_id, [creator_id, *member_ids], conn=c)
+            counters.add_chat({'is_group': 1}, conn=c)
+            return chat_id
+
+    def create_private(self, user_id, other_user_id, creator_id=None, conn=None):
+        with transaction(conn) as c:
+            chat_id = self.CREATE_PRIVATE.insert(c, (creator_id,))
+            self.add_members(chat_id, [user_id, other_user_id], conn=c)
+            counters.add_chat({}, conn=c)
+            return chat_id
+
+    def add_members(self, chat_id, user_ids, conn=None):
+        with transaction(conn) as c:
+            self.ADD_MEMBER.many(c, [(chat_id, uid) for uid in user_ids])
+
+    def delete(self, chat_id, conn=None):
+        """Чат и его участники (сообщения удаляет messages.delete_for_chat)"""
+        with transaction(conn) as c:
+            old = self.GET.one(c, (chat_id,))
+            self.DELETE_MEMBERS.run(c, (chat_id,))
+            self.DELETE.run(c, (chat_id,))
+            if old:
+                counters.add_chat(old, -1, conn=c)
+
+    def is_member(self, chat_id, user_id, conn=None):
+        with transaction(conn) as c:
+            return bool(self.IS_MEMBER.scalar(c, (chat_id, user_id)))
+
+    def member_chat_ids(self, user_id, conn=None):
+        with transaction(conn) as c:
+            return {r['chat_id'] for r in self.MEMBER_CHAT_IDS.all(c, (user_id,))}
+
+    def subscribe(self, chat_id, user_id, conn=None):
+        with transaction(conn) as c:
+            self.ADD_MEMBER.run(c, (chat_id, user_id))
+            self.ADD_SUBSCRIBERS.run(c, (1, chat_id))
+
+    def unsubscribe(self, chat_id, user_id, conn=None):
+        with transaction(conn) as c:
+            self.REMOVE_MEMBER.run(c, (chat_id, user_id))
+            self.ADD_SUBSCRIBERS.run(c, (-1, chat_id))
+
+    def find_private(self, user_id, other_user_id, conn=None):
+        """id личного чата двух пользователей или None"""
+        with transaction(conn) as c:
+            return self.FIND_PRIVATE.scalar(c, (user_id, other_user_id))
+
+    def for_user(self, user_id, conn=None):
+        with transaction(conn) as c:
+            return self.FOR_USER.all(c, (user_id,))
+
+    def private_for_user(self, user_id, conn=None):
+        with transaction(conn) as c:
+            return [r['id'] for r in self.PRIVATE_FOR_USER.all(c, (user_id,))]
+
+    def channel_by_name(self, name, conn=None):
+        with transaction(conn) as c:
+            return self.CHANNEL_BY_NAME.scalar(c, (name,))
+
+    def search_channels(self, query, conn=None):
+        with transaction(conn) as c:
+            return self.SEARCH_CHANNELS.all(c, (f'%{query}%', f'%{query}%'))
+
+    def page_channels(self, sort='new', cursor=None, limit=50, prefix=None, conn=None):
+        with transaction(conn) as c:
+            return self.LIST_CHANNELS.page(c, {'prefix': prefix_range(prefix) if prefix else None},
+                                           sort, cursor, limit)
+
+    def page_groups(self, sort='new', cursor=None, limit=50, prefix=None, conn=None):
+        with transaction(conn) as c:
+            return self.LIST_GROUPS.page(c, {'prefix': prefix_range(prefix) if prefix else None},
+                                         sort, cursor, limit)
+
+
+# ============= СООБЩЕНИЯ И РЕАКЦИИ (ШАРДЫ) =============
+
+_MESSAGE_WITH_SENDER = '''SELECT m.*, u.nickname, u.username, u.avatar, u.is_premium
+                          FROM messages m
+                          JOIN users u ON m.user_id = u.id'''
+
+
+class MessageRepository:
+    INSERT = Query('messages.insert', '''INSERT INTO messages (chat_id, user_id, content, message_type, file_url)
+                                         VALUES (?, ?, ?, ?, ?)''')
+    # id уникален между шардами: больше всех когда-либо выданных id шарда и id до шардирования,
+    # id % N == шард. Последний выданный id хранит message_seq шарда (не MAX(id): удалённые
+    # сообщения не должны отдавать свои id заново). Двигаем его первым UPDATE транзакции —
+    # под блокировкой записи только этого шарда — и вставляем сообщение с этим id.
+    NEXT_SHARDED_ID = Query('messages.next_sharded_id', '''UPDATE message_seq
+                                                            SET last_id = MAX(last_id, ?) + 1
+                                                                + (((? - MAX(last_id, ?) - 1) % ?) + ?) % ?
+                                                            WHERE id = 1''')
+    INSERT_SHARDED = Query('messages.insert_sharded', '''INSERT INTO messages (id, chat_id, user_id, content, message_type, file_url)
+                                                         SELECT last_id, ?, ?, ?, ?, ? FROM message_seq WHERE id = 1''')
+    WITH_SENDER = Query('messages.with_sender', _MESSAGE_WITH_SENDER + ' WHERE m.id = ?')
+    GET = Query('messages.get', 'SELECT * FROM messages WHERE id = ?')
+    SOFT_DELETE = Query('messages.soft_delete', '''UPDATE messages
+                                                   SET is_deleted = 1, deleted_at = CURRENT_TIMESTAMP, deleted_by = ?
+                                                   WHERE id = ?''')
+    GET_MANY = Query('messages.get_many', 'SELECT id, chat_id, user_id, is_deleted FROM messages WHERE id IN ({ids})')
+    SOFT_DELETE_MANY = Query('messages.soft_delete_many', '''UPDATE messages
+                                                             SET is_deleted = 1, deleted_at = CURRENT_TIMESTAMP,
+                                                                 deleted_by = ?
+                                                             WHERE is_deleted = 0 AND id IN ({ids})''')
+    HAS_POSTED = Query('messages.has_posted', 'SELECT 1 FROM messages WHERE chat_id = ? AND user_id = ? LIMIT 1')
+    DELETE_FOR_CHAT = Query('messages.delete_for_chat', 'DELETE FROM messages WHERE chat_id = ?')
+    LAST_IN_CHATS = Query('messages.last_in_chats', '''SELECT m.*, u.nickname, u.username
+                                                       FROM messages m
+                                                       JOIN users u ON m.user_id = u.id
+                                                       WHERE m.id IN (
+                                                           SELECT MAX(id) FROM messages
+                                                           WHERE chat_id IN ({ids})
+                                                           GROUP BY chat_id
+                                                       )''')
+    UNREAD_IN_CHATS = Query('messages.unread_in_chats', '''SELECT chat_id, COUNT(*) AS unread FROM messages
+                                                           WHERE chat_id IN ({ids}) AND user_id != ? AND is_read = 0
+                                                           GROUP BY chat_id''')
+    PAGE = Query('messages.page', _MESSAGE_WITH_SENDER + '''
+                                  WHERE m.chat_id = ? AND m.id < ?
+                                  ORDER BY m.id DESC
+                                  LIMIT ?''')
+    HISTORY = Query('messages.history', _MESSAGE_WITH_SENDER + '''
+                                        WHERE m.chat_id = ?
+                                        ORDER BY m.created_at ASC''')
+    # Прочтение меняет is_read — сообщения попадают в журнал, иначе кэш других клиентов его не увидит
+    CHANGE_UNREAD = Query('messages.change_unread', '''INSERT INTO message_changes (chat_id, message_id)
+                                                      SELECT chat_id, id FROM messages
+                                                      WHERE chat_id = ? AND user_id != ? AND is_read = 0''')
+    MARK_READ = Query('messages.mark_read', '''UPDATE messages SET is_read = 1
+                                               WHERE chat_id = ? AND user_id != ? AND is_read = 0''')
+    RECENT = Query('messages.recent', '''SELECT m.id, m.chat_id, m.user_id, m.content, m.message_type, m.file_url,
+                                                m.is_deleted, m.deleted_at, m.deleted_by, m.created_at,
+                                                u.username, u.nickname
+                                         FROM messages m
+                                         JOIN users u ON u.id = m.user_id
+                                         ORDER BY m.created_at DESC
+                                         LIMIT ?''')
+    # Журнал изменений чата: id записи — версия чата для условной загрузки истории
+    CHANGE = Query('messages.change', 'INSERT INTO message_changes (chat_id, message_id) VALUES (?, ?)')
+    VERSION = Query('messages.version', 'SELECT IFNULL(MAX(id), 0) FROM message_changes WHERE chat_id = ?')
+    FIRST_CHANGE = Query('messages.first_change', 'SELECT MIN(id) FROM message_changes WHERE chat_id = ?')
+    CHANGED_SINCE = Query('messages.changed_since', '''SELECT DISTINCT message_id FROM message_changes
+                                                       WHERE chat_id = ? AND id > ?
+                                                       LIMIT ?''')
+    WITH_SENDER_IN = Query('messages.with_sender_in', _MESSAGE_WITH_SENDER + ' WHERE m.id IN ({ids})')
+    DELETE_CHANGES_FOR_CHAT = Query('messages.delete_changes_for_chat', 'DELETE FROM message_changes WHERE chat_id = ?')
+    WITH_SENDERS = Query('messages.with_senders', '''SELECT m.id, m.content, m.message_type, m.is_deleted, m.user_id,
+                                                            u.username AS sender_username
+                                                     FROM messages m
+                                                     JOIN users u ON u.id = m.user_id
+                                                     WHERE m.id IN ({ids})''')
+
+    def insert(self, chat_id, user_id, content, message_type='text', file_url=None):
+        """Сохранить сообщение; вернуть его вместе с профилем отправителя (формат new_message)"""
+        with _shard(chat_id) as conn:
+            n = _message_shards
+            if n > 1:
+                self.NEXT_SHARDED_ID.run(conn, (_shard_id_floor, shard_for_chat(chat_id), _shard_id_floor, n, n, n))
+                msg_id = self.INSERT_SHARDED.insert(conn, (chat_id, user_id, content, message_type, file_url))
+            else:
+                msg_id = self.INSERT.insert(conn, (chat_id, user_id, content, message_type, file_url))
+            self.CHANGE.run(conn, (chat_id, msg_id))
+            conn.commit()
+            counters.add('messages', 1, series=True)
+            counters.seen('active_chats', chat_id)
+            counters.seen('active_users', user_id)
+            msg = self.WITH_SENDER.one(conn, (msg_id,))
+        support.on_message(msg)
+        return msg
+
+    def get(self, message_id, chat_id=None):
+        """Строка сообщения (без профиля отправителя) или None"""
+        if chat_id is not None:
+            shards = [shard_for_chat(chat_id)]
+        else:
+            shards = shards_for_message(message_id)
+        for index in shards:
+            with _shard(index=index) as conn:
+                row = self.GET.one(conn, (message_id,))
+            if row:
+                return row
+        return None
+
+    def soft_delete(self, message_id, chat_id, deleted_by):
+        with _shard(chat_id) as conn:
+            self.SOFT_DELETE.run(conn, (deleted_by, message_id))
+            self.CHANGE.run(conn, (chat_id, message_id))
+
+    def _by_shard(self, message_ids):
+        by_shard = defaultdict(list)
+        for message_id in message_ids:
+            for index in shards_for_message(message_id):
+                by_shard[index].append(message_id)
+        return by_shard
+
+    def get_many(self, message_ids):
+        """{id: (id, chat_id, user_id, is_deleted)} — один запрос на шард"""
+        result = {}
+        for index, ids in self._by_shard(message_ids).items():
+            with _shard(index=index) as conn:
+                for row in self.GET_MANY.all_in(conn, ids):
+                    result[row['id']] = row
+        return result
+
+    def soft_delete_many(self, message_ids, deleted_by):
+        """Мягко удалить пачку сообщений: одна транзакция на шард.
+        Возвращает строки (id, chat_id, user_id) тех, что удалены сейчас, а не раньше."""
+        deleted = []
+        for index, ids in self._by_shard(message_ids).items():
+            with _shard(index=index) as conn:
+                rows = [r for r in self.GET_MANY.all_in(conn, ids) if not r['is_deleted']]
+                if rows:
+                    self.SOFT_DELETE_MANY.run_in(conn, [r['id'] for r in rows], (deleted_by,))
+                    self.CHANGE.many(conn, [(r['chat_id'], r['id']) for r in rows])
+                deleted.extend(rows)
+        return deleted
+
+    def user_has_posted(self, chat_id, user_id):
+        with _shard(chat_id) as conn:
+            return bool(self.HAS_POSTED.scalar(conn, (chat_id, user_id)))
+
+    def delete_for_chat(self, chat_id):
+        """Все сообщения чата вместе с реакциями"""
+        with _shard(chat_id) as conn:
+            reactions.DELETE_FOR_CHAT.run(conn, (chat_id,))
+            self.DELETE_FOR_CHAT.run(conn, (chat_id,))
+            self.DELETE_CHANGES_FOR_CHAT.run(conn, (chat_id,))
+
+    def previews(self, chat_ids, user_id=None):
+        """{chat_id: (последнее сообщение, непрочитанные для user_id)} — два запроса на шард"""
+        by_shard = defaultdict(list)
+        for chat_id in chat_ids:
+            by_shard[shard_for_chat(chat_id)].append(chat_id)
+
+        result = {chat_id: (None, 0) for chat_id in chat_ids}
+        for index, ids in by_shard.items():
+            with _shard(index=index) as conn:
+                last = {r['chat_id']: r for r in self.LAST_IN_CHATS.all_in(conn, ids)}
+                unread = {}
+                if user_id is not None:
+                    unread = {r['chat_id']: r['unread'] for r in self.UNREAD_IN_CHATS.all_in(conn, ids, (user_id,))}
+            for chat_id in ids:
+                result[chat_id] = (last.get(chat_id), unread.get(chat_id, 0))
+        return result
+
+    def page(self, chat_id, limit, before_id=None, conn=None):
+        """Страница от новых к старым (строго до before_id)"""
+        if conn is not None:
+            return self.PAGE.all(conn, (chat_id, before_id or 2 ** 62, limit))
+        with _shard(chat_id) as c:
+            return self.PAGE.all(c, (chat_id, before_id or 2 ** 62, limit))
+
+    def history(self, chat_id, conn=None):
+        """Вся горячая история чата по возрастанию"""
+        if conn is not None:
+            return self.HISTORY.all(conn, (chat_id,))
+        with _shard(chat_id) as c:
+            return self.HISTORY.all(c, (chat_id,))
+
+    def version(self, chat_id, conn=None):
+        """Версия истории чата: id последней записи журнала (новое, удалённое, прочитанное сообщение,
+        реакция); 0 — пусто"""
+        if conn is not None:
+            return self.VERSION.scalar(conn, (chat_id,)) or 0
+        with _shard(chat_id) as c:
+            return self.VERSION.scalar(c, (chat_id,)) or 0
+
+    def changed_since(self, chat_id, since, limit, conn):
+        """Сообщения (с профилем отправителя), изменённые после версии since.
+        None — дельту не собрать: журнал до since уже очищен, изменений больше limit
+        или сообщение успело уйти в архив."""
+        first = self.FIRST_CHANGE.scalar(conn, (chat_id,))
+        if not since or first is None or since < first:
+            return None
+        ids = [r['message_id'] for r in self.CHANGED_SINCE.all(conn, (chat_id, since, limit + 1))]
+        if len(ids) > limit:
+            return None
+        rows = self.WITH_SENDER_IN.all_in(conn, ids)
+        if len(rows) != len(ids):
+            return None
+        rows.sort(key=lambda m: m['id'])
+        return rows
+
+    def touch(self, chat_id, message_id):
+        """Отметить сообщение изменённым (попадёт в дельту ?since=) без изменения строки"""
+        with _shard(chat_id) as conn:
+            self.CHANGE.run(conn, (chat_id, message_id))
+
+    def mark_read(self, chat_id, reader_id, conn=None):
+        if conn is not None:
+            self.CHANGE_UNREAD.run(conn, (chat_id, reader_id))
+            return self.MARK_READ.run(conn, (chat_id, reader_id)).rowcount
+        with _shard(chat_id) as c:
+            self.CHANGE_UNREAD.run(c, (chat_id, reader_id))
+            return self.MARK_READ.run(c, (chat_id, reader_id)).rowcount
+
+    def recent(self, limit):
+        """Последние сообщения по всем шардам с автором (для админки)"""
+        rows = []
+        for index in range(_message_shards):
+            with _shard(index=index) as conn:
+                rows.extend(self.RECENT.all(conn, (limit,)))
+        rows.sort(key=lambda m: (m['created_at'] or '', m['id']), reverse=True)
+        return rows[:limit]
+
+    def with_senders(self, refs):
+        """{message_id: сообщение + sender_username} для списка пар (chat_id, message_id)"""
+        by_shard = defaultdict(set)
+        for chat_id, message_id in refs:
+            by_shard[shard_for_chat(chat_id)].add(message_id)
+
+        result = {}
+        for index, ids in by_shard.items():
+            with _shard(index=index) as conn:
+                for r in self.WITH_SENDERS.all_in(conn, ids):
+                    result[r['id']] = r
+        return result
+
+
+class ReactionRepository:
+    FIND = Query('reactions.find', 'SELECT id FROM reactions WHERE message_id = ? AND user_id = ? AND emoji = ?')
+    ADD = Query('reactions.add', 'INSERT INTO reactions (message_id, user_id, emoji) VALUES (?, ?, ?)')
+    REMOVE = Query('reactions.remove', 'DELETE FROM reactions WHERE id = ?')
+    FOR_MESSAGES = Query('reactions.for_messages', '''SELECT r.message_id, r.emoji, u.username
+                                                      FROM reactions r
+                                                      JOIN users u ON r.user_id = u.id
+                                                      WHERE r.message_id IN ({ids})
+                                                      ORDER BY r.id''')
+    DELETE_FOR_CHAT = Query('reactions.delete_for_chat', '''DELETE FROM reactions
+                                                            WHERE message_id IN (SELECT id FROM messages WHERE chat_id = ?)''')
+
+    def toggle(self, chat_id, message_id, user_id, emoji):
+        """Поставить или снять реакцию; вернуть актуальный список реакций сообщения"""
+        with _shard(chat_id) as conn:
+            existing = self.FIND.scalar(conn, (message_id, user_id, emoji))
+            if existing:
+                self.REMOVE.run(conn, (existing,))
+            else:
+                self.ADD.run(conn, (message_id, user_id, emoji))
+            messages.CHANGE.run(conn, (chat_id, message_id))
+            conn.commit()
+            return self.for_messages(chat_id, [message_id], conn=conn).get(message_id, [])
+
+    def for_messages(self, chat_id, message_ids, conn=None):
+        """{message_id: [{emoji, username}]} одним запросом на пачку сообщений"""
+        result = defaultdict(list)
+        if not message_ids:
+            return result
+        if conn is None:
+            with _shard(chat_id) as c:
+                return self.for_messages(chat_id, message_ids, conn=c)
+        for r in self.FOR_MESSAGES.all_in(conn, message_ids):
+            result[r['message_id']].append({'emoji': r['emoji'], 'username': r['username']})
+        return result
+
+
+# ============= ЖАЛОБЫ =============
+
+class ReportRepository:
+    """Жалобы и очередь модерации.
+
+    reports — каждая жалоба; report_queue — одна строка на сообщение: сколько
+    на него открытых жалоб и какая последняя. Очередь листается по report_queue,
+    так что сообщение с сотней жалоб занимает в ней одну строку, а закрывается
+    сразу со всеми жалобами.
+    """
+    FIND_OPEN = Query('reports.find_open', '''SELECT id FROM reports
+                                              WHERE message_id = ? AND reporter_id = ? AND status = 'open'
+                                              LIMIT 1''')
+    CREATE = Query('reports.create', '''INSERT INTO reports (message_id, chat_id, reporter_id, reason)
+                                        VALUES (?, ?, ?, ?)''', writes=('reports',))
+    GET = Query('reports.get', 'SELECT id, message_id, chat_id, status FROM reports WHERE id = ?')
+    # Повторная жалоба на закрытое сообщение открывает его заново со счётчиком 1
+    ENQUEUE = Query('reports.enqueue', '''INSERT INTO report_queue (message_id, chat_id, status, reports_count,
+                                                                  first_report_id, last_report_id,
+                                                                  last_reporter_id, last_reason, last_report_at)
+                                          VALUES (?, ?, 'open', 1, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                                          ON CONFLICT (message_id) DO UPDATE SET
+                                              reports_count = CASE WHEN report_queue.status = 'open'
+                                                                   THEN report_queue.reports_count + 1 ELSE 1 END,
+                                              first_report_id = CASE WHEN report_queue.status = 'open'
+                                                                     THEN report_queue.first_report_id
+                                                                     ELSE excluded.first_report_id END,
+                                              status = 'open',
+                                              last_report_id = excluded.last_report_id,
+                                              last_reporter_id = excluded.last_reporter_id,
+                                              last_reason = excluded.last_reason,
+                                              last_report_at = excluded.last_report_at''', writes=('report_queue',))
+    QUEUE = KeysetList('reports.queue', '''SELECT q.last_report_id AS id, q.message_id, q.chat_id, q.status,
+                                                 q.reports_count, q.first_report_id, q.last_report_id,
+                                                 q.last_reason AS reason, q.last_report_at AS created_at,
+                                                 u.username AS reporter_username
+                                          FROM report_queue q
+                                          LEFT JOIN users u ON u.id = q.last_reporter_id''',
+                       # new — по последней жалобе (сообщение с новой жалобой всплывает наверх),
+                       # old — по первой, это стабильный порядок «кто дольше ждёт»
+                       sorts={'new': ('DESC', (('q.last_report_id', 'last_report_id'),)),
+                              'old': ('ASC', (('q.first_report_id', 'first_report_id'),)),
+                              'count': ('DESC', (('q.reports_count', 'reports_count'),
+                                                 ('q.last_report_id', 'last_report_id')))},
+                       filters={'status': 'q.status = ?'})
+    ENTRY = Query('reports.queue_entry', QUEUE.select + ' WHERE q.message_id = ?')
+    RESOLVE = Query('reports.resolve', '''UPDATE reports
+                                          SET status = 'resolved', resolved_by = ?, resolved_action = ?,
+                                              resolved_at = CURRENT_TIMESTAMP
+                                          WHERE status = 'open' AND message_id = ?''', writes=('reports',))
+    GET_MANY = Query('reports.get_many', 'SELECT id, message_id, chat_id, status FROM reports WHERE id IN ({ids})')
+    RESOLVE_MANY = Query('reports.resolve_many', '''UPDATE reports
+                                                    SET status = 'resolved', resolved_by = ?, resolved_action = ?,
+                                                        resolved_at = CURRENT_TIMESTAMP
+                                                    WHERE status = 'open' AND message_id IN ({ids})''',
+                         writes=('reports',))
+    DEQUEUE_MANY = Query('reports.dequeue_many', '''UPDATE report_queue SET status = 'resolved'
+                                                    WHERE status = 'open' AND message_id IN ({ids})''',
+                         writes=('report_queue',))
+    DEQUEUE = Query('reports.dequeue', '''UPDATE report_queue SET status = 'resolved'
+                                          WHERE status = 'open' AND message_id = ?''', writes=('report_queue',))
+    QUEUE_EMPTY = Query('reports.queue_empty', '''SELECT NOT EXISTS (SELECT 1 FROM report_queue)
+                                                     AND EXISTS (SELECT 1 FROM reports)''')
+    # Заполнение очереди по уже записанным жалобам: открытые группы, потом закрытые
+    FILL = Query('reports.fill_queue', '''INSERT INTO report_queue (message_id, chat_id, status, reports_count,
+                                                                   first_report_id, last_report_id)
+                                          SELECT message_id, MAX(chat_id), status, COUNT(*), MIN(id), MAX(id)
+                                          FROM reports
+                                          WHERE status = ?
+                                          AND message_id NOT IN (SELECT message_id FROM report_queue)
+                                          GROUP BY message_id, status''', writes=('report_queue',))
+    FILL_LAST = Query('reports.fill_queue_last', '''UPDATE report_queue SET
+                                                        last_reporter_id = (SELECT reporter_id FROM reports r
+                                                                            WHERE r.id = report_queue.last_report_id),
+                                                        last_reason = (SELECT reason FROM reports r
+                                                                       WHERE r.id = report_queue.last_report_id),
+                                                        last_report_at = (SELECT created_at FROM reports r
+                                                                          WHERE r.id = report_queue.last_report_id)
+                                                    WHERE last_report_at IS NULL''', writes=('report_queue',))
+
+    def find_open(self, message_id, reporter_id, conn=None):
+        with transaction(conn) as c:
+            return self.FIND_OPEN.scalar(c, (message_id, reporter_id))
+
+    def create(self, message_id, chat_id, reporter_id, reason, conn=None):
+        """Записать жалобу и поднять сообщение в очереди; вернуть (id жалобы, строка очереди)"""
+        with transaction(conn) as c:
+            report_id = self.CREATE.insert(c, (message_id, chat_id, reporter_id, reason))
+            self.ENQUEUE.run(c, (message_id, chat_id, report_id, report_id, reporter_id, reason))
+            entry = self.ENTRY.one(c, (message_id,))
+            counters.add('reports', 1, series=True, conn=c)
+            counters.add('reports_open', 1, conn=c)
+            if entry['reports_count'] == 1:
+                counters.add('reported_messages', 1, conn=c)
+            return report_id, entry
+
+    def get(self, report_id, conn=None):
+        with transaction(conn) as c:
+            return self.GET.one(c, (report_id,))
+
+    def queue(self, status='open', sort='new', cursor=None, limit=50, conn=None):
+        """Страница очереди: одна строка на сообщение, id — последняя жалоба на него"""
+        with transaction(conn) as c:
+            return self.QUEUE.page(c, {'status': status}, sort, cursor, limit)
+
+    def resolve(self, message_id, actor_id, action, conn=None):
+        """Закрыть все открытые жалобы на сообщение; вернуть, сколько закрыто"""
+        with transaction(conn) as c:
+            closed = max(self.RESOLVE.run(c, (actor_id, action, message_id)).rowcount, 0)
+            if closed:
+                counters.add('reports_open', -closed, conn=c)
+                counters.add('reports_resolved', closed, conn=c)
+            if self.DEQUEUE.run(c, (message_id,)).rowcount:
+                counters.add('reported_messages', -1, conn=c)
+            return closed
+
+    def open_messages(self, report_ids, conn=None):
+        """{message_id: chat_id} сообщений, на которые среди report_ids есть открытые жалобы"""
+        with transaction(conn) as c:
+            return {r['message_id']: r['chat_id'] for r in self.GET_MANY.all_in(c, report_ids)
+                    if r['status'] == 'open'}
+
+    def resolve_many(self, report_ids, actor_id, action, conn=None):
+        """Закрыть жалобы пачкой (вместе с остальными открытыми на те же сообщения).
+        Возвращает (число закрытых жалоб, {message_id: chat_id} затронутых сообщений)."""
+        with transaction(conn) as c:
+            targets = self.open_messages(report_ids, conn=c)
+            if not targets:
+                return 0, {}
+            closed = self.RESOLVE_MANY.run_in(c, list(targets), (actor_id, action))
+            if closed:
+                counters.add('reports_open', -closed, conn=c)
+                counters.add('reports_resolved', closed, conn=c)
+            counters.add('reported_messages', -self.DEQUEUE_MANY.run_in(c, list(targets)), conn=c)
+            return closed, targets
+
+    def ensure_queue(self):
+        """Разложить по очереди жалобы, записанные до её появления (один раз)"""
+        with transaction() as c:
+            if not self.QUEUE_EMPTY.scalar(c):
+                return 0
+            filled = sum(max(self.FILL.run(c, (status,)).rowcount, 0) for status in ('open', 'resolved'))
+            self.FILL_LAST.run(c)
+            return filled
+
+
+# ============= ПОДДЕРЖКА =============
+
+class SupportRepository:
+    """Диалоги пользователей с @support.
+
+    support_conversations — сводка по диалогу, которую обновляет запись сообщения
+    (messages.insert): последнее сообщение, время активности, сколько сообщений
+    пользователя ждут ответа и кому из модераторов диалог назначен. Входящие
+    поддержки — одна выборка по индексу вместо обхода всех чатов @support.
+    """
+    USERNAME = 'support'
+
+    OPEN = Query('support.open', '''INSERT OR IGNORE INTO support_conversations (chat_id, user_id)
+                                    VALUES (?, ?)''', writes=('support_conversations',))
+    # Сообщение в чат, которого нет в support_conversations, — обычный личный чат
+    IS_CONVERSATION = Query('support.is_conversation', 'SELECT 1 FROM support_conversations WHERE chat_id = ?',
+                            reads=('support_conversations',), cache_ttl=60)
+    # Ответ поддержки обнуляет ожидание, сообщение пользователя — прибавляет
+    TOUCH = Query('support.touch', '''UPDATE support_conversations
+                                     SET last_message_id = ?, last_message_content = ?, last_message_type = ?,
+                                         last_sender_id = ?, last_activity_at = ?,
+                                         unread_count = CASE WHEN ? = 1 THEN 0 ELSE unread_count + 1 END
+                                     WHERE chat_id = ?''')
+    MARK_READ = Query('support.mark_read', 'UPDATE support_conversations SET unread_count = 0 WHERE chat_id = ?')
+    ASSIGN = Query('support.assign', 'UPDATE support_conversations SET assigned_to = ? WHERE chat_id = ?')
+    INBOX = KeysetList('support.inbox', '''SELECT s.id, s.chat_id, s.user_id, s.unread_count, s.assigned_to,
+                                                 s.last_message_id, s.last_message_content, s.last_message_type,
+                                                 s.last_sender_id, s.last_activity_at,
+                                                 u.username, u.nickname, u.avatar,
+                                                 a.username AS assigned_username
+                                          FROM support_conversations s
+                                          LEFT JOIN users u ON u.id = s.user_id
+                                          LEFT JOIN users a ON a.id = s.assigned_to''',
+                       sorts={'recent': ('DESC', (('s.last_activity_at', 'last_activity_at'), ('s.id', 'id'))),
+                              'old': ('ASC', (('s.last_activity_at', 'last_activity_at'), ('s.id', 'id')))},
+                       filters={'assigned_to': 's.assigned_to = ?',
+                                'unassigned': 's.assigned_to IS NULL',
+                                'unread': 's.unread_count > 0'})
+    EMPTY = Query('support.empty', 'SELECT NOT EXISTS (SELECT 1 FROM support_conversations)')
+    FILL = Query('support.fill', '''INSERT OR IGNORE INTO support_conversations
+                                        (chat_id, user_id, last_message_id, last_message_content, last_message_type,
+                                         last_sender_id, last_activity_at, unread_count)
+                                    VALUES (?, ?, ?, ?, ?, ?, IFNULL(?, CURRENT_TIMESTAMP), ?)''',
+                 writes=('support_conversations',))
+
+    def __init__(self):
+        self._user_id = None
+
+    def user_id(self):
+        """id пользователя @support: ищется один раз на процесс; None, если его нет"""
+        if self._user_id is None:
+            row = users.get_by_username(self.USERNAME)
+            self._user_id = row['id'] if row else None
+        return self._user_id
+
+    def open(self, chat_id, user_id, conn=None):
+        with transaction(conn) as c:
+            self.OPEN.run(c, (chat_id, user_id))
+
+    def is_conversation(self, chat_id, conn=None):
+        with transaction(conn) as c:
+            return bool(self.IS_CONVERSATION.scalar(c, (chat_id,)))
+
+    def on_message(self, msg):
+        """Обновить сводку диалога после записи сообщения (вызывает messages.insert)"""
+        if not msg or not self.is_conversation(msg['chat_id']):
+            return
+        from_support = int(msg['user_id'] == self.user_id())
+        with transaction() as c:
+            self.TOUCH.run(c, (msg['id'], msg['content'], msg['message_type'], msg['user_id'],
+                               msg['created_at'], from_support, msg['chat_id']))
+
+    def mark_read(self, chat_id, conn=None):
+        with transaction(conn) as c:
+            return self.MARK_READ.run(c, (chat_id,)).rowcount > 0
+
+    def assign(self, chat_id, moderator_id, conn=None):
+        """Назначить диалог модератору (None — снять назначение)"""
+        with transaction(conn) as c:
+            return self.ASSIGN.run(c, (moderator_id, chat_id)).rowcount > 0
+
+    def inbox(self, sort='recent', cursor=None, limit=50, assigned_to=None, unassigned=False, unread=False,
+              conn=None):
+        with transaction(conn) as c:
+            return self.INBOX.page(c, {'assigned_to': assigned_to,
+                                       'unassigned': () if unassigned else None,
+                                       'unread': () if unread else None},
+                                   sort, cursor, limit)
+
+    def ensure(self):
+        """Заполнить сводки по уже существующим чатам @support (один раз).
+        Ожидающим ответа считаем диалог, где последнее слово за пользователем."""
+        support_id = self.user_id()
+        if support_id is None:
+            return 0
+        with transaction() as c:
+            if not self.EMPTY.scalar(c):
+                return 0
+            chat_ids = chats.private_for_user(support_id, conn=c)
+        previews = messages.previews(chat_ids)
+        rows = []
+        with transaction() as c:
+            for chat_id in chat_ids:
+                partner = users.chat_partner(chat_id, support_id, conn=c)
+                if not partner:
+                    continue
+                last = previews[chat_id][0]
+                if last:
+                    rows.append((chat_id, partner['id'], last['id'], last['content'], last['message_type'],
+                                 last['user_id'], last['created_at'], int(last['user_id'] != support_id)))
+                else:
+                    rows.append((chat_id, partner['id'], None, None, None, None, None, 0))
+            self.FILL.many(c, rows)
+        return len(rows)
+
+
+# ============= ГОЛОСОВЫЕ =============
+
+class VoiceRepository:
+    """Результат обработки голосовых (voice.py): сжатый файл, длительность, waveform.
+
+    Строка появляется при загрузке (pending) и находится по file_url, который
+    клиент потом присылает в send_message, — так к ней привязывается сообщение.
+    Обработка может закончиться и до, и после отправки сообщения.
+    """
+    CREATE = Query('voice.create', 'INSERT INTO voice_notes (file_url, user_id) VALUES (?, ?)')
+    GET = Query('voice.get', 'SELECT * FROM voice_notes WHERE file_url = ?')
+    # Привязать может только загрузивший, и только к одному сообщению
+    ATTACH = Query('voice.attach', '''UPDATE voice_notes SET chat_id = ?, message_id = ?
+                                      WHERE file_url = ? AND user_id = ? AND message_id IS NULL''')
+    FINISH = Query('voice.finish', '''UPDATE voice_notes
+                                      SET status = ?, url = ?, duration_ms = ?, waveform = ?,
+                                          finished_at = CURRENT_TIMESTAMP
+                                      WHERE file_url = ?''')
+    PENDING = Query('voice.pending', "SELECT file_url FROM voice_notes WHERE status = 'pending' ORDER BY id")
+    READY_IN = Query('voice.ready_in', '''SELECT file_url, url, duration_ms, waveform FROM voice_notes
+                                          WHERE status = 'ready' AND file_url IN ({ids})''')
+
+    @staticmethod
+    def info(row):
+        """Поле voice сообщения: {url, duration_ms, waveform}"""
+        return {'url': row['url'], 'duration_ms': row['duration_ms'],
+                'waveform': json.loads(row['waveform'] or '[]')}
+
+    def create(self, file_url, user_id, conn=None):
+        with transaction(conn) as c:
+            self.CREATE.run(c, (file_url, user_id))
+
+    def attach(self, file_url, user_id, chat_id, message_id, conn=None):
+        """Привязать голосовое к сообщению; строка voice_notes или None, если файл чужой или уже привязан"""
+        with transaction(conn) as c:
+            if not self.ATTACH.run(c, (chat_id, message_id, file_url, user_id)).rowcount:
+                return None
+            return self.GET.one(c, (file_url,))
+
+    def finish(self, file_url, url=None, duration_ms=None, waveform=None, failed=False, conn=None):
+        """Записать результат обработки; вернуть строку (chat_id, message_id — если сообщение уже отправлено)"""
+        with transaction(conn) as c:
+            self.FINISH.run(c, ('failed' if failed else 'ready', url, duration_ms,
+                                None if waveform is None else json.dumps(waveform), file_url))
+            return self.GET.one(c, (file_url,))
+
+    def pending(self, conn=None):
+        """file_url необработанных (после перезапуска сервера их ставят в очередь заново)"""
+        with transaction(conn) as c:
+            return [r['file_url'] for r in self.PENDING.all(c)]
+
+    def for_messages(self, messages, conn=None):
+        """Добавить поле voice готовым голосовым из списка сообщений"""
+        urls = {m['file_url'] for m in messages if m.get('message_type') == 'voice' and m.get('file_url')}
+        if not urls:
+            return messages
+        with transaction(conn) as c:
+            ready = {r['file_url']: self.info(r) for r in self.READY_IN.all_in(c, urls)}
+        for msg in messages:
+            if msg.get('file_url') in ready and msg.get('message_type') == 'voice':
+                msg['voice'] = ready[msg['file_url']]
+        return messages
+
+
+# ============= КЛЮЧИ (PREMIUM И EARLY ACCESS) =============
+
+class KeyRepository:
+    """Одинаковые запросы для premium_keys и early_access_keys.
+
+    Кампании на десятки тысяч ключей генерируются и импортируются пачками:
+    executemany на batch_size строк в своей короткой транзакции, между
+    пачками pause() уступает event loop. Коды одного запуска помечены batch —
+    по нему кампанию выгружают (export) и отличают свои строки от чужих.
+    Активация — claim(): один условный UPDATE, второй претендент получает 0 строк.
+    """
+
+    EXPORT_FIELDS = ('key_code', 'batch', 'is_used', 'used_by', 'username', 'created_at', 'used_at')
+
+    def __init__(self, table):
+        self.table = table
+        self.LIST = KeysetList(f'{table}.list', f'''SELECT k.*, u.username
+                                                    FROM {table} k
+                                                    LEFT JOIN users u ON k.used_by = u.id''',
+                               sorts={'new': ('DESC', (('k.id', 'id'),)),
+                                      'old': ('ASC', (('k.id', 'id'),))},
+                               filters={'used': 'k.is_used = ?',
+                                        'batch': 'k.batch = ?',
+                                        'prefix': 'k.key_code >= ? AND k.key_code < ?'})
+        self.GET = Query(f'{table}.get', f'SELECT * FROM {table} WHERE key_code = ?')
+        self.COUNT = Query(f'{table}.count', f'SELECT COUNT(*) FROM {table}')
+        # executemany: translate под Postgres не дописывает к нему RETURNING id
+        self.INSERT = Query(f'{table}.insert', f'INSERT OR IGNORE INTO {table} (key_code, batch) VALUES (?, ?)',
+                            writes=(table,))
+        self.EXISTING = Query(f'{table}.existing', f'SELECT key_code FROM {table} WHERE key_code IN ({{ids}})')
+        self.OWNED = Query(f'{table}.owned', f'SELECT key_code FROM {table} WHERE key_code IN ({{ids}}) AND batch = ?')
+        self.FREE = Query(f'{table}.free', f'''SELECT key_code FROM {table}
+                                               WHERE is_used = 0
+                                               ORDER BY created_at ASC
+                                               LIMIT ?''')
+        self.CLAIM = Query(f'{table}.claim', f'''UPDATE {table}
+                                                         SET is_used = 1, used_by = ?, used_at = CURRENT_TIMESTAMP
+                                                         WHERE key_code = ? AND is_used = 0''', writes=(table,))
+
+    def page(self, sort='new', cursor=None, limit=50, used=None, batch=None, prefix=None, conn=None):
+        with transaction(conn) as c:
+            return self.LIST.page(c, {'used': used, 'batch': batch,
+                                      'prefix': prefix_range(prefix) if prefix else None},
+                                  sort, cursor, limit)
+
+    def get(self, key_code, conn=None):
+        with transaction(conn) as c:
+            return self.GET.one(c, (key_code,))
+
+    def count(self, conn=None):
+        with transaction(conn) as c:
+            return self.COUNT.scalar(c)
+
+    @staticmethod
+    def new_code(prefix):
+        return f'{prefix}-{secrets.token_hex(4).upper()}-{secrets.token_hex(4).upper()}'
+
+    @staticmethod
+    def new_batch(prefix):
+        return f"{prefix}-{time.strftime('%Y%m%d%H%M%S', time.gmtime())}-{secrets.token_hex(3).upper()}"
+
+    def generate(self, count, prefix, batch=None, batch_size=1000, pause=None, conn=None):
+        """Создать count новых ключей вида PREFIX-XXXXXXXX-XXXXXXXX. Возвращает (batch, коды).
+
+        Коды, уже занятые в таблице, отсеиваются до вставки; если INSERT OR IGNORE
+        всё же пропустил строки (тот же код вставил другой узел), свои коды
+        определяются по batch, а недостача догенерируется следующей пачкой.
+        """
+        batch = batch or self.new_batch(prefix)
+        created = []
+        misses = 0
+        while len(created) < count:
+            codes = {self.new_code(prefix) for _ in range(min(batch_size, count - len(created)))}
+            with transaction(conn) as c:
+                codes -= {r['key_code'] for r in self.EXISTING.all_in(c, codes)}
+                fresh = list(codes)
+                added = self.INSERT.many(c, [(k, batch) for k in fresh])
+                if added != len(fresh):
+                    fresh = [r['key_code'] for r in self.OWNED.all_in(c, fresh, (batch,))]
+                counters.add(f'{self.table}_available', len(fresh), conn=c)
+            created.extend(fresh)
+            if not fresh:
+                misses += 1
+                if misses >= 5:
+                    raise RuntimeError(f'{self.table}: не удаётся подобрать свободные коды')
+            if pause and len(created) < count:
+                pause()
+        return batch, created
+
+    def import_codes(self, codes, batch=None, batch_size=1000, pause=None):
+        """Загрузить коды из итератора (поток CSV/NDJSON) пачками. Возвращает (добавлено, уже были)."""
+        added = seen = 0
+        chunk = []
+
+        def flush():
+            with transaction() as c:
+                n = self.INSERT.many(c, chunk)
+                counters.add(f'{self.table}_available', n, conn=c)
+            chunk.clear()
+            if pause:
+                pause()
+            return n
+
+        for code in codes:
+            chunk.append((code, batch))
+            seen += 1
+            if len(chunk) >= batch_size:
+                added += flush()
+        if chunk:
+            added += flush()
+        return added, seen - added
+
+    def export(self, used=None, batch=None, batch_size=1000):
+        """Генератор строк для выгрузки в порядке id: пачка за пачкой по курсору,
+        каждая через своё короткое соединение реплики"""
+        cursor = None
+        while True:
+            with replica() as c:
+                rows, cursor = self.LIST.page(c, {'used': used, 'batch': batch}, 'old', cursor, batch_size)
+            for row in rows:
+                yield {f: row[f] for f in self.EXPORT_FIELDS}
+            if not cursor:
+                return
+
+    def free(self, limit, conn=None):
+        """Коды неиспользованных ключей, старые первыми"""
+        with transaction(conn) as c:
+            return [r['key_code'] for r in self.FREE.all(c, (limit,))]
+
+    def claim(self, key_code, user_id, conn=None):
+        """Занять ключ за user_id одним условным UPDATE. False — ключа нет или он уже использован."""
+        with transaction(conn) as c:
+            if self.CLAIM.run(c, (user_id, key_code)).rowcount:
+                counters.add(f'{self.table}_available', -1, conn=c)
+                return True
+            return False
+
+
+# ============= ПЧЁЛКИ (BEE STARS) =============
+
+class StarRepository:
+    """Пчёлки: баланс users.bee_stars и журнал движений star_ledger.
+
+    Журнал только дописывается. Запись — amount пчёлок от from_id к to_id;
+    NULL с одной стороны — выпуск или списание системой (регистрация, аирдроп,
+    правка админом). Баланс пользователя — сумма входящих минус сумма исходящих,
+    users.bee_stars — его готовая копия. ensure() один раз, миграцией, заводит
+    в журнал остатки, накопленные до него (сиды init_db, старые данные); после
+    этого расхождения только показывает drift() (/admin/stars/verify), а
+    rebuild() по команде админа пересчитывает users по журналу.
+    Перевод списывает одним UPDATE с условием bee_stars >= amount, поэтому
+    одновременные подарки не уводят баланс в минус.
+    """
+
+    LOG = Query('stars.log', '''INSERT INTO star_ledger (kind, from_id, to_id, amount, actor_id, note)
+                                VALUES (?, ?, ?, ?, ?, ?)''', writes=('star_ledger',))
+    DEBIT = Query('stars.debit', 'UPDATE users SET bee_stars = bee_stars - ? WHERE id = ? AND bee_stars >= ?',
+                  writes=('users',))
+    CREDIT = Query('stars.credit', 'UPDATE users SET bee_stars = bee_stars + ? WHERE id = ?', writes=('users',))
+    CREDIT_MANY = Query('stars.credit_many', 'UPDATE users SET bee_stars = bee_stars + ? WHERE id IN ({ids})',
+                        writes=('users',))
+    SET_BALANCE = Query('stars.set_balance', 'UPDATE users SET bee_stars = ? WHERE id = ?', writes=('users',))
+    BALANCES = Query('stars.balances', 'SELECT id, bee_stars FROM users WHERE id IN ({ids})')
+    DRIFT = Query('stars.drift', '''SELECT id, bee_stars, ledger FROM (
+                                        SELECT u.id, IFNULL(u.bee_stars, 0) AS bee_stars,
+                                               IFNULL((SELECT SUM(l.amount) FROM star_ledger l WHERE l.to_id = u.id), 0)
+                                               - IFNULL((SELECT SUM(l.amount) FROM star_ledger l WHERE l.from_id = u.id), 0)
+                                               AS ledger
+                                        FROM users u
+                                    ) t
+                                    WHERE bee_stars != ledger
+                                    ORDER BY id''')
+    ANY = Query('stars.any', 'SELECT 1 FROM star_ledger LIMIT 1')
+    HISTORY = KeysetList('stars.history', '''SELECT l.*, f.username AS from_username, t.username AS to_username
+                                             FROM star_ledger l
+                                             LEFT JOIN users f ON f.id = l.from_id
+                                             LEFT JOIN users t ON t.id = l.to_id''',
+                         sorts={'new': ('DESC', (('l.id', 'id'),)),
+                                'old': ('ASC', (('l.id', 'id'),))},
+                         filters={'user': 'l.from_id = ? OR l.to_id = ?',
+                                  'kind': 'l.kind = ?'})
+
+    def log(self, kind, from_id, to_id, amount, actor_id=None, note=None, conn=None):
+        """Запись журнала без изменения балансов (их уже поменял вызывающий в той же транзакции).
+        Отрицательная сумма записывается как движение в обратную сторону."""
+        if not amount:
+            return
+        if amount < 0:
+            from_id, to_id, amount = to_id, from_id, -amount
+        with transaction(conn) as c:
+            self.LOG.run(c, (kind, from_id, to_id, amount, actor_id, note))
+
+    def transfer(self, from_id, to_id, amount, note=None, conn=None):
+        """Перевод пчёлок между пользователями одной транзакцией.
+        Возвращает (баланс отправителя, баланс получателя) или None, если пчёлок не хватает."""
+        if amount <= 0 or from_id == to_id:
+            return None
+        with transaction(conn) as c:
+            if not self.DEBIT.run(c, (amount, from_id, amount)).rowcount:
+                return None
+            if not self.CREDIT.run(c, (amount, to_id)).rowcount:
+                raise ValueError('Получатель не найден')
+            self.LOG.run(c, ('gift', from_id, to_id, amount, from_id, note))
+            balances = {r['id']: r['bee_stars'] for r in self.BALANCES.all_in(c, (from_id, to_id))}
+            return balances[from_id], balances[to_id]
+
+    def airdrop(self, user_ids, amount, actor_id=None, note=None, conn=None):
+        """Начислить amount каждому из user_ids: UPDATE на пачку id и executemany в журнал.
+        Возвращает {id: новый баланс} для существующих пользователей."""
+        with transaction(conn) as c:
+            ids = [r['id'] for r in self.BALANCES.all_in(c, user_ids)]
+            self.CREDIT_MANY.run_in(c, ids, (amount,))
+            self.LOG.many(c, [('airdrop', None, user_id, amount, actor_id, note) for user_id in ids])
+            counters.add('total_stars', amount * len(ids), conn=c)
+            return {r['id']: r['bee_stars'] for r in self.BALANCES.all_in(c, ids)}
+
+    def history(self, user_id=None, kind=None, sort='new', cursor=None, limit=50, conn=None):
+        with transaction(conn) as c:
+            return self.HISTORY.page(c, {'user': (user_id, user_id) if user_id else None, 'kind': kind},
+                                     sort, cursor, limit)
+
+    def drift(self, conn=None):
+        """Пользователи, у которых users.bee_stars не равен балансу по журналу"""
+        with transaction(conn) as c:
+            return self.DRIFT.all(c)
+
+    def ensure(self):
+        """Однократно записать в журнал остатки 'opening', накопленные до него.
+        Возвращает число найденных расхождений; при следующих запусках они не
+        исправляются — только печатаются."""
+        with transaction() as c:
+            rows = self.DRIFT.all(c)
+            # Журнал уже вели (остатки завели записями 'reconcile' до появления миграций) —
+            # сегодняшние расхождения настоящие, их не закрываем
+            opening = claim_migration('star_ledger_opening', c) and not self.ANY.scalar(c)
+            if opening:
+                entries = []
+                for row in rows:
+                    delta = row['bee_stars'] - row['ledger']
+                    entries.append(('opening', None, row['id'], delta, None, None) if delta > 0
+                                   else ('opening', row['id'], None, -delta, None, None))
+                self.LOG.many(c, entries)
+        if rows and not opening:
+            print(f'⚠️ Пчёлки: у {len(rows)} пользователей баланс расходится с журналом (/admin/stars/verify)')
+        return len(rows)
+
+    def rebuild(self):
+        """Пересчитать users.bee_stars из журнала. Возвращает число исправленных балансов."""
+        with transaction() as c:
+            rows = self.DRIFT.all(c)
+            self.SET_BALANCE.many(c, [(row['ledger'], row['id']) for row in rows])
+            counters.add('total_stars', sum(row['ledger'] - row['bee_stars'] for row in rows), conn=c)
+        return len(rows)
+
+
+# ============= СЧЁТЧИКИ СТАТИСТИКИ =============
+
+# Дашборд читает готовые числа из stats_counters вместо COUNT(*) по таблицам.
+# Репозитории сообщают о событиях (counters.add / counters.seen); дельта из
+# транзакции (conn=c) учитывается только после её commit. Дельты копятся
+# в памяти процесса и раз в несколько секунд сливаются в БД одним executemany
+# (flush). Узлы с общей БД прибавляют свои дельты, так что итог общий.
+# Строка счётчика — (name, period, bucket): period '' — итог, 'hour' / 'day' —
+# ряды по времени (UTC). Событие мимо репозитория (сиды init_db) или дельты
+# упавшего процесса выправляет rebuild().
+
+
+def time_buckets(ts=None):
+    """(час, день) UTC — ключи рядов по времени"""
+    t = time.gmtime(ts)
+    return time.strftime('%Y-%m-%d %H:00', t), time.strftime('%Y-%m-%d', t)
+
+
+class CounterRepository:
+    USER_FIELDS = ('is_premium', 'spam_blocked', 'bee_stars')
+
+    # executemany: translate под Postgres не дописывает к нему RETURNING id
+    UPSERT = Query('stats.upsert', '''INSERT INTO stats_counters (name, period, bucket, value) VALUES (?, ?, ?, ?)
+                                      ON CONFLICT (name, period, bucket)
+                                      DO UPDATE SET value = stats_counters.value + excluded.value''')
+    SET = Query('stats.set', '''INSERT INTO stats_counters (name, period, bucket, value) VALUES (?, '', '', ?)
+                                ON CONFLICT (name, period, bucket) DO UPDATE SET value = excluded.value''')
+    TOTALS = Query('stats.totals', "SELECT name, value FROM stats_counters WHERE period = ''")
+    SERIES = Query('stats.series', '''SELECT bucket, value FROM stats_counters
+                                      WHERE name = ? AND period = ? AND bucket >= ?
+                                      ORDER BY bucket''')
+    SEEN = Query('stats.seen', 'INSERT OR IGNORE INTO stats_daily_members (name, day, member) VALUES (?, ?, ?)')
+    PRUNE_HOURS = Query('stats.prune_hours', "DELETE FROM stats_counters WHERE period = 'hour' AND bucket < ?")
+    PRUNE_MEMBERS = Query('stats.prune_members', 'DELETE FROM stats_daily_members WHERE day < ?')
+    COUNT_MESSAGES = Query('stats.count_messages', 'SELECT COUNT(*) FROM messages')
+    # Итоги, которые пересчитываются по таблицам основной БД: подсчёт и запись — один оператор
+    REBUILD = {name: Query(f'stats.rebuild.{name}', f'''INSERT INTO stats_counters (name, period, bucket, value)
+                                                        SELECT '{name}', '', '', ({sql}) WHERE TRUE
+                                                        ON CONFLICT (name, period, bucket)
+                                                        DO UPDATE SET value = excluded.value''')
+               for name, sql in (
+        ('users', 'SELECT COUNT(*) FROM users'),
+        ('premium', 'SELECT COUNT(*) FROM users WHERE is_premium != 0'),
+        ('spam_blocked', 'SELECT COUNT(*) FROM users WHERE spam_blocked != 0'),
+        ('total_stars', 'SELECT IFNULL(SUM(bee_stars), 0) FROM users'),
+        ('chats', 'SELECT COUNT(*) FROM chats'),
+        ('channels', 'SELECT COUNT(*) FROM chats WHERE is_channel = 1'),
+        ('groups', 'SELECT COUNT(*) FROM chats WHERE is_group = 1 AND is_channel = 0'),
+        ('reports_open', "SELECT COUNT(*) FROM reports WHERE status = 'open'"),
+        ('reports_resolved', "SELECT COUNT(*) FROM reports WHERE status = 'resolved'"),
+        ('reported_messages', "SELECT COUNT(*) FROM report_queue WHERE status = 'open'"),
+        ('premium_keys_available', 'SELECT COUNT(*) FROM premium_keys WHERE is_used = 0'),
+        ('early_access_keys_available', 'SELECT COUNT(*) FROM early_access_keys WHERE is_used = 0'),
+    )}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = defaultdict(int)  # (name, period, bucket) -> дельта, ещё не в БД
+        self._members = defaultdict(set)  # (name, day) -> новые для процесса участники, ещё не в БД
+        self._known = {}                  # (name, day) -> участники, уже отправленные этим процессом
+        self._listeners = []
+
+    def add_listener(self, fn):
+        """Подписаться на изменения: fn(name, delta, total, today) — задет ли итог и сегодняшний бакет"""
+        self._listeners.append(fn)
+
+    def _notify(self, name, delta, total, today):
+        for fn in self._listeners:
+            try:
+                fn(name, delta, total, today)
+            except Exception:
+                pass
+
+    def add(self, name, delta=1, series=False, conn=None):
+        """Прибавить к итогу name; series — ещё и к часовому и дневному ряду.
+        С conn дельта применяется только после commit его транзакции."""
+        if not delta:
+            return
+        if conn is not None:
+            storage.after_commit(conn, lambda: self.add(name, delta, series))
+            return
+        hour, day = time_buckets()
+        with self._lock:
+            self._pending[(name, '', '')] += delta
+            if series:
+                self._pending[(name, 'hour', hour)] += delta
+                self._pending[(name, 'day', day)] += delta
+        self._notify(name, delta, True, series)
+
+    def add_user(self, row, sign=1, conn=None):
+        if not row:
+            return
+        self.add('premium', sign * bool(row['is_premium']), conn=conn)
+        self.add('spam_blocked', sign * bool(row['spam_blocked']), conn=conn)
+        self.add('total_stars', sign * int(row['bee_stars'] or 0), conn=conn)
+
+    def add_chat(self, row, sign=1, conn=None):
+        self.add('chats', sign, conn=conn)
+        if row.get('is_channel'):
+            self.add('channels', sign, conn=conn)
+        elif row.get('is_group'):
+            self.add('groups', sign, conn=conn)
+
+    def seen(self, name, member):
+        """Уникальные за сутки (активные чаты, пользователи): дневной ряд name растёт при первой встрече"""
+        _, day = time_buckets()
+        key = (name, day)
+        with self._lock:
+            known = self._known.get(key)
+            if known is None:
+                # Новые сутки — вчерашние множества больше не нужны
+                for old in [k for k in self._known if k[0] == name]:
+                    del self._known[old]
+                known = self._known[key] = set()
+            if member in known:
+                return
+            known.add(member)
+            self._members[key].add(member)
+
+    def flush(self):
+        """Слить накопленные дельты в БД одной транзакцией; вернуть число строк счётчиков"""
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(int)
+            members, self._members = self._members, defaultdict(set)
+        if not pending and not members:
+            return 0
+        rows = dict(pending)
+        fresh = {}
+        try:
+            with transaction() as c:
+                # Первую встречу за сутки решает UNIQUE в БД — так уникальность общая для всех узлов
+                for (name, day), ids in members.items():
+                    new = sum(max(self.SEEN.run(c, (name, day, member)).rowcount, 0) for member in ids)
+                    if new:
+                        fresh[name] = new
+                        rows[(name, 'day', day)] = rows.get((name, 'day', day), 0) + new
+                self.UPSERT.many(c, [(*key, value) for key, value in rows.items() if value])
+        except Exception:
+            # Дельты не теряем: вернутся в следующий flush
+            with self._lock:
+                for key, value in pending.items():
+                    self._pending[key] += value
+                for key, ids in members.items():
+                    self._members[key] |= ids
+            raise
+        # Новые уникальные за сутки известны только после записи
+        for name, new in fresh.items():
+            self._notify(name, new, False, True)
+        return len(rows)
+
+    def totals(self, conn=None):
+        """{name: итог} вместе с ещё не слитыми дельтами процесса"""
+        with transaction(conn) as c:
+            result = {r['name']: r['value'] for r in self.TOTALS.all(c)}
+        with self._lock:
+            for (name, period, _), value in self._pending.items():
+                if not period:
+                    result[name] = result.get(name, 0) + value
+        return result
+
+    def series(self, name, period, since, conn=None):
+        """[{bucket, value}] ряда name с бакета since включительно"""
+        with transaction(conn) as c:
+            values = {r['bucket']: r['value'] for r in self.SERIES.all(c, (name, period, since))}
+        with self._lock:
+            for (n, p, bucket), value in self._pending.items():
+                if n == name and p == period and bucket >= since:
+                    values[bucket] = values.get(bucket, 0) + value
+        return [{'bucket': b, 'value': values[b]} for b in sorted(values)]
+
+    def today(self, name, conn=None):
+        _, day = time_buckets()
+        points = self.series(name, 'day', day, conn=conn)
+        return points[0]['value'] if points else 0
+
+    def rebuild(self):
+        """Пересчитать итоги по таблицам. Ряды по времени и число сообщений
+        (это «отправлено», архив и компактация его не уменьшают) не трогаем;
+        сообщения считаются по шардам, только если итога ещё нет.
+
+        Первый пересчёт берёт блокировку записи, поэтому до commit таблицы не меняются.
+        Дельты этих итогов, накопленные процессом к этому моменту, уже вошли в подсчёт.
+        Их выбрасываем в той же транзакции, иначе следующий flush прибавил бы их второй раз."""
+        self.flush()
+        with transaction() as c:
+            existing = {r['name'] for r in self.TOTALS.all(c)}
+        messages = None
+        if 'messages' not in existing:
+            messages = 0
+            for index in range(shard_count()):
+                with _shard(index=index) as conn:
+                    messages += self.COUNT_MESSAGES.scalar(conn)
+        dropped = {}
+        try:
+            with transaction() as c:
+                for q in self.REBUILD.values():
+                    q.run(c)
+                if messages is not None:
+                    self.SET.run(c, ('messages', messages))
+                names = set(self.REBUILD) | ({'messages'} if messages is not None else set())
+                values = {r['name']: int(r['value']) for r in self.TOTALS.all(c) if r['name'] in names}
+                with self._lock:
+                    for key in [k for k in self._pending if not k[1] and k[0] in self.REBUILD]:
+                        dropped[key] = self._pending.pop(key)
+        except Exception:
+            with self._lock:
+                for key, value in dropped.items():
+                    self._pending[key] += value
+            raise
+        return values
+
+    def ensure(self):
+        """При первом запуске (или когда появился новый итог) посчитать итоги по таблицам"""
+        with transaction() as c:
+            existing = {r['name'] for r in self.TOTALS.all(c)}
+        if not existing or set(self.REBUILD) - existing:
+            self.rebuild()
+
+    def prune(self, hourly_days=7):
+        """Удалить часовые бакеты старше hourly_days и вчерашние множества уникальных"""
+        hour, _ = time_buckets(time.time() - hourly_days * 86400)
+        _, yesterday = time_buckets(time.time() - 86400)
+        with transaction() as c:
+            removed = self.PRUNE_HOURS.run(c, (hour,)).rowcount
+            removed += self.PRUNE_MEMBERS.run(c, (yesterday,)).rowcount
+        return removed
+
+
+users = UserRepository()
+chats = ChatRepository()
+messages = MessageRepository()
+reactions = ReactionRepository()
+reports = ReportRepository()
+premium_keys = KeyRepository('premium_keys')
+early_access_keys = KeyRepository('early_access_keys')
+counters = CounterRepository()
+support = SupportRepository()
+stars = StarRepository()
+voice = VoiceRepository()
@@ -0,0 +1,273 @@
+-- BeeGramm — схема PostgreSQL 🐝
+--
+-- Порт таблиц из init_db (server.py). Отличия от SQLite:
+--   * id — IDENTITY вместо AUTOINCREMENT;
+--   * время — TIMESTAMP(0) в UTC (сессии пула открываются с timezone=UTC),
+--     драйвер отдаёт его строкой 'YYYY-MM-DD HH:MM:SS', как SQLite;
+--   * внешние ключи не объявлены: в SQLite они не проверяются (foreign_keys
+--     выключены), а сирот после удаления пользователей и чатов убирает compact;
+--   * поиск по LIKE '%...%' (пользователи, каналы) ускоряют триграммные
+--     GIN-индексы pg_trgm — SQLite здесь делает полный проход.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    username TEXT UNIQUE NOT NULL,
+    password TEXT NOT NULL,
+    nickname TEXT,
+    bio TEXT,
+    status TEXT DEFAULT 'Жужжу в BeeGramm 🐝',
+    avatar TEXT DEFAULT 'default.png',
+    is_premium INTEGER DEFAULT 0,
+    early_access INTEGER DEFAULT 0,
+    is_admin INTEGER DEFAULT 0,
+    is_moderator INTEGER DEFAULT 0,
+    spam_blocked INTEGER DEFAULT 0,
+    banned_until BIGINT DEFAULT 0,
+    bee_stars INTEGER DEFAULT 100,
+    theme TEXT DEFAULT 'light',
+    token_epoch INTEGER DEFAULT 0,
+    created_at TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP
+);
+ALTER TABLE users ADD COLUMN IF NOT EXISTS token_epoch INTEGER DEFAULT 0;
+
+CREATE TABLE IF NOT EXISTS chats (
+    id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    name TEXT,
+    is_group INTEGER DEFAULT 0,
+    is_channel INTEGER DEFAULT 0,
+    is_support INTEGER DEFAULT 0,
+    description TEXT,
+    avatar TEXT,
+    creator_id INTEGER,
+    subscribers_count INTEGER DEFAULT 0,
+    created_at TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS chat_members (
+    id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    chat_id INTEGER,
+    user_id INTEGER,
+    joined_at TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    chat_id INTEGER,
+    user_id INTEGER,
+    content TEXT,
+    message_type TEXT DEFAULT 'text',
+    file_url TEXT,
+    is_read INTEGER DEFAULT 0,
+    is_deleted INTEGER DEFAULT 0,
+    deleted_at TIMESTAMP(0),
+    deleted_by INTEGER,
+    created_at TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS reactions (
+    id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    message_id INTEGER,
+    user_id INTEGER,
+    emoji TEXT
+);
+
+-- Журнал изменений сообщений чата: id — версия истории для условной загрузки
+CREATE TABLE IF NOT EXISTS message_changes (
+    id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    created_at TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS reports (
+    id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    message_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    reporter_id INTEGER NOT NULL,
+    reason TEXT,
+    status TEXT DEFAULT 'open',
+    resolved_by INTEGER,
+    resolved_action TEXT,
+    resolved_at TIMESTAMP(0),
+    created_at TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS report_queue (
+    id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    message_id INTEGER NOT NULL UNIQUE,
+    chat_id INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'open',
+    reports_count INTEGER NOT NULL DEFAULT 0,
+    first_report_id INTEGER NOT NULL,
+    last_report_id INTEGER NOT NULL,
+    last_reporter_id INTEGER,
+    last_reason TEXT,
+    last_report_at TIMESTAMP(0)
+);
+
+CREATE TABLE IF NOT EXISTS support_conversations (
+    id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    chat_id INTEGER NOT NULL UNIQUE,
+    user_id INTEGER NOT NULL,
+    last_message_id INTEGER,
+    last_message_content TEXT,
+    last_message_type TEXT,
+    last_sender_id INTEGER,
+    last_activity_at TIMESTAMP(0) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    unread_count INTEGER NOT NULL DEFAULT 0,
+    assigned_to INTEGER,
+    created_at TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS voice_notes (
+    id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    file_url TEXT NOT NULL UNIQUE,
+    user_id INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    url TEXT,
+    duration_ms INTEGER,
+    waveform TEXT,
+    chat_id INTEGER,
+    message_id INTEGER,
+    created_at TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP(0)
+);
+
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    applied_at TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS star_ledger (
+    id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    kind TEXT NOT NULL,
+    from_id INTEGER,
+    to_id INTEGER,
+    amount INTEGER NOT NULL,
+    actor_id INTEGER,
+    note TEXT,
+    created_at TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS audit_log (
+    id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    actor_id INTEGER,
+    action TEXT NOT NULL,
+    details TEXT,
+    ip TEXT,
+    created_at TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS ip_blocklist (
+    id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    ip TEXT UNIQUE NOT NULL,
+    reason TEXT,
+    created_at TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS ip_events (
+    id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    ip TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    endpoint TEXT,
+    meta TEXT,
+    created_at TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS sticker_packs (
+    id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    name TEXT,
+    is_premium INTEGER DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS stickers (
+    id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    pack_id INTEGER,
+    emoji TEXT,
+    url TEXT,
+    is_image INTEGER DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS premium_keys (
+    id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    key_code TEXT UNIQUE NOT NULL,
+    batch TEXT,
+    is_used INTEGER DEFAULT 0,
+    used_by INTEGER,
+    created_at TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP,
+    used_at TIMESTAMP(0)
+);
+
+CREATE TABLE IF NOT EXISTS early_access_keys (
+    id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    key_code TEXT UNIQUE NOT NULL,
+    batch TEXT,
+    is_used INTEGER DEFAULT 0,
+    used_by INTEGER,
+    created_at TIMESTAMP(0) DEFAULT CURRENT_TIMESTAMP,
+    used_at TIMESTAMP(0)
+);
+
+CREATE TABLE IF NOT EXISTS stats_counters (
+    name TEXT NOT NULL,
+    period TEXT NOT NULL DEFAULT '',
+    bucket TEXT NOT NULL DEFAULT '',
+    value BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (name, period, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS stats_daily_members (
+    id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    name TEXT NOT NULL,
+    day TEXT NOT NULL,
+    member INTEGER NOT NULL,
+    UNIQUE (name, day, member)
+);
+
+CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages(chat_id, id);
+CREATE INDEX IF NOT EXISTS idx_reactions_message ON reactions(message_id);
+CREATE INDEX IF NOT EXISTS idx_message_changes_chat ON message_changes(chat_id, id);
+CREATE INDEX IF NOT EXISTS idx_chat_members_user ON chat_members(user_id, chat_id);
+CREATE INDEX IF NOT EXISTS idx_chat_members_chat ON chat_members(chat_id);
+
+-- Сортировки и фильтры списков админки (repository.KeysetList)
+CREATE INDEX IF NOT EXISTS idx_users_stars ON users(bee_stars, id);
+CREATE INDEX IF NOT EXISTS idx_users_role ON users(is_admin, is_moderator, id);
+CREATE INDEX IF NOT EXISTS idx_users_premium ON users(is_premium, id);
+CREATE INDEX IF NOT EXISTS idx_users_spam_blocked ON users(spam_blocked, id);
+CREATE INDEX IF NOT EXISTS idx_users_early_access ON users(early_access, id);
+CREATE INDEX IF NOT EXISTS idx_chats_channels ON chats(is_channel, id);
+CREATE INDEX IF NOT EXISTS idx_chats_channels_name ON chats(is_channel, name, id);
+CREATE INDEX IF NOT EXISTS idx_chats_channels_subscribers ON chats(is_channel, subscribers_count, id);
+CREATE INDEX IF NOT EXISTS idx_chats_groups ON chats(is_group, is_channel, id);
+CREATE INDEX IF NOT EXISTS idx_chats_groups_name ON chats(is_group, is_channel, name, id);
+CREATE INDEX IF NOT EXISTS idx_premium_keys_used ON premium_keys(is_used, id);
+CREATE INDEX IF NOT EXISTS idx_early_access_keys_used ON early_access_keys(is_used, id);
+ALTER TABLE premium_keys ADD COLUMN IF NOT EXISTS batch TEXT;
+ALTER TABLE early_access_keys ADD COLUMN IF NOT EXISTS batch TEXT;
+CREATE INDEX IF NOT EXISTS idx_premium_keys_batch ON premium_keys(batch, id);
+CREATE INDEX IF NOT EXISTS idx_early_access_keys_batch ON early_access_keys(batch, id);
+
+-- Очередь модерации (repository.ReportRepository)
+CREATE INDEX IF NOT EXISTS idx_reports_message ON reports(message_id, status);
+CREATE INDEX IF NOT EXISTS idx_report_queue_new ON report_queue(status, last_report_id);
+CREATE INDEX IF NOT EXISTS idx_report_queue_old ON report_queue(status, first_report_id);
+CREATE INDEX IF NOT EXISTS idx_report_queue_count ON report_queue(status, reports_count, last_report_id);
+
+-- Журнал пчёлок (repository.StarRepository)
+CREATE INDEX IF NOT EXISTS idx_star_ledger_from ON star_ledger(from_id, id);
+CREATE INDEX IF NOT EXISTS idx_star_ledger_to ON star_ledger(to_id, id);
+
+-- Входящие поддержки (repository.SupportRepository)
+CREATE INDEX IF NOT EXISTS idx_support_activity ON support_conversations(last_activity_at, id);
+CREATE INDEX IF NOT EXISTS idx_support_assigned ON support_conversations(assigned_to, last_activity_at, id);
+CREATE INDEX IF NOT EXISTS idx_voice_notes_status ON voice_notes(status, id);
+
+-- Замена полнотекстового поиска: ILIKE '%q%' по триграммам
+CREATE INDEX IF NOT EXISTS idx_users_username_trgm ON users USING gin (username gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_users_nickname_trgm ON users USING gin (nickname gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_chats_name_trgm ON chats USING gin (name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_chats_description_trgm ON chats USING gin (description gin_trgm_ops);
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+BeeGramm — кодирование JSON 🐝
+
+Один кодировщик для ответов Flask (app.json = JSONProvider(app)) и пакетов
+Socket.IO (SocketIO(json=serialization)). Бэкенд выбирает configure():
+orjson — в разы быстрее на страницах сообщений и списке чатов; json —
+стандартная библиотека, если orjson не установлен.
+
+Строки БД (sqlite3.Row, storage.Row) кодируются как есть: маршрутам не нужно
+копировать их в dict только ради ответа.
+
+Сравнение бэкендов на типичных страницах: python bench_json.py
+"""
+
+import json as _json
+import sqlite3
+from datetime import date, datetime
+from decimal import Decimal
+
+from flask.json.provider import JSONProvider as _FlaskJSONProvider
+from werkzeug.http import http_date
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKENDS = ('orjson', 'json')
+
+_backend = 'json'
+
+if orjson is not None:
+    # Ключи-числа как в json (строками); даты — через _default, как во Flask
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+
+def _default(obj):
+    """Типы, которых нет в JSON: строки БД, даты, Decimal, множества"""
+    if isinstance(obj, sqlite3.Row):
+        return dict(obj)
+    if isinstance(obj, (datetime, date)):
+        return http_date(obj)
+    if isinstance(obj, Decimal):
+        return str(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def configure(backend='orjson'):
+    """Выбрать бэкенд: orjson | json. Без установленного orjson — json с предупреждением."""
+    global _backend
+    if backend not in BACKENDS:
+        raise ValueError(f'Неизвестный JSON_BACKEND: {backend}')
+    if backend == 'orjson' and orjson is None:
+        print('⚠️ orjson не установлен: JSON кодируется стандартным модулем json')
+        backend = 'json'
+    _backend = backend
+
+
+def backend():
+    return _backend
+
+
+def dumps_bytes(obj):
+    """obj -> JSON (UTF-8 bytes) текущим бэкендом"""
+    if _backend == 'orjson':
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS)
+    return _json.dumps(obj, default=_default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def dumps(obj, **kwargs):
+    """obj -> str. Интерфейс модуля json для python-socketio: separators и прочие
+    аргументы принимаются и не влияют — вывод всегда компактный."""
+    if _backend == 'orjson':
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS).decode('utf-8')
+    return _json.dumps(obj, default=_default, ensure_ascii=False, separators=(',', ':'))
+
+
+def loads(s, **kwargs):
+    if _backend == 'orjson':
+        return orjson.loads(s)
+    return _json.loads(s)
+
+
+class JSONProvider(_FlaskJSONProvider):
+    """app.json для Flask: jsonify, request.get_json и json-ответы идут через этот модуль"""
+
+    mimetype = 'application/json'
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj)
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps_bytes(obj), mimetype=self.mimetype)
@@ -1,29 +1,122 @@
 # -*- coding: utf-8 -*-
 """
 BeeGramm - Мессенджер с пчелиной тематикой 🐝
-Backend: Flask + Flask-SocketIO + SQLite
+Backend: Flask + Flask-SocketIO + SQLite / PostgreSQL
 """
 
-from flask import Flask, render_template, request, jsonify, send_from_directory, session, redirect
+from flask import Flask, render_template, request, jsonify, send_from_directory, session, redirect, Response, stream_with_context
 from flask_socketio import SocketIO, emit, join_room, leave_room
 import sqlite3
 import os
 import uuid
 import re
 import time
-import bcrypt
-from datetime import datetime
-from werkzeug.utils import secure_filename
+from datetime import datetime, timedelta
+from werkzeug.utils import secure_filename, safe_join
+from itsdangerous import URLSafeTimedSerializer, BadSignature
 import json
-from collections import defaultdict, deque
+import csv
+import io
+from collections import OrderedDict, defaultdict, deque
 import secrets
+import zlib
+import mimetypes
+import repository as repo
+import backup
+import passwords
+import serialization
+import wire
+import assets
+import voice
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'beegram_secret_honey_key_2024'
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB для премиум
-
-socketio = SocketIO(app, cors_allowed_origins="*")
+app.config['ARCHIVE_FOLDER'] = 'archive'
+app.config['ARCHIVE_AFTER_DAYS'] = 365  # сообщения старше уходят в архивные сегменты
+app.config['ARCHIVE_BLOCK_SIZE'] = 500  # сообщений в одном сжатом блоке
+app.config['ARCHIVE_INTERVAL_SECONDS'] = 6 * 60 * 60
+app.config['TOMBSTONE_RETENTION_DAYS'] = 30  # через сколько дней стирать содержимое удалённых сообщений
+app.config['MESSAGE_CHANGES_RETENTION_DAYS'] = 30  # журнал для ?since=: клиент с более старой версией получит всё
+app.config['MESSAGES_DELTA_MAX'] = 200  # изменённых сообщений в дельте; больше — отдаём историю целиком
+app.config['COMPACT_BATCH_SIZE'] = 500  # строк за одну короткую транзакцию
+app.config['COMPACT_VACUUM_STEP'] = 200  # страниц за один шаг incremental_vacuum
+app.config['COMPACT_INTERVAL_SECONDS'] = 60 * 60
+app.config['SLOW_QUERY_MS'] = 200  # запросы дольше пишутся в лог
+app.config['MESSAGE_SHARDS'] = 1  # 1 — сообщения в beegram.db; N > 1 — в beegram_shard_<i>.db по chat_id % N
+app.config['DB_BACKEND'] = 'sqlite'  # sqlite | postgres (несколько узлов на одной БД)
+app.config['DATABASE_URL'] = 'postgresql://beegram@localhost/beegram'  # только для postgres
+app.config['DB_POOL_SIZE'] = 20  # соединений в пуле postgres на процесс
+app.config['BACKUP_FOLDER'] = 'backups'
+app.config['BACKUP_INTERVAL_SECONDS'] = 6 * 60 * 60  # 0 — без расписания
+app.config['BACKUP_KEEP'] = 7  # сколько последних снимков хранить
+app.config['BACKUP_PAGES_PER_STEP'] = 256  # страниц за шаг backup(), между шагами уступаем event loop
+app.config['BACKUP_MAX_RESTARTS'] = 5  # после стольких перезапусков копии дочитываем одним шагом
+app.config['WAL_ARCHIVE'] = False  # непрерывная архивация WAL в BACKUP_FOLDER/wal
+app.config['WAL_ARCHIVE_INTERVAL_SECONDS'] = 10
+app.config['WAL_ARCHIVE_RESTART_BYTES'] = 16 * 1024 * 1024  # дальше WAL начинается заново (чекпойнт под блокировкой)
+app.config['READ_REPLICA'] = 'wal'  # off | wal (query_only-соединения к beegram.db) | snapshot (копия базы)
+app.config['READ_REPLICA_PATH'] = 'beegram_replica.db'  # только для snapshot
+app.config['READ_REPLICA_REFRESH_SECONDS'] = 60  # как часто обновлять копию snapshot
+app.config['READ_REPLICA_DSN'] = ''  # postgres: DSN реплики; пусто — читаем из основной БД
+app.config['ADMIN_PAGE_SIZE'] = 50  # строк на страницу списков админки по умолчанию
+app.config['ADMIN_PAGE_MAX'] = 200
+app.config['STATS_FLUSH_SECONDS'] = 5  # как часто сливать дельты счётчиков статистики в БД
+app.config['STATS_HOURLY_RETENTION_DAYS'] = 7  # часовые бакеты старше удаляются, дневные хранятся
+app.config['STATS_RECONCILE_SECONDS'] = 24 * 60 * 60  # пересчёт итогов по таблицам; 0 — только вручную
+app.config['ADMIN_PUSH_INTERVAL_SECONDS'] = 2  # живые панели (/admin, /moderator) получают пачку не чаще
+app.config['ADMIN_PUSH_MAX_ITEMS'] = 50  # записей одного вида в пачке; лишние только считаются
+app.config['BULK_MAX_ITEMS'] = 500  # целей в одном запросе массовой модерации
+app.config['PASSWORD_BCRYPT_ROUNDS'] = 12  # стоимость bcrypt; старые хэши пересчитываются при входе
+app.config['PASSWORD_HASH_WORKERS'] = 4  # потоков bcrypt на процесс
+app.config['PASSWORD_HASH_MAX_PENDING'] = 64  # ждущих bcrypt запросов сверх этого — 503
+app.config['JSON_BACKEND'] = 'orjson'  # orjson | json — кодировщик ответов API и Socket.IO (serialization.py)
+app.config['SOCKET_COMPACT_ENABLED'] = True  # компактный формат событий по запросу клиента (wire.py, нужен msgpack)
+app.config['PROFILES_MAX_IDS'] = 200  # id за один запрос /users/profiles
+app.config['OUTBOUND_SOFT_LIMIT'] = 64  # пакетов в очереди engine.io клиента: дальше режем необязательные события
+app.config['OUTBOUND_HARD_LIMIT'] = 512  # дальше клиент считается медленным и отключается
+app.config['OUTBOUND_DRAIN_SECONDS'] = 0.5  # как часто досылать свёрнутые события разгрузившимся клиентам
+app.config['CALL_RING_SECONDS'] = 60  # неотвеченный оффер звонка
+app.config['CALL_MAX_SECONDS'] = 4 * 60 * 60  # сессия звонка после ответа
+app.config['CALL_ICE_BATCH_MS'] = 40  # ICE-кандидаты за это окно уходят одним call_ice
+app.config['VOICE_WORKERS'] = 2  # процессов обработки голосовых (voice.py)
+app.config['VOICE_BITRATE'] = '24k'  # битрейт Opus после перекодирования (нужен ffmpeg)
+app.config['VOICE_WAVEFORM_POINTS'] = 64  # столбиков waveform у голосового
+app.config['VOICE_FFMPEG'] = None  # путь к ffmpeg; None — искать в PATH, без него только метаданные
+app.config['COMPRESS_MIN_BYTES'] = 1024  # JSON-ответы больше сжимаются (br или gzip по Accept-Encoding)
+app.config['COMPRESS_LEVEL'] = 5  # уровень gzip / quality brotli для динамических ответов
+app.config['ASSETS_FOLDER'] = os.path.join(app.static_folder, 'dist')  # python assets.py build
+app.config['ASSETS_MAX_AGE_SECONDS'] = 365 * 24 * 60 * 60
+app.config['CLAIMS_TTL_SECONDS'] = 5 * 60  # сколько claims сессии живут без перечитывания users
+app.config['CLAIMS_SETTLE_SECONDS'] = 2  # после смены прав claims перевыпускаются короткими
+app.config['MEMBERSHIP_CACHE_SIZE'] = 10000  # пользователей в кэше членства в чатах (LRU)
+app.config['QUERY_CACHE_SIZE'] = 5000  # результатов в кэше именованных запросов repository (LRU)
+app.config['JOBS_LOCK_FILE'] = 'beegram_jobs.lock'  # кто держит — ведёт архив, бэкапы и сжатие на этом узле
+app.config['MEMBERSHIP_CACHE_TTL_SECONDS'] = 60  # столько другие воркеры могут видеть прежнее членство
+app.config['STARS_AIRDROP_MAX_USERS'] = 10000  # получателей в одном аирдропе пчёлок
+app.config['STARS_AIRDROP_MAX_AMOUNT'] = 1000000  # пчёлок одному получателю за аирдроп
+app.config['KEYS_GENERATE_MAX'] = 100000  # ключей Premium за один запрос генерации
+app.config['KEYS_BATCH_SIZE'] = 1000  # строк в одной пачке генерации, импорта и выгрузки ключей
+
+serialization.configure(app.config['JSON_BACKEND'])
+app.json = serialization.JSONProvider(app)
+socketio = SocketIO(app, cors_allowed_origins="*", json=serialization)
+
+passwords.configure(rounds=app.config['PASSWORD_BCRYPT_ROUNDS'], workers=app.config['PASSWORD_HASH_WORKERS'],
+                    max_pending=app.config['PASSWORD_HASH_MAX_PENDING'], async_mode=socketio.async_mode)
+
+repo.configure(db_path='beegram.db', message_shards=app.config['MESSAGE_SHARDS'],
+               backend=app.config['DB_BACKEND'], dsn=app.config['DATABASE_URL'],
+               pool_size=app.config['DB_POOL_SIZE'],
+               manual_checkpoints=app.config['WAL_ARCHIVE'] and app.config['DB_BACKEND'] == 'sqlite',
+               replica=app.config['READ_REPLICA'], replica_path=app.config['READ_REPLICA_PATH'],
+               replica_dsn=app.config['READ_REPLICA_DSN'], cache_size=app.config['QUERY_CACHE_SIZE'])
 
 # ============= ПРОСТАЯ ЗАЩИТА ОТ ABUSE / DoS (in-memory) =============
 
@@ -62,6 +155,9 @@ def _log_suspicious_ip(ip, kind, endpoint, meta=None):
         )
         conn.commit()
         conn.close()
+        _live_publish('/admin', 'ip_event', {'ip': ip, 'kind': str(kind),
+                                             'endpoint': str(endpoint)[:200] if endpoint else None,
+                                             'created_at': _live_now()})
     except Exception:
         try:
             conn.close()
@@ -77,16 +173,25 @@ os.makedirs('uploads/voices', exist_ok=True)
 # ============= ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ =============
 
 def hash_password(password):
-    """Хэшировать пароль"""
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    """Хэшировать пароль (bcrypt в пуле потоков, см. passwords.py)"""
+    return passwords.hash_password(password)
 
 # ============= БАЗА ДАННЫХ =============
 
-def init_db():
-    """Инициализация базы данных"""
+def _init_sqlite_schema():
+    """Таблицы и миграции колонок SQLite (Postgres — schema_postgres.sql)"""
     conn = sqlite3.connect('beegram.db')
     c = conn.cursor()
-    
+
+    # Инкрементальный VACUUM: новая БД получает режим сразу, старая — одноразовым VACUUM
+    if c.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        print('🔧 Включаем auto_vacuum = INCREMENTAL...')
+        c.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        c.execute('VACUUM')
+
+    # WAL: читатели (в том числе онлайн-бэкап) не блокируют запись в чат
+    c.execute('PRAGMA journal_mode = WAL')
+
     # Проверяем, существует ли таблица users
     table_exists = c.execute(
         "SELECT name FROM sqlite_master WHERE type='table' AND name='users'"
@@ -153,6 +258,14 @@ def init_db():
             print('🔧 Добавляем поле is_support в chats...')
             c.execute('ALTER TABLE chats ADD COLUMN is_support INTEGER DEFAULT 0')
             conn.commit()
+
+    # Метка кампании (batch) у ключей Premium и Early Access
+    for keys_table in ('premium_keys', 'early_access_keys'):
+        key_columns = [row[1] for row in c.execute(f'PRAGMA table_info({keys_table})').fetchall()]
+        if key_columns and 'batch' not in key_columns:
+            print(f'🔧 Добавляем поле batch в {keys_table}...')
+            c.execute(f'ALTER TABLE {keys_table} ADD COLUMN batch TEXT')
+            conn.commit()
     
     # Таблица пользователей
     c.execute('''CREATE TABLE IF NOT EXISTS users (
@@ -171,6 +284,7 @@ def init_db():
         banned_until INTEGER DEFAULT 0,
         bee_stars INTEGER DEFAULT 100,
         theme TEXT DEFAULT 'light',
+        token_epoch INTEGER DEFAULT 0,
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     )''')
 
@@ -180,6 +294,10 @@ def init_db():
         print('🔧 Добавляем поле early_access...')
         c.execute('ALTER TABLE users ADD COLUMN early_access INTEGER DEFAULT 0')
         conn.commit()
+    if 'token_epoch' not in user_columns:
+        print('🔧 Добавляем поле token_epoch...')
+        c.execute('ALTER TABLE users ADD COLUMN token_epoch INTEGER DEFAULT 0')
+        conn.commit()
     
     # Таблица чатов
     c.execute('''CREATE TABLE IF NOT EXISTS chats (
@@ -248,6 +366,18 @@ def init_db():
         FOREIGN KEY (user_id) REFERENCES users(id)
     )''')
 
+    # Журнал изменений сообщений чата: id — версия истории для условной загрузки (?since=)
+    c.execute('''CREATE TABLE IF NOT EXISTS message_changes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+    c.execute('CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages(chat_id, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_reactions_message ON reactions(message_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_message_changes_chat ON message_changes(chat_id, id)')
+
     # Жалобы на сообщения (очередь модерации)
     c.execute('''CREATE TABLE IF NOT EXISTS reports (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -265,6 +395,69 @@ def init_db():
         FOREIGN KEY (reporter_id) REFERENCES users(id)
     )''')
 
+    # Очередь модерации: одна строка на сообщение с жалобами (repository.ReportRepository)
+    c.execute('''CREATE TABLE IF NOT EXISTS report_queue (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        message_id INTEGER NOT NULL UNIQUE,
+        chat_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'open',
+        reports_count INTEGER NOT NULL DEFAULT 0,
+        first_report_id INTEGER NOT NULL,
+        last_report_id INTEGER NOT NULL,
+        last_reporter_id INTEGER,
+        last_reason TEXT,
+        last_report_at TIMESTAMP
+    )''')
+
+    # Сводки диалогов с @support (repository.SupportRepository)
+    c.execute('''CREATE TABLE IF NOT EXISTS support_conversations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL UNIQUE,
+        user_id INTEGER NOT NULL,
+        last_message_id INTEGER,
+        last_message_content TEXT,
+        last_message_type TEXT,
+        last_sender_id INTEGER,
+        last_activity_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        unread_count INTEGER NOT NULL DEFAULT 0,
+        assigned_to INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+    # Обработка голосовых (voice.py, repository.VoiceRepository): строка на загруженный файл
+    c.execute('''CREATE TABLE IF NOT EXISTS voice_notes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        file_url TEXT NOT NULL UNIQUE,
+        user_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        url TEXT,
+        duration_ms INTEGER,
+        waveform TEXT,
+        chat_id INTEGER,
+        message_id INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        finished_at TIMESTAMP
+    )''')
+
+    # Выполненные однократные миграции данных (repository.claim_migration)
+    c.execute('''CREATE TABLE IF NOT EXISTS schema_migrations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL UNIQUE,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+    # Журнал движений пчёлок (repository.StarRepository): только дописывается
+    c.execute('''CREATE TABLE IF NOT EXISTS star_ledger (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        from_id INTEGER,
+        to_id INTEGER,
+        amount INTEGER NOT NULL,
+        actor_id INTEGER,
+        note TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+
     # Лог действий админа/модератора
     c.execute('''CREATE TABLE IF NOT EXISTS audit_log (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -315,11 +508,12 @@ def init_db():
         print('🔧 Добавляем поле is_image в stickers...')
         c.execute('ALTER TABLE stickers ADD COLUMN is_image INTEGER DEFAULT 0')
         conn.commit()
-    
+
     # Таблица ключей активации Premium
     c.execute('''CREATE TABLE IF NOT EXISTS premium_keys (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         key_code TEXT UNIQUE NOT NULL,
+        batch TEXT,
         is_used INTEGER DEFAULT 0,
         used_by INTEGER,
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -331,20 +525,78 @@ def init_db():
     c.execute('''CREATE TABLE IF NOT EXISTS early_access_keys (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         key_code TEXT UNIQUE NOT NULL,
+        batch TEXT,
         is_used INTEGER DEFAULT 0,
         used_by INTEGER,
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         used_at TIMESTAMP,
         FOREIGN KEY (used_by) REFERENCES users(id)
     )''')
-    
+
+    # Счётчики статистики (repository.counters): итоги и ряды по часам/дням
+    c.execute('''CREATE TABLE IF NOT EXISTS stats_counters (
+        name TEXT NOT NULL,
+        period TEXT NOT NULL DEFAULT '',
+        bucket TEXT NOT NULL DEFAULT '',
+        value INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (name, period, bucket)
+    )''')
+
+    # Кто уже учтён в «уникальных за сутки» (активные чаты и пользователи)
+    c.execute('''CREATE TABLE IF NOT EXISTS stats_daily_members (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        day TEXT NOT NULL,
+        member INTEGER NOT NULL,
+        UNIQUE (name, day, member)
+    )''')
+
+    # Индексы под сортировки и фильтры списков админки (repository.KeysetList)
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_stars ON users(bee_stars, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_role ON users(is_admin, is_moderator, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_premium ON users(is_premium, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_spam_blocked ON users(spam_blocked, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_early_access ON users(early_access, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_chats_channels ON chats(is_channel, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_chats_channels_name ON chats(is_channel, name, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_chats_channels_subscribers ON chats(is_channel, subscribers_count, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_chats_groups ON chats(is_group, is_channel, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_chats_groups_name ON chats(is_group, is_channel, name, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_chat_members_chat ON chat_members(chat_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_premium_keys_used ON premium_keys(is_used, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_early_access_keys_used ON early_access_keys(is_used, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_premium_keys_batch ON premium_keys(batch, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_early_access_keys_batch ON early_access_keys(batch, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_reports_message ON reports(message_id, status)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_report_queue_new ON report_queue(status, last_report_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_report_queue_old ON report_queue(status, first_report_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_report_queue_count ON report_queue(status, reports_count, last_report_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_star_ledger_from ON star_ledger(from_id, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_star_ledger_to ON star_ledger(to_id, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_support_activity ON support_conversations(last_activity_at, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_support_assigned ON support_conversations(assigned_to, last_activity_at, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_voice_notes_status ON voice_notes(status, id)')
+
+    conn.commit()
+    conn.close()
+
+
+def init_db():
+    """Инициализация базы данных"""
+    if repo.backend_name() == 'sqlite':
+        _init_sqlite_schema()
+    else:
+        repo.init_schema()
+
+    conn = repo.connect()
+    c = conn.cursor()
+
     # Добавляем стандартные стикерпаки
     c.execute("SELECT COUNT(*) FROM sticker_packs")
     if c.fetchone()[0] == 0:
         # Пак 1: Базовые пчёлки
-        c.execute("INSERT INTO sticker_packs (name, is_premium) VALUES (?, ?)", 
-                  ('Весёлые пчёлки 🐝', 0))
-        pack1_id = c.lastrowid
+        pack1_id = repo.insert_id(c, "INSERT INTO sticker_packs (name, is_premium) VALUES (?, ?)",
+                                  ('Весёлые пчёлки 🐝', 0))
         stickers1 = [
             ('🐝', '🐝'),
             ('🍯', '🍯'),
@@ -357,9 +609,8 @@ def init_db():
                       (pack1_id, emoji, url))
         
         # Пак 2: Мёд и соты
-        c.execute("INSERT INTO sticker_packs (name, is_premium) VALUES (?, ?)", 
-                  ('Мёд и соты 🍯', 0))
-        pack2_id = c.lastrowid
+        pack2_id = repo.insert_id(c, "INSERT INTO sticker_packs (name, is_premium) VALUES (?, ?)",
+                                  ('Мёд и соты 🍯', 0))
         stickers2 = [
             ('🍯', '🍯'),
             ('🥄', '🥄'),
@@ -372,9 +623,8 @@ def init_db():
                       (pack2_id, emoji, url))
         
         # Пак 3: Премиум пчёлки
-        c.execute("INSERT INTO sticker_packs (name, is_premium) VALUES (?, ?)", 
-                  ('Золотые пчёлки ✨', 1))
-        pack3_id = c.lastrowid
+        pack3_id = repo.insert_id(c, "INSERT INTO sticker_packs (name, is_premium) VALUES (?, ?)",
+                                  ('Золотые пчёлки ✨', 1))
         stickers3 = [
             ('👑', '👑'),
             ('✨', '✨'),
@@ -387,9 +637,8 @@ def init_db():
                       (pack3_id, emoji, url))
         
         # Пак 4: Эмоции
-        c.execute("INSERT INTO sticker_packs (name, is_premium) VALUES (?, ?)", 
-                  ('Эмоции 😊', 0))
-        pack4_id = c.lastrowid
+        pack4_id = repo.insert_id(c, "INSERT INTO sticker_packs (name, is_premium) VALUES (?, ?)",
+                                  ('Эмоции 😊', 0))
         stickers4 = [
             ('😊', '😊'), ('😂', '😂'), ('😍', '😍'), ('🥰', '🥰'),
             ('😎', '😎'), ('🤔', '🤔'), ('😱', '😱'), ('😭', '😭'),
@@ -400,9 +649,8 @@ def init_db():
                       (pack4_id, emoji, url))
         
         # Пак 5: Животные
-        c.execute("INSERT INTO sticker_packs (name, is_premium) VALUES (?, ?)", 
-                  ('Животные 🐾', 0))
-        pack5_id = c.lastrowid
+        pack5_id = repo.insert_id(c, "INSERT INTO sticker_packs (name, is_premium) VALUES (?, ?)",
+                                  ('Животные 🐾', 0))
         stickers5 = [
             ('🐶', '🐶'), ('🐱', '🐱'), ('🐭', '🐭'), ('🐹', '🐹'),
             ('🐰', '🐰'), ('🦊', '🦊'), ('🐻', '🐻'), ('🐼', '🐼'),
@@ -413,9 +661,8 @@ def init_db():
                       (pack5_id, emoji, url))
         
         # Пак 6: Еда
-        c.execute("INSERT INTO sticker_packs (name, is_premium) VALUES (?, ?)", 
-                  ('Еда 🍕', 0))
-        pack6_id = c.lastrowid
+        pack6_id = repo.insert_id(c, "INSERT INTO sticker_packs (name, is_premium) VALUES (?, ?)",
+                                  ('Еда 🍕', 0))
         stickers6 = [
             ('🍕', '🍕'), ('🍔', '🍔'), ('🍟', '🍟'), ('🌭', '🌭'),
             ('🍿', '🍿'), ('🍩', '🍩'), ('🍪', '🍪'), ('🎂', '🎂'),
@@ -426,9 +673,8 @@ def init_db():
                       (pack6_id, emoji, url))
         
         # Пак 7: Премиум эмоции
-        c.execute("INSERT INTO sticker_packs (name, is_premium) VALUES (?, ?)", 
-                  ('VIP Эмоции 💫', 1))
-        pack7_id = c.lastrowid
+        pack7_id = repo.insert_id(c, "INSERT INTO sticker_packs (name, is_premium) VALUES (?, ?)",
+                                  ('VIP Эмоции 💫', 1))
         stickers7 = [
             ('🔥', '🔥'), ('💯', '💯'), ('💪', '💪'), ('🙌', '🙌'),
             ('👏', '👏'), ('🎉', '🎉'), ('🎊', '🎊'), ('🎈', '🎈'),
@@ -498,10 +744,10 @@ def init_db():
     admin_id = admin_user[0] if admin_user else 1
     beegramm = c.execute('SELECT id FROM chats WHERE is_channel = 1 AND name = ?', ('BeeGramm',)).fetchone()
     if not beegramm:
-        c.execute('''INSERT INTO chats (name, is_channel, description, creator_id, subscribers_count)
-                     VALUES (?, ?, ?, ?, ?)''',
-                  ('BeeGramm', 1, 'Официальный канал BeeGramm 🐝', admin_id, 0))
-        beegramm_id = c.lastrowid
+        beegramm_id = repo.insert_id(c, '''INSERT INTO chats (name, is_channel, description, creator_id,
+                                                          subscribers_count)
+                                         VALUES (?, ?, ?, ?, ?)''',
+                                     ('BeeGramm', 1, 'Официальный канал BeeGramm 🐝', admin_id, 0))
         c.execute('''INSERT INTO messages (chat_id, user_id, content, message_type)
                      VALUES (?, ?, ?, ?)''',
                   (beegramm_id, admin_id, 'Добро пожаловать в BeeGramm! 🐝\n\nЗдесь будут новости и обновления.', 'system'))
@@ -522,13 +768,23 @@ def init_db():
 
 # Инициализируем БД при запуске
 init_db()
+repo.init_shards()
+repo.reports.ensure_queue()
+repo.support.ensure()
+repo.stars.ensure()
+repo.counters.ensure()
+
+
+@app.before_request
+def _ensure_background_jobs():
+    _start_background_jobs()
 
 
 @app.before_request
 def _http_rate_limit_and_block():
     # Не ограничиваем статику и uploads
     p = request.path or ''
-    if p.startswith('/static/') or p.startswith('/uploads/'):
+    if p.startswith(('/static/', '/assets/', '/uploads/')):
         return None
 
     ip = _get_client_ip()
@@ -556,7 +812,7 @@ def _early_access_guard():
         return None
 
     # разрешённые пути без EA
-    if p.startswith('/static/') or p.startswith('/uploads/'):
+    if p.startswith(('/static/', '/assets/', '/uploads/')):
         return None
 
     if p in ('/', '/login', '/register', '/logout', '/early_access/activate', '/premium/activate'):
@@ -565,8 +821,7 @@ def _early_access_guard():
     if 'user_id' not in session:
         return None
 
-    user = get_user_by_id(session['user_id'])
-    if _has_early_access_user(user):
+    if _has_early_access_user(_current_claims()):
         return None
 
     # блокируем основной функционал
@@ -583,22 +838,42 @@ def _early_access_guard():
 
 def get_db():
     """Получить соединение с БД"""
-    conn = sqlite3.connect('beegram.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+    return repo.connect()
+
+
+def log_actions(actor_id, entries, conn):
+    """Пачка записей audit_log [(action, details)] одним executemany в транзакции conn:
+    аудит массового действия пишется вместе с ним. Возвращает записи для _publish_audit."""
+    ip = request.headers.get('X-Forwarded-For', request.remote_addr) if request else None
+    rows = [(actor_id, str(action), json.dumps(details, ensure_ascii=False) if details is not None else None, ip)
+            for action, details in entries]
+    if rows:
+        conn.executemany('INSERT INTO audit_log (actor_id, action, details, ip) VALUES (?, ?, ?, ?)', rows)
+    return [{'id': None, 'action': str(action), 'details': details, 'ip': ip} for action, details in entries]
+
+
+def _publish_audit(actor_id, items):
+    """Отдать записи аудита живой админке (после commit)"""
+    if not items or not _live_sids['/admin']:
+        return
+    actor = get_user_by_id(actor_id) if actor_id else None
+    for item in items:
+        _live_publish('/admin', 'audit', dict(item, actor_id=actor_id, created_at=_live_now(),
+                                              actor_username=actor['username'] if actor else None))
 
 
 def log_action(actor_id, action, details=None):
     """Запись действия в audit_log (best-effort, не ломает основной поток)"""
     try:
+        ip = request.headers.get('X-Forwarded-For', request.remote_addr) if request else None
         conn = get_db()
-        conn.execute(
-            'INSERT INTO audit_log (actor_id, action, details, ip) VALUES (?, ?, ?, ?)',
-            (actor_id, str(action), json.dumps(details, ensure_ascii=False) if details is not None else None,
-             request.headers.get('X-Forwarded-For', request.remote_addr) if request else None)
+        entry_id = repo.insert_id(
+            conn, 'INSERT INTO audit_log (actor_id, action, details, ip) VALUES (?, ?, ?, ?)',
+            (actor_id, str(action), json.dumps(details, ensure_ascii=False) if details is not None else None, ip)
         )
         conn.commit()
         conn.close()
+        _publish_audit(actor_id, [{'id': entry_id, 'action': str(action), 'details': details, 'ip': ip}])
     except Exception:
         try:
             conn.close()
@@ -615,6 +890,29 @@ def _require_admin():
     return admin, None
 
 
+def _page_params(*flags):
+    """Параметры списков админки: cursor, limit, sort, q (префикс) и флаги 0/1. Возвращает (params, err)."""
+    args = request.args
+    try:
+        limit = int(args.get('limit') or app.config['ADMIN_PAGE_SIZE'])
+    except ValueError:
+        return None, (jsonify({'success': False, 'error': 'limit должно быть числом'}), 400)
+    params = {
+        'cursor': args.get('cursor') or None,
+        'limit': max(1, min(limit, app.config['ADMIN_PAGE_MAX'])),
+        'sort': args.get('sort') or 'new',
+        'prefix': (args.get('q') or '').strip() or None,
+    }
+    for name in flags:
+        value = args.get(name)
+        if value in (None, ''):
+            continue
+        if value not in ('0', '1'):
+            return None, (jsonify({'success': False, 'error': f'{name} должно быть 0 или 1'}), 400)
+        params[name] = int(value)
+    return params, None
+
+
 def _has_early_access_user(user):
     if not user:
         return False
@@ -627,22 +925,253 @@ def _early_access_blocked_json():
     return jsonify({'success': False, 'error': 'Нужен Early Access ключ'}), 403
 
 def check_password(password, hashed):
-    """Проверить пароль"""
-    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    """Проверить пароль (bcrypt в пуле потоков, см. passwords.py)"""
+    return passwords.check_password(password, hashed)
+
+
+def _password_busy_json():
+    return (jsonify({'success': False, 'error': 'Сервер перегружен, попробуйте войти через несколько секунд'}),
+            503, {'Retry-After': '2'})
 
 def get_user_by_id(user_id):
     """Получить пользователя по ID"""
-    conn = get_db()
-    user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
-    conn.close()
-    return dict(user) if user else None
+    return repo.users.get(user_id)
 
 def get_user_by_username(username):
     """Получить пользователя по username"""
-    conn = get_db()
-    user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
-    conn.close()
-    return dict(user) if user else None
+    return repo.users.get_by_username(username)
+
+
+# ============= ПОДПИСАННЫЕ CLAIMS СЕССИИ =============
+
+# Сокет-события и проверка Early Access не читают users на каждый вызов.
+# При входе (или первом обращении) сервер выпускает компактный подписанный
+# токен [id, флаги ролей, banned_until, имя, эпоха, версия, token_epoch, срок] и кладёт его
+# в сессию; проверка — подпись и сравнение версии с памятью процесса, без БД.
+# Изменение users.CLAIM_FIELDS поднимает версию пользователя (_bump_claims),
+# и следующий вызов перевыпускает токен одним чтением users.
+# Эпоха — случайное число процесса: после перезапуска версии начинаются
+# заново, и старый токен подтверждает только личность. Версии живут в памяти
+# одного процесса, поэтому срок claims ограничен CLAIMS_TTL_SECONDS — столько
+# другие воркеры могут видеть прежние права.
+# Тот же токен /login отдаёт клиентам без cookie (auth={token} при подключении сокета).
+# Такой токен принимается только свежим и только с текущим users.token_epoch:
+# его поднимают /logout и изменение CLAIM_FIELDS (бан, роли), отзывая выданные токены.
+
+_CLAIM_FLAGS = ('is_admin', 'is_moderator', 'early_access', 'is_premium', 'spam_blocked')
+_claims_signer = URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='beegram-claims')
+_claims_epoch = secrets.token_hex(4)
+_claims_versions = defaultdict(int)
+_claims_bumped = {}  # user_id -> когда подняли версию
+
+
+def _bump_claims(user_ids):
+    now = time.time()
+    for uid in user_ids:
+        _claims_versions[int(uid)] += 1
+        _claims_bumped[int(uid)] = now
+
+
+repo.users.add_listener(_bump_claims)
+
+
+def _issue_claims(user):
+    """Подписанный токен claims по строке users"""
+    uid = user['id']
+    flags = sum(1 << i for i, name in enumerate(_CLAIM_FLAGS) if user.get(name))
+    now = time.time()
+    # Версию поднимают до commit: пока изменение не устоялось, строка могла прочитаться старой
+    settle_until = _claims_bumped.get(uid, 0) + app.config['CLAIMS_SETTLE_SECONDS']
+    expires = settle_until if now < settle_until else now + app.config['CLAIMS_TTL_SECONDS']
+    return _claims_signer.dumps([uid, flags, int(user.get('banned_until') or 0),
+                                 user.get('nickname') or user['username'],
+                                 _claims_epoch, _claims_versions.get(uid, 0), int(user.get('token_epoch') or 0),
+                                 int(expires) + 1])
+
+
+def _read_claims(token):
+    """(user_id, claims) по токену. claims — None, если токен устарел; (None, None) — подпись неверна.
+    Личность токен подтверждает не дольше срока жизни сессии."""
+    try:
+        uid, flags, banned_until, name, epoch, version, token_epoch, expires = _claims_signer.loads(
+            token, max_age=app.permanent_session_lifetime.total_seconds())
+    except (BadSignature, ValueError, TypeError):
+        return None, None
+    if epoch != _claims_epoch or version != _claims_versions.get(uid, 0) or expires < time.time():
+        return uid, None
+    claims = {name: int(bool(flags & (1 << i))) for i, name in enumerate(_CLAIM_FLAGS)}
+    claims.update(id=uid, banned_until=banned_until, name=name, token_epoch=token_epoch)
+    return uid, claims
+
+
+def _bearer_user_id(token):
+    """user_id по токену из /login или None. В отличие от cookie сессии, токен не перевыпускается:
+    он должен быть не старше своего срока, а его token_epoch — совпадать со строкой users"""
+    try:
+        uid, _flags, _banned, _name, _epoch, _version, token_epoch, expires = _claims_signer.loads(
+            token, max_age=app.permanent_session_lifetime.total_seconds())
+    except (BadSignature, ValueError, TypeError):
+        return None
+    if expires < time.time() or repo.users.token_epoch(uid) != token_epoch:
+        return None
+    return uid
+
+
+def _current_claims():
+    """Claims пользователя сессии (HTTP или сокета): id, флаги ролей, banned_until, name.
+    None — не авторизован или пользователь удалён."""
+    uid = session.get('user_id')
+    if uid is None:
+        return None
+    token = session.get('claims')
+    if token:
+        token_uid, claims = _read_claims(token)
+        if claims and token_uid == uid:
+            return claims
+    user = get_user_by_id(uid)
+    if not user:
+        return None
+    session['claims'] = _issue_claims(user)
+    return _read_claims(session['claims'])[1]
+
+
+@app.route('/admin/db/queries', methods=['GET'])
+def admin_db_queries():
+    """Статистика именованных запросов слоя данных (только админ)"""
+    admin, err = _require_admin()
+    if err:
+        return err
+    return jsonify({'success': True, 'queries': repo.stats()})
+
+
+def _log_slow_query(name, elapsed_ms, rows, cached):
+    if elapsed_ms >= app.config['SLOW_QUERY_MS']:
+        print(f'🐢 Медленный запрос {name}: {elapsed_ms:.1f} мс, строк {rows}')
+
+
+repo.add_hook(_log_slow_query)
+
+# ============= КЭШ ЧЛЕНСТВА В ЧАТАХ =============
+
+# user_id -> (срок, set(chat_id)); заполняется лениво, сбрасывается при изменении chat_members.
+# Кэш свой у каждого процесса: сброс видит только этот процесс, поэтому записи живут
+# не дольше MEMBERSHIP_CACHE_TTL_SECONDS, а число пользователей ограничено MEMBERSHIP_CACHE_SIZE.
+_chat_membership = OrderedDict()
+
+
+def _user_chat_ids(user_id):
+    """Множество чатов пользователя (один запрос на промах кэша)"""
+    entry = _chat_membership.get(user_id)
+    now = time.time()
+    if entry is not None and entry[0] > now:
+        _chat_membership.move_to_end(user_id)
+        return entry[1]
+    ids = repo.chats.member_chat_ids(user_id)
+    _chat_membership[user_id] = (now + app.config['MEMBERSHIP_CACHE_TTL_SECONDS'], ids)
+    _chat_membership.move_to_end(user_id)
+    while len(_chat_membership) > app.config['MEMBERSHIP_CACHE_SIZE']:
+        _chat_membership.popitem(last=False)
+    return ids
+
+
+def _is_chat_member(user_id, chat_id):
+    try:
+        chat_id = int(chat_id)
+    except (TypeError, ValueError):
+        return False
+    return chat_id in _user_chat_ids(user_id)
+
+
+def _invalidate_membership(user_ids=(), chat_id=None):
+    """Сбросить кэш членства для пользователей и/или убрать удалённый чат у всех"""
+    for uid in user_ids:
+        try:
+            _chat_membership.pop(int(uid), None)
+        except (TypeError, ValueError):
+            pass
+    if chat_id is not None:
+        for _expires, ids in _chat_membership.values():
+            ids.discard(chat_id)
+        # Удалённый чат: его комнату покидают все
+        for room in (f'chat_{chat_id}', f'chat_{chat_id}~c'):
+            socketio.close_room(room, namespace='/')
+
+
+def _revoke_membership(user_ids, chat_id=None):
+    """Пользователи вышли из чата (chat_id=None — из всех): сбросить кэш и вывести
+    их сокеты этого процесса из комнат, чтобы события чата до них больше не доходили"""
+    _invalidate_membership(user_ids)
+    manager = socketio.server.manager
+    for uid in user_ids:
+        for sid, _eio_sid in list(manager.get_participants('/', f'user_{uid}')):
+            if chat_id is not None:
+                rooms = [f'chat_{chat_id}', f'chat_{chat_id}~c']
+            else:
+                rooms = [r for r in manager.get_rooms(sid, '/') if r and r.startswith('chat_')]
+            for room in rooms:
+                socketio.server.leave_room(sid, room, namespace='/')
+
+# ============= СТАТИКА И СЖАТИЕ =============
+
+# Манифест сборки читается при старте: после python assets.py build сервер перезапускают
+_asset_manifest = assets.load_manifest(app.config['ASSETS_FOLDER'])
+
+
+@app.context_processor
+def _asset_helpers():
+    return {'asset_url': asset_url}
+
+
+def asset_url(name):
+    """URL css/js для шаблона: хэшированный файл сборки или /static/ с версией по mtime"""
+    hashed = _asset_manifest.get(name)
+    if hashed:
+        return f'/assets/{hashed}'
+    try:
+        version = int(os.path.getmtime(os.path.join(app.static_folder, name)))
+    except OSError:
+        version = 0
+    return f'/static/{name}?v={version}'
+
+
+@app.route('/assets/<path:filename>')
+def hashed_asset(filename):
+    """Файл сборки: готовый .br/.gz по Accept-Encoding, кэш на год (имя меняется вместе с содержимым)"""
+    folder = app.config['ASSETS_FOLDER']
+    path = safe_join(folder, filename)
+    if path is None or not os.path.isfile(path):
+        return jsonify({'success': False, 'error': 'Файл не найден'}), 404
+
+    offered = [enc for enc, suffix in assets.SUFFIXES.items() if os.path.isfile(path + suffix)]
+    encoding = assets.negotiate(request.headers.get('Accept-Encoding'), offered)
+    max_age = app.config['ASSETS_MAX_AGE_SECONDS']
+    if encoding:
+        response = send_from_directory(folder, filename + assets.SUFFIXES[encoding], max_age=max_age,
+                                       mimetype=mimetypes.guess_type(filename)[0])
+        response.headers['Content-Encoding'] = encoding
+    else:
+        response = send_from_directory(folder, filename, max_age=max_age)
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@app.after_request
+def _compress_response(response):
+    """Сжать JSON-ответ больше COMPRESS_MIN_BYTES кодировкой, которую принимает клиент"""
+    if (response.mimetype != 'application/json' or response.status_code != 200
+            or response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers):
+        return response
+    data = response.get_data()
+    if len(data) < app.config['COMPRESS_MIN_BYTES']:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = assets.negotiate(request.headers.get('Accept-Encoding'))
+    if encoding:
+        response.set_data(assets.compress(data, encoding, app.config['COMPRESS_LEVEL']))
+        response.headers['Content-Encoding'] = encoding
+    return response
 
 # ============= МАРШРУТЫ =============
 
@@ -672,7 +1201,11 @@ def uploaded_file(filename):
 @app.route('/logout', methods=['POST'])
 def logout():
     """Выход из аккаунта"""
-    session.pop('user_id', None)
+    uid = session.pop('user_id', None)
+    session.pop('claims', None)
+    if uid is not None:
+        # Токены /login этого пользователя больше не пускают сокеты
+        repo.users.revoke_tokens(uid)
     return jsonify({'success': True})
 
 
@@ -696,30 +1229,33 @@ def create_report():
     if not message_id or not chat_id:
         return jsonify({'success': False, 'error': 'Некорректные данные'}), 400
 
-    conn = get_db()
+    # Проверяем, что сообщение существует и принадлежит чату
     try:
-        # Проверяем, что сообщение существует и принадлежит чату
-        msg = conn.execute('SELECT id, user_id, is_deleted FROM messages WHERE id = ? AND chat_id = ?', (message_id, chat_id)).fetchone()
-        if not msg:
-            return jsonify({'success': False, 'error': 'Сообщение не найдено'}), 404
-        if msg['is_deleted']:
-            return jsonify({'success': False, 'error': 'Сообщение уже удалено'}), 400
-
-        # Не даём спамить жалобами на одно и то же сообщение от одного пользователя
-        exists = conn.execute(
-            "SELECT id FROM reports WHERE message_id = ? AND reporter_id = ? AND status = 'open' LIMIT 1",
-            (message_id, reporter_id)
-        ).fetchone()
-        if exists:
-            return jsonify({'success': True, 'report_id': exists['id']})
-
-        c = conn.cursor()
-        c.execute('''INSERT INTO reports (message_id, chat_id, reporter_id, reason)
-                     VALUES (?, ?, ?, ?)''', (message_id, chat_id, reporter_id, reason))
-        report_id = c.lastrowid
-        conn.commit()
-    finally:
-        conn.close()
+        msg = repo.messages.get(message_id, chat_id=chat_id)
+    except (TypeError, ValueError):
+        msg = None
+    if not msg and _archive_has(chat_id, message_id):
+        return jsonify({'success': False, 'error': 'Сообщение в архиве', 'archived': True}), 409
+    if not msg or str(msg['chat_id']) != str(chat_id):
+        return jsonify({'success': False, 'error': 'Сообщение не найдено'}), 404
+    if msg['is_deleted']:
+        return jsonify({'success': False, 'error': 'Сообщение уже удалено'}), 400
+
+    # Не даём спамить жалобами на одно и то же сообщение от одного пользователя
+    exists = repo.reports.find_open(message_id, reporter_id)
+    if exists:
+        return jsonify({'success': True, 'report_id': exists})
+
+    report_id, entry = repo.reports.create(message_id, chat_id, reporter_id, reason)
+
+    # Строка очереди целиком: панель заменяет карточку сообщения новой (со счётчиком жалоб)
+    namespaces = [ns for ns in ('/admin', '/moderator') if _live_sids[ns]]
+    if namespaces:
+        sender = get_user_by_id(msg['user_id'])
+        entry.update(message_content=msg['content'], message_type=msg['message_type'],
+                     is_deleted=msg['is_deleted'], sender_username=sender['username'] if sender else None)
+        for ns in namespaces:
+            _live_publish(ns, 'new_report', entry, key='message_id')
 
     log_action(reporter_id, 'report_create', {
         'report_id': report_id,
@@ -736,7 +1272,8 @@ def _actor_is_mod_or_admin(actor):
 
 @app.route('/moderator/reports', methods=['GET'])
 def moderator_get_reports():
-    """Очередь жалоб (модер/админ)"""
+    """Очередь жалоб постранично, одна карточка на сообщение (модер/админ).
+    ?status=open|resolved, ?sort=new|old|count, ?cursor="""
     if 'user_id' not in session:
         return jsonify({'success': False, 'error': 'Не авторизован'}), 401
     actor = get_user_by_id(session['user_id'])
@@ -747,28 +1284,41 @@ def moderator_get_reports():
     if status not in ('open', 'resolved'):
         status = 'open'
 
-    conn = get_db()
-    rows = conn.execute('''
-        SELECT r.id, r.message_id, r.chat_id, r.reason, r.status, r.created_at,
-               m.content AS message_content, m.message_type, m.is_deleted,
-               u.username AS reporter_username,
-               su.username AS sender_username
-        FROM reports r
-        JOIN messages m ON m.id = r.message_id
-        JOIN users u ON u.id = r.reporter_id
-        JOIN users su ON su.id = m.user_id
-        WHERE r.status = ?
-        ORDER BY r.created_at DESC
-        LIMIT 200
-    ''', (status,)).fetchall()
-    conn.close()
+    params, err = _page_params()
+    if err:
+        return err
+    params.pop('prefix')
+    try:
+        with repo.replica() as conn:
+            rows, next_cursor = repo.reports.queue(status, conn=conn, **params)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+    # Сообщения живут в шардах — подтягиваем их отдельно
+    messages = repo.messages.with_senders([(r['chat_id'], r['message_id']) for r in rows])
+    result = []
+    for item in rows:
+        m = messages.get(item['message_id'])
+        if not m:
+            continue
+        item['message_content'] = m['content']
+        item['message_type'] = m['message_type']
+        item['is_deleted'] = m['is_deleted']
+        item['sender_username'] = m['sender_username']
+        result.append(item)
+
+    return jsonify({'success': True, 'reports': result, 'next_cursor': next_cursor, 'counts': _report_counts()})
 
-    return jsonify({'success': True, 'reports': [dict(x) for x in rows]})
+
+def _report_counts():
+    """Размер очереди по статусам — из счётчиков статистики, без COUNT по reports"""
+    totals = repo.counters.totals()
+    return {field: totals.get(name, 0) for name, field in _REPORT_COUNT_FIELDS.items()}
 
 
 @app.route('/moderator/report/<int:report_id>/resolve', methods=['POST'])
 def moderator_resolve_report(report_id):
-    """Закрыть жалобу (действие опционально) (модер/админ)"""
+    """Закрыть жалобу вместе с остальными открытыми на то же сообщение (действие опционально) (модер/админ)"""
     if 'user_id' not in session:
         return jsonify({'success': False, 'error': 'Не авторизован'}), 401
     actor = get_user_by_id(session['user_id'])
@@ -780,53 +1330,41 @@ def moderator_resolve_report(report_id):
     ban_minutes = int(data.get('ban_minutes') or 0)
     spam_block = bool(data.get('spam_block'))
 
-    conn = get_db()
-    c = conn.cursor()
-    rpt = c.execute('SELECT id, message_id, chat_id, status FROM reports WHERE id = ?', (report_id,)).fetchone()
+    rpt = repo.reports.get(report_id)
     if not rpt:
-        conn.close()
         return jsonify({'success': False, 'error': 'Жалоба не найдена'}), 404
     if rpt['status'] != 'open':
-        conn.close()
         return jsonify({'success': True})
 
-    msg = c.execute('SELECT id, user_id, is_deleted FROM messages WHERE id = ?', (rpt['message_id'],)).fetchone()
+    msg = repo.messages.get(rpt['message_id'], chat_id=rpt['chat_id'])
     if not msg:
-        conn.close()
         return jsonify({'success': False, 'error': 'Сообщение не найдено'}), 404
 
     target_user_id = msg['user_id']
 
     # Действия
     if action == 'delete_message' and not msg['is_deleted']:
-        c.execute('''UPDATE messages
-                     SET is_deleted = 1, deleted_at = CURRENT_TIMESTAMP, deleted_by = ?
-                     WHERE id = ?''', (actor['id'], msg['id']))
-        socketio.emit('message_deleted', {
+        repo.messages.soft_delete(msg['id'], rpt['chat_id'], actor['id'])
+        _room_emit('message_deleted', {
             'message_id': msg['id'],
             'chat_id': rpt['chat_id']
-        }, room=f"chat_{rpt['chat_id']}")
-
-    if spam_block:
-        # Нельзя спам-блокать админа
-        target = c.execute('SELECT id, is_admin FROM users WHERE id = ?', (target_user_id,)).fetchone()
-        if target and not target['is_admin']:
-            c.execute('UPDATE users SET spam_blocked = 1 WHERE id = ?', (target_user_id,))
+        }, f"chat_{rpt['chat_id']}")
 
-    if ban_minutes > 0:
-        target = c.execute('SELECT id, is_admin FROM users WHERE id = ?', (target_user_id,)).fetchone()
+    with repo.transaction() as conn:
+        # Нельзя спам-блокать и банить админа
+        target = repo.users.get(target_user_id, conn=conn)
         if target and not target['is_admin']:
-            until = int(time.time()) + (ban_minutes * 60)
-            c.execute('UPDATE users SET banned_until = ? WHERE id = ?', (until, target_user_id))
+            if spam_block:
+                repo.users.update(target_user_id, conn=conn, spam_blocked=1)
+            if ban_minutes > 0:
+                repo.users.update(target_user_id, conn=conn, banned_until=int(time.time()) + (ban_minutes * 60))
 
-    c.execute('''UPDATE reports
-                 SET status = 'resolved', resolved_by = ?, resolved_action = ?, resolved_at = CURRENT_TIMESTAMP
-                 WHERE id = ?''', (actor['id'], action, report_id))
-    conn.commit()
-    conn.close()
+        closed = repo.reports.resolve(rpt['message_id'], actor['id'], action, conn=conn)
 
     log_action(actor.get('id'), 'report_resolve', {
         'report_id': report_id,
+        'message_id': rpt['message_id'],
+        'reports_closed': closed,
         'action': action,
         'spam_block': spam_block,
         'ban_minutes': ban_minutes
@@ -835,6 +1373,276 @@ def moderator_resolve_report(report_id):
     return jsonify({'success': True})
 
 
+# ============= МАССОВАЯ МОДЕРАЦИЯ =============
+
+# Во время спам-волны модератор закрывает сотни жалоб разом. Всё, что лежит в основной
+# БД (жалобы, пользователи, блок-лист, аудит), меняется одной транзакцией; сообщения
+# живут в шардах — там по транзакции на шард, и удаляются они до основной транзакции,
+# чтобы при сбое жалобы остались открытыми. message_deleted уходит одним событием на комнату.
+
+def _bulk_ids(data, key, cast=int, limit=None):
+    """Цели массового действия из JSON: без повторов, не больше limit (BULK_MAX_ITEMS). Возвращает (ids, err)."""
+    raw = data.get(key)
+    if not isinstance(raw, list) or not raw:
+        return None, (jsonify({'success': False, 'error': f'{key}: нужен непустой список'}), 400)
+    limit = limit or app.config['BULK_MAX_ITEMS']
+    if len(raw) > limit:
+        return None, (jsonify({'success': False, 'error': f'Не больше {limit} за раз'}), 400)
+    try:
+        ids = list(dict.fromkeys(cast(x) for x in raw))
+    except (TypeError, ValueError):
+        return None, (jsonify({'success': False, 'error': f'{key}: некорректное значение'}), 400)
+    return ids, None
+
+
+def _emit_messages_deleted(rows):
+    """Одно message_deleted на комнату чата со всеми удалёнными в нём сообщениями"""
+    by_chat = defaultdict(list)
+    for row in rows:
+        by_chat[row['chat_id']].append(row['id'])
+    for chat_id, ids in by_chat.items():
+        _room_emit('message_deleted', {'chat_id': chat_id, 'message_id': ids[0], 'message_ids': ids},
+                   f'chat_{chat_id}')
+
+
+def _restrict_entries(targets, spam_blocked, ban_minutes):
+    entries = []
+    for t in targets:
+        if spam_blocked is not None:
+            entries.append(('spam_block_set', {'target_user_id': t['id'], 'spam_blocked': bool(spam_blocked),
+                                               'bulk': True}))
+        if ban_minutes is not None:
+            entries.append(('user_ban', {'target_user_id': t['id'], 'ban_minutes': ban_minutes, 'bulk': True}))
+    return entries
+
+
+@app.route('/moderator/bulk/reports/resolve', methods=['POST'])
+def moderator_bulk_resolve_reports():
+    """Закрыть пачку жалоб: {report_ids, action, spam_block, ban_minutes} (модер/админ)"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'Не авторизован'}), 401
+    actor = get_user_by_id(session['user_id'])
+    if not _actor_is_mod_or_admin(actor):
+        return jsonify({'success': False, 'error': 'Доступ запрещён'}), 403
+
+    data = request.get_json(silent=True) or {}
+    report_ids, err = _bulk_ids(data, 'report_ids')
+    if err:
+        return err
+    action = str(data.get('action') or 'resolve').strip()
+    if action not in ('resolve', 'delete_message'):
+        return jsonify({'success': False, 'error': 'action должно быть resolve или delete_message'}), 400
+    try:
+        ban_minutes = int(data.get('ban_minutes') or 0)
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'ban_minutes должно быть числом'}), 400
+    if ban_minutes < 0 or ban_minutes > 60 * 24 * 30:
+        return jsonify({'success': False, 'error': 'ban_minutes должно быть от 0 до 43200'}), 400
+    spam_block = bool(data.get('spam_block'))
+
+    deleted = []
+    senders = []
+    if action == 'delete_message' or spam_block or ban_minutes > 0:
+        targets = list(repo.reports.open_messages(report_ids))
+        if action == 'delete_message':
+            deleted = repo.messages.soft_delete_many(targets, actor['id'])
+        if spam_block or ban_minutes > 0:
+            senders = list({m['user_id'] for m in repo.messages.get_many(targets).values()})
+
+    with repo.transaction() as conn:
+        closed, targets = repo.reports.resolve_many(report_ids, actor['id'], action, conn=conn)
+        restricted = []
+        if senders:
+            restricted = repo.users.restrict_many(
+                senders, conn=conn, spam_blocked=1 if spam_block else None,
+                banned_until=int(time.time()) + ban_minutes * 60 if ban_minutes > 0 else None)
+        entries = [('report_resolve', {'message_id': message_id, 'chat_id': chat_id, 'action': action,
+                                       'spam_block': spam_block, 'ban_minutes': ban_minutes, 'bulk': True})
+                   for message_id, chat_id in targets.items()]
+        entries += [('message_delete', {'message_id': r['id'], 'chat_id': r['chat_id'], 'via': 'bulk_report'})
+                    for r in deleted]
+        entries += _restrict_entries(restricted, 1 if spam_block else None, ban_minutes if ban_minutes > 0 else None)
+        audit = log_actions(actor['id'], entries, conn)
+
+    _emit_messages_deleted(deleted)
+    _publish_audit(actor['id'], audit)
+    return jsonify({'success': True, 'reports_closed': closed, 'messages': len(targets),
+                    'messages_deleted': len(deleted), 'users_restricted': len(restricted)})
+
+
+@app.route('/moderator/bulk/messages/delete', methods=['POST'])
+def moderator_bulk_delete_messages():
+    """Мягко удалить пачку сообщений: {message_ids} (модер/админ)"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'Не авторизован'}), 401
+    actor = get_user_by_id(session['user_id'])
+    if not _actor_is_mod_or_admin(actor):
+        return jsonify({'success': False, 'error': 'Доступ запрещён'}), 403
+
+    data = request.get_json(silent=True) or {}
+    message_ids, err = _bulk_ids(data, 'message_ids')
+    if err:
+        return err
+
+    deleted = repo.messages.soft_delete_many(message_ids, actor['id'])
+    with repo.transaction() as conn:
+        audit = log_actions(actor['id'], [('message_delete', {'message_id': r['id'], 'chat_id': r['chat_id'],
+                                                              'via': 'bulk'}) for r in deleted], conn)
+
+    _emit_messages_deleted(deleted)
+    _publish_audit(actor['id'], audit)
+    return jsonify({'success': True, 'deleted': len(deleted)})
+
+
+@app.route('/moderator/bulk/users', methods=['POST'])
+def moderator_bulk_restrict_users():
+    """Спам-блок и/или бан пачки пользователей: {user_ids, spam_blocked: 0|1, ban_minutes (0 — снять бан)}
+    (модер/админ). Администраторов пропускает."""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'Не авторизован'}), 401
+    actor = get_user_by_id(session['user_id'])
+    if not _actor_is_mod_or_admin(actor):
+        return jsonify({'success': False, 'error': 'Доступ запрещён'}), 403
+
+    data = request.get_json(silent=True) or {}
+    user_ids, err = _bulk_ids(data, 'user_ids')
+    if err:
+        return err
+    spam_blocked = None if data.get('spam_blocked') is None else (1 if data.get('spam_blocked') else 0)
+    ban_minutes = None
+    if data.get('ban_minutes') is not None:
+        try:
+            ban_minutes = int(data['ban_minutes'])
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'ban_minutes должно быть числом'}), 400
+        if ban_minutes < 0 or ban_minutes > 60 * 24 * 30:
+            return jsonify({'success': False, 'error': 'ban_minutes должно быть от 0 до 43200'}), 400
+    if spam_blocked is None and ban_minutes is None:
+        return jsonify({'success': False, 'error': 'Укажите spam_blocked и/или ban_minutes'}), 400
+
+    banned_until = None
+    if ban_minutes is not None:
+        banned_until = int(time.time()) + ban_minutes * 60 if ban_minutes else 0
+
+    with repo.transaction() as conn:
+        targets = repo.users.restrict_many(user_ids, conn=conn, spam_blocked=spam_blocked, banned_until=banned_until)
+        audit = log_actions(actor['id'], _restrict_entries(targets, spam_blocked, ban_minutes), conn)
+
+    _publish_audit(actor['id'], audit)
+    return jsonify({'success': True, 'users': len(targets), 'skipped': len(user_ids) - len(targets)})
+
+
+@app.route('/admin/bulk/ips/block', methods=['POST'])
+def admin_bulk_block_ips():
+    """Заблокировать пачку IP: {ips, reason} (только админ)"""
+    admin, err = _require_admin()
+    if err:
+        return err
+
+    data = request.get_json(silent=True) or {}
+    ips, err = _bulk_ids(data, 'ips', cast=lambda x: str(x).strip()[:64])
+    if err:
+        return err
+    ips = [ip for ip in ips if ip]
+    reason = (data.get('reason') or '').strip()[:200]
+
+    with repo.transaction() as conn:
+        # Уже заблокированные INSERT OR IGNORE пропустит — в аудит и ответ они не попадают
+        known = set()
+        for start in range(0, len(ips), repo.IN_CHUNK):
+            chunk = ips[start:start + repo.IN_CHUNK]
+            known.update(r['ip'] for r in conn.execute(
+                f"SELECT ip FROM ip_blocklist WHERE ip IN ({','.join('?' * len(chunk))})", chunk).fetchall())
+        fresh = [ip for ip in ips if ip not in known]
+        blocked = 0
+        if fresh:
+            blocked = max(conn.executemany('INSERT OR IGNORE INTO ip_blocklist (ip, reason) VALUES (?, ?)',
+                                           [(ip, reason) for ip in fresh]).rowcount, 0)
+        audit = log_actions(admin['id'], [('ip_block', {'ip': ip, 'reason': reason, 'bulk': True}) for ip in fresh],
+                            conn)
+
+    _publish_audit(admin['id'], audit)
+    return jsonify({'success': True, 'blocked': blocked, 'skipped': len(ips) - blocked})
+
+
+# ============= ПЧЁЛКИ: АИРДРОП И ЖУРНАЛ =============
+
+@app.route('/admin/stars/airdrop', methods=['POST'])
+def admin_stars_airdrop():
+    """Начислить пчёлки пачке пользователей: {user_ids, amount, note} (только админ)"""
+    admin, err = _require_admin()
+    if err:
+        return err
+
+    data = request.get_json(silent=True) or {}
+    user_ids, err = _bulk_ids(data, 'user_ids', limit=app.config['STARS_AIRDROP_MAX_USERS'])
+    if err:
+        return err
+    try:
+        amount = int(data.get('amount'))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'amount должно быть числом'}), 400
+    max_amount = app.config['STARS_AIRDROP_MAX_AMOUNT']
+    if amount <= 0 or amount > max_amount:
+        return jsonify({'success': False, 'error': f'amount должно быть от 1 до {max_amount}'}), 400
+    note = (data.get('note') or '').strip()[:200] or None
+
+    balances = repo.stars.airdrop(user_ids, amount, actor_id=admin['id'], note=note)
+
+    for user_id, bee_stars in balances.items():
+        _room_emit('bee_stars_updated', {'user_id': user_id, 'bee_stars': bee_stars}, f'user_{user_id}')
+    log_action(admin['id'], 'stars_airdrop', {'users': len(balances), 'amount': amount, 'note': note})
+    return jsonify({'success': True, 'credited': len(balances), 'skipped': len(user_ids) - len(balances)})
+
+
+@app.route('/admin/stars/ledger', methods=['GET'])
+def admin_stars_ledger():
+    """Журнал пчёлок постранично (только админ). ?user_id=, ?kind=, ?sort=new|old, ?cursor="""
+    admin, err = _require_admin()
+    if err:
+        return err
+
+    params, err = _page_params()
+    if err:
+        return err
+    params.pop('prefix')
+    try:
+        user_id = int(request.args.get('user_id') or 0) or None
+    except ValueError:
+        return jsonify({'success': False, 'error': 'user_id должно быть числом'}), 400
+    kind = request.args.get('kind') or None
+    try:
+        with repo.replica() as conn:
+            entries, next_cursor = repo.stars.history(user_id=user_id, kind=kind, conn=conn, **params)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify({'success': True, 'entries': entries, 'next_cursor': next_cursor})
+
+
+@app.route('/admin/stars/verify', methods=['GET'])
+def admin_stars_verify():
+    """Сверка users.bee_stars с журналом (только админ): расхождения, первые ADMIN_PAGE_MAX"""
+    admin, err = _require_admin()
+    if err:
+        return err
+
+    with repo.replica() as conn:
+        drift = repo.stars.drift(conn=conn)
+    return jsonify({'success': True, 'count': len(drift), 'drift': drift[:app.config['ADMIN_PAGE_MAX']]})
+
+
+@app.route('/admin/stars/rebuild', methods=['POST'])
+def admin_stars_rebuild():
+    """Восстановить балансы пчёлок из журнала (только админ)"""
+    admin, err = _require_admin()
+    if err:
+        return err
+
+    fixed = repo.stars.rebuild()
+    log_action(admin['id'], 'stars_rebuild', {'fixed': fixed})
+    return jsonify({'success': True, 'fixed': fixed})
+
+
 @app.route('/admin/audit', methods=['GET'])
 def admin_get_audit():
     """Лог действий (только админ)"""
@@ -844,16 +1652,15 @@ def admin_get_audit():
     if not user or not user.get('is_admin'):
         return jsonify({'success': False, 'error': 'Доступ запрещён'}), 403
 
-    conn = get_db()
-    rows = conn.execute('''
-        SELECT a.id, a.actor_id, a.action, a.details, a.ip, a.created_at,
-               u.username AS actor_username
-        FROM audit_log a
-        LEFT JOIN users u ON u.id = a.actor_id
-        ORDER BY a.created_at DESC
-        LIMIT 300
-    ''').fetchall()
-    conn.close()
+    with repo.replica() as conn:
+        rows = conn.execute('''
+            SELECT a.id, a.actor_id, a.action, a.details, a.ip, a.created_at,
+                   u.username AS actor_username
+            FROM audit_log a
+            LEFT JOIN users u ON u.id = a.actor_id
+            ORDER BY a.created_at DESC
+            LIMIT 300
+        ''').fetchall()
 
     result = []
     for r in rows:
@@ -873,20 +1680,19 @@ def admin_security_ips():
     if err:
         return err
 
-    conn = get_db()
-    blocked = conn.execute('SELECT ip, reason, created_at FROM ip_blocklist ORDER BY created_at DESC LIMIT 500').fetchall()
-    recent = conn.execute('''
-        SELECT ip, kind, endpoint, created_at
-        FROM ip_events
-        ORDER BY created_at DESC
-        LIMIT 300
-    ''').fetchall()
-    conn.close()
+    with repo.replica() as conn:
+        blocked = conn.execute('SELECT ip, reason, created_at FROM ip_blocklist ORDER BY created_at DESC LIMIT 500').fetchall()
+        recent = conn.execute('''
+            SELECT ip, kind, endpoint, created_at
+            FROM ip_events
+            ORDER BY created_at DESC
+            LIMIT 300
+        ''').fetchall()
 
     return jsonify({
         'success': True,
-        'blocked': [dict(x) for x in blocked],
-        'events': [dict(x) for x in recent]
+        'blocked': blocked,
+        'events': recent
     })
 
 
@@ -951,7 +1757,8 @@ def moderator_panel():
 
 @app.route('/moderator/support/chats', methods=['GET'])
 def moderator_support_chats():
-    """Список диалогов поддержки (модер/админ)"""
+    """Входящие поддержки постранично (модер/админ).
+    ?sort=recent|old, ?assigned=me|none|<id>, ?unread=1, ?cursor="""
     if 'user_id' not in session:
         return jsonify({'success': False, 'error': 'Не авторизован'}), 401
 
@@ -959,27 +1766,67 @@ def moderator_support_chats():
     if not actor or (not actor.get('is_admin') and not actor.get('is_moderator')):
         return jsonify({'success': False, 'error': 'Доступ запрещён'}), 403
 
-    return _support_chats_impl()
+    return _support_chats_impl(actor)
 
 
-@app.route('/moderator/support/send', methods=['POST'])
-def moderator_support_send():
-    """Ответить в поддержку от имени @support (модер/админ)"""
+@app.route('/moderator/support/<int:chat_id>/read', methods=['POST'])
+def moderator_support_read(chat_id):
+    """Отметить диалог прочитанным поддержкой (модер/админ)"""
     if 'user_id' not in session:
         return jsonify({'success': False, 'error': 'Не авторизован'}), 401
 
     actor = get_user_by_id(session['user_id'])
-    if not actor or (not actor.get('is_admin') and not actor.get('is_moderator')):
+    if not _actor_is_mod_or_admin(actor):
         return jsonify({'success': False, 'error': 'Доступ запрещён'}), 403
 
-    data = request.get_json(silent=True) or {}
-    chat_id = data.get('chat_id')
-    content = (data.get('content') or '').strip()
-    return _support_send_impl(chat_id, content)
+    if not repo.support.mark_read(chat_id):
+        return jsonify({'success': False, 'error': 'Это не чат поддержки'}), 404
+    return jsonify({'success': True})
 
 
-@app.route('/moderator/users/search', methods=['GET'])
-def moderator_search_users():
+@app.route('/moderator/support/<int:chat_id>/assign', methods=['POST'])
+def moderator_support_assign(chat_id):
+    """Назначить диалог модератору: {user_id} — кому, без него — себе, null — снять (модер/админ)"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'Не авторизован'}), 401
+
+    actor = get_user_by_id(session['user_id'])
+    if not _actor_is_mod_or_admin(actor):
+        return jsonify({'success': False, 'error': 'Доступ запрещён'}), 403
+
+    data = request.get_json(silent=True) or {}
+    assignee_id = data['user_id'] if 'user_id' in data else actor['id']
+    if assignee_id is not None:
+        assignee = get_user_by_id(assignee_id)
+        if not _actor_is_mod_or_admin(assignee):
+            return jsonify({'success': False, 'error': 'Назначить можно только модератора или админа'}), 400
+        assignee_id = assignee['id']
+
+    if not repo.support.assign(chat_id, assignee_id):
+        return jsonify({'success': False, 'error': 'Это не чат поддержки'}), 404
+
+    log_action(actor['id'], 'support_assign', {'chat_id': chat_id, 'assigned_to': assignee_id})
+    return jsonify({'success': True, 'assigned_to': assignee_id})
+
+
+@app.route('/moderator/support/send', methods=['POST'])
+def moderator_support_send():
+    """Ответить в поддержку от имени @support (модер/админ)"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'Не авторизован'}), 401
+
+    actor = get_user_by_id(session['user_id'])
+    if not actor or (not actor.get('is_admin') and not actor.get('is_moderator')):
+        return jsonify({'success': False, 'error': 'Доступ запрещён'}), 403
+
+    data = request.get_json(silent=True) or {}
+    chat_id = data.get('chat_id')
+    content = (data.get('content') or '').strip()
+    return _support_send_impl(chat_id, content)
+
+
+@app.route('/moderator/users/search', methods=['GET'])
+def moderator_search_users():
     """Модератор: поиск пользователей (для спам-блока)"""
     if 'user_id' not in session:
         return jsonify({'success': False, 'error': 'Не авторизован'}), 401
@@ -992,15 +1839,9 @@ def moderator_search_users():
     if len(query) < 2:
         return jsonify({'success': True, 'users': []})
 
-    conn = get_db()
-    users = conn.execute('''SELECT id, username, nickname, spam_blocked
-                            FROM users
-                            WHERE username LIKE ? OR nickname LIKE ?
-                            ORDER BY created_at DESC
-                            LIMIT 30''',
-                         (f'%{query}%', f'%{query}%')).fetchall()
-    conn.close()
-    return jsonify({'success': True, 'users': [dict(u) for u in users]})
+    with repo.replica() as conn:
+        users = repo.users.search_moderation(query, conn=conn)
+    return jsonify({'success': True, 'users': users})
 
 
 @app.route('/moderator/user/<int:user_id>/spam_block', methods=['POST'])
@@ -1017,18 +1858,13 @@ def moderator_set_spam_block(user_id):
     value = 1 if data.get('spam_blocked') else 0
 
     # Нельзя спам-блокать админа
-    conn = get_db()
-    try:
-        target = conn.execute('SELECT id, is_admin FROM users WHERE id = ?', (user_id,)).fetchone()
-        if not target:
-            return jsonify({'success': False, 'error': 'Пользователь не найден'}), 404
-        if target['is_admin']:
-            return jsonify({'success': False, 'error': 'Нельзя применять к администратору'}), 400
+    target = repo.users.get(user_id)
+    if not target:
+        return jsonify({'success': False, 'error': 'Пользователь не найден'}), 404
+    if target['is_admin']:
+        return jsonify({'success': False, 'error': 'Нельзя применять к администратору'}), 400
 
-        conn.execute('UPDATE users SET spam_blocked = ? WHERE id = ?', (value, user_id))
-        conn.commit()
-    finally:
-        conn.close()
+    repo.users.update(user_id, spam_blocked=value)
 
     log_action(actor.get('id'), 'spam_block_set', {
         'target_user_id': user_id,
@@ -1061,24 +1897,17 @@ def register():
         return jsonify({'success': False, 'error': 'Пользователь уже существует'}), 400
     
     # Создаём пользователя
-    hashed_pw = hash_password(password)
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('''INSERT INTO users (username, password, nickname) 
-                VALUES (?, ?, ?)''', (username, hashed_pw, nickname))
-    user_id = c.lastrowid
+    try:
+        hashed_pw = hash_password(password)
+    except passwords.PasswordBusy:
+        return _password_busy_json()
+    with repo.transaction() as conn:
+        user_id = repo.users.create(username, hashed_pw, nickname, conn=conn)
 
-    # Автоподписка на канал BeeGramm
-    beegramm = c.execute('SELECT id FROM chats WHERE is_channel = 1 AND name = ?', ('BeeGramm',)).fetchone()
-    if beegramm:
-        beegramm_id = beegramm[0]
-        exists = c.execute('SELECT id FROM chat_members WHERE chat_id = ? AND user_id = ?',
-                           (beegramm_id, user_id)).fetchone()
-        if not exists:
-            c.execute('INSERT INTO chat_members (chat_id, user_id) VALUES (?, ?)', (beegramm_id, user_id))
-            c.execute('UPDATE chats SET subscribers_count = subscribers_count + 1 WHERE id = ?', (beegramm_id,))
-    conn.commit()
-    conn.close()
+        # Автоподписка на канал BeeGramm
+        beegramm_id = repo.chats.channel_by_name('BeeGramm', conn=conn)
+        if beegramm_id and not repo.chats.is_member(beegramm_id, user_id, conn=conn):
+            repo.chats.subscribe(beegramm_id, user_id, conn=conn)
     
     return jsonify({'success': True, 'user_id': user_id})
 
@@ -1091,8 +1920,18 @@ def login():
     
     user = get_user_by_username(username)
     
-    if not user or not check_password(password, user['password']):
-        return jsonify({'success': False, 'error': 'Неверный логин или пароль'}), 401
+    try:
+        if not user or not check_password(password, user['password']):
+            return jsonify({'success': False, 'error': 'Неверный логин или пароль'}), 401
+    except passwords.PasswordBusy:
+        return _password_busy_json()
+
+    # Хэш со старой стоимостью bcrypt пересчитываем, пока пароль у нас в руках
+    if passwords.needs_rehash(user['password']):
+        try:
+            repo.users.rehash_password(user['id'], user['password'], hash_password(password))
+        except passwords.PasswordBusy:
+            pass
 
     # Бан по времени
     try:
@@ -1105,9 +1944,11 @@ def login():
         return jsonify({'success': False, 'error': f'Вы забанены. Осталось ~{mins_left} мин.'}), 403
     
     session['user_id'] = user['id']
+    session['claims'] = _issue_claims(user)
     
     return jsonify({
         'success': True,
+        'token': session['claims'],
         'user': {
             'id': user['id'],
             'username': user['username'],
@@ -1125,6 +1966,13 @@ def login():
     })
 
 
+def _key_claim_error(keys, key_code, conn):
+    """Ответ, когда claim() не занял ключ: такого нет или его уже использовали"""
+    if not keys.get(key_code, conn=conn):
+        return jsonify({'success': False, 'error': 'Неверный ключ'}), 400
+    return jsonify({'success': False, 'error': 'Ключ уже использован'}), 400
+
+
 @app.route('/early_access/activate', methods=['POST'])
 def activate_early_access():
     """Активировать Early Access ключ"""
@@ -1136,23 +1984,11 @@ def activate_early_access():
     if not key_code:
         return jsonify({'success': False, 'error': 'Введите ключ'}), 400
 
-    conn = get_db()
-    c = conn.cursor()
-    try:
-        key = c.execute('SELECT * FROM early_access_keys WHERE key_code = ?', (key_code,)).fetchone()
-        if not key:
-            return jsonify({'success': False, 'error': 'Неверный ключ'}), 400
-        if key['is_used']:
-            return jsonify({'success': False, 'error': 'Ключ уже использован'}), 400
-
-        user_id = session['user_id']
-        c.execute('UPDATE users SET early_access = 1 WHERE id = ?', (user_id,))
-        c.execute('''UPDATE early_access_keys
-                     SET is_used = 1, used_by = ?, used_at = CURRENT_TIMESTAMP
-                     WHERE key_code = ?''', (user_id, key_code))
-        conn.commit()
-    finally:
-        conn.close()
+    user_id = session['user_id']
+    with repo.transaction() as conn:
+        if not repo.early_access_keys.claim(key_code, user_id, conn=conn):
+            return _key_claim_error(repo.early_access_keys, key_code, conn)
+        repo.users.update(user_id, conn=conn, early_access=1)
 
     return jsonify({'success': True, 'message': 'Early Access активирован! 🗝️'})
 
@@ -1198,11 +2034,7 @@ def admin_command():
         conn = get_db()
         try:
             if sub == 'list':
-                rows = conn.execute('''SELECT key_code FROM early_access_keys
-                                       WHERE is_used = 0
-                                       ORDER BY created_at ASC
-                                       LIMIT 10''').fetchall()
-                keys = [r['key_code'] for r in rows]
+                keys = repo.early_access_keys.free(10, conn=conn)
                 if not keys:
                     return jsonify({'success': True, 'output': 'Нет доступных EA ключей'})
                 return jsonify({'success': True, 'output': "EA keys (free):\n" + "\n".join(keys)})
@@ -1217,16 +2049,12 @@ def admin_command():
                 if n <= 0 or n > 100:
                     return jsonify({'success': False, 'error': 'N должно быть от 1 до 100'}), 400
 
-                total = conn.execute('SELECT COUNT(*) as c FROM early_access_keys').fetchone()['c']
+                total = repo.early_access_keys.count(conn=conn)
                 if total >= 100:
                     return jsonify({'success': False, 'error': 'Лимит 100 EA ключей уже достигнут'}), 400
                 can = min(n, 100 - total)
 
-                new_keys = []
-                for _ in range(can):
-                    k = f"EA-{secrets.token_hex(4).upper()}-{secrets.token_hex(4).upper()}"
-                    conn.execute('INSERT INTO early_access_keys (key_code) VALUES (?)', (k,))
-                    new_keys.append(k)
+                _, new_keys = repo.early_access_keys.generate(can, 'EA', conn=conn)
                 conn.commit()
 
                 log_action(admin.get('id'), 'ea_keys_generate', {'count': can})
@@ -1239,14 +2067,14 @@ def admin_command():
                 if not re.fullmatch(r'[A-Za-z0-9]+', target_username):
                     return jsonify({'success': False, 'error': 'Некорректный username'}), 400
 
-                target = conn.execute('SELECT id, is_admin, early_access FROM users WHERE username = ?', (target_username,)).fetchone()
+                target = repo.users.get_by_username(target_username, conn=conn)
                 if not target:
                     return jsonify({'success': False, 'error': 'Пользователь не найден'}), 404
                 if target['is_admin']:
                     return jsonify({'success': False, 'error': 'Админу не нужно EA'}), 400
 
                 if sub == 'revoke':
-                    conn.execute('UPDATE users SET early_access = 0 WHERE id = ?', (target['id'],))
+                    repo.users.update(target['id'], conn=conn, early_access=0)
                     conn.commit()
                     log_action(admin.get('id'), 'ea_revoke', {'username': target_username, 'user_id': target['id']})
                     return jsonify({'success': True, 'output': f'OK: EA revoked for @{target_username}'})
@@ -1254,20 +2082,16 @@ def admin_command():
                 if target['early_access']:
                     return jsonify({'success': False, 'error': 'У пользователя уже есть EA'}), 400
 
-                free = conn.execute('''SELECT key_code FROM early_access_keys
-                                       WHERE is_used = 0
-                                       ORDER BY created_at ASC
-                                       LIMIT 1''').fetchone()
-                if not free:
+                # Свободный ключ мог занять параллельный запрос — берём первый, который удалось занять
+                key_code = next((k for k in repo.early_access_keys.free(5, conn=conn)
+                                 if repo.early_access_keys.claim(k, target['id'], conn=conn)), None)
+                if not key_code:
                     return jsonify({'success': False, 'error': 'Нет свободных EA ключей'}), 400
 
-                conn.execute('UPDATE users SET early_access = 1 WHERE id = ?', (target['id'],))
-                conn.execute('''UPDATE early_access_keys
-                                SET is_used = 1, used_by = ?, used_at = CURRENT_TIMESTAMP
-                                WHERE key_code = ?''', (target['id'], free['key_code']))
+                repo.users.update(target['id'], conn=conn, early_access=1)
                 conn.commit()
-                log_action(admin.get('id'), 'ea_give', {'username': target_username, 'user_id': target['id'], 'key_code': free['key_code']})
-                return jsonify({'success': True, 'output': f'OK: EA granted to @{target_username} (key {free["key_code"]})'})
+                log_action(admin.get('id'), 'ea_give', {'username': target_username, 'user_id': target['id'], 'key_code': key_code})
+                return jsonify({'success': True, 'output': f'OK: EA granted to @{target_username} (key {key_code})'})
 
             return jsonify({'success': False, 'error': 'Неизвестная подкоманда /ea'}), 400
         finally:
@@ -1281,35 +2105,29 @@ def admin_command():
         if not re.fullmatch(r'[A-Za-z0-9]+', target_username):
             return jsonify({'success': False, 'error': 'Некорректный username'}), 400
 
-        conn = get_db()
+        target = repo.users.get_by_username(target_username)
+        if not target:
+            return jsonify({'success': False, 'error': 'Пользователь не найден'}), 404
+        if target['is_admin']:
+            return jsonify({'success': False, 'error': 'Нельзя банить администратора'}), 400
+
+        if cmd == '/unban':
+            repo.users.update(target['id'], banned_until=0)
+            return jsonify({'success': True, 'output': f'OK: unban @{target_username}'})
+
+        # /ban
+        if len(parts) < 3:
+            return jsonify({'success': False, 'error': 'Нужно указать время в минутах'}), 400
         try:
-            target = conn.execute('SELECT id, is_admin, banned_until FROM users WHERE username = ?', (target_username,)).fetchone()
-            if not target:
-                return jsonify({'success': False, 'error': 'Пользователь не найден'}), 404
-            if target['is_admin']:
-                return jsonify({'success': False, 'error': 'Нельзя банить администратора'}), 400
-
-            if cmd == '/unban':
-                conn.execute('UPDATE users SET banned_until = 0 WHERE id = ?', (target['id'],))
-                conn.commit()
-                return jsonify({'success': True, 'output': f'OK: unban @{target_username}'})
+            minutes = int(parts[2])
+        except Exception:
+            return jsonify({'success': False, 'error': 'minutes должно быть числом'}), 400
+        if minutes <= 0 or minutes > 60 * 24 * 30:
+            return jsonify({'success': False, 'error': 'minutes должно быть от 1 до 43200'}), 400
 
-            # /ban
-            if len(parts) < 3:
-                return jsonify({'success': False, 'error': 'Нужно указать время в минутах'}), 400
-            try:
-                minutes = int(parts[2])
-            except Exception:
-                return jsonify({'success': False, 'error': 'minutes должно быть числом'}), 400
-            if minutes <= 0 or minutes > 60 * 24 * 30:
-                return jsonify({'success': False, 'error': 'minutes должно быть от 1 до 43200'}), 400
-
-            until = int(time.time()) + minutes * 60
-            conn.execute('UPDATE users SET banned_until = ? WHERE id = ?', (until, target['id']))
-            conn.commit()
-            return jsonify({'success': True, 'output': f'OK: ban @{target_username} for {minutes} min' })
-        finally:
-            conn.close()
+        until = int(time.time()) + minutes * 60
+        repo.users.update(target['id'], banned_until=until)
+        return jsonify({'success': True, 'output': f'OK: ban @{target_username} for {minutes} min' })
 
     return jsonify({'success': False, 'error': 'Неизвестная команда. Введите /help'}), 400
 
@@ -1321,33 +2139,21 @@ def open_support_chat():
         return jsonify({'success': False, 'error': 'Не авторизован'}), 401
 
     user_id = session['user_id']
-    support = get_user_by_username('support')
-    if not support:
+    support_id = repo.support.user_id()
+    if not support_id:
         return jsonify({'success': False, 'error': 'Поддержка недоступна'}), 500
 
-    conn = get_db()
-    c = conn.cursor()
-
-    existing = c.execute('''SELECT c.id FROM chats c
-                            JOIN chat_members cm1 ON c.id = cm1.chat_id
-                            JOIN chat_members cm2 ON c.id = cm2.chat_id
-                            WHERE c.is_group = 0 AND IFNULL(c.is_channel, 0) = 0
-                            AND cm1.user_id = ? AND cm2.user_id = ?''',
-                         (user_id, support['id'])).fetchone()
+    existing = repo.chats.find_private(user_id, support_id)
     if existing:
-        chat_id = existing[0]
-        conn.close()
-        return jsonify({'success': True, 'chat_id': chat_id})
-
-    c.execute('INSERT INTO chats (is_group, creator_id) VALUES (?, ?)', (0, user_id))
-    chat_id = c.lastrowid
-    c.execute('INSERT INTO chat_members (chat_id, user_id) VALUES (?, ?)', (chat_id, user_id))
-    c.execute('INSERT INTO chat_members (chat_id, user_id) VALUES (?, ?)', (chat_id, support['id']))
-    c.execute('''INSERT INTO messages (chat_id, user_id, content, message_type)
-                 VALUES (?, ?, ?, ?)''',
-              (chat_id, support['id'], 'Здравствуйте! Опишите проблему — мы поможем 🐝', 'system'))
-    conn.commit()
-    conn.close()
+        return jsonify({'success': True, 'chat_id': existing})
+
+    with repo.transaction() as conn:
+        chat_id = repo.chats.create_private(user_id, support_id, creator_id=user_id, conn=conn)
+        repo.support.open(chat_id, user_id, conn=conn)
+
+    repo.messages.insert(chat_id, support_id, 'Здравствуйте! Опишите проблему — мы поможем 🐝', 'system')
+
+    _invalidate_membership([user_id, support_id])
 
     return jsonify({'success': True, 'chat_id': chat_id})
 
@@ -1362,7 +2168,7 @@ def admin_support_chats():
     if not actor or (not actor.get('is_admin')):
         return jsonify({'success': False, 'error': 'Доступ запрещён'}), 403
 
-    return _support_chats_impl()
+    return _support_chats_impl(actor)
 
 
 @app.route('/admin/support/send', methods=['POST'])
@@ -1381,44 +2187,47 @@ def admin_support_send():
     return _support_send_impl(chat_id, content)
 
 
-def _support_chats_impl():
+def _support_chats_impl(actor):
     """Внутренняя реализация списка чатов поддержки (права проверяются снаружи)."""
-    support = get_user_by_username('support')
-    if not support:
-        return jsonify({'success': False, 'error': 'Поддержка недоступна'}), 500
+    params, err = _page_params('unread')
+    if err:
+        return err
+    params.pop('prefix')
+    if params['sort'] == 'new':
+        params['sort'] = 'recent'
+    params['unread'] = bool(params.get('unread'))
+
+    assigned = (request.args.get('assigned') or '').strip()
+    if assigned == 'me':
+        params['assigned_to'] = actor['id']
+    elif assigned == 'none':
+        params['unassigned'] = True
+    elif assigned:
+        if not assigned.isdigit():
+            return jsonify({'success': False, 'error': 'assigned должно быть me, none или id'}), 400
+        params['assigned_to'] = int(assigned)
 
-    conn = get_db()
     try:
-        chats = conn.execute('''SELECT DISTINCT c.id
-                                FROM chats c
-                                JOIN chat_members cm ON c.id = cm.chat_id
-                                WHERE c.is_group = 0 AND IFNULL(c.is_channel, 0) = 0
-                                AND c.id IN (
-                                    SELECT chat_id FROM chat_members WHERE user_id = ?
-                                )''', (support['id'],)).fetchall()
-
-        result = []
-        for row in chats:
-            chat_id = row['id']
-            other_user = conn.execute('''SELECT u.id, u.username, u.nickname, u.avatar
-                                         FROM users u
-                                         JOIN chat_members cm ON u.id = cm.user_id
-                                         WHERE cm.chat_id = ? AND u.id != ?
-                                         LIMIT 1''', (chat_id, support['id'])).fetchone()
-            last_msg = conn.execute('''SELECT m.id, m.content, m.created_at, m.message_type
-                                       FROM messages m
-                                       WHERE m.chat_id = ?
-                                       ORDER BY m.created_at DESC
-                                       LIMIT 1''', (chat_id,)).fetchone()
-            result.append({
-                'chat_id': chat_id,
-                'user': dict(other_user) if other_user else None,
-                'last_message': dict(last_msg) if last_msg else None
-            })
-    finally:
-        conn.close()
-
-    return jsonify({'success': True, 'chats': result})
+        with repo.replica() as conn:
+            rows, next_cursor = repo.support.inbox(conn=conn, **params)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+    result = [{
+        'chat_id': r['chat_id'],
+        'user': {'id': r['user_id'], 'username': r['username'], 'nickname': r['nickname'], 'avatar': r['avatar']}
+                if r['username'] is not None else None,
+        'last_message': {'id': r['last_message_id'], 'content': r['last_message_content'],
+                         'created_at': r['last_activity_at'], 'message_type': r['last_message_type'],
+                         'user_id': r['last_sender_id']}
+                        if r['last_message_id'] else None,
+        'unread_count': r['unread_count'],
+        'assigned_to': r['assigned_to'],
+        'assigned_username': r['assigned_username'],
+        'last_activity_at': r['last_activity_at'],
+    } for r in rows]
+
+    return jsonify({'success': True, 'chats': result, 'next_cursor': next_cursor})
 
 
 def _support_send_impl(chat_id, content):
@@ -1426,31 +2235,16 @@ def _support_send_impl(chat_id, content):
     if not chat_id or not content:
         return jsonify({'success': False, 'error': 'Некорректные данные'}), 400
 
-    support = get_user_by_username('support')
-    if not support:
+    support_id = repo.support.user_id()
+    if not support_id:
         return jsonify({'success': False, 'error': 'Поддержка недоступна'}), 500
 
-    conn = get_db()
-    try:
-        c = conn.cursor()
-        is_support_chat = c.execute('''SELECT 1 FROM chat_members WHERE chat_id = ? AND user_id = ?''',
-                                    (chat_id, support['id'])).fetchone()
-        if not is_support_chat:
-            return jsonify({'success': False, 'error': 'Это не чат поддержки'}), 400
-
-        c.execute('''INSERT INTO messages (chat_id, user_id, content, message_type)
-                     VALUES (?, ?, ?, ?)''', (chat_id, support['id'], content, 'text'))
-        msg_id = c.lastrowid
-        conn.commit()
+    if not repo.support.is_conversation(chat_id):
+        return jsonify({'success': False, 'error': 'Это не чат поддержки'}), 400
 
-        msg = c.execute('''SELECT m.*, u.nickname, u.username, u.avatar, u.is_premium
-                           FROM messages m
-                           JOIN users u ON m.user_id = u.id
-                           WHERE m.id = ?''', (msg_id,)).fetchone()
-    finally:
-        conn.close()
+    msg = repo.messages.insert(chat_id, support_id, content, 'text')
 
-    socketio.emit('new_message', dict(msg), room=f'chat_{chat_id}')
+    _room_emit('new_message', msg, f'chat_{chat_id}')
     return jsonify({'success': True})
 
 @app.route('/profile/update', methods=['POST'])
@@ -1462,21 +2256,8 @@ def update_profile():
     data = request.json
     user_id = session['user_id']
     
-    conn = get_db()
-    c = conn.cursor()
-    
     # Обновляем поля
-    if 'nickname' in data:
-        c.execute('UPDATE users SET nickname = ? WHERE id = ?', (data['nickname'], user_id))
-    if 'bio' in data:
-        c.execute('UPDATE users SET bio = ? WHERE id = ?', (data['bio'], user_id))
-    if 'status' in data:
-        c.execute('UPDATE users SET status = ? WHERE id = ?', (data['status'], user_id))
-    if 'theme' in data:
-        c.execute('UPDATE users SET theme = ? WHERE id = ?', (data['theme'], user_id))
-    
-    conn.commit()
-    conn.close()
+    repo.users.update(user_id, **{k: data[k] for k in ('nickname', 'bio', 'status', 'theme') if k in data})
     
     return jsonify({'success': True})
 
@@ -1490,19 +2271,7 @@ def admin_get_messages():
     if not user or not user.get('is_admin'):
         return jsonify({'success': False, 'error': 'Доступ запрещён'}), 403
     
-    conn = get_db()
-    messages = conn.execute('''
-        SELECT m.id, m.chat_id, m.user_id, m.content, m.message_type, m.file_url,
-               m.is_deleted, m.deleted_at, m.deleted_by, m.created_at,
-               u.username, u.nickname
-        FROM messages m
-        JOIN users u ON u.id = m.user_id
-        ORDER BY m.created_at DESC
-        LIMIT 200
-    ''').fetchall()
-    conn.close()
-    
-    return jsonify({'messages': [dict(m) for m in messages]})
+    return jsonify({'messages': repo.messages.recent(200)})
 
 @app.route('/admin/message/<int:message_id>/delete', methods=['POST'])
 def admin_delete_message(message_id):
@@ -1514,22 +2283,14 @@ def admin_delete_message(message_id):
     if not user or not user.get('is_admin'):
         return jsonify({'success': False, 'error': 'Доступ запрещён'}), 403
     
-    conn = get_db()
-    c = conn.cursor()
-    msg = c.execute('SELECT chat_id, is_deleted FROM messages WHERE id = ?', (message_id,)).fetchone()
+    msg = repo.messages.get(message_id)
     if not msg:
-        conn.close()
         return jsonify({'success': False, 'error': 'Сообщение не найдено'}), 404
-    
+
     if msg['is_deleted']:
-        conn.close()
         return jsonify({'success': True})
-    
-    c.execute('''UPDATE messages
-                 SET is_deleted = 1, deleted_at = CURRENT_TIMESTAMP, deleted_by = ?
-                 WHERE id = ?''', (user['id'], message_id))
-    conn.commit()
-    conn.close()
+
+    repo.messages.soft_delete(message_id, msg['chat_id'], user['id'])
 
     log_action(user.get('id'), 'message_delete', {
         'message_id': message_id,
@@ -1537,10 +2298,10 @@ def admin_delete_message(message_id):
         'via': 'admin_http'
     })
     
-    socketio.emit('message_deleted', {
+    _room_emit('message_deleted', {
         'message_id': message_id,
         'chat_id': msg['chat_id']
-    }, room=f"chat_{msg['chat_id']}")
+    }, f"chat_{msg['chat_id']}")
     
     return jsonify({'success': True})
 
@@ -1560,7 +2321,7 @@ def admin_get_sticker_packs():
     for pack in packs:
         pack_dict = dict(pack)
         stickers = conn.execute('SELECT * FROM stickers WHERE pack_id = ? ORDER BY id ASC', (pack['id'],)).fetchall()
-        pack_dict['stickers'] = [dict(s) for s in stickers]
+        pack_dict['stickers'] = stickers
         result.append(pack_dict)
     conn.close()
     return jsonify({'packs': result})
@@ -1583,8 +2344,7 @@ def admin_create_sticker_pack():
     
     conn = get_db()
     c = conn.cursor()
-    c.execute('INSERT INTO sticker_packs (name, is_premium) VALUES (?, ?)', (name, is_premium))
-    pack_id = c.lastrowid
+    pack_id = repo.insert_id(c, 'INSERT INTO sticker_packs (name, is_premium) VALUES (?, ?)', (name, is_premium))
     conn.commit()
     conn.close()
     return jsonify({'success': True, 'pack_id': pack_id})
@@ -1612,8 +2372,8 @@ def admin_add_sticker(pack_id):
         conn.close()
         return jsonify({'success': False, 'error': 'Пак не найден'}), 404
     
-    c.execute('INSERT INTO stickers (pack_id, emoji, url) VALUES (?, ?, ?)', (pack_id, emoji, url))
-    sticker_id = c.lastrowid
+    sticker_id = repo.insert_id(c, 'INSERT INTO stickers (pack_id, emoji, url) VALUES (?, ?, ?)',
+                                (pack_id, emoji, url))
     conn.commit()
     conn.close()
     return jsonify({'success': True, 'sticker_id': sticker_id})
@@ -1628,33 +2388,36 @@ def admin_delete_chat(chat_id):
     if not user or not user.get('is_admin'):
         return jsonify({'success': False, 'error': 'Доступ запрещён'}), 403
     
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('DELETE FROM reactions WHERE message_id IN (SELECT id FROM messages WHERE chat_id = ?)', (chat_id,))
-    c.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
-    c.execute('DELETE FROM chat_members WHERE chat_id = ?', (chat_id,))
-    c.execute('DELETE FROM chats WHERE id = ?', (chat_id,))
-    conn.commit()
-    conn.close()
+    repo.messages.delete_for_chat(chat_id)
+    repo.chats.delete(chat_id)
+
+    _invalidate_membership(chat_id=chat_id)
     
     return jsonify({'success': True})
 
 @app.route('/admin/users', methods=['GET'])
 def admin_get_users():
-    """Получить всех пользователей (только для админа)"""
+    """Пользователи постранично (только для админа).
+
+    ?sort=new|old|username|stars, ?role=admin|moderator|regular, ?premium=, ?spam_blocked=,
+    ?early_access= (0/1), ?q= — префикс username, ?cursor= — next_cursor прошлой страницы.
+    """
     if 'user_id' not in session:
         return jsonify({'success': False, 'error': 'Не авторизован'}), 401
     
     user = get_user_by_id(session['user_id'])
     if not user or not user['is_admin']:
         return jsonify({'success': False, 'error': 'Доступ запрещён'}), 403
-    
-    conn = get_db()
-    users = conn.execute('''SELECT id, username, nickname, avatar, is_premium, is_admin, is_moderator, spam_blocked, bee_stars, created_at
-                            FROM users ORDER BY created_at DESC''').fetchall()
-    conn.close()
-    
-    return jsonify({'users': [dict(u) for u in users]})
+
+    params, err = _page_params('premium', 'spam_blocked', 'early_access')
+    if err:
+        return err
+    try:
+        with repo.replica() as conn:
+            users, next_cursor = repo.users.page(role=request.args.get('role') or None, conn=conn, **params)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify({'success': True, 'users': users, 'next_cursor': next_cursor})
 
 @app.route('/admin/user/<int:user_id>/update', methods=['POST'])
 def admin_update_user(user_id):
@@ -1667,24 +2430,8 @@ def admin_update_user(user_id):
         return jsonify({'success': False, 'error': 'Доступ запрещён'}), 403
     
     data = request.get_json(silent=True) or {}
-    conn = get_db()
-    c = conn.cursor()
-    
-    if 'is_premium' in data:
-        c.execute('UPDATE users SET is_premium = ? WHERE id = ?', (data['is_premium'], user_id))
-    if 'bee_stars' in data:
-        c.execute('UPDATE users SET bee_stars = ? WHERE id = ?', (data['bee_stars'], user_id))
-    if 'is_admin' in data:
-        c.execute('UPDATE users SET is_admin = ? WHERE id = ?', (data['is_admin'], user_id))
-    if 'is_moderator' in data:
-        c.execute('UPDATE users SET is_moderator = ? WHERE id = ?', (data['is_moderator'], user_id))
-    if 'spam_blocked' in data:
-        c.execute('UPDATE users SET spam_blocked = ? WHERE id = ?', (data['spam_blocked'], user_id))
-    if 'early_access' in data:
-        c.execute('UPDATE users SET early_access = ? WHERE id = ?', (data['early_access'], user_id))
-    
-    conn.commit()
-    conn.close()
+    fields = ('is_premium', 'bee_stars', 'is_admin', 'is_moderator', 'spam_blocked', 'early_access')
+    repo.users.update(user_id, **{k: data[k] for k in fields if k in data})
     
     return jsonify({'success': True})
 
@@ -1701,32 +2448,31 @@ def admin_delete_user(user_id):
     if user_id == session['user_id']:
         return jsonify({'success': False, 'error': 'Нельзя удалить себя'}), 400
     
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('DELETE FROM users WHERE id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    repo.users.delete(user_id)
+
+    _revoke_membership([user_id])
     
     return jsonify({'success': True})
 
 @app.route('/admin/keys', methods=['GET'])
 def admin_get_keys():
-    """Получить все ключи (только для админа)"""
+    """Premium-ключи постранично (только для админа). ?used=0|1, ?q= — префикс кода, ?sort=new|old, ?cursor="""
     if 'user_id' not in session:
         return jsonify({'success': False, 'error': 'Не авторизован'}), 401
     
     admin = get_user_by_id(session['user_id'])
     if not admin or not admin['is_admin']:
         return jsonify({'success': False, 'error': 'Доступ запрещён'}), 403
-    
-    conn = get_db()
-    keys = conn.execute('''SELECT k.*, u.username 
-                           FROM premium_keys k
-                           LEFT JOIN users u ON k.used_by = u.id
-                           ORDER BY k.created_at DESC''').fetchall()
-    conn.close()
-    
-    return jsonify({'keys': [dict(k) for k in keys]})
+
+    params, err = _page_params('used')
+    if err:
+        return err
+    try:
+        with repo.replica() as conn:
+            keys, next_cursor = repo.premium_keys.page(conn=conn, **params)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify({'success': True, 'keys': keys, 'next_cursor': next_cursor})
 
 @app.route('/admin/keys/generate', methods=['POST'])
 def admin_generate_keys():
@@ -1738,42 +2484,39 @@ def admin_generate_keys():
     if not admin or not admin['is_admin']:
         return jsonify({'success': False, 'error': 'Доступ запрещён'}), 403
     
-    data = request.json
-    count = data.get('count', 1)
-    
-    import secrets
-    conn = get_db()
-    c = conn.cursor()
-    
-    new_keys = []
-    for _ in range(count):
-        key = f"BEE-{secrets.token_hex(4).upper()}-{secrets.token_hex(4).upper()}"
-        c.execute('INSERT INTO premium_keys (key_code) VALUES (?)', (key,))
-        new_keys.append(key)
-    
-    conn.commit()
-    conn.close()
-    
-    return jsonify({'success': True, 'keys': new_keys})
+    data = request.get_json(silent=True) or {}
+    try:
+        count = int(data.get('count', 1))
+    except Exception:
+        return jsonify({'success': False, 'error': 'count должно быть числом'}), 400
+    limit = app.config['KEYS_GENERATE_MAX']
+    if count <= 0 or count > limit:
+        return jsonify({'success': False, 'error': f'count должно быть от 1 до {limit}'}), 400
+
+    batch, new_keys = repo.premium_keys.generate(count, 'BEE', batch_size=app.config['KEYS_BATCH_SIZE'],
+                                                 pause=lambda: socketio.sleep(0))
+    log_action(admin.get('id'), 'keys_generate', {'count': len(new_keys), 'batch': batch})
+    return jsonify({'success': True, 'batch': batch, 'keys': new_keys})
 
 @app.route('/admin/early_access/keys', methods=['GET'])
 def admin_get_early_access_keys():
-    """Получить все ключи раннего доступа (только для админа)"""
+    """Ключи раннего доступа постранично (только для админа). ?used=0|1, ?q=, ?sort=new|old, ?cursor="""
     if 'user_id' not in session:
         return jsonify({'success': False, 'error': 'Не авторизован'}), 401
     
     admin = get_user_by_id(session['user_id'])
     if not admin or not admin['is_admin']:
         return jsonify({'success': False, 'error': 'Доступ запрещён'}), 403
-    
-    conn = get_db()
-    keys = conn.execute('''SELECT k.*, u.username 
-                           FROM early_access_keys k
-                           LEFT JOIN users u ON k.used_by = u.id
-                           ORDER BY k.created_at DESC''').fetchall()
-    conn.close()
-    
-    return jsonify({'keys': [dict(k) for k in keys]})
+
+    params, err = _page_params('used')
+    if err:
+        return err
+    try:
+        with repo.replica() as conn:
+            keys, next_cursor = repo.early_access_keys.page(conn=conn, **params)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify({'success': True, 'keys': keys, 'next_cursor': next_cursor})
 
 @app.route('/admin/early_access/keys/generate', methods=['POST'])
 def admin_generate_early_access_keys():
@@ -1793,60 +2536,150 @@ def admin_generate_early_access_keys():
     if count <= 0 or count > 100:
         return jsonify({'success': False, 'error': 'count должно быть от 1 до 100'}), 400
 
-    conn = get_db()
-    c = conn.cursor()
-
-    try:
-        total = c.execute('SELECT COUNT(*) as c FROM early_access_keys').fetchone()['c']
+    with repo.transaction() as conn:
+        total = repo.early_access_keys.count(conn=conn)
         if total >= 100:
             return jsonify({'success': False, 'error': 'Лимит 100 ключей уже достигнут'}), 400
         can = min(count, 100 - total)
-        new_keys = []
-        for _ in range(can):
-            key = f"EA-{secrets.token_hex(4).upper()}-{secrets.token_hex(4).upper()}"
-            c.execute('INSERT INTO early_access_keys (key_code) VALUES (?)', (key,))
-            new_keys.append(key)
-        conn.commit()
-    finally:
-        conn.close()
+        _, new_keys = repo.early_access_keys.generate(can, 'EA', conn=conn)
 
     log_action(admin.get('id'), 'ea_keys_generate', {'count': len(new_keys)})
     return jsonify({'success': True, 'keys': new_keys})
 
+
+# ============= ВЫГРУЗКА И ИМПОРТ КЛЮЧЕЙ =============
+
+# Кампания может насчитывать 100k ключей: выгрузка идёт потоком пачками по
+# курсору (keys.export), импорт читает тело запроса построчно и пишет пачками
+# (keys.import_codes) — весь набор не собирается в памяти ни там, ни там.
+
+_KEY_CODE = re.compile(r'[A-Z0-9][A-Z0-9-]{3,63}')
+
+
+def _keys_export(keys, name):
+    """Потоковая выгрузка ключей: ?format=csv|ndjson, ?used=0|1, ?batch="""
+    fmt = request.args.get('format') or 'csv'
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({'success': False, 'error': 'format должно быть csv или ndjson'}), 400
+    params, err = _page_params('used')
+    if err:
+        return err
+    batch = (request.args.get('batch') or '').strip() or None
+    batch_size = app.config['KEYS_BATCH_SIZE']
+    rows = keys.export(used=params.get('used'), batch=batch, batch_size=batch_size)
+
+    def lines():
+        if fmt == 'csv':
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            writer.writerow(keys.EXPORT_FIELDS)
+            for i, row in enumerate(rows, 1):
+                writer.writerow(['' if row[f] is None else row[f] for f in keys.EXPORT_FIELDS])
+                if i % batch_size == 0:
+                    yield buf.getvalue()
+                    buf.seek(0)
+                    buf.truncate()
+            yield buf.getvalue()
+            return
+        chunk = []
+        for row in rows:
+            chunk.append(json.dumps(row, ensure_ascii=False) + '\n')
+            if len(chunk) >= batch_size:
+                yield ''.join(chunk)
+                chunk = []
+        yield ''.join(chunk)
+
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    suffix = f'_{batch}' if batch else ''
+    return Response(stream_with_context(lines()), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={name}{suffix}.{fmt}'})
+
+
+def _read_key_codes(stream, fmt, stats):
+    """Коды ключей из тела запроса построчно. CSV — первая колонка (заголовок key_code
+    пропускается), NDJSON — строка или объект с key_code. Негодные строки считает stats['invalid']."""
+    text = io.TextIOWrapper(stream, encoding='utf-8', errors='replace', newline='')
+    if fmt == 'csv':
+        values = (row[0] if row else '' for row in csv.reader(text))
+    else:
+        values = (line for line in text if line.strip())
+    for value in values:
+        if fmt == 'ndjson':
+            try:
+                value = json.loads(value)
+            except ValueError:
+                value = None
+            if isinstance(value, dict):
+                value = value.get('key_code')
+        code = value.strip().upper() if isinstance(value, str) else ''
+        if code == 'KEY_CODE':
+            continue
+        if not _KEY_CODE.fullmatch(code):
+            stats['invalid'] += 1
+            continue
+        yield code
+
+
+@app.route('/admin/keys/export', methods=['GET'])
+def admin_export_keys():
+    """Выгрузить ключи Premium потоком CSV/NDJSON (только для админа)"""
+    admin, err = _require_admin()
+    if err:
+        return err
+    return _keys_export(repo.premium_keys, 'premium_keys')
+
+
+@app.route('/admin/early_access/keys/export', methods=['GET'])
+def admin_export_early_access_keys():
+    """Выгрузить ключи раннего доступа потоком CSV/NDJSON (только для админа)"""
+    admin, err = _require_admin()
+    if err:
+        return err
+    return _keys_export(repo.early_access_keys, 'early_access_keys')
+
+
+@app.route('/admin/keys/import', methods=['POST'])
+def admin_import_keys():
+    """Импорт ключей Premium из тела запроса: CSV (text/csv) или NDJSON (?format=ndjson).
+    Уже существующие коды пропускаются. ?batch= — метка кампании, иначе генерируется."""
+    admin, err = _require_admin()
+    if err:
+        return err
+
+    fmt = request.args.get('format') or ('ndjson' if 'ndjson' in (request.mimetype or '') else 'csv')
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({'success': False, 'error': 'format должно быть csv или ndjson'}), 400
+    batch = (request.args.get('batch') or '').strip()[:64] or repo.premium_keys.new_batch('IMPORT')
+
+    stats = {'invalid': 0}
+    added, duplicates = repo.premium_keys.import_codes(
+        _read_key_codes(request.stream, fmt, stats), batch=batch,
+        batch_size=app.config['KEYS_BATCH_SIZE'], pause=lambda: socketio.sleep(0))
+
+    log_action(admin.get('id'), 'keys_import', {'batch': batch, 'added': added,
+                                                'duplicates': duplicates, 'invalid': stats['invalid']})
+    return jsonify({'success': True, 'batch': batch, 'added': added,
+                    'duplicates': duplicates, 'invalid': stats['invalid']})
+
+
 @app.route('/premium/activate', methods=['POST'])
 def activate_premium():
     """Активировать Premium ключ"""
     if 'user_id' not in session:
         return jsonify({'success': False, 'error': 'Не авторизован'}), 401
     
-    data = request.json
-    key_code = data.get('key_code', '').strip().upper()
+    data = request.get_json(silent=True) or {}
+    key_code = (data.get('key_code') or '').strip().upper()
     
     if not key_code:
         return jsonify({'success': False, 'error': 'Введите ключ'}), 400
     
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Проверяем ключ
-    key = c.execute('SELECT * FROM premium_keys WHERE key_code = ?', (key_code,)).fetchone()
-    
-    if not key:
-        conn.close()
-        return jsonify({'success': False, 'error': 'Неверный ключ'}), 400
-    
-    if key['is_used']:
-        conn.close()
-        return jsonify({'success': False, 'error': 'Ключ уже использован'}), 400
-    
-    # Активируем Premium
+    # Занимаем ключ и активируем Premium в одной транзакции
     user_id = session['user_id']
-    c.execute('UPDATE users SET is_premium = 1 WHERE id = ?', (user_id,))
-    c.execute('''UPDATE premium_keys SET is_used = 1, used_by = ?, used_at = CURRENT_TIMESTAMP 
-                 WHERE key_code = ?''', (user_id, key_code))
-    
-    conn.commit()
-    conn.close()
+    with repo.transaction() as conn:
+        if not repo.premium_keys.claim(key_code, user_id, conn=conn):
+            return _key_claim_error(repo.premium_keys, key_code, conn)
+        repo.users.update(user_id, conn=conn, is_premium=1)
     
     return jsonify({'success': True, 'message': 'BeeGramm Premium активирован! '})
 
@@ -1869,29 +2702,33 @@ def upload_avatar():
     file.save(filepath)
     
     # Обновляем в БД
-    user_id = session['user_id']
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('UPDATE users SET avatar = ? WHERE id = ?', (f'avatars/{filename}', user_id))
-    conn.commit()
-    conn.close()
+    repo.users.update(session['user_id'], avatar=f'avatars/{filename}')
     
     return jsonify({'success': True, 'avatar': f'avatars/{filename}'})
 
+@app.route('/users/profiles', methods=['GET'])
+def user_profiles():
+    """Профили отправителей для кэша клиента компактного формата: ?ids=1,2,3"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'Не авторизован'}), 401
+
+    try:
+        ids = list(dict.fromkeys(int(x) for x in request.args.get('ids', '').split(',') if x.strip()))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'ids: некорректное значение'}), 400
+    limit = app.config['PROFILES_MAX_IDS']
+    if not ids or len(ids) > limit:
+        return jsonify({'success': False, 'error': f'ids: от 1 до {limit} id'}), 400
+
+    rows = repo.users.profiles(ids)
+    return jsonify({'success': True, 'profiles': {uid: wire.profile(row) for uid, row in rows.items()}})
+
 @app.route('/users/search', methods=['GET'])
 def search_users():
     """Поиск пользователей"""
     query = request.args.get('q', '')
     
-    conn = get_db()
-    users = conn.execute('''SELECT id, username, nickname, avatar, is_premium, bee_stars 
-                            FROM users 
-                            WHERE username LIKE ? OR nickname LIKE ?
-                            LIMIT 20''', 
-                         (f'%{query}%', f'%{query}%')).fetchall()
-    conn.close()
-    
-    return jsonify({'users': [dict(u) for u in users]})
+    return jsonify({'users': repo.users.search(query)})
 
 @app.route('/chats/create', methods=['POST'])
 def create_chat():
@@ -1905,68 +2742,32 @@ def create_chat():
     is_channel = data.get('is_channel', False)
     members = data.get('members', []) or []
     
-    conn = get_db()
-    c = conn.cursor()
-    
     if is_channel:
-        # Канал
+        # Канал (создатель — первый подписчик)
         name = data.get('name', 'Новый канал')
         description = data.get('description', '')
-        c.execute('''INSERT INTO chats (name, is_channel, description, creator_id, subscribers_count) 
-                     VALUES (?, ?, ?, ?, ?)''', (name, 1, description, user_id, 1))
-        chat_id = c.lastrowid
-        
-        # Добавляем создателя как подписчика
-        c.execute('INSERT INTO chat_members (chat_id, user_id) VALUES (?, ?)', 
-                  (chat_id, user_id))
+        chat_id = repo.chats.create_channel(name, description, user_id)
     elif is_group:
-        # Групповой чат
+        # Групповой чат: создатель и участники
         name = data.get('name', 'Новая группа')
         description = data.get('description', '')
-        c.execute('''INSERT INTO chats (name, is_group, description, creator_id) 
-                     VALUES (?, ?, ?, ?)''', (name, 1, description, user_id))
-        chat_id = c.lastrowid
-        
-        # Добавляем создателя
-        c.execute('INSERT INTO chat_members (chat_id, user_id) VALUES (?, ?)', 
-                  (chat_id, user_id))
-        
-        # Добавляем участников
-        for member_id in members:
-            c.execute('INSERT INTO chat_members (chat_id, user_id) VALUES (?, ?)', 
-                      (chat_id, member_id))
+        chat_id = repo.chats.create_group(name, description, user_id, members)
     else:
         # Личный чат
         other_user_id = members[0] if members else None
         if not other_user_id:
-            conn.close()
             return jsonify({'success': False, 'error': 'Укажите собеседника'}), 400
 
         if int(other_user_id) == int(user_id):
-            conn.close()
             return jsonify({'success': False, 'error': 'Нельзя создать чат с самим собой'}), 400
-        
+
         # Проверяем, есть ли уже чат с этим пользователем
-        existing = c.execute('''SELECT c.id FROM chats c
-                                JOIN chat_members cm1 ON c.id = cm1.chat_id
-                                JOIN chat_members cm2 ON c.id = cm2.chat_id
-                                WHERE c.is_group = 0 
-                                AND IFNULL(c.is_channel, 0) = 0
-                                AND cm1.user_id = ? AND cm2.user_id = ?''',
-                             (user_id, other_user_id)).fetchone()
-        
-        if existing:
-            chat_id = existing[0]
-        else:
-            c.execute('INSERT INTO chats (is_group) VALUES (?)', (0,))
-            chat_id = c.lastrowid
-            c.execute('INSERT INTO chat_members (chat_id, user_id) VALUES (?, ?)', 
-                      (chat_id, user_id))
-            c.execute('INSERT INTO chat_members (chat_id, user_id) VALUES (?, ?)', 
-                      (chat_id, other_user_id))
-    
-    conn.commit()
-    conn.close()
+        with repo.transaction() as conn:
+            chat_id = repo.chats.find_private(user_id, other_user_id, conn=conn)
+            if not chat_id:
+                chat_id = repo.chats.create_private(user_id, other_user_id, conn=conn)
+
+    _invalidate_membership([user_id] + list(members))
     
     return jsonify({'success': True, 'chat_id': chat_id})
 
@@ -1978,32 +2779,24 @@ def list_chats():
     
     user_id = session['user_id']
     
+    chats = repo.chats.for_user(user_id)
+    previews = repo.messages.previews([chat['id'] for chat in chats], user_id)
+
     conn = get_db()
-    chats = conn.execute('''SELECT DISTINCT c.id, c.name, c.is_group, c.is_channel, c.description,
-                                   c.avatar, c.creator_id, c.subscribers_count
-                            FROM chats c
-                            JOIN chat_members cm ON c.id = cm.chat_id
-                            WHERE cm.user_id = ?
-                            ORDER BY c.id DESC''', (user_id,)).fetchall()
-    
     result = []
-    for chat in chats:
-        chat_dict = dict(chat)
+    for chat_dict in chats:
+        chat = chat_dict
         
         # Для личных чатов получаем имя собеседника
         is_group = int(chat['is_group'] or 0)
         is_channel = int(chat['is_channel'] or 0)
 
         if not is_group and not is_channel:
-            other_user = conn.execute('''SELECT u.id, u.nickname, u.username, u.avatar, u.status, u.is_premium
-                                         FROM users u
-                                         JOIN chat_members cm ON u.id = cm.user_id
-                                         WHERE cm.chat_id = ? AND u.id != ?''',
-                                      (chat['id'], user_id)).fetchone()
+            other_user = repo.users.chat_partner(chat['id'], user_id, conn=conn)
             if other_user:
                 chat_dict['name'] = other_user['nickname'] or other_user['username']
                 chat_dict['avatar'] = other_user['avatar']
-                chat_dict['other_user'] = dict(other_user)
+                chat_dict['other_user'] = other_user
 
         if is_channel:
             chat_dict['type'] = 'channel'
@@ -2012,21 +2805,10 @@ def list_chats():
         else:
             chat_dict['type'] = 'private'
         
-        # Получаем последнее сообщение
-        last_msg = conn.execute('''SELECT m.*, u.nickname, u.username
-                                   FROM messages m
-                                   JOIN users u ON m.user_id = u.id
-                                   WHERE m.chat_id = ?
-                                   ORDER BY m.created_at DESC
-                                   LIMIT 1''', (chat['id'],)).fetchone()
-        
+        # Последнее сообщение и количество непрочитанных
+        last_msg, unread = previews[chat['id']]
         if last_msg:
-            chat_dict['last_message'] = dict(last_msg)
-        
-        # Количество непрочитанных
-        unread = conn.execute('''SELECT COUNT(*) FROM messages 
-                                 WHERE chat_id = ? AND user_id != ? AND is_read = 0''',
-                              (chat['id'], user_id)).fetchone()[0]
+            chat_dict['last_message'] = last_msg
         chat_dict['unread_count'] = unread
         
         result.append(chat_dict)
@@ -2037,38 +2819,578 @@ def list_chats():
 
 @app.route('/chats/<int:chat_id>/messages', methods=['GET'])
 def get_messages(chat_id):
-    """Получить сообщения чата"""
+    """Получить сообщения чата.
+
+    ?since=<version> — условная загрузка для кэша клиента: 304, если история
+    не менялась; {delta: true, messages: [...]} — только новые и изменённые
+    сообщения (удалённые, с другими реакциями); иначе — как без since.
+    В ответе всегда version — её клиент пришлёт в следующий раз.
+    """
     if 'user_id' not in session:
         return jsonify({'success': False, 'error': 'Не авторизован'}), 401
     
+    # ?limit=N[&before_id=ID] — страница от новых к старым; без limit — вся история
+    limit = request.args.get('limit', type=int)
+    before_id = request.args.get('before_id', type=int)
+    since = request.args.get('since', type=int)
+    if limit:
+        limit = max(1, min(limit, 200))
+
+    conn = repo.shard_connect(chat_id)
+    try:
+        # Помечаем сообщения как прочитанные до подсчёта версии: прочтение тоже изменение
+        # истории, и ответ уже отдаёт сообщения с is_read = 1
+        if repo.messages.mark_read(chat_id, session['user_id'], conn=conn):
+            conn.commit()
+        version = repo.messages.version(chat_id, conn=conn)
+        if since is not None and not before_id and since <= version:
+            if since == version:
+                return '', 304
+            delta = repo.messages.changed_since(chat_id, since, app.config['MESSAGES_DELTA_MAX'], conn)
+            if delta is not None:
+                reactions = repo.reactions.for_messages(chat_id, [m['id'] for m in delta], conn=conn)
+                for msg in delta:
+                    msg['reactions'] = reactions.get(msg['id'], [])
+                repo.voice.for_messages(delta)
+                return jsonify({'messages': delta, 'delta': True, 'version': version})
+
+        if limit:
+            result = repo.messages.page(chat_id, limit, before_id, conn=conn)
+        else:
+            result = repo.messages.history(chat_id, conn=conn)
+
+        # Реакции — одним запросом на страницу
+        reactions = repo.reactions.for_messages(chat_id, [m['id'] for m in result], conn=conn)
+        for msg in result:
+            msg['reactions'] = reactions.get(msg['id'], [])
+
+        # Подмешиваем архивные сообщения (горячая копия важнее — при сбое архивации бывают дубли)
+        hot_ids = {m['id'] for m in result}
+        archived = [m for m in _archive_read(conn, chat_id, before_id=before_id if limit else None, limit=limit)
+                    if m['id'] not in hot_ids]
+        if archived:
+            if limit:
+                result = sorted(result + archived, key=lambda m: m['id'], reverse=True)[:limit]
+            else:
+                result = sorted(result + archived, key=lambda m: (m['created_at'] or '', m['id']))
+        if limit:
+            result.reverse()
+        repo.voice.for_messages(result)
+    finally:
+        conn.close()
+
+    return jsonify({'messages': result, 'version': version})
+
+# ============= АРХИВ СООБЩЕНИЙ =============
+
+# Старые сообщения переезжают из beegram.db в архивные сегменты — отдельный
+# SQLite-файл на чат (archive/chat_<id>.db) со сжатыми блоками по
+# ARCHIVE_BLOCK_SIZE сообщений. get_messages читает их прозрачно.
+
+
+def _archive_path(chat_id):
+    return os.path.join(app.config['ARCHIVE_FOLDER'], f'chat_{int(chat_id)}.db')
+
+
+def _archive_write_block(chat_id, messages):
+    """Записать блок сообщений (по возрастанию id) в сегмент чата"""
+    arc = sqlite3.connect(_archive_path(chat_id))
+    try:
+        arc.execute('''CREATE TABLE IF NOT EXISTS blocks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            min_id INTEGER NOT NULL,
+            max_id INTEGER NOT NULL,
+            min_created_at TIMESTAMP,
+            max_created_at TIMESTAMP,
+            count INTEGER NOT NULL,
+            payload BLOB NOT NULL
+        )''')
+        arc.execute('CREATE INDEX IF NOT EXISTS idx_blocks_max_id ON blocks(max_id)')
+        payload = zlib.compress(json.dumps(messages, ensure_ascii=False).encode('utf-8'), 9)
+        arc.execute('''INSERT INTO blocks (min_id, max_id, min_created_at, max_created_at, count, payload)
+                       VALUES (?, ?, ?, ?, ?, ?)''',
+                    (messages[0]['id'], messages[-1]['id'], messages[0]['created_at'],
+                     messages[-1]['created_at'], len(messages), payload))
+        arc.commit()
+    finally:
+        arc.close()
+
+
+def _archive_read(conn, chat_id, before_id=None, limit=None):
+    """Архивные сообщения чата от новых к старым (в формате get_messages)"""
+    path = _archive_path(chat_id)
+    if not os.path.exists(path):
+        return []
+
+    arc = sqlite3.connect(path)
+    try:
+        query = 'SELECT payload FROM blocks'
+        params = ()
+        if before_id:
+            query += ' WHERE min_id < ?'
+            params = (before_id,)
+        query += ' ORDER BY max_id DESC'
+
+        result = []
+        seen = set()
+        for (payload,) in arc.execute(query, params):
+            for msg in json.loads(zlib.decompress(payload).decode('utf-8')):
+                if (before_id and msg['id'] >= before_id) or msg['id'] in seen:
+                    continue
+                seen.add(msg['id'])
+                result.append(msg)
+            if limit and len(result) >= limit:
+                break
+    finally:
+        arc.close()
+
+    result.sort(key=lambda m: m['id'], reverse=True)
+    if limit:
+        result = result[:limit]
+
+    # Профиль отправителя берём актуальный — как и для горячих сообщений
+    users = repo.users.profiles({m['user_id'] for m in result}, conn=conn)
+    for msg in result:
+        u = users.get(msg['user_id'])
+        msg['nickname'] = u['nickname'] if u else None
+        msg['username'] = u['username'] if u else None
+        msg['avatar'] = u['avatar'] if u else None
+        msg['is_premium'] = u['is_premium'] if u else 0
+    return result
+
+
+def _archive_has(chat_id, message_id):
+    """Лежит ли сообщение в архивном сегменте чата. Архив только для чтения:
+    реакции, удаление и жалобы на такие сообщения отклоняются явно"""
+    try:
+        chat_id, message_id = int(chat_id), int(message_id)
+    except (TypeError, ValueError):
+        return False
+    path = _archive_path(chat_id)
+    if not os.path.exists(path):
+        return False
+    arc = sqlite3.connect(path)
+    try:
+        for (payload,) in arc.execute('SELECT payload FROM blocks WHERE min_id <= ? AND max_id >= ?',
+                                      (message_id, message_id)):
+            if any(m['id'] == message_id for m in json.loads(zlib.decompress(payload).decode('utf-8'))):
+                return True
+    finally:
+        arc.close()
+    return False
+
+
+def archive_old_messages(older_than_days=None):
+    """Перенести сообщения старше порога в архивные сегменты. Возвращает число перенесённых.
+
+    Последнее сообщение чата (для превью в списке) и сообщения с открытыми
+    жалобами остаются в горячей базе.
+    """
+    days = older_than_days or app.config['ARCHIVE_AFTER_DAYS']
+    cutoff = (datetime.utcnow() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+    block_size = app.config['ARCHIVE_BLOCK_SIZE']
+    os.makedirs(app.config['ARCHIVE_FOLDER'], exist_ok=True)
+
+    moved = 0
+    for index in range(repo.shard_count()):
+        moved += _archive_shard(repo.shard_connect(index=index), cutoff, block_size)
+    return moved
+
+
+def _archive_shard(conn, cutoff, block_size):
+    moved = 0
+    try:
+        chat_ids = [r['chat_id'] for r in conn.execute(
+            'SELECT DISTINCT chat_id FROM messages WHERE created_at < ?', (cutoff,)).fetchall()]
+        for chat_id in chat_ids:
+            while True:
+                rows = conn.execute('''SELECT * FROM messages
+                                       WHERE chat_id = ? AND created_at < ?
+                                       AND id < (SELECT MAX(id) FROM messages WHERE chat_id = ?)
+                                       AND id NOT IN (SELECT message_id FROM reports WHERE status = 'open')
+                                       ORDER BY id ASC
+                                       LIMIT ?''', (chat_id, cutoff, chat_id, block_size)).fetchall()
+                if not rows:
+                    break
+
+                ids = [r['id'] for r in rows]
+                marks = ','.join('?' * len(ids))
+                reactions = defaultdict(list)
+                for r in conn.execute(f'''SELECT r.message_id, r.emoji, u.username
+                                          FROM reactions r
+                                          JOIN users u ON r.user_id = u.id
+                                          WHERE r.message_id IN ({marks})''', ids).fetchall():
+                    reactions[r['message_id']].append({'emoji': r['emoji'], 'username': r['username']})
+
+                block = []
+                for r in rows:
+                    item = dict(r)
+                    item['reactions'] = reactions.get(r['id'], [])
+                    block.append(item)
+
+                # Сначала сегмент, потом удаление: при сбое получим дубль, а не потерю
+                _archive_write_block(chat_id, block)
+                conn.execute(f'DELETE FROM reactions WHERE message_id IN ({marks})', ids)
+                conn.execute(f'DELETE FROM messages WHERE id IN ({marks})', ids)
+                conn.commit()
+                moved += len(ids)
+
+                if len(rows) < block_size:
+                    break
+    finally:
+        conn.close()
+
+    return moved
+
+
+@app.route('/admin/maintenance/archive', methods=['POST'])
+def admin_archive_messages():
+    """Запустить архивацию старых сообщений (только админ)"""
+    admin, err = _require_admin()
+    if err:
+        return err
+
+    data = request.get_json(silent=True) or {}
+    try:
+        days = int(data.get('older_than_days') or app.config['ARCHIVE_AFTER_DAYS'])
+    except Exception:
+        return jsonify({'success': False, 'error': 'older_than_days должно быть числом'}), 400
+    if days <= 0:
+        return jsonify({'success': False, 'error': 'older_than_days должно быть больше 0'}), 400
+    if repo.backend_name() != 'sqlite':
+        return jsonify({'success': False, 'error': 'Архивные сегменты поддерживаются только для SQLite'}), 400
+
+    moved = archive_old_messages(days)
+    log_action(admin.get('id'), 'messages_archive', {'older_than_days': days, 'moved': moved})
+    return jsonify({'success': True, 'moved': moved})
+
+
+# ============= СЖАТИЕ БАЗЫ (TOMBSTONES И СИРОТЫ) =============
+
+# Каждый шаг — короткая транзакция на COMPACT_BATCH_SIZE строк, между шагами
+# уступаем event loop, чтобы не держать блокировку записи и не тормозить чат.
+
+# Порядок важен: удаление сообщений-сирот порождает сирот среди реакций.
+# Шардовые правила выполняются в каждом шарде (users/chats видны через ATTACH),
+# глобальные — только в beegram.db.
+_SHARD_ORPHAN_RULES = [
+    ('messages', 'chat_id NOT IN (SELECT id FROM chats) OR user_id NOT IN (SELECT id FROM users)'),
+    ('reactions', 'message_id NOT IN (SELECT id FROM messages) OR user_id NOT IN (SELECT id FROM users)'),
+    ('message_changes', 'chat_id NOT IN (SELECT id FROM chats)'),
+]
+# Жалобы на сообщения, ушедшие в архив, остаются: проверяем только чат и автора жалобы
+_GLOBAL_ORPHAN_RULES = [
+    ('reports', 'chat_id NOT IN (SELECT id FROM chats) OR reporter_id NOT IN (SELECT id FROM users)'),
+    ('report_queue', 'chat_id NOT IN (SELECT id FROM chats)'),
+    ('support_conversations', 'chat_id NOT IN (SELECT id FROM chats)'),
+    ('chat_members', 'chat_id NOT IN (SELECT id FROM chats) OR user_id NOT IN (SELECT id FROM users)'),
+]
+
+
+def _incremental_vacuum(conn):
+    """Вернуть свободные страницы маленькими шагами. Возвращает (страниц, байт)."""
+    if repo.backend_name() != 'sqlite':
+        return 0, 0  # в Postgres место возвращает autovacuum
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    freelist_before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    step = app.config['COMPACT_VACUUM_STEP']
+    while conn.execute('PRAGMA freelist_count').fetchone()[0] > 0:
+        left = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        conn.execute(f'PRAGMA incremental_vacuum({step})').fetchall()
+        conn.commit()
+        if conn.execute('PRAGMA freelist_count').fetchone()[0] >= left:
+            break  # auto_vacuum выключен — вернуть нечего
+        socketio.sleep(0)
+    pages = freelist_before - conn.execute('PRAGMA freelist_count').fetchone()[0]
+    return pages, pages * page_size
+
+
+def _delete_in_batches(conn, table, where, params=()):
+    """DELETE по id пачками с коммитом после каждой. Возвращает число удалённых строк."""
+    batch = app.config['COMPACT_BATCH_SIZE']
+    total = 0
+    while True:
+        cur = conn.execute(f'''DELETE FROM {table} WHERE id IN (
+                                  SELECT id FROM {table} WHERE {where} LIMIT ?
+                              )''', (*params, batch))
+        conn.commit()
+        total += cur.rowcount
+        if cur.rowcount < batch:
+            return total
+        socketio.sleep(0)
+
+
+def compact_database(retention_days=None):
+    """Стереть содержимое старых tombstones, удалить сирот, вернуть страницы ОС"""
+    days = retention_days or app.config['TOMBSTONE_RETENTION_DAYS']
+    cutoff = (datetime.utcnow() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+    changes_cutoff = (datetime.utcnow() - timedelta(days=app.config['MESSAGE_CHANGES_RETENTION_DAYS'])
+                      ).strftime('%Y-%m-%d %H:%M:%S')
+    batch = app.config['COMPACT_BATCH_SIZE']
+    report = {'tombstones_purged': 0, 'changes_pruned': 0, 'orphans': defaultdict(int), 'pages_reclaimed': 0,
+              'bytes_reclaimed': 0}
+
+    for index in range(repo.shard_count()):
+        _compact_shard(repo.shard_connect(index=index), cutoff, changes_cutoff, batch, report)
+
     conn = get_db()
-    messages = conn.execute('''SELECT m.*, u.nickname, u.username, u.avatar, u.is_premium
-                               FROM messages m
-                               JOIN users u ON m.user_id = u.id
-                               WHERE m.chat_id = ?
-                               ORDER BY m.created_at ASC''', (chat_id,)).fetchall()
-    
-    result = []
-    for msg in messages:
-        msg_dict = dict(msg)
-        
-        # Получаем реакции
-        reactions = conn.execute('''SELECT r.emoji, u.username
-                                    FROM reactions r
-                                    JOIN users u ON r.user_id = u.id
-                                    WHERE r.message_id = ?''', (msg['id'],)).fetchall()
-        msg_dict['reactions'] = [dict(r) for r in reactions]
-        
-        result.append(msg_dict)
-    
-    # Помечаем сообщения как прочитанные
-    user_id = session['user_id']
-    conn.execute('''UPDATE messages SET is_read = 1 
-                    WHERE chat_id = ? AND user_id != ?''', (chat_id, user_id))
-    conn.commit()
-    conn.close()
-    
-    return jsonify({'messages': result})
+    try:
+        # Сироты после admin_delete_user / admin_delete_chat
+        for table, where in _GLOBAL_ORPHAN_RULES:
+            report['orphans'][table] += _delete_in_batches(conn, table, where)
+        if repo.shard_count() > 1:
+            pages, size = _incremental_vacuum(conn)
+            report['pages_reclaimed'] += pages
+            report['bytes_reclaimed'] += size
+        chat_ids = {r['id'] for r in conn.execute('SELECT id FROM chats').fetchall()}
+    finally:
+        conn.close()
+
+    # Архивные сегменты удалённых чатов
+    removed_segments = 0
+    folder = app.config['ARCHIVE_FOLDER']
+    if os.path.isdir(folder):
+        for name in os.listdir(folder):
+            m = re.fullmatch(r'chat_(\d+)\.db', name)
+            if m and int(m.group(1)) not in chat_ids:
+                os.remove(os.path.join(folder, name))
+                removed_segments += 1
+
+    report['orphans'] = dict(report['orphans'])
+    report['archive_segments_removed'] = removed_segments
+    return report
+
+
+def _compact_shard(conn, cutoff, changes_cutoff, batch, report):
+    try:
+        # 1. Tombstones: оставляем строку (id, чат, автор, отметка удаления), стираем содержимое.
+        #    Сообщения с открытыми жалобами не трогаем — модератору нужен текст.
+        while True:
+            cur = conn.execute('''UPDATE messages SET content = NULL, file_url = NULL
+                                   WHERE id IN (
+                                       SELECT id FROM messages
+                                       WHERE is_deleted = 1 AND deleted_at < ?
+                                       AND (content IS NOT NULL OR file_url IS NOT NULL)
+                                       AND id NOT IN (SELECT message_id FROM reports WHERE status = 'open')
+                                       LIMIT ?
+                                   )''', (cutoff, batch))
+            conn.commit()
+            report['tombstones_purged'] += cur.rowcount
+            if cur.rowcount < batch:
+                break
+            socketio.sleep(0)
+
+        report['orphans']['reactions_on_tombstones'] += _delete_in_batches(
+            conn, 'reactions',
+            'message_id IN (SELECT id FROM messages WHERE is_deleted = 1 AND deleted_at < ?)', (cutoff,))
+
+        # 2. Сироты после admin_delete_user / admin_delete_chat
+        for table, where in _SHARD_ORPHAN_RULES:
+            report['orphans'][table] += _delete_in_batches(conn, table, where)
+
+        # 3. Старый журнал изменений. Последняя запись чата остаётся — это его текущая версия
+        report['changes_pruned'] += _delete_in_batches(
+            conn, 'message_changes',
+            'created_at < ? AND id NOT IN (SELECT MAX(id) FROM message_changes GROUP BY chat_id)', (changes_cutoff,))
+
+        # 4. Возвращаем свободные страницы
+        pages, size = _incremental_vacuum(conn)
+        report['pages_reclaimed'] += pages
+        report['bytes_reclaimed'] += size
+    finally:
+        conn.close()
+
+
+@app.route('/admin/maintenance/compact', methods=['POST'])
+def admin_compact_database():
+    """Запустить сжатие базы (только админ)"""
+    admin, err = _require_admin()
+    if err:
+        return err
+
+    data = request.get_json(silent=True) or {}
+    try:
+        days = int(data.get('retention_days') or app.config['TOMBSTONE_RETENTION_DAYS'])
+    except Exception:
+        return jsonify({'success': False, 'error': 'retention_days должно быть числом'}), 400
+    if days <= 0:
+        return jsonify({'success': False, 'error': 'retention_days должно быть больше 0'}), 400
+
+    report = compact_database(days)
+    log_action(admin.get('id'), 'db_compact', report)
+    return jsonify({'success': True, 'report': report})
+
+
+def _compact_loop():
+    while True:
+        socketio.sleep(app.config['COMPACT_INTERVAL_SECONDS'])
+        try:
+            report = compact_database()
+            print(f"🧹 Сжатие БД: освобождено страниц {report['pages_reclaimed']}, "
+                  f"стёрто tombstones {report['tombstones_purged']}")
+        except Exception as e:
+            print(f'⚠️ Ошибка сжатия БД: {e}')
+
+
+def _archive_loop():
+    while True:
+        socketio.sleep(app.config['ARCHIVE_INTERVAL_SECONDS'])
+        try:
+            moved = archive_old_messages()
+            if moved:
+                print(f'📦 В архив перенесено сообщений: {moved}')
+        except Exception as e:
+            print(f'⚠️ Ошибка архивации: {e}')
+
+
+# ============= БЭКАПЫ =============
+
+# Снимки через sqlite3 backup() шагами по BACKUP_PAGES_PER_STEP страниц, между
+# шагами уступаем event loop. При WAL_ARCHIVE кадры WAL непрерывно копируются в
+# BACKUP_FOLDER/wal, восстановление и проверка — python backup.py restore/verify.
+
+_wal_archivers = {}  # путь базы -> backup.WalArchiver
+
+
+def _init_wal_archivers():
+    if not app.config['WAL_ARCHIVE'] or repo.backend_name() != 'sqlite':
+        return
+    epoch = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+    for path in repo.database_files():
+        _wal_archivers[path] = backup.WalArchiver(path, app.config['BACKUP_FOLDER'], epoch=epoch,
+                                                  restart_bytes=app.config['WAL_ARCHIVE_RESTART_BYTES'])
+
+
+def run_backup():
+    """Снять снимок всех файлов базы и почистить старые. Возвращает манифест."""
+    folder = app.config['BACKUP_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    manifest = backup.create_backup(
+        repo.database_files(), folder,
+        pages_per_step=app.config['BACKUP_PAGES_PER_STEP'],
+        pause=lambda: socketio.sleep(0),
+        max_restarts=app.config['BACKUP_MAX_RESTARTS'],
+        archivers=_wal_archivers)
+    epoch = next(iter(_wal_archivers.values())).epoch if _wal_archivers else None
+    manifest['pruned'] = backup.prune_backups(folder, app.config['BACKUP_KEEP'], current_epoch=epoch)
+    return manifest
+
+
+@app.route('/admin/maintenance/backup', methods=['POST'])
+def admin_run_backup():
+    """Снять онлайн-бэкап (только админ)"""
+    admin, err = _require_admin()
+    if err:
+        return err
+    if repo.backend_name() != 'sqlite':
+        return jsonify({'success': False, 'error': 'Встроенные бэкапы поддерживаются только для SQLite'}), 400
+
+    manifest = run_backup()
+    log_action(admin.get('id'), 'db_backup', {'name': manifest['name'], 'seconds': manifest['seconds']})
+    return jsonify({'success': True, 'backup': manifest})
+
+
+@app.route('/admin/maintenance/backups', methods=['GET'])
+def admin_list_backups():
+    """Список снимков и состояние архивации WAL (только админ)"""
+    admin, err = _require_admin()
+    if err:
+        return err
+
+    return jsonify({
+        'success': True,
+        'backups': backup.list_backups(app.config['BACKUP_FOLDER']),
+        'wal_archive': {os.path.basename(path): dict(a.stats, seq=a.position()['seq'], epoch=a.epoch)
+                        for path, a in _wal_archivers.items()},
+    })
+
+
+def _backup_loop():
+    # С архивацией WAL цепочка новой эпохи начинается со снимка — снимаем его сразу
+    if not _wal_archivers:
+        socketio.sleep(app.config['BACKUP_INTERVAL_SECONDS'])
+    while True:
+        try:
+            manifest = run_backup()
+            print(f"💾 Бэкап {manifest['name']}: {len(manifest['files'])} файлов за {manifest['seconds']} с")
+        except Exception as e:
+            print(f'⚠️ Ошибка бэкапа: {e}')
+        socketio.sleep(app.config['BACKUP_INTERVAL_SECONDS'])
+
+
+def _wal_archive_loop():
+    while True:
+        socketio.sleep(app.config['WAL_ARCHIVE_INTERVAL_SECONDS'])
+        for archiver in list(_wal_archivers.values()):
+            try:
+                archiver.tick()
+            except Exception as e:
+                print(f'⚠️ Ошибка архивации WAL {archiver.db_path}: {e}')
+            socketio.sleep(0)
+
+
+def _replica_loop():
+    while True:
+        try:
+            repo.refresh_replica(pages_per_step=app.config['BACKUP_PAGES_PER_STEP'], pause=socketio.sleep)
+        except Exception as e:
+            print(f'⚠️ Ошибка обновления реплики: {e}')
+        socketio.sleep(app.config['READ_REPLICA_REFRESH_SECONDS'])
+
+
+# Задачи запускает первый запрос или подключение к процессу — так они работают и под
+# gunicorn, где __main__ не выполняется. Счётчики, панели, очереди сокетов и голосовые
+# у каждого процесса свои; архив, бэкапы, реплику и сжатие ведёт один процесс узла —
+# тот, кто взял блокировку JOBS_LOCK_FILE (ОС снимает её вместе с процессом).
+_background_started = False
+_jobs_lock = None
+
+
+def _claim_node_jobs():
+    """Стать процессом, который ведёт задачи обслуживания файлов БД на этом узле"""
+    global _jobs_lock
+    if fcntl is None:
+        return True  # без flock (Windows) считаем процесс единственным
+    lock = open(app.config['JOBS_LOCK_FILE'], 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return False
+    _jobs_lock = lock
+    return True
+
+
+def _start_background_jobs():
+    """Фоновые задачи обслуживания БД (один раз на процесс)"""
+    global _background_started
+    if _background_started:
+        return
+    _background_started = True
+    voice.configure(workers=app.config['VOICE_WORKERS'], bitrate=app.config['VOICE_BITRATE'],
+                    points=app.config['VOICE_WAVEFORM_POINTS'], ffmpeg=app.config['VOICE_FFMPEG'])
+    voice.start()
+    if _claim_node_jobs():
+        _start_node_jobs()
+    socketio.start_background_task(_stats_loop)
+    socketio.start_background_task(_live_push_loop)
+    socketio.start_background_task(_outbound_drain_loop)
+    socketio.start_background_task(_voice_loop)
+
+
+def _start_node_jobs():
+    # Сегменты — локальные файлы узла; при общей БД Postgres их не видели бы соседи
+    if repo.backend_name() == 'sqlite':
+        socketio.start_background_task(_archive_loop)
+        _init_wal_archivers()
+        if _wal_archivers:
+            socketio.start_background_task(_wal_archive_loop)
+        if app.config['BACKUP_INTERVAL_SECONDS']:
+            socketio.start_background_task(_backup_loop)
+        if app.config['READ_REPLICA'] == 'snapshot':
+            socketio.start_background_task(_replica_loop)
+    socketio.start_background_task(_compact_loop)
+    socketio.start_background_task(_voice_requeue)
 
 @app.route('/stickers', methods=['GET'])
 def get_stickers():
@@ -2091,7 +3413,7 @@ def get_stickers():
         pack_dict = dict(pack)
         stickers = conn.execute('SELECT * FROM stickers WHERE pack_id = ?', 
                                 (pack['id'],)).fetchall()
-        pack_dict['stickers'] = [dict(s) for s in stickers]
+        pack_dict['stickers'] = stickers
         result.append(pack_dict)
     
     conn.close()
@@ -2158,7 +3480,67 @@ def upload_voice():
     filepath = os.path.join('uploads/voices', filename)
     file.save(filepath)
 
-    return jsonify({'success': True, 'file_url': f'voices/{filename}', 'filename': file.filename})
+    # Перекодирование и waveform — в пуле процессов; сообщение можно отправлять сразу
+    file_url = f'voices/{filename}'
+    repo.voice.create(file_url, session['user_id'])
+    _voice_submit(file_url)
+
+    return jsonify({'success': True, 'file_url': file_url, 'filename': file.filename})
+
+
+# ============= ОБРАБОТКА ГОЛОСОВЫХ =============
+
+# file_url -> Future из пула voice.py. Готовность опрашивает _voice_loop:
+# результат пишется в voice_notes, а если сообщение уже отправлено —
+# чат получает voice_ready и сообщение попадает в дельту истории.
+_voice_jobs = {}
+
+
+def _voice_submit(file_url):
+    # До запуска фоновых задач голосовое остаётся pending — его поставит в очередь _voice_loop
+    if not voice.running():
+        return
+    path = os.path.join(app.config['UPLOAD_FOLDER'], file_url)
+    try:
+        _voice_jobs[file_url] = voice.submit(path)
+    except Exception as e:
+        print(f'⚠️ Голосовое {file_url} не поставлено в обработку: {e}')
+        repo.voice.finish(file_url, failed=True)
+
+
+def _voice_finish(file_url, future):
+    try:
+        result = future.result()
+    except Exception as e:
+        print(f'⚠️ Ошибка обработки голосового {file_url}: {e}')
+        repo.voice.finish(file_url, failed=True)
+        return
+    url = os.path.relpath(result['path'], os.path.abspath(app.config['UPLOAD_FOLDER'])).replace(os.sep, '/')
+    note = repo.voice.finish(file_url, url, result['duration_ms'], result['waveform'])
+    if note and note['message_id']:
+        repo.messages.touch(note['chat_id'], note['message_id'])
+        _room_emit('voice_ready', {'chat_id': note['chat_id'], 'message_id': note['message_id'],
+                                   'voice': repo.voice.info(note)}, f"chat_{note['chat_id']}")
+
+
+def _voice_requeue():
+    """Голосовые, не обработанные до перезапуска. Их ставит в очередь один процесс узла
+    (_start_node_jobs), иначе каждый воркер перекодировал бы файл заново, и только те,
+    чей файл лежит здесь: при общей БД Postgres остальные загружены на другие узлы"""
+    for file_url in repo.voice.pending():
+        if file_url not in _voice_jobs and os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], file_url)):
+            _voice_submit(file_url)
+
+
+def _voice_loop():
+    while True:
+        socketio.sleep(0.2)
+        for file_url, future in [item for item in _voice_jobs.items() if item[1].done()]:
+            del _voice_jobs[file_url]
+            try:
+                _voice_finish(file_url, future)
+            except Exception as e:
+                print(f'⚠️ Ошибка сохранения голосового {file_url}: {e}')
 
 
 @app.route('/admin/stickers/packs/<int:pack_id>/upload', methods=['POST'])
@@ -2196,11 +3578,420 @@ def admin_upload_sticker_image(pack_id):
 
     return jsonify({'success': True})
 
+# ============= СТАТИСТИКА =============
+
+# Числа дашборда — готовые счётчики repository.counters, без COUNT(*) по таблицам
+
+# Поле ответа /admin/stats для итога счётчика и для его сегодняшнего бакета
+_STATS_TOTAL_FIELDS = {
+    'users': 'users',
+    'premium': 'premium',
+    'spam_blocked': 'spam_blocked',
+    'total_stars': 'total_stars',
+    'chats': 'chats',
+    'channels': 'channels',
+    'groups': 'groups',
+    'messages': 'messages',
+    'reports_open': 'reports_open',
+    'premium_keys_available': 'keys_available',
+    'early_access_keys_available': 'early_access_keys_available',
+}
+# Счётчики очереди жалоб: имя счётчика -> поле counts в /moderator/reports
+_REPORT_COUNT_FIELDS = {
+    'reports_open': 'open',
+    'reports_resolved': 'resolved',
+    'reported_messages': 'open_messages',
+}
+_STATS_TODAY_FIELDS = {
+    'messages': 'messages_today',
+    'active_chats': 'active_chats',
+    'active_users': 'active_users',
+    'users': 'signups_today',
+}
+
+
+def _stats_since(period, count):
+    """Первый бакет окна из count последних часов/дней"""
+    step = 3600 if period == 'hour' else 86400
+    hour, day = repo.time_buckets(time.time() - (count - 1) * step)
+    return hour if period == 'hour' else day
+
+
+@app.route('/admin/stats', methods=['GET'])
+def admin_stats():
+    """Сводка для дашборда админки"""
+    admin, err = _require_admin()
+    if err:
+        return err
+
+    totals = repo.counters.totals()
+    result = {'success': True}
+    for name, field in _STATS_TOTAL_FIELDS.items():
+        result[field] = totals.get(name, 0)
+    for name, field in _STATS_TODAY_FIELDS.items():
+        result[field] = repo.counters.today(name)
+    return jsonify(result)
+
+
+@app.route('/api/stats/messages', methods=['GET'])
+def api_stats_messages():
+    """Сообщения: итог, за сегодня и ряды — по часам за сутки, по дням за 30 дней"""
+    admin, err = _require_admin()
+    if err:
+        return err
+
+    return jsonify({
+        'success': True,
+        'total': repo.counters.totals().get('messages', 0),
+        'today': repo.counters.today('messages'),
+        'hourly': repo.counters.series('messages', 'hour', _stats_since('hour', 24)),
+        'daily': repo.counters.series('messages', 'day', _stats_since('day', 30)),
+    })
+
+
+@app.route('/api/stats/premium', methods=['GET'])
+def api_stats_premium():
+    """Premium: сколько сейчас, активаций сегодня и по дням за 30 дней"""
+    admin, err = _require_admin()
+    if err:
+        return err
+
+    return jsonify({
+        'success': True,
+        'count': repo.counters.totals().get('premium', 0),
+        'today': repo.counters.today('premium_activations'),
+        'daily': repo.counters.series('premium_activations', 'day', _stats_since('day', 30)),
+    })
+
+
+@app.route('/admin/stats/rebuild', methods=['POST'])
+def admin_stats_rebuild():
+    """Пересчитать итоги по таблицам (после ручных правок БД)"""
+    admin, err = _require_admin()
+    if err:
+        return err
+
+    values = repo.counters.rebuild()
+    log_action(admin['id'], 'stats_rebuild', values)
+    return jsonify({'success': True, 'totals': values})
+
+
+def _stats_loop():
+    last_prune = last_reconcile = time.monotonic()
+    while True:
+        socketio.sleep(app.config['STATS_FLUSH_SECONDS'])
+        try:
+            repo.counters.flush()
+            now = time.monotonic()
+            if now - last_prune >= 3600:
+                repo.counters.prune(app.config['STATS_HOURLY_RETENTION_DAYS'])
+                last_prune = now
+            reconcile = app.config['STATS_RECONCILE_SECONDS']
+            if reconcile and now - last_reconcile >= reconcile:
+                repo.counters.rebuild()
+                last_reconcile = now
+        except Exception as e:
+            print(f'⚠️ Ошибка записи статистики: {e}')
+
+# ============= ЖИВЫЕ ПАНЕЛИ (SOCKET.IO /admin И /moderator) =============
+
+# Админка получает изменения счётчиков, новые жалобы, записи аудита и ip_events,
+# панель модератора — новые жалобы и счётчики очереди; всё push-ом вместо опроса.
+# Записи копятся в памяти и уходят пачкой раз в ADMIN_PUSH_INTERVAL_SECONDS;
+# пока в namespace никого нет, для него ничего не копим.
+# События видит только узел, где они произошли: панель получает пачки своего узла.
+
+_LIVE_ROOMS = {'/admin': 'admins', '/moderator': 'moderators'}
+# Какие итоги счётчиков видит панель: имя счётчика -> поле в stats_delta
+_LIVE_TOTAL_FIELDS = {'/admin': _STATS_TOTAL_FIELDS, '/moderator': _REPORT_COUNT_FIELDS}
+_LIVE_TODAY_FIELDS = {'/admin': _STATS_TODAY_FIELDS, '/moderator': {}}
+
+_live_sids = {ns: set() for ns in _LIVE_ROOMS}
+_live_outbox = {ns: defaultdict(list) for ns in _LIVE_ROOMS}  # событие -> записи до следующей пачки
+_live_dropped = {ns: defaultdict(int) for ns in _LIVE_ROOMS}  # событие -> сколько записей не влезло в пачку
+_live_deltas = {ns: {'totals': defaultdict(int), 'today': defaultdict(int)} for ns in _LIVE_ROOMS}
+
+
+def _live_publish(namespace, event, item, key=None):
+    """Поставить запись в следующую пачку панели namespace.
+    key — поле, по которому новая запись заменяет ещё не отправленную прежнюю."""
+    if not _live_sids[namespace]:
+        return
+    items = _live_outbox[namespace][event]
+    if key is not None:
+        items[:] = [it for it in items if it.get(key) != item.get(key)]
+    if len(items) >= app.config['ADMIN_PUSH_MAX_ITEMS']:
+        _live_dropped[namespace][event] += 1
+        return
+    items.append(item)
+
+
+def _live_on_counter(name, delta, total, today):
+    for ns, sids in _live_sids.items():
+        if not sids:
+            continue
+        if total and name in _LIVE_TOTAL_FIELDS[ns]:
+            _live_deltas[ns]['totals'][_LIVE_TOTAL_FIELDS[ns][name]] += delta
+        if today and name in _LIVE_TODAY_FIELDS[ns]:
+            _live_deltas[ns]['today'][_LIVE_TODAY_FIELDS[ns][name]] += delta
+
+
+repo.counters.add_listener(_live_on_counter)
+
+
+def _live_now():
+    # Тот же формат, что CURRENT_TIMESTAMP в БД (UTC)
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+
+
+@socketio.on('connect', namespace='/admin')
+def admin_socket_connect():
+    claims = _current_claims()
+    if not claims or not claims['is_admin']:
+        return False
+    _live_sids['/admin'].add(request.sid)
+    join_room(_LIVE_ROOMS['/admin'])
+
+
+@socketio.on('disconnect', namespace='/admin')
+def admin_socket_disconnect():
+    _live_sids['/admin'].discard(request.sid)
+
+
+@socketio.on('connect', namespace='/moderator')
+def moderator_socket_connect():
+    if not _actor_is_mod_or_admin(_current_claims()):
+        return False
+    _live_sids['/moderator'].add(request.sid)
+    join_room(_LIVE_ROOMS['/moderator'])
+
+
+@socketio.on('disconnect', namespace='/moderator')
+def moderator_socket_disconnect():
+    _live_sids['/moderator'].discard(request.sid)
+
+
+def _live_push():
+    """Отправить накопленное одной пачкой на событие в каждую панель"""
+    for ns, room in _LIVE_ROOMS.items():
+        outbox, dropped, deltas = _live_outbox[ns], _live_dropped[ns], _live_deltas[ns]
+        if not _live_sids[ns]:
+            outbox.clear()
+            dropped.clear()
+            for d in deltas.values():
+                d.clear()
+            continue
+
+        totals = {k: v for k, v in deltas['totals'].items() if v}
+        today = {k: v for k, v in deltas['today'].items() if v}
+        for d in deltas.values():
+            d.clear()
+        if totals or today:
+            socketio.emit('stats_delta', {'totals': totals, 'today': today}, namespace=ns, to=room)
+
+        items = dict(outbox)
+        lost = dict(dropped)
+        outbox.clear()
+        dropped.clear()
+        for event in set(items) | set(lost):
+            socketio.emit(event, {'items': items.get(event, []), 'dropped': lost.get(event, 0)},
+                          namespace=ns, to=room)
+
+
+def _live_push_loop():
+    while True:
+        socketio.sleep(app.config['ADMIN_PUSH_INTERVAL_SECONDS'])
+        try:
+            _live_push()
+        except Exception as e:
+            print(f'⚠️ Ошибка рассылки панелям: {e}')
+
+# ============= ИСХОДЯЩИЕ СОБЫТИЯ (BACKPRESSURE) =============
+
+# Политика доставки по классам событий, когда клиент не успевает читать:
+#   coalesce — держим только последнее значение по ключу и досылаем, когда очередь разгребётся
+#   drop     — выбрасываем (устаревший ICE-кандидат никому не нужен)
+#   keep     — доставляем всегда; если очередь переполнена — отключаем клиента с подсказкой resync
+_OUTBOUND_POLICY = {
+    'user_typing': 'coalesce',
+    'reactions_updated': 'coalesce',
+    'bee_stars_updated': 'coalesce',
+    'call_ice': 'drop',
+    'new_message': 'keep',
+    'message_deleted': 'keep',
+}
+# Поле payload, по которому сворачиваются coalesce-события (внутри одной комнаты)
+_OUTBOUND_COALESCE_FIELD = {
+    'user_typing': 'user_id',
+    'reactions_updated': 'message_id',
+    'bee_stars_updated': 'user_id',
+}
+
+_outbound_pending = defaultdict(dict)  # sid -> {(event, room, key): payload}
+# sid клиентов компактного формата. Каждый из них состоит ещё и в комнате-двойнике
+# <room>~c: сжатые события кодируются один раз и уходят туда одним emit
+_compact_sids = set()
+_outbound_stats = defaultdict(int)  # counter -> value
+
+
+def _outbound_depth(eio_sid):
+    """Сколько пакетов ждут отправки клиенту (очередь engine.io)"""
+    sock = socketio.server.eio.sockets.get(eio_sid)
+    if sock is None:
+        return 0
+    try:
+        return sock.queue.qsize()
+    except Exception:
+        return 0
+
+
+def _outbound_flush(sid):
+    """Дослать свёрнутые события клиенту, который разгрёб очередь"""
+    pending = _outbound_pending.pop(sid, None)
+    if not pending:
+        return
+    for (event, _room, _key), payload in pending.items():
+        socketio.emit(event, payload, to=sid)
+
+
+def _outbound_drain_loop():
+    """Досылать свёрнутое клиентам, чья очередь опустилась ниже мягкого лимита.
+    Без этого последнее состояние (реакции, «перестал печатать») в затихшей
+    комнате ждало бы следующего события и могло не прийти вовсе."""
+    while True:
+        socketio.sleep(app.config['OUTBOUND_DRAIN_SECONDS'])
+        manager = socketio.server.manager
+        for sid in list(_outbound_pending):
+            if not manager.is_connected(sid, '/'):
+                _outbound_pending.pop(sid, None)
+                continue
+            if _outbound_depth(manager.eio_sid_from_sid(sid, '/')) < app.config['OUTBOUND_SOFT_LIMIT']:
+                _outbound_flush(sid)
+
+
+def _evict_slow_consumer(sid, eio_sid, depth):
+    """Отключить клиента, который не успевает получать обязательные события"""
+    _outbound_stats['evicted'] += 1
+    _outbound_pending.pop(sid, None)
+    sock = socketio.server.eio.sockets.get(eio_sid)
+    if sock is None:
+        # Сокета engine.io уже нет (или это тестовый клиент) — закрываем только Socket.IO
+        socketio.emit('resync_required', {'reason': 'slow_consumer'}, to=sid)
+        socketio.server.disconnect(sid)
+        return
+    # Накопленное клиенту уже не поможет (он перезагрузит состояние), а в памяти держит
+    # сотни пакетов: выбрасываем очередь, чтобы подсказка resync ушла первой
+    while True:
+        try:
+            sock.queue.get_nowait()
+        except Exception:
+            break
+        sock.queue.task_done()
+    socketio.emit('resync_required', {'reason': 'slow_consumer'}, to=sid)
+    # Закрываем сокет engine.io целиком; close() ждёт отправки очереди — не в этом гринлете
+    socketio.start_background_task(socketio.server.eio.disconnect, eio_sid)
+
+
+def _join_room(room):
+    """join_room с комнатой-двойником для клиента компактного формата"""
+    join_room(room)
+    if request.sid in _compact_sids:
+        join_room(f'{room}~c')
+
+
+def _leave_room(room):
+    leave_room(room)
+    if request.sid in _compact_sids:
+        leave_room(f'{room}~c')
+
+
+def _room_emit(event, payload, room, skip_sid=None):
+    """Рассылка в комнату с учётом переполненных очередей отдельных клиентов.
+
+    Быстрый путь — обычный emit в комнату. Клиенты с глубокой очередью
+    исключаются из общей рассылки и обслуживаются по политике события.
+    Клиентам компактного формата событие из wire.ENCODERS уходит отдельным
+    emit в комнату-двойник — MessagePack кодируется один раз на всю комнату.
+    """
+    slow = []
+    compact = []
+    for sid, eio_sid in socketio.server.manager.get_participants('/', room):
+        if sid == skip_sid:
+            continue
+        if sid in _compact_sids:
+            compact.append(sid)
+        depth = _outbound_depth(eio_sid)
+        if depth >= app.config['OUTBOUND_SOFT_LIMIT'] or sid in _outbound_pending:
+            slow.append((sid, eio_sid, depth))
+
+    packed = wire.encode(event, payload) if compact else None
+    _outbound_stats['emitted'] += 1
+    if not slow and packed is None:
+        socketio.emit(event, payload, room=room, skip_sid=skip_sid)
+        return
+
+    skip = [sid for sid, _, _ in slow]
+    if skip_sid:
+        skip.append(skip_sid)
+    if packed is None:
+        socketio.emit(event, payload, room=room, skip_sid=skip)
+    else:
+        _outbound_stats['compact'] += 1
+        socketio.emit(event, payload, room=room, skip_sid=skip + compact)
+        socketio.emit(event, packed, room=f'{room}~c', skip_sid=skip)
+
+    policy = _OUTBOUND_POLICY.get(event, 'keep')
+    for sid, eio_sid, depth in slow:
+        data = packed if packed is not None and sid in _compact_sids else payload
+        if depth < app.config['OUTBOUND_SOFT_LIMIT']:
+            # Очередь разгрузилась — сначала досылаем свёрнутое
+            _outbound_flush(sid)
+            socketio.emit(event, data, to=sid)
+        elif policy == 'drop':
+            _outbound_stats['dropped'] += 1
+        elif policy == 'coalesce':
+            key = (event, room, (payload or {}).get(_OUTBOUND_COALESCE_FIELD.get(event)))
+            _outbound_pending[sid][key] = data
+            _outbound_stats['coalesced'] += 1
+        elif depth >= app.config['OUTBOUND_HARD_LIMIT']:
+            _evict_slow_consumer(sid, eio_sid, depth)
+        else:
+            socketio.emit(event, data, to=sid)
+
+
+@app.route('/admin/socket/queues', methods=['GET'])
+def admin_socket_queues():
+    """Метрики исходящих очередей Socket.IO (только админ)"""
+    admin, err = _require_admin()
+    if err:
+        return err
+
+    depths = []
+    for eio_sid in list(socketio.server.eio.sockets.keys()):
+        depths.append((_outbound_depth(eio_sid), eio_sid))
+    depths.sort(reverse=True)
+
+    return jsonify({
+        'success': True,
+        'clients': len(depths),
+        'max_depth': depths[0][0] if depths else 0,
+        'total_depth': sum(d for d, _ in depths),
+        'over_soft_limit': sum(1 for d, _ in depths if d >= app.config['OUTBOUND_SOFT_LIMIT']),
+        'pending_coalesced': sum(len(p) for p in _outbound_pending.values()),
+        'compact_clients': len(_compact_sids),
+        'soft_limit': app.config['OUTBOUND_SOFT_LIMIT'],
+        'hard_limit': app.config['OUTBOUND_HARD_LIMIT'],
+        'counters': dict(_outbound_stats),
+        'top': [{'eio_sid': s, 'depth': d} for d, s in depths[:20]]
+    })
+
 # ============= SOCKET.IO СОБЫТИЯ =============
 
 @socketio.on('connect')
-def handle_connect():
-    """Подключение клиента"""
+def handle_connect(auth=None):
+    """Подключение клиента. Без cookie сессии можно войти токеном из /login: auth={token}.
+    auth={format: 'compact'} — компактный формат событий (wire.py)"""
+    _start_background_jobs()
     ip = _get_client_ip()
     if _is_ip_blocked(ip):
         try:
@@ -2214,48 +4005,72 @@ def handle_connect():
         _log_suspicious_ip(ip, 'socket_connect_rate', 'connect')
         return False
 
+    if 'user_id' not in session and isinstance(auth, dict) and auth.get('token'):
+        uid = _bearer_user_id(auth['token'])
+        if uid is None:
+            return False
+        session['user_id'] = uid
+        session['claims'] = auth['token']
+
+    requested = auth.get('format') if isinstance(auth, dict) else None
+    if wire.negotiate(requested, app.config['SOCKET_COMPACT_ENABLED']) == 'compact':
+        _compact_sids.add(request.sid)
+
     if 'user_id' in session:
-        join_room(f"user_{session['user_id']}")
+        _join_room(f"user_{session['user_id']}")
 
     print('Client connected')
 
 @socketio.on('disconnect')
 def handle_disconnect():
     """Отключение клиента"""
+    _outbound_pending.pop(request.sid, None)
+    _compact_sids.discard(request.sid)
+    key, call, user_id = _call_of_sid(request.sid)
+    if call:
+        _call_hangup(key, call, user_id)
     print('Client disconnected')
 
 @socketio.on('join_chat')
 def handle_join_chat(data):
-    """Присоединение к чату"""
-    if 'user_id' in session:
-        user = get_user_by_id(session['user_id'])
-        if not _has_early_access_user(user):
-            emit('message_error', {'error': 'Нужен Early Access ключ'})
-            return
+    """Присоединение к чату. Ack — вошёл ли клиент в комнату: только тогда его кэш истории
+    может считаться свежим без запросов (события комнаты до него дойдут)"""
+    claims = _current_claims()
+    if claims and not _has_early_access_user(claims):
+        emit('message_error', {'error': 'Нужен Early Access ключ'})
+        return False
     chat_id = data.get('chat_id')
-    join_room(f'chat_{chat_id}')
+    if not claims or not _is_chat_member(claims['id'], chat_id):
+        emit('message_error', {'error': 'Нет доступа к чату'})
+        return False
+    _join_room(f'chat_{chat_id}')
     emit('joined_chat', {'chat_id': chat_id})
+    return True
 
 @socketio.on('leave_chat')
 def handle_leave_chat(data):
     """Выход из чата"""
     chat_id = data.get('chat_id')
-    leave_room(f'chat_{chat_id}')
+    _leave_room(f'chat_{chat_id}')
 
 @socketio.on('send_message')
 def handle_send_message(data):
     """Отправка сообщения"""
     chat_id = data.get('chat_id')
-    user_id = data.get('user_id')
     content = data.get('content')
     message_type = data.get('message_type', 'text')
     file_url = data.get('file_url')
 
-    if 'user_id' in session:
-        user = get_user_by_id(session['user_id'])
-        if not _has_early_access_user(user):
-            emit('message_error', {'error': 'Нужен Early Access ключ'})
-            return
+    # Отправитель — только из claims сессии; user_id из payload не используется
+    sender = _current_claims()
+    if sender and not _has_early_access_user(sender):
+        emit('message_error', {'error': 'Нужен Early Access ключ'})
+        return
+
+    if not sender or not _is_chat_member(sender['id'], chat_id):
+        emit('message_error', {'error': 'Нет доступа к чату'})
+        return
+    user_id = sender['id']
 
     ip = _get_client_ip()
     if not _rate_check(_rate_socket, (ip, 'send_message'), limit=45, per_seconds=10):
@@ -2264,54 +4079,31 @@ def handle_send_message(data):
         return
 
     # Бан: запрещаем отправку любых сообщений
-    try:
-        conn = get_db()
-        row = conn.execute('SELECT banned_until, is_admin FROM users WHERE id = ?', (user_id,)).fetchone()
-        if row and (not row['is_admin']):
-            banned_until = int(row['banned_until'] or 0)
-            now_ts = int(time.time())
-            if banned_until and banned_until > now_ts:
-                mins_left = max(1, int((banned_until - now_ts + 59) / 60))
-                conn.close()
-                emit('message_error', {'error': f'Вы забанены. Осталось ~{mins_left} мин.'})
-                return
-        conn.close()
-    except Exception:
-        try:
-            conn.close()
-        except Exception:
-            pass
+    if not sender['is_admin']:
+        banned_until = int(sender['banned_until'] or 0)
+        now_ts = int(time.time())
+        if banned_until and banned_until > now_ts:
+            mins_left = max(1, int((banned_until - now_ts + 59) / 60))
+            emit('message_error', {'error': f'Вы забанены. Осталось ~{mins_left} мин.'})
+            return
 
     # Спам-блок: запрещаем инициировать личные сообщения тем, кто ещё не писал тебе
     try:
-        conn = get_db()
-        sender = conn.execute('SELECT spam_blocked, is_admin, is_moderator FROM users WHERE id = ?', (user_id,)).fetchone()
-        if sender and sender['spam_blocked'] and not sender['is_admin'] and not sender['is_moderator']:
-            chat = conn.execute('SELECT id, is_group, is_channel FROM chats WHERE id = ?', (chat_id,)).fetchone()
+        if sender['spam_blocked'] and not sender['is_admin'] and not sender['is_moderator']:
+            chat = repo.chats.get(chat_id)
             if chat and (not chat['is_group']) and (not chat.get('is_channel')):
-                other = conn.execute('''SELECT user_id FROM chat_members WHERE chat_id = ? AND user_id != ? LIMIT 1''',
-                                    (chat_id, user_id)).fetchone()
+                other = repo.users.chat_partner(chat_id, user_id)
                 if other:
-                    other_has_replied = conn.execute('''SELECT 1 FROM messages WHERE chat_id = ? AND user_id = ? LIMIT 1''',
-                                                   (chat_id, other['user_id'])).fetchone()
-                    if not other_has_replied:
-                        conn.close()
+                    if not repo.messages.user_has_posted(chat_id, other['id']):
                         emit('message_error', {'error': 'Спам-блок: нельзя писать пользователю, пока он сам не напишет вам'})
                         return
-        conn.close()
     except Exception:
-        try:
-            conn.close()
-        except Exception:
-            pass
-    
+        pass
+
     # Лимит длины текстовых сообщений
     if message_type == 'text' and content is not None:
         try:
-            conn = get_db()
-            sender = conn.execute('SELECT is_premium FROM users WHERE id = ?', (user_id,)).fetchone()
-            conn.close()
-            max_len = 1000 if (sender and sender['is_premium']) else 500
+            max_len = 1000 if sender['is_premium'] else 500
             if len(content) > max_len:
                 emit('message_error', {
                     'error': f'Слишком длинное сообщение (макс. {max_len} символов)'
@@ -2332,177 +4124,224 @@ def handle_send_message(data):
             try:
                 amount = int(parts[2])
                 
-                conn = get_db()
-                c = conn.cursor()
-                
-                # Получаем отправителя
-                sender = c.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
-                
                 # Получаем получателя
-                receiver = c.execute('SELECT * FROM users WHERE username = ?', 
-                                     (target_username,)).fetchone()
-                
-                if receiver and sender['bee_stars'] >= amount and amount > 0:
-                    # Переводим пчёлок
-                    c.execute('UPDATE users SET bee_stars = bee_stars - ? WHERE id = ?',
-                              (amount, user_id))
-                    c.execute('UPDATE users SET bee_stars = bee_stars + ? WHERE id = ?',
-                              (amount, receiver['id']))
-                    conn.commit()
-                    
+                receiver = repo.users.get_by_username(target_username)
+
+                # Баланс проверяет само списание (bee_stars >= amount) в одной транзакции с зачислением
+                balances = repo.stars.transfer(user_id, receiver['id'], amount) if receiver else None
+                if balances:
                     # Отправляем системное сообщение
-                    c.execute('''INSERT INTO messages (chat_id, user_id, content, message_type)
-                                 VALUES (?, ?, ?, ?)''',
-                              (chat_id, user_id, 
-                               f" Отправил(а) {amount} пчёлок пользователю @{target_username}!",
-                               'system'))
-                    msg_id = c.lastrowid
-                    conn.commit()
-                    
-                    # Отправляем обновление
-                    msg = c.execute('''SELECT m.*, u.nickname, u.username, u.avatar, u.is_premium
-                                       FROM messages m
-                                       JOIN users u ON m.user_id = u.id
-                                       WHERE m.id = ?''', (msg_id,)).fetchone()
-                    
-                    emit('new_message', dict(msg), room=f'chat_{chat_id}')
-                    emit('bee_stars_updated', {
+                    msg = repo.messages.insert(chat_id, user_id,
+                                         f" Отправил(а) {amount} пчёлок пользователю @{target_username}!",
+                                         'system')
+
+                    _room_emit('new_message', msg, f'chat_{chat_id}')
+                    _room_emit('bee_stars_updated', {
                         'user_id': user_id,
-                        'bee_stars': sender['bee_stars'] - amount
-                    }, room=f'chat_{chat_id}')
-                    
-                conn.close()
+                        'bee_stars': balances[0]
+                    }, f'chat_{chat_id}')
+                    _room_emit('bee_stars_updated', {
+                        'user_id': receiver['id'],
+                        'bee_stars': balances[1]
+                    }, f"user_{receiver['id']}")
+
                 return
             except:
                 pass
     
     # Сохраняем сообщение
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('''INSERT INTO messages (chat_id, user_id, content, message_type, file_url)
-                 VALUES (?, ?, ?, ?, ?)''',
-              (chat_id, user_id, content, message_type, file_url))
-    msg_id = c.lastrowid
-    conn.commit()
-    
-    # Получаем полное сообщение
-    msg = c.execute('''SELECT m.*, u.nickname, u.username, u.avatar, u.is_premium
-                       FROM messages m
-                       JOIN users u ON m.user_id = u.id
-                       WHERE m.id = ?''', (msg_id,)).fetchone()
-    conn.close()
-    
+    msg = repo.messages.insert(chat_id, user_id, content, message_type, file_url)
+    if message_type == 'voice' and file_url:
+        note = repo.voice.attach(file_url, user_id, chat_id, msg['id'])
+        if note and note['status'] == 'ready':
+            msg['voice'] = repo.voice.info(note)
+
     # Отправляем всем в чате
-    emit('new_message', dict(msg), room=f'chat_{chat_id}')
+    _room_emit('new_message', msg, f'chat_{chat_id}')
 
 @socketio.on('add_reaction')
 def handle_add_reaction(data):
     """Добавление реакции"""
     message_id = data.get('message_id')
-    user_id = data.get('user_id')
     emoji = data.get('emoji')
     chat_id = data.get('chat_id')
+
+    claims = _current_claims()
+    if not claims or not _is_chat_member(claims['id'], chat_id):
+        emit('message_error', {'error': 'Нет доступа к чату'})
+        return
+    user_id = claims['id']
     
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Проверяем, есть ли уже такая реакция
-    existing = c.execute('''SELECT id FROM reactions 
-                            WHERE message_id = ? AND user_id = ? AND emoji = ?''',
-                         (message_id, user_id, emoji)).fetchone()
-    
-    if existing:
-        # Удаляем реакцию
-        c.execute('DELETE FROM reactions WHERE id = ?', (existing[0],))
-    else:
-        # Добавляем реакцию
-        c.execute('INSERT INTO reactions (message_id, user_id, emoji) VALUES (?, ?, ?)',
-                  (message_id, user_id, emoji))
-    
-    conn.commit()
-    
-    # Получаем все реакции на сообщение
-    reactions = c.execute('''SELECT r.emoji, u.username
-                             FROM reactions r
-                             JOIN users u ON r.user_id = u.id
-                             WHERE r.message_id = ?''', (message_id,)).fetchall()
-    conn.close()
-    
+    msg = repo.messages.get(message_id, chat_id=chat_id)
+    if not msg and _archive_has(chat_id, message_id):
+        emit('message_error', {'error': 'Сообщение в архиве', 'archived': True, 'message_id': message_id})
+        return
+    if not msg or str(msg['chat_id']) != str(chat_id):
+        return
+
+    # Ставим или снимаем реакцию и получаем все реакции на сообщение
+    reactions = repo.reactions.toggle(chat_id, message_id, user_id, emoji)
+
     # Отправляем обновление
-    emit('reactions_updated', {
+    _room_emit('reactions_updated', {
+        'chat_id': chat_id,
         'message_id': message_id,
-        'reactions': [dict(r) for r in reactions]
-    }, room=f'chat_{chat_id}')
+        'reactions': reactions
+    }, f'chat_{chat_id}')
 
 
 @socketio.on('typing')
 def handle_typing(data):
     """Пользователь печатает"""
     chat_id = data.get('chat_id')
-    user_id = data.get('user_id')
     is_typing = data.get('is_typing')
 
     ip = _get_client_ip()
     if not _rate_check(_rate_socket, (ip, 'typing'), limit=60, per_seconds=10):
         return
 
-    if 'user_id' in session:
-        user = get_user_by_id(session['user_id'])
-        if not _has_early_access_user(user):
-            return
-    
-    user = get_user_by_id(user_id)
+    claims = _current_claims()
+    if not _has_early_access_user(claims) or not _is_chat_member(claims['id'], chat_id):
+        return
     
-    emit('user_typing', {
-        'user_id': user_id,
-        'username': user['nickname'] or user['username'],
+    _room_emit('user_typing', {
+        'user_id': claims['id'],
+        'username': claims['name'],
         'is_typing': is_typing
-    }, room=f'chat_{chat_id}', include_self=False)
+    }, f'chat_{chat_id}', skip_sid=request.sid)
 
 
 @socketio.on('delete_message')
 def handle_delete_message(data):
     message_id = data.get('message_id')
-    user_id = data.get('user_id')
     chat_id = data.get('chat_id')
 
-    if not message_id or not user_id or not chat_id:
+    if not message_id or not chat_id:
         emit('message_error', {'error': 'Некорректные данные'})
         return
 
-    actor = get_user_by_id(user_id)
-    if not actor:
-        emit('message_error', {'error': 'Пользователь не найден'})
+    actor = _current_claims()
+    if not actor or not _is_chat_member(actor['id'], chat_id):
+        emit('message_error', {'error': 'Нет доступа к чату'})
         return
+    user_id = actor['id']
 
-    conn = get_db()
-    c = conn.cursor()
-    msg = c.execute('SELECT id, chat_id, user_id, is_deleted FROM messages WHERE id = ?', (message_id,)).fetchone()
+    msg = repo.messages.get(message_id, chat_id=chat_id)
+    if not msg and _archive_has(chat_id, message_id):
+        emit('message_error', {'error': 'Сообщение в архиве', 'archived': True, 'message_id': message_id})
+        return
     if not msg or msg['chat_id'] != chat_id:
-        conn.close()
         emit('message_error', {'error': 'Сообщение не найдено'})
         return
 
     if msg['is_deleted']:
-        conn.close()
         return
 
     can_delete = (msg['user_id'] == user_id) or actor.get('is_admin') or actor.get('is_moderator')
     if not can_delete:
-        conn.close()
         emit('message_error', {'error': 'Нет прав на удаление'})
         return
 
-    c.execute('''UPDATE messages
-                 SET is_deleted = 1, deleted_at = CURRENT_TIMESTAMP, deleted_by = ?
-                 WHERE id = ?''', (user_id, message_id))
-    conn.commit()
-    conn.close()
+    repo.messages.soft_delete(message_id, chat_id, user_id)
 
-    emit('message_deleted', {
+    _room_emit('message_deleted', {
         'message_id': message_id,
         'chat_id': chat_id
-    }, room=f'chat_{chat_id}')
+    }, f'chat_{chat_id}')
+
+
+# ============= ЗВОНКИ (СИГНАЛИНГ) =============
+
+# Сессии звонков в памяти процесса. Оффер один раз проверяет claims, early
+# access и членство обоих собеседников в чате и заводит сессию; answer
+# принимается только от вызванного и привязывает к ней его сокет. ICE и
+# hangup ищут сессию по sid сокета — без claims и БД. Кандидаты копятся
+# CALL_ICE_BATCH_MS и уходят собеседнику одним call_ice со списком candidates.
+# Неотвеченный оффер живёт CALL_RING_SECONDS, разговор — не дольше
+# CALL_MAX_SECONDS; отключение сокета участника завершает звонок.
+_calls = {}  # (chat_id, user_a, user_b) -> сессия звонка
+_call_by_sid = {}  # sid -> ключ сессии
+
+
+def _call_key(chat_id, user_a, user_b):
+    return (chat_id, min(user_a, user_b), max(user_a, user_b))
+
+
+def _call_drop(key):
+    call = _calls.pop(key, None)
+    if call:
+        for sid in call['sids'].values():
+            if _call_by_sid.get(sid) == key:
+                _call_by_sid.pop(sid, None)
+    return call
+
+
+def _call_expire():
+    now = time.monotonic()
+    for key in [k for k, c in _calls.items() if c['expires'] <= now]:
+        _call_drop(key)
+
+
+def _call_get(key):
+    call = _calls.get(key)
+    if call and call['expires'] <= time.monotonic():
+        _call_drop(key)
+        return None
+    return call
+
+
+def _call_of_sid(sid):
+    """(ключ, сессия, user_id) звонка, к которому привязан сокет, или (None, None, None).
+    Устаревшую привязку (сессии нет или сокет в ней уже не числится) удаляет."""
+    key = _call_by_sid.get(sid)
+    call = _call_get(key) if key else None
+    user_id = next((uid for uid, s in call['sids'].items() if s == sid), None) if call else None
+    if user_id is None:
+        if key:
+            _call_by_sid.pop(sid, None)
+        return None, None, None
+    return key, call, user_id
+
+
+def _call_bind(sid, key):
+    """Привязать сокет к звонку key; прежний звонок этого сокета завершается —
+    один сокет не участвует в двух звонках"""
+    old_key, old_call, old_user_id = _call_of_sid(sid)
+    if old_call and old_key != key:
+        _call_hangup(old_key, old_call, old_user_id)
+    _call_by_sid[sid] = key
+
+
+def _call_peer_room(call, user_id):
+    """Куда слать собеседнику user_id: его сокет в звонке или, пока не ответил, все его вкладки"""
+    peer = call['callee'] if user_id == call['caller'] else call['caller']
+    sid = call['sids'].get(peer)
+    return peer, (sid or f'user_{peer}')
+
+
+def _call_ice_flush(key, from_user_id):
+    socketio.sleep(app.config['CALL_ICE_BATCH_MS'] / 1000)
+    call = _call_get(key)
+    if not call:
+        return
+    candidates = call['ice'].pop(from_user_id, None)
+    if candidates:
+        _, room = _call_peer_room(call, from_user_id)
+        _room_emit('call_ice', {
+            'from_user_id': from_user_id,
+            'chat_id': call['chat_id'],
+            'candidates': candidates
+        }, room)
+
+
+def _call_from_payload(data, claims):
+    """Сессия по (chat_id, to_user_id) из payload для сокета, ещё не привязанного к звонку"""
+    try:
+        chat_id, to_user_id = int(data.get('chat_id')), int(data.get('to_user_id'))
+    except (TypeError, ValueError):
+        return None, None
+    key = _call_key(chat_id, claims['id'], to_user_id)
+    return key, _call_get(key)
 
 
 @socketio.on('call_offer')
@@ -2512,24 +4351,38 @@ def handle_call_offer(data):
         _log_suspicious_ip(ip, 'socket_rate', 'call_offer')
         return
 
-    if 'user_id' not in session:
-        return
-
-    user = get_user_by_id(session['user_id'])
-    if not _has_early_access_user(user):
+    claims = _current_claims()
+    if not _has_early_access_user(claims):
         return
 
-    to_user_id = data.get('to_user_id')
-    chat_id = data.get('chat_id')
     sdp = data.get('sdp')
-    if not to_user_id or not chat_id or not sdp:
+    try:
+        to_user_id, chat_id = int(data.get('to_user_id')), int(data.get('chat_id'))
+    except (TypeError, ValueError):
+        return
+    if not sdp or to_user_id == claims['id']:
+        return
+    if not _is_chat_member(claims['id'], chat_id) or not _is_chat_member(to_user_id, chat_id):
         return
 
-    emit('call_offer', {
-        'from_user_id': session['user_id'],
+    _call_expire()
+    key = _call_key(chat_id, claims['id'], to_user_id)
+    _call_drop(key)  # повторный оффер заменяет прежнюю сессию
+    _call_bind(request.sid, key)
+    _calls[key] = {
+        'chat_id': chat_id,
+        'caller': claims['id'],
+        'callee': to_user_id,
+        'sids': {claims['id']: request.sid},
+        'ice': {},
+        'expires': time.monotonic() + app.config['CALL_RING_SECONDS'],
+    }
+
+    _room_emit('call_offer', {
+        'from_user_id': claims['id'],
         'chat_id': chat_id,
         'sdp': sdp
-    }, room=f"user_{to_user_id}")
+    }, f"user_{to_user_id}")
 
 @socketio.on('call_answer')
 def handle_call_answer(data):
@@ -2537,24 +4390,25 @@ def handle_call_answer(data):
     if not _rate_check(_rate_socket, (ip, 'call_answer'), limit=10, per_seconds=60):
         return
 
-    if 'user_id' not in session:
-        return
-
-    user = get_user_by_id(session['user_id'])
-    if not _has_early_access_user(user):
+    claims = _current_claims()
+    if not _has_early_access_user(claims):
         return
 
-    to_user_id = data.get('to_user_id')
-    chat_id = data.get('chat_id')
     sdp = data.get('sdp')
-    if not to_user_id or not chat_id or not sdp:
+    key, call = _call_from_payload(data, claims)
+    # Отвечать может только вызванный, и только на живой оффер
+    if not sdp or not call or call['callee'] != claims['id'] or claims['id'] in call['sids']:
         return
 
-    emit('call_answer', {
-        'from_user_id': session['user_id'],
-        'chat_id': chat_id,
+    _call_bind(request.sid, key)
+    call['sids'][claims['id']] = request.sid
+    call['expires'] = time.monotonic() + app.config['CALL_MAX_SECONDS']
+
+    _room_emit('call_answer', {
+        'from_user_id': claims['id'],
+        'chat_id': call['chat_id'],
         'sdp': sdp
-    }, room=f"user_{to_user_id}")
+    }, call['sids'][call['caller']])
 
 
 @socketio.on('call_ice')
@@ -2563,24 +4417,15 @@ def handle_call_ice(data):
     if not _rate_check(_rate_socket, (ip, 'call_ice'), limit=120, per_seconds=60):
         return
 
-    if 'user_id' not in session:
-        return
-
-    user = get_user_by_id(session['user_id'])
-    if not _has_early_access_user(user):
-        return
-
-    to_user_id = data.get('to_user_id')
-    chat_id = data.get('chat_id')
+    key, call, user_id = _call_of_sid(request.sid)
     candidate = data.get('candidate')
-    if not to_user_id or not chat_id or not candidate:
+    if not call or not candidate:
         return
 
-    emit('call_ice', {
-        'from_user_id': session['user_id'],
-        'chat_id': chat_id,
-        'candidate': candidate
-    }, room=f"user_{to_user_id}")
+    pending = call['ice'].setdefault(user_id, [])
+    pending.append(candidate)
+    if len(pending) == 1:
+        socketio.start_background_task(_call_ice_flush, key, user_id)
 
 
 @socketio.on('call_hangup')
@@ -2589,41 +4434,34 @@ def handle_call_hangup(data):
     if not _rate_check(_rate_socket, (ip, 'call_hangup'), limit=30, per_seconds=60):
         return
 
-    if 'user_id' not in session:
-        return
+    key, call, user_id = _call_of_sid(request.sid)
+    if not call:
+        # Отклонить входящий звонок можно с любой вкладки вызванного
+        claims = _current_claims()
+        if not claims:
+            return
+        key, call = _call_from_payload(data, claims)
+        if not call or call['callee'] != claims['id']:
+            return
+        user_id = claims['id']
 
-    user = get_user_by_id(session['user_id'])
-    if not _has_early_access_user(user):
-        return
+    _call_hangup(key, call, user_id)
 
-    to_user_id = data.get('to_user_id')
-    chat_id = data.get('chat_id')
-    if not to_user_id or not chat_id:
-        return
 
-    emit('call_hangup', {
-        'from_user_id': session['user_id'],
-        'chat_id': chat_id
-    }, room=f"user_{to_user_id}")
+def _call_hangup(key, call, user_id):
+    _call_drop(key)
+    _, room = _call_peer_room(call, user_id)
+    _room_emit('call_hangup', {
+        'from_user_id': user_id,
+        'chat_id': call['chat_id']
+    }, room)
 
 @app.route('/channels/search', methods=['GET'])
 def search_channels():
     """Поиск публичных каналов"""
     query = request.args.get('q', '')
     
-    conn = get_db()
-    channels = conn.execute('''SELECT c.id, c.name, c.description, c.subscribers_count, c.avatar,
-                                      u.nickname as creator_name
-                               FROM chats c
-                               LEFT JOIN users u ON c.creator_id = u.id
-                               WHERE c.is_channel = 1 
-                               AND (c.name LIKE ? OR c.description LIKE ?)
-                               ORDER BY c.subscribers_count DESC
-                               LIMIT 20''', 
-                            (f'%{query}%', f'%{query}%')).fetchall()
-    conn.close()
-    
-    return jsonify({'channels': [dict(ch) for ch in channels]})
+    return jsonify({'channels': repo.chats.search_channels(query)})
 
 @app.route('/channels/<int:channel_id>/subscribe', methods=['POST'])
 def subscribe_channel(channel_id):
@@ -2633,26 +4471,15 @@ def subscribe_channel(channel_id):
     
     user_id = session['user_id']
     
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Проверяем, не подписан ли уже
-    existing = c.execute('SELECT id FROM chat_members WHERE chat_id = ? AND user_id = ?',
-                         (channel_id, user_id)).fetchone()
-    
-    if existing:
-        return jsonify({'success': False, 'error': 'Уже подписаны'}), 400
-    
-    # Добавляем подписку
-    c.execute('INSERT INTO chat_members (chat_id, user_id) VALUES (?, ?)', 
-              (channel_id, user_id))
-    
-    # Обновляем счётчик подписчиков
-    c.execute('UPDATE chats SET subscribers_count = subscribers_count + 1 WHERE id = ?',
-              (channel_id,))
-    
-    conn.commit()
-    conn.close()
+    with repo.transaction() as conn:
+        # Проверяем, не подписан ли уже
+        if repo.chats.is_member(channel_id, user_id, conn=conn):
+            return jsonify({'success': False, 'error': 'Уже подписаны'}), 400
+
+        # Подписка и счётчик подписчиков
+        repo.chats.subscribe(channel_id, user_id, conn=conn)
+
+    _invalidate_membership([user_id])
     
     return jsonify({'success': True})
 
@@ -2664,68 +4491,57 @@ def unsubscribe_channel(channel_id):
     
     user_id = session['user_id']
     
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Удаляем подписку
-    c.execute('DELETE FROM chat_members WHERE chat_id = ? AND user_id = ?',
-              (channel_id, user_id))
-    
-    # Обновляем счётчик подписчиков
-    c.execute('UPDATE chats SET subscribers_count = subscribers_count - 1 WHERE id = ?',
-              (channel_id,))
-    
-    conn.commit()
-    conn.close()
+    # Удаляем подписку и обновляем счётчик подписчиков
+    repo.chats.unsubscribe(channel_id, user_id)
+
+    _revoke_membership([user_id], channel_id)
     
     return jsonify({'success': True})
 
 @app.route('/admin/channels', methods=['GET'])
 def admin_get_channels():
-    """Получить все каналы (только для админа)"""
+    """Каналы постранично (только для админа). ?sort=new|old|name|subscribers, ?q= — префикс названия, ?cursor="""
     if 'user_id' not in session:
         return jsonify({'success': False, 'error': 'Не авторизован'}), 401
     
     user = get_user_by_id(session['user_id'])
     if not user or not user['is_admin']:
         return jsonify({'success': False, 'error': 'Доступ запрещён'}), 403
-    
-    conn = get_db()
-    channels = conn.execute('''SELECT c.*, u.username as creator_username
-                               FROM chats c
-                               LEFT JOIN users u ON c.creator_id = u.id
-                               WHERE c.is_channel = 1
-                               ORDER BY c.created_at DESC''').fetchall()
-    conn.close()
-    
-    return jsonify({'channels': [dict(ch) for ch in channels]})
+
+    params, err = _page_params()
+    if err:
+        return err
+    try:
+        with repo.replica() as conn:
+            channels, next_cursor = repo.chats.page_channels(conn=conn, **params)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify({'success': True, 'channels': channels, 'next_cursor': next_cursor})
 
 @app.route('/admin/groups', methods=['GET'])
 def admin_get_groups():
-    """Получить все группы (только для админа)"""
+    """Группы постранично (только для админа). ?sort=new|old|name, ?q= — префикс названия, ?cursor="""
     if 'user_id' not in session:
         return jsonify({'success': False, 'error': 'Не авторизован'}), 401
     
     user = get_user_by_id(session['user_id'])
     if not user or not user['is_admin']:
         return jsonify({'success': False, 'error': 'Доступ запрещён'}), 403
-    
-    conn = get_db()
-    groups = conn.execute('''SELECT c.*, u.username as creator_username,
-                                    COUNT(cm.id) as members_count
-                             FROM chats c
-                             LEFT JOIN users u ON c.creator_id = u.id
-                             LEFT JOIN chat_members cm ON c.id = cm.chat_id
-                             WHERE c.is_group = 1 AND c.is_channel = 0
-                             GROUP BY c.id
-                             ORDER BY c.created_at DESC''').fetchall()
-    conn.close()
-    
-    return jsonify({'groups': [dict(g) for g in groups]})
+
+    params, err = _page_params()
+    if err:
+        return err
+    try:
+        with repo.replica() as conn:
+            groups, next_cursor = repo.chats.page_groups(conn=conn, **params)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify({'success': True, 'groups': groups, 'next_cursor': next_cursor})
 
 # ============= ЗАПУСК СЕРВЕРА =============
 
 if __name__ == '__main__':
     print('🐝 BeeGramm запущен на http://localhost:5000')
     print('🍯 Жужжим и работаем!')
+    _start_background_jobs()
     socketio.run(app, host='0.0.0.0', port=5000, debug=True)
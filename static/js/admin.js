@@ -1,6 +1,19 @@
 // Админ-панель BeeGramm
 
 let currentUser = null;
+let currentReportStatus = 'open';
+
+// Карточки дашборда: id элемента -> поле /admin/stats (и stats_delta)
+const DASHBOARD_STATS = {
+    'stat-users': 'users',
+    'stat-premium': 'premium',
+    'stat-total-stars': 'total_stars',
+    'stat-keys-available': 'keys_available',
+    'stat-chats': 'chats',
+    'stat-messages': 'messages',
+    'stat-spam-blocked': 'spam_blocked'
+};
+let dashboardStats = null;
 
 // Инициализация
 document.addEventListener('DOMContentLoaded', async () => {
@@ -31,6 +44,7 @@ document.addEventListener('DOMContentLoaded', async () => {
     await loadDashboard();
 
     initAdminCmd();
+    initAdminLive();
 });
 
 function initAdminCmd() {
@@ -146,27 +160,18 @@ function backToApp() {
 async function loadDashboard() {
     try {
         // Загружаем статистику
-        const [usersRes, keysRes, statsRes] = await Promise.all([
-            fetch('/admin/users'),
-            fetch('/admin/keys'),
+        // Счётчики считает сервер (/admin/stats); списки нужны только для «последних»
+        const [usersRes, statsRes] = await Promise.all([
+            fetch('/admin/users?limit=5'),
             fetch('/admin/stats')
         ]);
         
         const usersData = await usersRes.json();
-        const keysData = await keysRes.json();
         const statsData = await statsRes.json();
         
         if (usersData.users) {
-            const users = usersData.users;
-            const premiumUsers = users.filter(u => u.is_premium).length;
-            const totalStars = users.reduce((sum, u) => sum + u.bee_stars, 0);
-            
-            document.getElementById('stat-users').textContent = users.length;
-            document.getElementById('stat-premium').textContent = premiumUsers;
-            document.getElementById('stat-total-stars').textContent = totalStars.toLocaleString();
-            
             // Последние пользователи
-            const recentUsers = users.slice(0, 5);
+            const recentUsers = usersData.users;
             const recentList = document.getElementById('recent-users');
             recentList.innerHTML = recentUsers.map(user => `
                 <div class="activity-item">
@@ -184,38 +189,132 @@ async function loadDashboard() {
             `).join('');
         }
         
-        if (keysData.keys) {
-            const availableKeys = keysData.keys.filter(k => !k.is_used).length;
-            document.getElementById('stat-keys-available').textContent = availableKeys;
-        }
-
-        if (statsData && statsData.success) {
-            document.getElementById('stat-chats').textContent = statsData.chats;
-            document.getElementById('stat-messages').textContent = statsData.messages;
-            const spamEl = document.getElementById('stat-spam-blocked');
-            if (spamEl) spamEl.textContent = statsData.spam_blocked;
-        } else {
-            document.getElementById('stat-chats').textContent = '—';
-            document.getElementById('stat-messages').textContent = '—';
-            const spamEl = document.getElementById('stat-spam-blocked');
-            if (spamEl) spamEl.textContent = '—';
-        }
+        dashboardStats = (statsData && statsData.success) ? statsData : null;
+        renderDashboardStats();
         
     } catch (error) {
         console.error('Ошибка загрузки дашборда:', error);
     }
 }
 
+function renderDashboardStats() {
+    Object.entries(DASHBOARD_STATS).forEach(([id, field]) => {
+        const el = document.getElementById(id);
+        if (!el) return;
+        const ok = dashboardStats && dashboardStats[field] != null;
+        el.textContent = ok ? Number(dashboardStats[field]).toLocaleString() : '—';
+    });
+}
+
+// ============= ЖИВЫЕ ОБНОВЛЕНИЯ (SOCKET.IO /admin) =============
+
+// Сервер присылает пачки раз в пару секунд: дельты счётчиков, жалобы, аудит, ip_events
+function initAdminLive() {
+    if (typeof io === 'undefined') return;
+    const live = io('/admin');
+
+    live.on('stats_delta', (data) => {
+        if (!dashboardStats) return;
+        Object.entries({...(data.totals || {}), ...(data.today || {})}).forEach(([field, delta]) => {
+            dashboardStats[field] = (dashboardStats[field] || 0) + delta;
+        });
+        renderDashboardStats();
+    });
+
+    live.on('new_report', (data) => {
+        if (currentReportStatus !== 'open') return;
+        // Карточка сообщения одна: новая жалоба заменяет прежнюю карточку (счётчик вырос)
+        const list = document.getElementById('reports-list');
+        (data.items || []).forEach(r => {
+            list?.querySelector(`[data-message-id="${r.message_id}"]`)?.remove();
+        });
+        prependLive('reports-list', data, renderReport, () => loadReports(currentReportStatus));
+    });
+
+    live.on('audit', (data) => {
+        prependLive('audit-list', data, renderAuditItem, loadAudit);
+    });
+
+    live.on('ip_event', (data) => {
+        prependLive('security-events', data, renderIpEvent, loadSecurity);
+    });
+
+    // После переподключения пачки могли потеряться — перечитываем открытый раздел
+    live.on('connect', () => {
+        if (dashboardStats) loadDashboard();
+    });
+}
+
+function prependLive(containerId, data, render, reload) {
+    const container = document.getElementById(containerId);
+    if (!container || !container.closest('.admin-section.active')) return;
+    if (data.dropped) {
+        // Часть записей не влезла в пачку — проще перечитать список целиком
+        reload();
+        return;
+    }
+    if (!container.querySelector('.message-item')) container.innerHTML = '';
+    const html = (data.items || []).slice().reverse().map(render).join('');
+    container.insertAdjacentHTML('afterbegin', html);
+}
+
+// ============= СПИСКИ ПО СТРАНИЦАМ =============
+
+// Курсоры следующих страниц по спискам; null — дальше страниц нет
+const listCursors = {};
+
+async function fetchPage(name, url, params, append) {
+    const query = new URLSearchParams();
+    Object.entries(params).forEach(([key, value]) => {
+        if (value !== '' && value != null) query.set(key, value);
+    });
+    if (append && listCursors[name]) query.set('cursor', listCursors[name]);
+
+    const response = await fetch(`${url}?${query}`);
+    const data = await response.json();
+
+    listCursors[name] = data.next_cursor || null;
+    const more = document.getElementById(`${name}-more`);
+    if (more) more.hidden = !listCursors[name];
+    return data;
+}
+
+function renderPage(container, html, append) {
+    if (append) {
+        container.insertAdjacentHTML('beforeend', html);
+    } else {
+        container.innerHTML = html;
+    }
+}
+
+function filterValue(id) {
+    const el = document.getElementById(id);
+    return el ? el.value.trim() : '';
+}
+
+function debounce(fn, delay) {
+    let timer = null;
+    return (...args) => {
+        clearTimeout(timer);
+        timer = setTimeout(() => fn(...args), delay);
+    };
+}
+
 // ============= ПОЛЬЗОВАТЕЛИ =============
 
-async function loadUsers() {
+async function loadUsers(append = false) {
     try {
-        const response = await fetch('/admin/users');
-        const data = await response.json();
+        const data = await fetchPage('users', '/admin/users', {
+            q: filterValue('user-search'),
+            role: filterValue('user-role-filter'),
+            premium: filterValue('user-premium-filter'),
+            spam_blocked: filterValue('user-spam-filter'),
+            sort: filterValue('user-sort')
+        }, append);
         
         if (data.users) {
             const tbody = document.getElementById('users-table-body');
-            tbody.innerHTML = data.users.map(user => `
+            renderPage(tbody, data.users.map(user => `
                 <tr>
                     <td>${user.id}</td>
                     <td>
@@ -268,7 +367,7 @@ async function loadUsers() {
                         </div>
                     </td>
                 </tr>
-            `).join('');
+            `).join(''), append);
         }
     } catch (error) {
         console.error('Ошибка загрузки пользователей:', error);
@@ -463,14 +562,13 @@ async function deleteUser(userId) {
 
 // ============= КЛЮЧИ =============
 
-async function loadKeys() {
+async function loadKeys(append = false) {
     try {
-        const response = await fetch('/admin/keys');
-        const data = await response.json();
+        const data = await fetchPage('keys', '/admin/keys', {used: filterValue('keys-used-filter')}, append);
         
         if (data.keys) {
             const grid = document.getElementById('keys-grid');
-            grid.innerHTML = data.keys.map(key => `
+            renderPage(grid, data.keys.map(key => `
                 <div class="key-card ${key.is_used ? 'used' : ''}">
                     <div class="key-code">${key.key_code}</div>
                     <span class="key-status ${key.is_used ? 'used' : 'available'}">
@@ -487,7 +585,7 @@ async function loadKeys() {
                         </div>
                     `}
                 </div>
-            `).join('');
+            `).join(''), append);
         }
     } catch (error) {
         console.error('Ошибка загрузки ключей:', error);
@@ -532,14 +630,16 @@ async function generateKeys() {
 
 // ============= КАНАЛЫ =============
 
-async function loadChannels() {
+async function loadChannels(append = false) {
     try {
-        const response = await fetch('/admin/channels');
-        const data = await response.json();
+        const data = await fetchPage('channels', '/admin/channels', {
+            q: filterValue('channel-search'),
+            sort: filterValue('channel-sort')
+        }, append);
         
         if (data.channels) {
             const tbody = document.getElementById('channels-table-body');
-            tbody.innerHTML = data.channels.map(channel => `
+            renderPage(tbody, data.channels.map(channel => `
                 <tr>
                     <td>${channel.id}</td>
                     <td><strong>${channel.name}</strong></td>
@@ -558,7 +658,7 @@ async function loadChannels() {
                         </div>
                     </td>
                 </tr>
-            `).join('');
+            `).join(''), append);
         }
     } catch (error) {
         console.error('Ошибка загрузки каналов:', error);
@@ -589,14 +689,16 @@ function editChannel(channelId) {
 
 // ============= ГРУППЫ =============
 
-async function loadGroups() {
+async function loadGroups(append = false) {
     try {
-        const response = await fetch('/admin/groups');
-        const data = await response.json();
+        const data = await fetchPage('groups', '/admin/groups', {
+            q: filterValue('group-search'),
+            sort: filterValue('group-sort')
+        }, append);
         
         if (data.groups) {
             const tbody = document.getElementById('groups-table-body');
-            tbody.innerHTML = data.groups.map(group => `
+            renderPage(tbody, data.groups.map(group => `
                 <tr>
                     <td>${group.id}</td>
                     <td><strong>${group.name}</strong></td>
@@ -615,7 +717,7 @@ async function loadGroups() {
                         </div>
                     </td>
                 </tr>
-            `).join('');
+            `).join(''), append);
         }
     } catch (error) {
         console.error('Ошибка загрузки групп:', error);
@@ -765,10 +867,39 @@ async function addStickerToPack(packId) {
 
 // ============= ЖАЛОБЫ + AUDIT =============
 
-async function loadReports(status) {
+function renderReport(r) {
+    const msg = r.is_deleted ? '<i>Сообщение удалено</i>' : escapeHtml(r.message_content || '—');
+    const reason = (r.reason || '').trim();
+    const count = r.reports_count > 1 ? ` • жалоб: <b>${r.reports_count}</b>` : '';
+    const actions = (r.status === 'open') ? `
+        <div class="action-buttons" style="margin-top:12px; display:flex; gap:10px; flex-wrap:wrap;">
+            <button class="btn-danger" onclick="resolveReport(${r.id}, {action: 'delete_message'})">🗑️ Удалить</button>
+            <button class="btn-primary" onclick="resolveReport(${r.id}, {action: 'resolve', spam_block: true})">🚫 Спам-блок</button>
+            <button class="btn-primary" onclick="resolveReportPromptBan(${r.id})">⏱️ Бан</button>
+            <button class="btn-secondary" onclick="resolveReport(${r.id}, {action: 'resolve'})">✅ Закрыть</button>
+        </div>
+    ` : '';
+
+    return `
+        <div class="message-item" data-message-id="${r.message_id}">
+            <div class="message-header">
+                <div class="message-user">#${r.id} • @${escapeHtml(r.reporter_username)} → @${escapeHtml(r.sender_username)} • чат #${r.chat_id}${count}</div>
+                <div class="message-time">${new Date(r.created_at).toLocaleString('ru-RU')}</div>
+            </div>
+            ${reason ? `<div class="message-text"><b>Причина:</b> ${escapeHtml(reason)}</div>` : ''}
+            <div class="message-text">${msg}</div>
+            ${actions}
+        </div>
+    `;
+}
+
+async function loadReports(status, append = false) {
+    currentReportStatus = status || currentReportStatus;
     try {
-        const response = await fetch(`/moderator/reports?status=${encodeURIComponent(status || 'open')}`);
-        const data = await response.json();
+        const data = await fetchPage('reports', '/moderator/reports', {
+            status: currentReportStatus,
+            sort: filterValue('report-sort')
+        }, append);
 
         const list = document.getElementById('reports-list');
         if (!list) return;
@@ -779,35 +910,12 @@ async function loadReports(status) {
         }
 
         const reports = data.reports || [];
-        if (reports.length === 0) {
+        if (reports.length === 0 && !append) {
             list.innerHTML = '<div style="text-align: center; padding: 40px;">Нет жалоб</div>';
             return;
         }
 
-        list.innerHTML = reports.map(r => {
-            const msg = r.is_deleted ? '<i>Сообщение удалено</i>' : escapeHtml(r.message_content || '—');
-            const reason = (r.reason || '').trim();
-            const actions = (r.status === 'open') ? `
-                <div class="action-buttons" style="margin-top:12px; display:flex; gap:10px; flex-wrap:wrap;">
-                    <button class="btn-danger" onclick="resolveReport(${r.id}, {action: 'delete_message'})">🗑️ Удалить</button>
-                    <button class="btn-primary" onclick="resolveReport(${r.id}, {action: 'resolve', spam_block: true})">🚫 Спам-блок</button>
-                    <button class="btn-primary" onclick="resolveReportPromptBan(${r.id})">⏱️ Бан</button>
-                    <button class="btn-secondary" onclick="resolveReport(${r.id}, {action: 'resolve'})">✅ Закрыть</button>
-                </div>
-            ` : '';
-
-            return `
-                <div class="message-item">
-                    <div class="message-header">
-                        <div class="message-user">#${r.id} • @${escapeHtml(r.reporter_username)} → @${escapeHtml(r.sender_username)} • чат #${r.chat_id}</div>
-                        <div class="message-time">${new Date(r.created_at).toLocaleString('ru-RU')}</div>
-                    </div>
-                    ${reason ? `<div class="message-text"><b>Причина:</b> ${escapeHtml(reason)}</div>` : ''}
-                    <div class="message-text">${msg}</div>
-                    ${actions}
-                </div>
-            `;
-        }).join('');
+        renderPage(list, reports.map(renderReport).join(''), append);
     } catch (e) {
         console.error('Ошибка загрузки жалоб:', e);
     }
@@ -842,6 +950,21 @@ async function resolveReport(reportId, payload) {
     }
 }
 
+function renderAuditItem(it) {
+    const who = it.actor_username ? '@' + it.actor_username : ('ID ' + it.actor_id);
+    const when = new Date(it.created_at).toLocaleString('ru-RU');
+    const details = it.details ? escapeHtml(JSON.stringify(it.details)) : '—';
+    return `
+        <div class="message-item">
+            <div class="message-header">
+                <div class="message-user">${escapeHtml(who)} • ${escapeHtml(it.action)}</div>
+                <div class="message-time">${when}</div>
+            </div>
+            <div class="message-text">${details}</div>
+        </div>
+    `;
+}
+
 async function loadAudit() {
     try {
         const response = await fetch('/admin/audit');
@@ -861,20 +984,7 @@ async function loadAudit() {
             return;
         }
 
-        list.innerHTML = items.map(it => {
-            const who = it.actor_username ? '@' + it.actor_username : ('ID ' + it.actor_id);
-            const when = new Date(it.created_at).toLocaleString('ru-RU');
-            const details = it.details ? escapeHtml(JSON.stringify(it.details)) : '—';
-            return `
-                <div class="message-item">
-                    <div class="message-header">
-                        <div class="message-user">${escapeHtml(who)} • ${escapeHtml(it.action)}</div>
-                        <div class="message-time">${when}</div>
-                    </div>
-                    <div class="message-text">${details}</div>
-                </div>
-            `;
-        }).join('');
+        list.innerHTML = items.map(renderAuditItem).join('');
     } catch (e) {
         console.error('Ошибка audit:', e);
     }
@@ -891,6 +1001,18 @@ function escapeHtml(str) {
 
 // ============= SECURITY (IP EVENTS + BLOCKLIST) =============
 
+function renderIpEvent(e) {
+    return `
+        <div class="message-item">
+            <div class="message-header">
+                <div class="message-user">${escapeHtml(e.ip)} • ${escapeHtml(e.kind)}</div>
+                <div class="message-time">${new Date(e.created_at).toLocaleString('ru-RU')}</div>
+            </div>
+            <div class="message-text">${escapeHtml(e.endpoint || '—')}</div>
+        </div>
+    `;
+}
+
 async function loadSecurity() {
     try {
         const res = await fetch('/admin/security/ips');
@@ -910,15 +1032,7 @@ async function loadSecurity() {
         const events = data.events || [];
         const blocked = data.blocked || [];
 
-        eventsEl.innerHTML = events.length ? events.map(e => `
-            <div class="message-item">
-                <div class="message-header">
-                    <div class="message-user">${escapeHtml(e.ip)} • ${escapeHtml(e.kind)}</div>
-                    <div class="message-time">${new Date(e.created_at).toLocaleString('ru-RU')}</div>
-                </div>
-                <div class="message-text">${escapeHtml(e.endpoint || '—')}</div>
-            </div>
-        `).join('') : '<div style="padding: 16px;">Нет событий</div>';
+        eventsEl.innerHTML = events.length ? events.map(renderIpEvent).join('') : '<div style="padding: 16px;">Нет событий</div>';
 
         blockedEl.innerHTML = blocked.length ? blocked.map(b => `
             <div class="message-item">
@@ -1037,13 +1151,7 @@ document.addEventListener('click', (e) => {
     }
 });
 
-// Поиск пользователей
-document.getElementById('user-search')?.addEventListener('input', (e) => {
-    const search = e.target.value.toLowerCase();
-    const rows = document.querySelectorAll('#users-table-body tr');
-    
-    rows.forEach(row => {
-        const text = row.textContent.toLowerCase();
-        row.style.display = text.includes(search) ? '' : 'none';
-    });
-});
+// Поиск по префиксу — на сервере, после паузы в наборе
+document.getElementById('user-search')?.addEventListener('input', debounce(() => loadUsers(), 300));
+document.getElementById('channel-search')?.addEventListener('input', debounce(() => loadChannels(), 300));
+document.getElementById('group-search')?.addEventListener('input', debounce(() => loadGroups(), 300));
@@ -6,13 +6,44 @@ document.addEventListener('DOMContentLoaded', function() {
     // Quick action buttons
     setupQuickActions();
     
-    // Load real-time stats
+    // Load stats once, then apply pushed deltas from the /admin namespace
     loadDashboardStats();
-    
-    // Update stats every 30 seconds
-    setInterval(loadDashboardStats, 30000);
+    subscribeDashboardStats();
 });
 
+// Stats cards: element id -> field of /admin/stats and stats_delta
+const DASHBOARD_FIELDS = {
+    'total-users': 'users',
+    'active-users': 'active_users',
+    'total-messages': 'messages',
+    'today-messages': 'messages_today',
+    'premium-users': 'premium'
+};
+let dashboardValues = null;
+
+function renderDashboardValues() {
+    Object.entries(DASHBOARD_FIELDS).forEach(([id, field]) => {
+        const el = document.getElementById(id);
+        if (el && dashboardValues) el.textContent = dashboardValues[field] ?? '0';
+    });
+}
+
+function subscribeDashboardStats() {
+    if (typeof io === 'undefined') return;
+    const live = io('/admin');
+    live.on('stats_delta', (data) => {
+        if (!dashboardValues) return;
+        Object.entries({...(data.totals || {}), ...(data.today || {})}).forEach(([field, delta]) => {
+            dashboardValues[field] = (dashboardValues[field] || 0) + delta;
+        });
+        renderDashboardValues();
+    });
+    // Pushes may have been missed while disconnected
+    live.on('connect', () => {
+        if (dashboardValues) loadDashboardStats();
+    });
+}
+
 // Initialize Charts
 function initCharts() {
     // User Growth Chart
@@ -160,26 +191,18 @@ function setupQuickActions() {
 // Load Dashboard Stats
 async function loadDashboardStats() {
     try {
-        const [usersRes, messagesRes, premiumRes] = await Promise.all([
-            fetch('/admin/users').then(res => res.json()),
-            fetch('/api/stats/messages').then(res => res.json()),
+        const [statsRes, premiumRes] = await Promise.all([
+            fetch('/admin/stats').then(res => res.json()),
             fetch('/api/stats/premium').then(res => res.json())
         ]);
         
         // Update stats cards
-        if (usersRes.users) {
-            document.getElementById('total-users').textContent = usersRes.users.length;
-            const activeUsers = usersRes.users.filter(u => u.last_active > Date.now() - 86400000).length;
-            document.getElementById('active-users').textContent = activeUsers;
-        }
-        
-        if (messagesRes) {
-            document.getElementById('total-messages').textContent = messagesRes.total || '0';
-            document.getElementById('today-messages').textContent = messagesRes.today || '0';
+        if (statsRes && statsRes.success) {
+            dashboardValues = statsRes;
+            renderDashboardValues();
         }
         
         if (premiumRes) {
-            document.getElementById('premium-users').textContent = premiumRes.count || '0';
             document.getElementById('revenue').textContent = `$${premiumRes.revenue || '0'}`;
         }
         
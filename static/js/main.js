@@ -1,6 +1,7 @@
 // BeeGramm - Клиентская часть 🐝
 
 let socket;
+let socketNeedsResync = false;
 let currentUser = null;
 let currentChat = null;
 let typingTimeout = null;
@@ -227,6 +228,7 @@ async function logout() {
     } catch (e) {
         // игнор
     }
+    await MessageCache.clear();
     window.location.reload();
 }
 
@@ -777,17 +779,39 @@ async function activateEarlyAccess() {
 // ============= SOCKET.IO =============
 
 function connectSocket() {
-    socket = io();
+    // Компактный формат событий (static/js/wire.js); сервер без msgpack ответит обычным JSON
+    socket = io({ auth: BeeWire.supported ? { format: 'compact' } : {} });
     
     socket.on('connect', () => {
         console.log('🐝 Подключено к серверу!');
     });
     
-    socket.on('disconnect', () => {
+    socket.on('disconnect', (reason) => {
         console.log('❌ Отключено от сервера');
+        // Без сокета события чатов могли потеряться — дальше только условная загрузка
+        MessageCache.unwatchAll();
+        // Сервер отключил нас как медленного клиента — переподключаемся и догружаем пропущенное
+        if (socketNeedsResync && reason === 'io server disconnect') {
+            socket.connect();
+        }
+    });
+
+    socket.on('resync_required', () => {
+        socketNeedsResync = true;
+    });
+
+    socket.on('connect', () => {
+        if (!socketNeedsResync) return;
+        socketNeedsResync = false;
+        loadChats();
+        if (currentChat) {
+            joinChat(currentChat.id);
+            loadMessages(currentChat.id);
+        }
     });
     
-    socket.on('new_message', (message) => {
+    socket.on('new_message', BeeWire.handler('new_message', (message) => {
+        MessageCache.touched(message.chat_id);
         const isCurrent = currentChat && message.chat_id === currentChat.id;
         if (isCurrent) {
             appendMessage(message);
@@ -802,12 +826,18 @@ function connectSocket() {
         if (shouldNotify) {
             notifyIncoming(message);
         }
-    });
+    }));
     
-    socket.on('reactions_updated', (data) => {
+    socket.on('reactions_updated', BeeWire.handler('reactions_updated', (data) => {
+        MessageCache.touched(data.chat_id);
         updateMessageReactions(data.message_id, data.reactions);
-    });
+    }));
     
+    socket.on('voice_ready', (data) => {
+        MessageCache.touched(data.chat_id);
+        updateMessageVoice(data);
+    });
+
     socket.on('user_typing', (data) => {
         if (currentChat && data.user_id !== currentUser.id) {
             showTypingIndicator(data.username, data.is_typing);
@@ -821,9 +851,11 @@ function connectSocket() {
         }
     });
 
+    // Массовое удаление приходит одним событием на чат: message_ids
     socket.on('message_deleted', (data) => {
         if (!data?.message_id) return;
-        markMessageDeleted(data.message_id);
+        MessageCache.touched(data.chat_id);
+        (data.message_ids || [data.message_id]).forEach(markMessageDeleted);
     });
 
     socket.on('message_error', (data) => {
@@ -852,13 +884,17 @@ function connectSocket() {
         setCallStatus('Соединяемся...');
     });
 
+    // Сервер копит кандидаты и шлёт пачкой: candidates
     socket.on('call_ice', async (data) => {
-        if (!rtcPc || !data?.candidate || !data?.from_user_id) return;
+        const candidates = data?.candidates || (data?.candidate ? [data.candidate] : []);
+        if (!rtcPc || !candidates.length || !data?.from_user_id) return;
         if (rtcPeerUserId !== data.from_user_id) return;
-        try {
-            await rtcPc.addIceCandidate(data.candidate);
-        } catch (e) {
-            // ignore
+        for (const candidate of candidates) {
+            try {
+                await rtcPc.addIceCandidate(candidate);
+            } catch (e) {
+                // ignore
+            }
         }
     });
 
@@ -967,23 +1003,139 @@ async function openChat(chat) {
     showCallButtonForChat(chat);
     
     // Присоединяемся к комнате
-    if (socket) {
-        socket.emit('join_chat', { chat_id: chat.id });
-    }
+    joinChat(chat.id);
     
     // Загружаем сообщения
     await loadMessages(chat.id);
 }
 
+// ============= КЭШ СООБЩЕНИЙ (IndexedDB) =============
+// История чата хранится в IndexedDB вместе с версией с сервера (version).
+// Открытие чата: сразу рисуем кэш, затем ?since=<version> — 304, если ничего
+// не менялось, или дельта (новые и изменённые сообщения). Пока сокет на связи
+// и в комнате чата не было событий, кэш заведомо свежий — запроса нет вовсе.
+// Но только если сервер подтвердил вход в комнату: при отказе (нет доступа,
+// нет Early Access) события не придут, и кэш свежим не считается.
+
+const MessageCache = (() => {
+    const memory = new Map();  // chatId -> {version, messages}
+    const watched = new Set();  // чаты, чей кэш свежий, пока сокет подключён
+    const joined = new Set();  // комнаты, вход в которые сервер подтвердил (ack join_chat)
+    const events = new Map();  // chatId -> число событий комнаты: не считать свежим ответ, обогнанный событием
+    let dbPromise = null;
+
+    function db() {
+        if (!dbPromise) {
+            dbPromise = new Promise((resolve) => {
+                if (!window.indexedDB) return resolve(null);
+                const request = indexedDB.open('beegram', 1);
+                request.onupgradeneeded = () => request.result.createObjectStore('chats', { keyPath: 'key' });
+                request.onsuccess = () => resolve(request.result);
+                request.onerror = () => resolve(null);  // приватный режим и т.п. — работаем без кэша
+            });
+        }
+        return dbPromise;
+    }
+
+    function key(chatId) {
+        return `${currentUser?.id}:${chatId}`;
+    }
+
+    async function store(mode, fn) {
+        const conn = await db();
+        if (!conn) return null;
+        return new Promise((resolve) => {
+            const tx = conn.transaction('chats', mode);
+            const request = fn(tx.objectStore('chats'));
+            tx.oncomplete = () => resolve(request?.result ?? null);
+            tx.onerror = () => resolve(null);
+        });
+    }
+
+    async function get(chatId) {
+        if (memory.has(chatId)) return memory.get(chatId);
+        const entry = await store('readonly', s => s.get(key(chatId)));
+        if (entry) memory.set(chatId, entry);
+        return entry;
+    }
+
+    async function put(chatId, version, messages) {
+        const entry = { key: key(chatId), version, messages };
+        memory.set(chatId, entry);
+        await store('readwrite', s => s.put(entry));
+    }
+
+    // Дельта поверх кэша: изменённые заменяются, новые добавляются
+    function merge(messages, delta) {
+        const byId = new Map(messages.map(m => [m.id, m]));
+        delta.forEach(m => byId.set(m.id, m));
+        return [...byId.values()].sort((a, b) => a.id - b.id);
+    }
+
+    return {
+        get, put, merge,
+        isFresh: (chatId) => watched.has(chatId) && memory.has(chatId),
+        mark: (chatId) => events.get(chatId) || 0,
+        watch(chatId, mark) {
+            if (socket?.connected && joined.has(chatId) && (events.get(chatId) || 0) === mark) watched.add(chatId);
+        },
+        joined(chatId, ok) {
+            if (ok) {
+                joined.add(chatId);
+            } else {
+                joined.delete(chatId);
+                watched.delete(chatId);
+            }
+        },
+        touched(chatId) {
+            watched.delete(chatId);
+            events.set(chatId, (events.get(chatId) || 0) + 1);
+        },
+        unwatchAll() {
+            watched.clear();
+            joined.clear();
+        },
+        async clear() {
+            memory.clear();
+            watched.clear();
+            joined.clear();
+            await store('readwrite', s => s.clear());
+        },
+    };
+})();
+
+function joinChat(chatId) {
+    if (!socket) return;
+    socket.emit('join_chat', { chat_id: chatId }, (ok) => MessageCache.joined(chatId, ok === true));
+}
+
 async function loadMessages(chatId) {
     try {
-        const response = await fetch(`/chats/${chatId}/messages`);
+        const cached = await MessageCache.get(chatId);
+        if (cached) {
+            renderMessages(cached.messages);
+            scrollToBottom();
+            if (MessageCache.isFresh(chatId)) return;
+        }
+
+        const mark = MessageCache.mark(chatId);
+        const url = cached ? `/chats/${chatId}/messages?since=${cached.version}` : `/chats/${chatId}/messages`;
+        const response = await fetch(url);
+        if (response.status === 304) {
+            MessageCache.watch(chatId, mark);
+            return;
+        }
         const data = await response.json();
-        
-        if (data.messages) {
-            renderMessages(data.messages);
+        if (!data.messages) return;
+
+        BeeWire.rememberProfiles(data.messages);
+        const messages = data.delta && cached ? MessageCache.merge(cached.messages, data.messages) : data.messages;
+        if (currentChat && currentChat.id === chatId) {
+            renderMessages(messages);
             scrollToBottom();
         }
+        await MessageCache.put(chatId, data.version, messages);
+        MessageCache.watch(chatId, mark);
     } catch (error) {
         console.error('Ошибка загрузки сообщений:', error);
     }
@@ -1043,13 +1195,7 @@ function appendMessage(message) {
     } else if (message.message_type === 'sticker') {
         contentHTML = `<div class="message-bubble" style="background: transparent; font-size: 64px;">${message.content}</div>`;
     } else if (message.message_type === 'voice') {
-        contentHTML = `
-            <div class="message-bubble">
-                <audio controls style="width: 260px; max-width: 100%;">
-                    <source src="/uploads/${message.file_url}">
-                </audio>
-            </div>
-        `;
+        contentHTML = `<div class="message-bubble">${voiceHTML(message)}</div>`;
     }
     
     // Реакции
@@ -1230,6 +1376,42 @@ function toggleReaction(messageId, emoji) {
     });
 }
 
+// Голосовое: сжатый файл, если сервер его уже обработал (voice.py), и waveform с длительностью
+// до загрузки звука — preload="none", файл качается только по нажатию
+function voiceHTML(message) {
+    const voice = message.voice;
+    const src = voice?.url || message.file_url;
+    let meta = '';
+    if (voice) {
+        const seconds = Math.round((voice.duration_ms || 0) / 1000);
+        const bars = (voice.waveform || []).map(v =>
+            `<span style="display: inline-block; width: 2px; margin-right: 1px; height: ${Math.max(2, Math.round(v / 4))}px; background: currentColor; opacity: 0.6;"></span>`
+        ).join('');
+        meta = `
+            <div class="voice-meta" style="display: flex; align-items: center; gap: 8px;">
+                <span class="voice-waveform" style="display: inline-flex; align-items: flex-end; height: 25px;">${bars}</span>
+                <span class="voice-duration">${Math.floor(seconds / 60)}:${String(seconds % 60).padStart(2, '0')}</span>
+            </div>
+        `;
+    }
+    return `
+        ${meta}
+        <audio controls preload="${voice ? 'none' : 'metadata'}" style="width: 260px; max-width: 100%;">
+            <source src="/uploads/${src}">
+        </audio>
+    `;
+}
+
+function updateMessageVoice(data) {
+    const messageDiv = document.querySelector(`[data-message-id="${data.message_id}"]`);
+    const bubble = messageDiv?.querySelector('.message-bubble');
+    const audio = bubble?.querySelector('audio');
+    // Не перерисовываем голосовое, которое уже слушают
+    if (!audio || (audio.currentTime > 0 && !audio.ended)) return;
+    const fileUrl = audio.querySelector('source')?.getAttribute('src')?.replace(/^\/uploads\//, '');
+    bubble.innerHTML = voiceHTML({ file_url: fileUrl, voice: data.voice });
+}
+
 function updateMessageReactions(messageId, reactions) {
     const messageDiv = document.querySelector(`[data-message-id="${messageId}"]`);
     if (!messageDiv) return;
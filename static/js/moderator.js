@@ -1,6 +1,10 @@
 let currentUser = null;
 let selectedSupportChatId = null;
 let searchTimeout = null;
+let supportCursor = null;
+let currentReportStatus = 'open';
+let reportsCursor = null;
+let reportCounts = null;
 
 document.addEventListener('DOMContentLoaded', async () => {
     const savedUser = localStorage.getItem('beegram_user');
@@ -25,6 +29,7 @@ document.addEventListener('DOMContentLoaded', async () => {
     document.getElementById('mod-avatar').src = avatarUrl;
 
     await loadSupportChats();
+    initModeratorLive();
 });
 
 function backToApp() {
@@ -42,53 +47,164 @@ function showSection(name) {
     if (name === 'reports') loadReports('open');
 }
 
-async function loadReports(status) {
+// Очередь приходит страницами по курсору: одна карточка на сообщение, со счётчиком жалоб
+async function loadReports(status, append = false) {
+    currentReportStatus = status || currentReportStatus;
     try {
-        const res = await fetch(`/moderator/reports?status=${encodeURIComponent(status || 'open')}`);
+        const query = new URLSearchParams({ status: currentReportStatus });
+        const sort = document.getElementById('report-sort');
+        if (sort) query.set('sort', sort.value);
+        if (append && reportsCursor) query.set('cursor', reportsCursor);
+
+        const res = await fetch(`/moderator/reports?${query}`);
         const data = await res.json();
         if (!data.success) {
             console.error(data.error);
             return;
         }
 
+        reportsCursor = data.next_cursor || null;
+        const more = document.getElementById('reports-more');
+        if (more) more.hidden = !reportsCursor;
+        reportCounts = data.counts || null;
+        renderReportCounts();
+
         const root = document.getElementById('reports-list');
         if (!root) return;
         const reports = data.reports || [];
-        if (reports.length === 0) {
+        if (reports.length === 0 && !append) {
             root.innerHTML = '<div style="color:#94a3b8; padding: 10px;">Нет жалоб</div>';
             return;
         }
 
-        root.innerHTML = reports.map(r => {
-            const msg = r.is_deleted ? '<i>Сообщение удалено</i>' : (r.message_content || '—');
-            const reason = (r.reason || '').trim();
-            const reasonHtml = reason ? `<div class="meta">Причина: ${escapeHtml(reason)}</div>` : '';
-            const actions = (r.status === 'open') ? `
-                <div style="display:flex; gap:8px; flex-wrap: wrap; margin-top:10px;">
-                    <button class="btn-danger" onclick="resolveReport(${r.id}, {action: 'delete_message'})">🗑️ Удалить</button>
-                    <button class="btn-primary" onclick="resolveReport(${r.id}, {action: 'resolve', spam_block: true})">🚫 Спам-блок</button>
-                    <button class="btn-primary" onclick="resolveReportPromptBan(${r.id})">⏱️ Бан</button>
-                    <button class="btn-primary" onclick="resolveReport(${r.id}, {action: 'resolve'})">✅ Закрыть</button>
-                </div>
-            ` : '';
-
-            return `
-                <div class="user-card" style="align-items:flex-start;">
-                    <div style="flex:1;">
-                        <div><strong>#${r.id}</strong> • от <strong>@${r.reporter_username}</strong> на <strong>@${r.sender_username}</strong> • чат #${r.chat_id}</div>
-                        <div class="meta">${new Date(r.created_at).toLocaleString('ru-RU')}</div>
-                        ${reasonHtml}
-                        <div style="margin-top:8px; padding:10px; border-radius:10px; background: rgba(255,255,255,0.04);">${escapeHtml(msg)}</div>
-                        ${actions}
-                    </div>
-                </div>
-            `;
-        }).join('');
+        const html = reports.map(renderReport).join('');
+        if (append) {
+            root.insertAdjacentHTML('beforeend', html);
+        } else {
+            root.innerHTML = html;
+            updateBulkBar();
+        }
     } catch (e) {
         console.error('Ошибка загрузки жалоб:', e);
     }
 }
 
+function renderReport(r) {
+    const msg = r.is_deleted ? '<i>Сообщение удалено</i>' : (r.message_content || '—');
+    const reason = (r.reason || '').trim();
+    const reasonHtml = reason ? `<div class="meta">Причина: ${escapeHtml(reason)}</div>` : '';
+    const count = r.reports_count > 1 ? ` • жалоб: <strong>${r.reports_count}</strong>` : '';
+    const actions = (r.status === 'open') ? `
+        <div style="display:flex; gap:8px; flex-wrap: wrap; margin-top:10px;">
+            <button class="btn-danger" onclick="resolveReport(${r.id}, {action: 'delete_message'})">🗑️ Удалить</button>
+            <button class="btn-primary" onclick="resolveReport(${r.id}, {action: 'resolve', spam_block: true})">🚫 Спам-блок</button>
+            <button class="btn-primary" onclick="resolveReportPromptBan(${r.id})">⏱️ Бан</button>
+            <button class="btn-primary" onclick="resolveReport(${r.id}, {action: 'resolve'})">✅ Закрыть</button>
+        </div>
+    ` : '';
+
+    const pick = (r.status === 'open')
+        ? `<input type="checkbox" class="report-pick" value="${r.id}" onchange="updateBulkBar()" style="margin-right:10px;">`
+        : '';
+
+    return `
+        <div class="user-card" style="align-items:flex-start;" data-message-id="${r.message_id}">
+            ${pick}
+            <div style="flex:1;">
+                <div><strong>#${r.id}</strong> • от <strong>@${r.reporter_username}</strong> на <strong>@${r.sender_username}</strong> • чат #${r.chat_id}${count}</div>
+                <div class="meta">${new Date(r.created_at).toLocaleString('ru-RU')}</div>
+                ${reasonHtml}
+                <div style="margin-top:8px; padding:10px; border-radius:10px; background: rgba(255,255,255,0.04);">${escapeHtml(msg)}</div>
+                ${actions}
+            </div>
+        </div>
+    `;
+}
+
+// ============= МАССОВЫЕ ДЕЙСТВИЯ =============
+
+function selectedReportIds() {
+    return [...document.querySelectorAll('.report-pick:checked')].map(x => parseInt(x.value, 10));
+}
+
+function updateBulkBar() {
+    const bar = document.getElementById('reports-bulk');
+    const count = selectedReportIds().length;
+    if (!bar) return;
+    bar.hidden = count === 0;
+    document.getElementById('reports-bulk-count').textContent = `Выбрано: ${count}`;
+}
+
+function toggleAllReports(checked) {
+    document.querySelectorAll('.report-pick').forEach(x => { x.checked = checked; });
+    updateBulkBar();
+}
+
+async function bulkResolveReports(payload) {
+    const ids = selectedReportIds();
+    if (ids.length === 0) return;
+    if (!confirm(`Применить к ${ids.length} жалобам?`)) return;
+    try {
+        const res = await fetch('/moderator/bulk/reports/resolve', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ report_ids: ids, ...payload })
+        });
+        const data = await res.json();
+        if (!data.success) {
+            alert(data.error || 'Ошибка');
+            return;
+        }
+        loadReports('open');
+        updateBulkBar();
+    } catch (e) {
+        console.error('Ошибка массового закрытия:', e);
+    }
+}
+
+function renderReportCounts() {
+    const el = document.getElementById('reports-counts');
+    if (!el || !reportCounts) return;
+    el.textContent = `Открыто: ${reportCounts.open_messages} сообщ. (${reportCounts.open} жалоб) • решено жалоб: ${reportCounts.resolved}`;
+}
+
+// ============= ЖИВЫЕ ОБНОВЛЕНИЯ (SOCKET.IO /moderator) =============
+
+// Сервер присылает пачки раз в пару секунд: новые жалобы и дельты счётчиков очереди
+function initModeratorLive() {
+    if (typeof io === 'undefined') return;
+    const live = io('/moderator');
+
+    live.on('stats_delta', (data) => {
+        if (!reportCounts) return;
+        Object.entries(data.totals || {}).forEach(([field, delta]) => {
+            reportCounts[field] = (reportCounts[field] || 0) + delta;
+        });
+        renderReportCounts();
+    });
+
+    live.on('new_report', (data) => {
+        const root = document.getElementById('reports-list');
+        if (!root || currentReportStatus !== 'open' || !root.closest('.mod-section.active')) return;
+        if (data.dropped) {
+            // Часть жалоб не влезла в пачку — проще перечитать первую страницу
+            loadReports('open');
+            return;
+        }
+        if (!root.querySelector('[data-message-id]')) root.innerHTML = '';
+        (data.items || []).forEach(r => {
+            // Карточка сообщения одна: новая жалоба заменяет прежнюю (счётчик вырос)
+            root.querySelector(`[data-message-id="${r.message_id}"]`)?.remove();
+            root.insertAdjacentHTML('afterbegin', renderReport(r));
+        });
+    });
+
+    // После переподключения пачки могли потеряться
+    live.on('connect', () => {
+        if (reportCounts) loadReports(currentReportStatus);
+    });
+}
+
 async function resolveReportPromptBan(reportId) {
     const raw = prompt('Бан на сколько минут? (например 60)');
     if (!raw) return;
@@ -127,20 +243,31 @@ function escapeHtml(str) {
         .replaceAll("'", '&#039;');
 }
 
-async function loadSupportChats() {
+// Входящие приходят страницами по курсору, свежая активность сверху
+async function loadSupportChats(append = false) {
     try {
-        const res = await fetch('/moderator/support/chats');
+        const query = new URLSearchParams();
+        const filter = document.getElementById('support-filter')?.value || '';
+        if (filter === 'unread') query.set('unread', '1');
+        else if (filter) query.set('assigned', filter);
+        if (append && supportCursor) query.set('cursor', supportCursor);
+
+        const res = await fetch(`/moderator/support/chats?${query}`);
         const data = await res.json();
         if (!data.success) {
             console.error(data.error);
             return;
         }
 
+        supportCursor = data.next_cursor || null;
+        const more = document.getElementById('support-more');
+        if (more) more.hidden = !supportCursor;
+
         const list = document.getElementById('support-chats');
-        list.innerHTML = '';
+        if (!append) list.innerHTML = '';
 
         const chats = data.chats || [];
-        if (chats.length === 0) {
+        if (chats.length === 0 && !append) {
             list.innerHTML = '<div style="color:#94a3b8; padding: 10px;">Нет диалогов</div>';
             return;
         }
@@ -150,9 +277,11 @@ async function loadSupportChats() {
             const last = item.last_message;
             const div = document.createElement('div');
             div.className = 'chat-row' + (selectedSupportChatId === item.chat_id ? ' active' : '');
+            const unread = item.unread_count ? `<span class="unread">${item.unread_count}</span>` : '';
+            const assigned = item.assigned_username ? ` • 👤 @${escapeHtml(item.assigned_username)}` : '';
             div.innerHTML = `
-                <div><strong>@${user?.username || 'unknown'}</strong> ${user?.nickname ? '— ' + user.nickname : ''}</div>
-                <div class="small">${last ? (last.message_type === 'text' ? (last.content || '') : '[' + last.message_type + ']') : 'Нет сообщений'}</div>
+                ${unread}<div><strong>@${user?.username || 'unknown'}</strong> ${user?.nickname ? '— ' + user.nickname : ''}</div>
+                <div class="small">${last ? (last.message_type === 'text' ? escapeHtml(last.content || '') : '[' + last.message_type + ']') : 'Нет сообщений'}${assigned}</div>
             `;
             div.addEventListener('click', () => {
                 selectedSupportChatId = item.chat_id;
@@ -160,6 +289,13 @@ async function loadSupportChats() {
                 div.classList.add('active');
                 const sel = document.getElementById('support-selected');
                 if (sel) sel.textContent = `Диалог: @${user?.username || 'unknown'}`;
+                const assign = document.getElementById('support-assign');
+                if (assign) assign.hidden = item.assigned_to === currentUser.id;
+                if (item.unread_count) {
+                    fetch(`/moderator/support/${item.chat_id}/read`, { method: 'POST' });
+                    div.querySelector('.unread')?.remove();
+                    item.unread_count = 0;
+                }
             });
             list.appendChild(div);
         });
@@ -168,6 +304,26 @@ async function loadSupportChats() {
     }
 }
 
+async function assignSupportChat() {
+    if (!selectedSupportChatId) return;
+    try {
+        const res = await fetch(`/moderator/support/${selectedSupportChatId}/assign`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({})
+        });
+        const data = await res.json();
+        if (!data.success) {
+            alert(data.error || 'Ошибка');
+            return;
+        }
+        document.getElementById('support-assign').hidden = true;
+        loadSupportChats();
+    } catch (e) {
+        console.error('Ошибка назначения:', e);
+    }
+}
+
 async function sendSupportReply() {
     const text = (document.getElementById('support-reply').value || '').trim();
     if (!selectedSupportChatId) {
@@ -0,0 +1,155 @@
+// BeeGramm — компактный формат событий Socket.IO 🐝
+// Пара к wire.py: MessagePack-декодер, версия профиля отправителя и
+// разворачивание коротких кодов обратно в формат JSON-событий.
+
+const BeeWire = (() => {
+    const utf8 = new TextDecoder();
+
+    // ============= MESSAGEPACK =============
+    // Только то, что шлёт сервер: nil, bool, int, float, str, bin, array, map
+
+    function decode(buffer) {
+        const bytes = buffer instanceof Uint8Array ? buffer : new Uint8Array(buffer);
+        const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+        let pos = 0;
+
+        const str = (n) => { const s = utf8.decode(bytes.subarray(pos, pos + n)); pos += n; return s; };
+        const bin = (n) => { const b = bytes.slice(pos, pos + n); pos += n; return b; };
+        const arr = (n) => { const a = new Array(n); for (let i = 0; i < n; i++) a[i] = read(); return a; };
+        const map = (n) => { const o = {}; for (let i = 0; i < n; i++) { const k = read(); o[k] = read(); } return o; };
+        const u8 = () => view.getUint8(pos++);
+        const u16 = () => { const v = view.getUint16(pos); pos += 2; return v; };
+        const u32 = () => { const v = view.getUint32(pos); pos += 4; return v; };
+
+        function read() {
+            const t = u8();
+            if (t < 0x80) return t;
+            if (t < 0x90) return map(t & 0x0f);
+            if (t < 0xa0) return arr(t & 0x0f);
+            if (t < 0xc0) return str(t & 0x1f);
+            if (t >= 0xe0) return t - 0x100;
+            switch (t) {
+                case 0xc0: return null;
+                case 0xc2: return false;
+                case 0xc3: return true;
+                case 0xc4: return bin(u8());
+                case 0xc5: return bin(u16());
+                case 0xc6: return bin(u32());
+                case 0xca: { const v = view.getFloat32(pos); pos += 4; return v; }
+                case 0xcb: { const v = view.getFloat64(pos); pos += 8; return v; }
+                case 0xcc: return u8();
+                case 0xcd: return u16();
+                case 0xce: return u32();
+                case 0xcf: { const v = Number(view.getBigUint64(pos)); pos += 8; return v; }
+                case 0xd0: { const v = view.getInt8(pos); pos += 1; return v; }
+                case 0xd1: { const v = view.getInt16(pos); pos += 2; return v; }
+                case 0xd2: { const v = view.getInt32(pos); pos += 4; return v; }
+                case 0xd3: { const v = Number(view.getBigInt64(pos)); pos += 8; return v; }
+                case 0xd9: return str(u8());
+                case 0xda: return str(u16());
+                case 0xdb: return str(u32());
+                case 0xdc: return arr(u16());
+                case 0xdd: return arr(u32());
+                case 0xde: return map(u16());
+                case 0xdf: return map(u32());
+            }
+            throw new Error(`msgpack: неизвестный тип 0x${t.toString(16)}`);
+        }
+
+        return read();
+    }
+
+    // ============= ПРОФИЛИ ОТПРАВИТЕЛЕЙ =============
+
+    const CRC_TABLE = (() => {
+        const table = new Uint32Array(256);
+        for (let n = 0; n < 256; n++) {
+            let c = n;
+            for (let k = 0; k < 8; k++) c = c & 1 ? 0xedb88320 ^ (c >>> 1) : c >>> 1;
+            table[n] = c >>> 0;
+        }
+        return table;
+    })();
+
+    function crc32(bytes) {
+        let c = 0xffffffff;
+        for (let i = 0; i < bytes.length; i++) c = CRC_TABLE[(c ^ bytes[i]) & 0xff] ^ (c >>> 8);
+        return (c ^ 0xffffffff) >>> 0;
+    }
+
+    // То же, что wire.profile_version на сервере
+    function profileVersion(p) {
+        const raw = [p.nickname || '', p.username || '', p.avatar || '', p.is_premium ? '1' : '0'].join('\x1f');
+        return crc32(new TextEncoder().encode(raw));
+    }
+
+    const profiles = new Map();  // user_id -> {nickname, username, avatar, is_premium, v}
+
+    // Профили из JSON-ответов (история сообщений) — чтобы не запрашивать их повторно
+    function rememberProfiles(messages) {
+        (messages || []).forEach(m => {
+            if (m && m.user_id != null && !profiles.has(m.user_id)) {
+                const p = { nickname: m.nickname, username: m.username, avatar: m.avatar, is_premium: m.is_premium };
+                p.v = profileVersion(p);
+                profiles.set(m.user_id, p);
+            }
+        });
+    }
+
+    async function fetchProfiles(ids) {
+        const response = await fetch(`/users/profiles?ids=${ids.join(',')}`);
+        const data = await response.json();
+        Object.entries(data.profiles || {}).forEach(([id, p]) => profiles.set(Number(id), p));
+    }
+
+    // ============= СОБЫТИЯ =============
+
+    const MESSAGE_FIELDS = [
+        ['id', 'i', null], ['chat_id', 'c', null], ['user_id', 's', null], ['content', 't', null],
+        ['message_type', 'y', 'text'], ['file_url', 'f', null], ['is_read', 'r', 0],
+        ['is_deleted', 'd', 0], ['created_at', 'a', null],
+    ];
+
+    async function message(c) {
+        const known = profiles.get(c.s);
+        if (!known || known.v !== c.v) {
+            try {
+                await fetchProfiles([c.s]);
+            } catch (e) {
+                // покажем сообщение и без профиля
+            }
+        }
+        const msg = {};
+        MESSAGE_FIELDS.forEach(([field, code, def]) => { msg[field] = code in c ? c[code] : def; });
+        if (c.o) msg.voice = c.o;
+        const p = profiles.get(c.s) || {};
+        msg.nickname = p.nickname ?? null;
+        msg.username = p.username ?? null;
+        msg.avatar = p.avatar ?? null;
+        msg.is_premium = p.is_premium ?? 0;
+        return msg;
+    }
+
+    function reactions(c) {
+        const list = [];
+        c.r.forEach(([emoji, names]) => names.forEach(username => list.push({ emoji, username })));
+        return { chat_id: c.c, message_id: c.m, reactions: list };
+    }
+
+    const DECODERS = { new_message: message, reactions_updated: reactions };
+
+    // Бинарный payload развернуть в формат JSON-события; JSON — вернуть как есть.
+    // Разворачивание идёт по очереди, чтобы промах кэша профилей не менял порядок событий.
+    let queue = Promise.resolve();
+
+    function handler(event, fn) {
+        return (data) => {
+            queue = queue.then(async () => {
+                const isBinary = data instanceof ArrayBuffer || data instanceof Uint8Array;
+                fn(isBinary ? await DECODERS[event](decode(data)) : data);
+            }).catch(e => console.error(`Ошибка события ${event}:`, e));
+        };
+    }
+
+    return { decode, profileVersion, rememberProfiles, handler, supported: typeof TextDecoder !== 'undefined' };
+})();
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+BeeGramm — драйверы хранилища 🐝
+
+SQLiteBackend — прежнее поведение: файл beegram.db (и шарды сообщений рядом).
+PostgresBackend — общий сервер БД для нескольких узлов: пул соединений,
+совместимый с gevent (psycogreen), и тонкая обёртка над psycopg2, которая
+принимает SQL в диалекте репозитория (плейсхолдеры ?, INSERT OR IGNORE,
+id новой строки через insert_id) и отдаёт строки с доступом по имени и по номеру, как sqlite3.Row.
+
+Бэкенд выбирает repository.configure(backend=...); маршруты об этом не знают.
+"""
+
+import os
+import re
+import sqlite3
+import threading
+from datetime import date, datetime
+from decimal import Decimal
+from functools import lru_cache
+
+try:
+    from gevent.lock import BoundedSemaphore
+except ImportError:
+    BoundedSemaphore = threading.BoundedSemaphore
+
+
+# Хуки после commit: fn(tables) — таблицы, которые репозиторий менял в этой транзакции
+_commit_hooks = []
+
+
+def add_commit_hook(fn):
+    _commit_hooks.append(fn)
+
+
+def note_writes(target, tables):
+    """Запомнить таблицы, изменённые в транзакции соединения (или его курсора)"""
+    written = getattr(getattr(target, 'connection', target), 'written', None)
+    if written is not None:
+        written.update(tables)
+
+
+def after_commit(target, fn):
+    """Выполнить fn() после commit транзакции соединения (или его курсора); при rollback — забыть.
+    У соединений без такого учёта fn выполняется сразу."""
+    pending = getattr(getattr(target, 'connection', target), 'on_commit', None)
+    if pending is None:
+        fn()
+    else:
+        pending.append(fn)
+
+
+def _committed(conn):
+    tables, conn.written = conn.written, set()
+    callbacks, conn.on_commit = conn.on_commit, []
+    if tables:
+        for fn in _commit_hooks:
+            fn(tables)
+    for fn in callbacks:
+        fn()
+
+
+class Connection(sqlite3.Connection):
+    """sqlite3.Connection, который после commit сообщает хукам изменённые таблицы"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.written = set()
+        self.on_commit = []
+
+    def commit(self):
+        super().commit()
+        _committed(self)
+
+    def rollback(self):
+        super().rollback()
+        self.written = set()
+        self.on_commit = []
+
+
+class ReplicaConnection(Connection):
+    """Соединение только для чтения (см. repository.replica)"""
+    replica = True
+
+
+def open_sqlite(path, manual_checkpoints=False, read_only=False):
+    """Соединение SQLite со строками sqlite3.Row.
+
+    manual_checkpoints — чекпойнты WAL делает только архиватор (backup.WalArchiver),
+    иначе кадры ушли бы в файл базы раньше, чем в архив.
+    read_only — соединение реплики: query_only, запись запрещена.
+    """
+    if read_only:
+        conn = sqlite3.connect(path, factory=ReplicaConnection)
+        conn.execute('PRAGMA query_only = 1')
+    else:
+        conn = sqlite3.connect(path, factory=Connection)
+    conn.row_factory = sqlite3.Row
+    if manual_checkpoints:
+        conn.execute('PRAGMA wal_autocheckpoint = 0')
+    return conn
+
+
+class SQLiteBackend:
+    name = 'sqlite'
+    supports_shards = True
+
+    def __init__(self, path, manual_checkpoints=False):
+        self.path = path
+        self.manual_checkpoints = manual_checkpoints
+
+    def connect(self):
+        return open_sqlite(self.path, self.manual_checkpoints)
+
+    def init_schema(self):
+        """Схему SQLite создаёт и мигрирует init_db в server.py"""
+
+    def close(self):
+        pass
+
+
+class PostgresBackend:
+    name = 'postgres'
+    # Шарды — это файлы SQLite; Postgres масштабируется своими средствами
+    supports_shards = False
+
+    SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema_postgres.sql')
+
+    def __init__(self, dsn, pool_size=10, read_only=False):
+        try:
+            import psycopg2
+            import psycopg2.pool
+        except ImportError:
+            raise RuntimeError('Для DB_BACKEND = postgres нужен пакет psycopg2-binary')
+        try:
+            # Ожидание ответа сервера отдаёт управление другим гринлетам
+            from psycogreen.gevent import patch_psycopg
+            patch_psycopg()
+        except ImportError:
+            print('⚠️ psycogreen не установлен: запросы к Postgres будут блокировать воркер gevent')
+
+        self._psycopg2 = psycopg2
+        self.read_only = read_only
+        # Время в БД хранится в UTC — как CURRENT_TIMESTAMP в SQLite
+        options = '-c timezone=UTC'
+        if read_only:
+            options += ' -c default_transaction_read_only=on'
+        self._pool = psycopg2.pool.ThreadedConnectionPool(1, pool_size, dsn, options=options)
+        # ThreadedConnectionPool при исчерпании бросает PoolError — ждём свободное соединение.
+        # Семафор gevent: ожидание уступает hub, и гринлеты с соединениями успевают их вернуть
+        # (threading.BoundedSemaphore без monkey-patching заблокировал бы весь процесс)
+        self._slots = BoundedSemaphore(pool_size)
+
+    def connect(self):
+        self._slots.acquire()
+        try:
+            raw = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        return PgConnection(self, raw)
+
+    def release(self, raw):
+        try:
+            broken = bool(raw.closed)
+            if not broken:
+                # Незакоммиченное не должно уехать в пул — как close() без commit в SQLite
+                raw.rollback()
+            self._pool.putconn(raw, close=broken)
+        finally:
+            self._slots.release()
+
+    def init_schema(self):
+        """Создать таблицы и индексы из schema_postgres.sql (идемпотентно)"""
+        with open(self.SCHEMA_PATH, encoding='utf-8') as f:
+            ddl = f.read()
+        conn = self.connect()
+        try:
+            conn.raw.cursor().execute(ddl)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def close(self):
+        self._pool.closeall()
+
+
+# ============= ОБЁРТКА НАД PSYCOPG2 =============
+
+# Строковые литералы пропускаем целиком, чтобы не трогать '?' внутри них
+_PLACEHOLDER = re.compile(r"'(?:[^']|'')*'|\?")
+_INSERT_OR_IGNORE = re.compile(r'^\s*INSERT\s+OR\s+IGNORE\s+', re.IGNORECASE)
+
+
+@lru_cache(maxsize=2048)
+def translate(sql, returning=False):
+    """SQL репозитория -> SQL Postgres. Возвращает (sql, добавлен ли RETURNING id).
+
+    returning — вызывающему нужен id вставленной строки (insert_id); без него
+    INSERT в таблицу без колонки id (stats_counters) тоже работает.
+    """
+    ignore = _INSERT_OR_IGNORE.match(sql)
+    if ignore:
+        sql = 'INSERT ' + sql[ignore.end():]
+    sql = sql.replace('%', '%%')
+    sql = _PLACEHOLDER.sub(lambda m: '%s' if m.group(0) == '?' else m.group(0), sql)
+    sql = re.sub(r'\bIFNULL\(', 'COALESCE(', sql, flags=re.IGNORECASE)
+    # LIKE в SQLite не различает регистр (ASCII)
+    sql = re.sub(r'\bLIKE\b', 'ILIKE', sql)
+    sql = sql.rstrip().rstrip(';')
+    if ignore:
+        sql += ' ON CONFLICT DO NOTHING'
+    add_returning = (returning and re.match(r'\s*INSERT\b', sql, re.IGNORECASE)
+                     and not re.search(r'\bRETURNING\b', sql, re.IGNORECASE))
+    if add_returning:
+        sql += ' RETURNING id'
+    return sql, bool(add_returning)
+
+
+def _value(v):
+    if isinstance(v, datetime):
+        return v.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(v, date):
+        return v.isoformat()
+    if isinstance(v, Decimal):
+        return int(v) if v == v.to_integral_value() else float(v)
+    if isinstance(v, memoryview):
+        return v.tobytes()
+    return v
+
+
+class Row(dict):
+    """Строка результата: dict по именам колонок плюс row[0], row[1], ... как у sqlite3.Row"""
+
+    def __init__(self, names, values):
+        values = tuple(_value(v) for v in values)
+        super().__init__(zip(names, values))
+        self._values = values
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self._values[key]
+        return super().__getitem__(key)
+
+
+class PgCursor:
+    def __init__(self, raw):
+        self._raw = raw
+        self.lastrowid = None
+
+    def execute(self, sql, params=(), returning_id=False):
+        sql, returning = translate(sql, returning_id)
+        self._raw.execute(sql, tuple(params))
+        if returning:
+            row = self._raw.fetchone()
+            self.lastrowid = row[0] if row else None
+        return self
+
+    def executemany(self, sql, seq):
+        sql, _ = translate(sql)
+        self._raw.executemany(sql, [tuple(p) for p in seq])
+        return self
+
+    @property
+    def rowcount(self):
+        return self._raw.rowcount
+
+    @property
+    def description(self):
+        return self._raw.description
+
+    def _names(self):
+        return [d[0] for d in self._raw.description]
+
+    def fetchone(self):
+        if self._raw.description is None:
+            return None
+        row = self._raw.fetchone()
+        return Row(self._names(), row) if row is not None else None
+
+    def fetchall(self):
+        if self._raw.description is None:
+            return []
+        names = self._names()
+        return [Row(names, r) for r in self._raw.fetchall()]
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        self._raw.close()
+
+
+class PgConnection:
+    """Соединение из пула с интерфейсом sqlite3.Connection (execute, cursor, commit, close)"""
+
+    def __init__(self, backend, raw):
+        self._backend = backend
+        self.raw = raw
+        self.replica = backend.read_only
+        self.written = set()
+        self.on_commit = []
+
+    def cursor(self):
+        return PgCursor(self.raw.cursor())
+
+    def execute(self, sql, params=(), returning_id=False):
+        return self.cursor().execute(sql, params, returning_id)
+
+    def executemany(self, sql, seq):
+        return self.cursor().executemany(sql, seq)
+
+    def commit(self):
+        self.raw.commit()
+        _committed(self)
+
+    def rollback(self):
+        self.raw.rollback()
+        self.written = set()
+        self.on_commit = []
+
+    def close(self):
+        if self.raw is not None:
+            self._backend.release(self.raw)
+            self.raw = None
+
+    def __del__(self):
+        # Забытый close() не должен навсегда занять слот пула
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def execute(target, sql, params=(), returning_id=False):
+    """target.execute(sql, params) для соединения или курсора любого бэкенда.
+    returning_id — после INSERT понадобится cursor.lastrowid (в Postgres — RETURNING id)."""
+    if returning_id and isinstance(target, (PgConnection, PgCursor)):
+        return target.execute(sql, params, returning_id=True)
+    return target.execute(sql, params)
+
+
+def insert_id(target, sql, params=()):
+    """INSERT одной строки -> id новой строки (только для таблиц с колонкой id)"""
+    return execute(target, sql, params, returning_id=True).lastrowid
+
+
+def make_backend(name, db_path, dsn=None, pool_size=10, manual_checkpoints=False):
+    if name == 'sqlite':
+        return SQLiteBackend(db_path, manual_checkpoints=manual_checkpoints)
+    if name == 'postgres':
+        if not dsn:
+            raise ValueError('Для DB_BACKEND = postgres укажите DATABASE_URL')
+        return PostgresBackend(dsn, pool_size=pool_size)
+    raise ValueError(f'Неизвестный DB_BACKEND: {name}')
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Общие фикстуры тестов хранилища 🐝
+
+Каждый тест с фикстурой `store` выполняется на SQLite (один файл и два шарда
+сообщений) и на Postgres. Postgres берётся из BEEGRAM_TEST_DATABASE_URL — это
+должна быть отдельная пустая БД: тесты пересоздают в ней схему public. Если
+переменная не задана, но в PATH есть initdb и pg_ctl, поднимается временный
+кластер. Без psycopg2 или без сервера вариант postgres пропускается.
+"""
+
+import os
+import shutil
+import socket
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import repository as repo  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def server_module(tmp_path_factory):
+    """server.py при импорте создаёт и наполняет beegram.db в текущем каталоге —
+    импортируем его в отдельном каталоге. Нужен ради схемы SQLite (_init_sqlite_schema)."""
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('server'))
+    try:
+        import server
+    finally:
+        os.chdir(cwd)
+    return server
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture(scope='session')
+def postgres_dsn(tmp_path_factory):
+    try:
+        import psycopg2  # noqa: F401
+    except ImportError:
+        pytest.skip('psycopg2 не установлен')
+
+    dsn = os.environ.get('BEEGRAM_TEST_DATABASE_URL')
+    if dsn:
+        yield dsn
+        return
+
+    initdb, pg_ctl = shutil.which('initdb'), shutil.which('pg_ctl')
+    if not initdb or not pg_ctl:
+        pytest.skip('нет BEEGRAM_TEST_DATABASE_URL и initdb/pg_ctl для временного кластера')
+    base = tmp_path_factory.mktemp('pg')
+    data = base / 'data'
+    port = _free_port()
+    try:
+        subprocess.run([initdb, '-D', str(data), '-U', 'beegram', '--auth=trust', '-E', 'UTF8'],
+                       check=True, capture_output=True)
+        subprocess.run([pg_ctl, '-D', str(data), '-l', str(base / 'server.log'), '-w',
+                        '-o', f"-p {port} -k {base} -c listen_addresses=''", 'start'],
+                       check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        # initdb, например, не запускается от root
+        pytest.skip(f'не удалось поднять временный Postgres: {e}')
+    try:
+        yield f'postgresql://beegram@/postgres?host={base}&port={port}'
+    finally:
+        subprocess.run([pg_ctl, '-D', str(data), '-m', 'immediate', 'stop'], capture_output=True)
+
+
+def _reset_postgres(dsn):
+    import psycopg2
+    conn = psycopg2.connect(dsn)
+    try:
+        conn.cursor().execute('DROP SCHEMA public CASCADE; CREATE SCHEMA public')
+        conn.commit()
+    finally:
+        conn.close()
+
+
+@pytest.fixture(params=['sqlite', 'sqlite_sharded', 'postgres'])
+def store(request, tmp_path, monkeypatch, server_module):
+    """Чистое хранилище выбранного вида; возвращает его имя"""
+    kind = request.param
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(repo, '_shard_id_floor', 0)
+    repo._cache.clear()
+    repo._cache_keys.clear()
+    if kind == 'postgres':
+        dsn = request.getfixturevalue('postgres_dsn')
+        _reset_postgres(dsn)
+        repo.configure(backend='postgres', dsn=dsn, message_shards=1, pool_size=4)
+        repo.init_schema()
+    else:
+        repo.configure(backend='sqlite', db_path='beegram.db', message_shards=2 if kind == 'sqlite_sharded' else 1)
+        server_module._init_sqlite_schema()
+        repo.init_shards()
+    yield kind
+    repo.backend().close()
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Одинаковое поведение репозитория на SQLite (с шардами и без) и на Postgres 🐝
+"""
+
+import pytest
+
+import repository as repo
+
+
+def _user(name):
+    return repo.users.create(name, 'hash', name.title())
+
+
+def test_users(store):
+    uid = _user('alice')
+    user = repo.users.get(uid)
+    assert user['username'] == 'alice'
+    assert user['nickname'] == 'Alice'
+    assert user['bee_stars'] == 100
+    assert repo.users.get_by_username('alice')['id'] == uid
+    assert repo.users.get(uid + 1000) is None
+
+    repo.users.update(uid, nickname='Алиса', is_premium=1)
+    user = repo.users.get(uid)
+    assert (user['nickname'], user['is_premium']) == ('Алиса', 1)
+
+    bob = _user('bob')
+    assert set(repo.users.profiles([uid, bob])) == {uid, bob}
+
+    repo.users.delete(bob)
+    assert repo.users.get(bob) is None
+
+
+def test_chats(store):
+    alice, bob, carol = _user('alice'), _user('bob'), _user('carol')
+
+    private = repo.chats.create_private(alice, bob, creator_id=alice)
+    assert repo.chats.find_private(alice, bob) == private
+    assert repo.chats.find_private(bob, alice) == private
+    assert repo.chats.find_private(alice, carol) is None
+
+    group = repo.chats.create_group('Улей', 'про мёд', alice, [carol])
+    assert repo.chats.member_chat_ids(carol) == {group}
+    assert repo.chats.member_chat_ids(alice) == {private, group}
+
+    channel = repo.chats.create_channel('news', 'новости', alice)
+    subscribers = repo.chats.get(channel)['subscribers_count']
+    repo.chats.subscribe(channel, bob)
+    assert repo.chats.is_member(channel, bob)
+    assert repo.chats.get(channel)['subscribers_count'] == subscribers + 1
+    repo.chats.unsubscribe(channel, bob)
+    assert not repo.chats.is_member(channel, bob)
+    assert repo.chats.get(channel)['subscribers_count'] == subscribers
+    assert repo.chats.channel_by_name('news') == channel
+
+    repo.chats.delete(group)
+    assert repo.chats.get(group) is None
+    assert repo.chats.member_chat_ids(carol) == set()
+
+
+def test_messages(store):
+    alice, bob = _user('alice'), _user('bob')
+    chat = repo.chats.create_private(alice, bob)
+
+    sent = [repo.messages.insert(chat, alice if i % 2 == 0 else bob, f'm{i}') for i in range(5)]
+    ids = [m['id'] for m in sent]
+    assert ids == sorted(ids)
+    assert sent[0]['username'] == 'alice'
+    assert [m['content'] for m in repo.messages.history(chat)] == ['m0', 'm1', 'm2', 'm3', 'm4']
+
+    msg = repo.messages.get(ids[1], chat_id=chat)
+    assert (msg['content'], msg['user_id'], msg['is_read']) == ('m1', bob, 0)
+    assert repo.messages.get(ids[1])['id'] == ids[1]
+
+    version = repo.messages.version(chat)
+    assert repo.messages.mark_read(chat, alice) == 2
+    assert repo.messages.version(chat) > version
+    assert repo.messages.get(ids[1], chat_id=chat)['is_read'] == 1
+
+    repo.messages.soft_delete(ids[2], chat, alice)
+    assert repo.messages.get(ids[2], chat_id=chat)['is_deleted'] == 1
+    deleted = repo.messages.soft_delete_many([ids[2], ids[3]], bob)
+    assert [r['id'] for r in deleted] == [ids[3]]
+
+    reactions = repo.reactions.toggle(chat, ids[0], bob, '🐝')
+    assert [r['emoji'] for r in reactions] == ['🐝']
+    assert repo.reactions.toggle(chat, ids[0], bob, '🐝') == []
+
+    last, unread = repo.messages.previews([chat], alice)[chat]
+    assert (last['id'], unread) == (ids[4], 0)
+
+
+def test_sharded_inserts(store):
+    if store != 'sqlite_sharded':
+        pytest.skip('шарды сообщений есть только у SQLite')
+    alice, bob = _user('alice'), _user('bob')
+    chats = [repo.chats.create_private(alice, bob) for _ in range(2)]
+    assert {repo.shard_for_chat(c) for c in chats} == {0, 1}
+
+    for chat in chats:
+        ids = [repo.messages.insert(chat, alice, 'x')['id'] for _ in range(3)]
+        assert all(i % 2 == repo.shard_for_chat(chat) for i in ids)
+        assert repo.messages.get(ids[0])['chat_id'] == chat
+
+    # id удалённых сообщений не выдаются заново
+    chat = chats[0]
+    before = max(m['id'] for m in repo.messages.history(chat))
+    repo.messages.delete_for_chat(chat)
+    assert repo.messages.insert(chat, alice, 'y')['id'] > before
+
+
+def test_keyset_paging(store):
+    ids = [_user(f'user{i:02d}') for i in range(7)]
+
+    seen, cursor = [], None
+    while True:
+        rows, cursor = repo.users.page(sort='new', cursor=cursor, limit=3)
+        seen.extend(r['id'] for r in rows)
+        if not cursor:
+            break
+    assert seen == sorted(ids, reverse=True)
+
+    rows, cursor = repo.users.page(sort='username', limit=4, prefix='user0')
+    assert [r['username'] for r in rows] == ['user00', 'user01', 'user02', 'user03']
+    rows, cursor = repo.users.page(sort='username', cursor=cursor, limit=4, prefix='user0')
+    assert [r['username'] for r in rows] == ['user04', 'user05', 'user06']
+    assert cursor is None
+
+    with pytest.raises(ValueError):
+        repo.users.page(sort='nope')
+
+    chat = repo.chats.create_private(ids[0], ids[1])
+    sent = [repo.messages.insert(chat, ids[0], str(i))['id'] for i in range(5)]
+    page = repo.messages.page(chat, 2)
+    assert [m['id'] for m in page] == sent[:-3:-1]
+    page = repo.messages.page(chat, 2, before_id=page[-1]['id'])
+    assert [m['id'] for m in page] == sent[-3:-5:-1]
+
+
+def test_star_transfers(store):
+    alice, bob = _user('alice'), _user('bob')
+
+    assert repo.stars.transfer(alice, bob, 30, note='за мёд') == (70, 130)
+    assert repo.stars.transfer(alice, bob, 1000) is None
+    assert repo.stars.transfer(alice, alice, 10) is None
+    with pytest.raises(ValueError):
+        repo.stars.transfer(alice, bob + 1000, 10)
+    # Неудачный перевод откатывается целиком
+    assert repo.users.get(alice)['bee_stars'] == 70
+
+    assert repo.stars.airdrop([alice, bob, bob + 1000], 5) == {alice: 75, bob: 135}
+    assert repo.stars.drift() == []
+
+    rows, cursor = repo.stars.history(user_id=alice, limit=2)
+    assert [r['kind'] for r in rows] == ['airdrop', 'gift']
+    assert rows[1]['from_username'] == 'alice' and rows[1]['to_username'] == 'bob'
+    rows, cursor = repo.stars.history(user_id=alice, cursor=cursor, limit=2)
+    assert [r['kind'] for r in rows] == ['signup']
+    assert cursor is None
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+BeeGramm — обработка голосовых сообщений 🐝
+
+Браузер пишет голосовое как получится: webm/ogg/wav с любым битрейтом, и
+плееру приходится скачивать файл целиком, чтобы узнать длительность. После
+загрузки файл уходит в пул процессов (CPU-работа не держит event loop и GIL
+воркера), и задача:
+
+  * перекодирует его в Ogg/Opus моно с низким битрейтом (VOICE_BITRATE) —
+    если есть ffmpeg;
+  * считает длительность (мс) и огибающую громкости — waveform из
+    VOICE_WAVEFORM_POINTS чисел 0..100 для отрисовки до загрузки звука.
+
+Без ffmpeg файл остаётся как есть, а метаданные считаются на чистом Python
+по контейнеру: WAV — по сэмплам, Ogg и WebM — по меткам времени и размерам
+пакетов (у Opus VBR размер пакета растёт с громкостью, этого хватает для
+огибающей).
+
+configure() только запоминает параметры; пул создаёт start() из фоновых задач
+сервера. submit() возвращает concurrent.futures.Future; ждать его в запросе
+нельзя — server.py опрашивает готовность в фоновой задаче (_voice_loop).
+
+Процессы пула стартуют методом spawn и выполняют только этот модуль: spawn
+исполняет в дочернем процессе модуль __main__ родителя, а им может быть
+server.py (init_db, ensure(), фоновые задачи — второй раз и на живой базе).
+ProcessPoolExecutor запускает процессы только внутри submit(), поэтому на это
+время __main__ подменяется модулем voice (_worker_main).
+"""
+
+import array
+import math
+import multiprocessing
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import wave
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+_pool = None
+_started = False
+_settings = {'workers': 2, 'bitrate': '24k', 'points': 64, 'ffmpeg': None}
+
+PCM_RATE = 8000  # частота, в которой ffmpeg отдаёт сэмплы для огибающей
+SUFFIX = '.opus.ogg'
+
+
+def configure(workers=2, bitrate='24k', points=64, ffmpeg=None):
+    """Параметры пула и перекодирования (пул создаёт start()). ffmpeg=None — искать в PATH."""
+    _settings.update(workers=workers, bitrate=bitrate, points=points, ffmpeg=ffmpeg)
+
+
+def start():
+    """Разрешить обработку (один раз). Пул и его процессы появятся с первой задачей."""
+    global _started
+    if _started:
+        return
+    _settings['ffmpeg'] = _settings['ffmpeg'] or shutil.which('ffmpeg')
+    if _settings['ffmpeg'] is None:
+        print('⚠️ ffmpeg не найден: голосовые не перекодируются, метаданные считаются по контейнеру')
+    _started = True
+
+
+def running():
+    return _started
+
+
+def _new_pool():
+    # spawn: дочерний процесс не наследует hub gevent/eventlet родителя
+    return ProcessPoolExecutor(max_workers=_settings['workers'], mp_context=multiprocessing.get_context('spawn'))
+
+
+@contextmanager
+def _worker_main():
+    """Процесс, запущенный внутри блока, выполнит при старте этот модуль вместо __main__ родителя"""
+    main = sys.modules['__main__']
+    sys.modules['__main__'] = sys.modules[__name__]
+    try:
+        yield
+    finally:
+        sys.modules['__main__'] = main
+
+
+def submit(path):
+    """Поставить файл в очередь. Результат future — dict: path, duration_ms, waveform."""
+    global _pool
+    if not _started:
+        raise RuntimeError('Пул обработки голосовых не запущен (voice.start)')
+    if _pool is None:
+        _pool = _new_pool()
+    args = (process, os.path.abspath(path), _settings['ffmpeg'], _settings['bitrate'], _settings['points'])
+    with _worker_main():
+        try:
+            return _pool.submit(*args)
+        except BrokenProcessPool:
+            # Процесс пула умер (OOM, kill) — пул больше не принимает задачи, создаём новый
+            _pool = _new_pool()
+            return _pool.submit(*args)
+
+
+# ============= ЗАДАЧА (в процессе пула) =============
+
+def process(path, ffmpeg=None, bitrate='24k', points=64):
+    if ffmpeg:
+        out = os.path.splitext(path)[0] + SUFFIX
+        subprocess.run([ffmpeg, '-nostdin', '-loglevel', 'error', '-y', '-i', path, '-vn', '-ac', '1',
+                        '-c:a', 'libopus', '-b:a', bitrate, '-application', 'voip', out],
+                       check=True, timeout=300)
+        pcm = subprocess.run([ffmpeg, '-nostdin', '-loglevel', 'error', '-i', out, '-ac', '1',
+                              '-ar', str(PCM_RATE), '-f', 's16le', '-'],
+                             check=True, timeout=300, stdout=subprocess.PIPE).stdout
+        samples = array.array('h', pcm[:len(pcm) // 2 * 2])
+        if sys.byteorder == 'big':
+            samples.byteswap()
+        return {'path': out, 'duration_ms': len(samples) * 1000 // PCM_RATE,
+                'waveform': envelope([abs(s) for s in samples], points)}
+
+    duration_ms, levels = metadata(path)
+    return {'path': path, 'duration_ms': duration_ms, 'waveform': envelope(levels, points)}
+
+
+def envelope(levels, points):
+    """Уровни -> points чисел 0..100: пик в каждом из points равных отрезков, нормировка по максимуму"""
+    if not levels or points <= 0:
+        return []
+    n = len(levels)
+    peaks = [max(levels[i * n // points:max((i + 1) * n // points, i * n // points + 1)])
+             for i in range(min(points, n))]
+    top = max(peaks) or 1
+    return [round(100 * p / top) for p in peaks]
+
+
+# ============= МЕТАДАННЫЕ БЕЗ FFMPEG =============
+
+def metadata(path):
+    """(длительность в мс, уровни для огибающей) по контейнеру файла"""
+    with open(path, 'rb') as f:
+        head = f.read(4)
+    if head == b'RIFF':
+        return _wav(path)
+    if head == b'OggS':
+        return _ogg(path)
+    if head == b'\x1a\x45\xdf\xa3':
+        return _webm(path)
+    raise ValueError('Неизвестный формат голосового')
+
+
+def _wav(path):
+    with wave.open(path, 'rb') as w:
+        rate, width, channels, frames = w.getframerate(), w.getsampwidth(), w.getnchannels(), w.getnframes()
+        raw = w.readframes(frames)
+    if width == 2:
+        samples = array.array('h', raw)
+        if sys.byteorder == 'big':
+            samples.byteswap()
+        levels = [abs(s) for s in samples[::channels]]
+    elif width == 1:
+        levels = [abs(b - 128) for b in raw[::channels]]
+    else:
+        levels = [abs(int.from_bytes(raw[i:i + width], 'little', signed=True))
+                  for i in range(0, len(raw), width * channels)]
+    return frames * 1000 // rate, levels
+
+
+def _ogg(path):
+    """Длительность — по granule position последней страницы, уровни — размеры пакетов"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    pos, granule, rate, pre_skip = 0, 0, 48000, 0
+    packets, current, first = [], 0, None
+    while data.startswith(b'OggS', pos):
+        page_granule = struct.unpack_from('<q', data, pos + 6)[0]
+        count = data[pos + 26]
+        lacing = data[pos + 27:pos + 27 + count]
+        body = pos + 27 + count
+        if first is None:
+            first = data[body:body + 19]
+            if first.startswith(b'OpusHead'):
+                pre_skip = struct.unpack_from('<H', first, 10)[0]
+            elif first.startswith(b'\x01vorbis'):
+                rate = struct.unpack_from('<I', first, 12)[0]
+        for size in lacing:
+            current += size
+            if size < 255:
+                packets.append(current)
+                current = 0
+        if page_granule >= 0:
+            granule = page_granule
+        pos = body + sum(lacing)
+    # Первые пакеты — заголовки кодека
+    levels = packets[2:] if len(packets) > 2 else packets
+    return max(0, granule - pre_skip) * 1000 // rate, levels
+
+
+# Элементы WebM, внутрь которых заходим (остальные пропускаем по размеру)
+_EBML_MASTERS = {0x18538067, 0x1549A966, 0x1F43B675, 0xA0}  # Segment, Info, Cluster, BlockGroup
+
+
+def _vint(data, pos, keep_marker=False):
+    first = data[pos]
+    if not first:
+        raise ValueError('Битый vint')
+    length = 8 - first.bit_length() + 1
+    value = first if keep_marker else first & (0xFF >> length)
+    for b in data[pos + 1:pos + length]:
+        value = (value << 8) | b
+    return value, pos + length, value == (1 << (7 * length)) - 1
+
+
+def _webm(path):
+    """Длительность — по времени последнего блока (MediaRecorder не пишет Duration), уровни — размеры блоков"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    pos, scale, cluster, last, duration = 0, 1000000, 0, 0, None
+    levels = []
+    while pos < len(data):
+        try:
+            element, pos, _ = _vint(data, pos, keep_marker=True)
+            size, pos, unknown = _vint(data, pos)
+        except (IndexError, ValueError):
+            break
+        if element in _EBML_MASTERS:
+            continue
+        if unknown:
+            break
+        payload = data[pos:pos + size]
+        if element == 0x2AD7B1:  # TimecodeScale
+            scale = int.from_bytes(payload, 'big')
+        elif element == 0x4489:  # Duration (float, в единицах TimecodeScale)
+            duration = struct.unpack('>f' if size == 4 else '>d', payload)[0]
+        elif element == 0xE7:  # Timecode кластера
+            cluster = int.from_bytes(payload, 'big')
+        elif element in (0xA3, 0xA1):  # SimpleBlock / Block
+            _track, header, _ = _vint(payload, 0)
+            relative = struct.unpack_from('>h', payload, header)[0]
+            last = max(last, cluster + relative)
+            levels.append(size - header - 3)
+        pos += size
+    ticks = duration if duration and not math.isnan(duration) else last
+    return int(ticks * scale / 1000000), levels
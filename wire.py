@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+BeeGramm — компактный формат событий Socket.IO 🐝
+
+Клиент выбирает формат при подключении: io({auth: {format: 'compact'}}).
+Без этого (или без установленного msgpack на сервере) события идут JSON,
+как раньше. Компактный клиент получает самые частые события одним бинарным
+вложением MessagePack:
+
+  new_message       — короткие коды полей вместо m.* и без профиля
+                      отправителя: только его id (s) и версия профиля (v).
+                      Профиль клиент берёт из своего кэша, а при промахе или
+                      другой версии — из /users/profiles?ids=... и кэширует.
+                      Поля со значением по умолчанию не передаются;
+                      обработанное голосовое (voice) — как есть в o.
+  reactions_updated — реакции сгруппированы по эмодзи: [[emoji, [username, ...]], ...]
+
+Остальные события компактному клиенту приходят JSON. Разворачивает формат
+static/js/wire.js.
+"""
+
+import zlib
+
+from serialization import _default
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+FORMATS = ('json', 'compact')
+
+# Поле строки сообщения -> код и значение, которое можно не передавать
+MESSAGE_FIELDS = (
+    ('id', 'i', None),
+    ('chat_id', 'c', None),
+    ('user_id', 's', None),
+    ('content', 't', None),
+    ('message_type', 'y', 'text'),
+    ('file_url', 'f', None),
+    ('is_read', 'r', 0),
+    ('is_deleted', 'd', 0),
+    ('created_at', 'a', None),
+)
+PROFILE_FIELDS = ('nickname', 'username', 'avatar', 'is_premium')
+
+
+def available():
+    return msgpack is not None
+
+
+def negotiate(requested, enabled=True):
+    """Формат для клиента: compact — только если он его просил и сервер умеет"""
+    if requested == 'compact' and enabled and available():
+        return 'compact'
+    return 'json'
+
+
+def profile_version(row):
+    """Версия профиля отправителя: crc32 от nickname, username, avatar, is_premium.
+    Та же функция в static/js/wire.js — кэш клиента сверяется с ней."""
+    raw = '\x1f'.join((row['nickname'] or '', row['username'] or '', row['avatar'] or '',
+                       '1' if row['is_premium'] else '0'))
+    return zlib.crc32(raw.encode('utf-8'))
+
+
+def profile(row):
+    """Профиль для кэша клиента (ответ /users/profiles)"""
+    item = {f: row[f] for f in PROFILE_FIELDS}
+    item['v'] = profile_version(row)
+    return item
+
+
+def message(msg):
+    out = {}
+    for field, code, default in MESSAGE_FIELDS:
+        value = msg[field]
+        if value is not None and value != default:
+            out[code] = value
+    if msg.get('voice'):
+        out['o'] = msg['voice']
+    out['v'] = profile_version(msg)
+    return out
+
+
+def reactions(payload):
+    groups = {}
+    for r in payload['reactions']:
+        groups.setdefault(r['emoji'], []).append(r['username'])
+    return {'c': payload['chat_id'], 'm': payload['message_id'],
+            'r': [[emoji, names] for emoji, names in groups.items()]}
+
+
+# Событие -> сжатие payload в короткие коды
+ENCODERS = {
+    'new_message': message,
+    'reactions_updated': reactions,
+}
+
+
+def encode(event, payload):
+    """payload события в MessagePack (bytes) или None, если событие идёт JSON"""
+    fn = ENCODERS.get(event)
+    if fn is None or msgpack is None:
+        return None
+    return msgpack.packb(fn(payload), default=_default, use_bin_type=True)